@@ -1,15 +1,16 @@
 # oogiri/admin.py
 from django.contrib import admin
-from .models import Question, Answer
+from .headline_store import search_headlines
+from .models import HeadlineSet, NewsHeadline, Question, Answer, EvaluationJob, EvaluationCacheEntry, TrainingFlagChange
 import json
 
 @admin.register(Question)
 class QuestionAdmin(admin.ModelAdmin):
     # 一覧画面の表示項目
-    list_display = ('question_text', 'theme', 'user', 'is_manual', 'is_excellent', 'created_at')
+    list_display = ('question_text', 'theme', 'user', 'is_manual', 'is_excellent', 'is_pooled', 'created_at')
     
     # 絞り込み項目
-    list_filter = ('theme', 'is_manual', 'is_excellent', 'created_at')
+    list_filter = ('theme', 'is_manual', 'is_excellent', 'is_pooled', 'created_at')
     
     # 検索対象項目
     search_fields = ('question_text', 'source_title')
@@ -17,14 +18,53 @@ class QuestionAdmin(admin.ModelAdmin):
     # 編集画面での表示順序とグループ化
     fieldsets = (
         (None, {
-            'fields': ('question_text', 'theme', 'is_excellent', 'user', 'is_manual')
+            'fields': ('question_text', 'theme', 'is_excellent', 'user', 'is_manual', 'is_pooled')
         }),
         ('AI情報', {
-            'fields': ('source_title',),
+            'fields': ('source_title', 'headline_set'),
             'description': 'AI生成時のみ使用されます。'
         }),
     )   
 
+    # ニュースタイトルの組は数が多いため、選択肢を全て読み込まずIDで指定する
+    raw_id_fields = ('headline_set',)
+
+    def get_search_results(self, request, queryset, search_term):
+        # 元ネタのニュースは、ニュースタイトルの全文検索インデックスで探す
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term:
+            results |= queryset.filter(headline_set__news_headlines__in=search_headlines(search_term).values('id'))
+            may_have_duplicates = True
+        return results, may_have_duplicates
+
+
+@admin.register(HeadlineSet)
+class HeadlineSetAdmin(admin.ModelAdmin):
+    list_display = ('id', '__str__', 'created_at')
+    readonly_fields = ('digest',)
+    raw_id_fields = ('news_headlines',)
+    # 検索ボックスを表示する (改行区切りのタイトルを icontains で探さず、get_search_results で全文検索インデックスを使う)
+    search_fields = ('headlines',)
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        return queryset.filter(news_headlines__in=search_headlines(search_term).values('id')), True
+
+
+@admin.register(NewsHeadline)
+class NewsHeadlineAdmin(admin.ModelAdmin):
+    list_display = ('title', 'url', 'first_fetched_at', 'last_fetched_at')
+    list_filter = ('themes__theme', 'last_fetched_at')
+    readonly_fields = ('digest',)
+    search_fields = ('title',)
+
+    def get_search_results(self, request, queryset, search_term):
+        # タイトルは全文検索インデックス (SQLite の FTS5) で探す
+        if not search_term:
+            return queryset, False
+        return queryset.filter(id__in=search_headlines(search_term).values('id')), False
+
 @admin.register(Answer)
 class AnswerAdmin(admin.ModelAdmin):
     list_display = (
@@ -52,4 +92,23 @@ class AnswerAdmin(admin.ModelAdmin):
         'is_excellent_answer' 
     )
 
-    
\ No newline at end of file
+
+@admin.register(EvaluationJob)
+class EvaluationJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'answer', 'status', 'attempts', 'locked_at', 'last_error', 'created_at', 'updated_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('answer__answer_text', 'last_error')
+    raw_id_fields = ('answer',)
+
+
+@admin.register(EvaluationCacheEntry)
+class EvaluationCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ('key', 'score', 'comment', 'hit_count', 'last_hit_at', 'created_at')
+    list_filter = ('score',)
+    search_fields = ('key', 'comment')
+
+
+@admin.register(TrainingFlagChange)
+class TrainingFlagChangeAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'object_id', 'created_at')
+    list_filter = ('kind', 'created_at')
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class OogiriConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'oogiri'
+
+    def ready(self):
+        # シグナルハンドラを登録する
+        from . import signals  # noqa: F401
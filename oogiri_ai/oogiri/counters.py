@@ -0,0 +1,34 @@
+# oogiri/counters.py
+"""
+DBに保存する累計のカウンタ (UsageCounter)。
+
+Djangoのキャッシュの incr はキャッシュのバックエンドによっては読んでから書き戻す (FileBasedCache) ため、
+採点ワーカーの複数のスレッドとWebのプロセスが同時に数えると加算が失われる。
+ここでは F() を使った UPDATE で加算し、DBの中で読み書きを1回で行う。
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .models import UsageCounter
+
+
+def increment(name: str, amount: int = 1) -> None:
+    """
+    カウンタ name に amount を加える。まだ無いカウンタは作る。
+    """
+    if UsageCounter.objects.filter(name=name).update(value=F('value') + amount):
+        return
+    try:
+        with transaction.atomic():
+            UsageCounter.objects.create(name=name, value=amount)
+    except IntegrityError:
+        # 別のプロセスが先に作った場合は、そのカウンタに加える
+        UsageCounter.objects.filter(name=name).update(value=F('value') + amount)
+
+
+def counter_values(*names: str) -> dict[str, int]:
+    """
+    カウンタの値を {名前: 値} で返す (まだ無いカウンタは 0)。
+    """
+    values = dict.fromkeys(names, 0)
+    values.update(UsageCounter.objects.filter(name__in=names).values_list('name', 'value'))
+    return values
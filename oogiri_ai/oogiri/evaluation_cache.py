@@ -0,0 +1,169 @@
+# oogiri/evaluation_cache.py
+"""
+採点結果のキャッシュ。
+同じお題に同じ回答 (表記ゆれを正規化した上で同じもの) が送られた場合に、Geminiで再び採点せずに保存済みの結果を返す。
+結果は EvaluationCacheEntry テーブルに保存し、ヒット数・ミス数は UsageCounter テーブルで数える (oogiri/counters.py)。
+"""
+import functools
+import hashlib
+import re
+import unicodedata
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from .counters import counter_values, increment
+from .models import EvaluationCacheEntry
+
+# 全角英数字・記号 (！〜～) と全角スペースを半角にする変換表
+_FULLWIDTH_ASCII = {code: code - 0xFEE0 for code in range(0xFF01, 0xFF5F)}
+_FULLWIDTH_ASCII[0x3000] = 0x20
+# 半角カタカナ (濁点・半濁点を含む連続部分)
+_HALFWIDTH_KANA = re.compile(r'[｡-ﾟ]+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _fold_width(text: str) -> str:
+    # 全角英数字は半角に、半角カタカナは全角にそろえる (NFKCを使わない場合のための個別の正規化)
+    text = text.translate(_FULLWIDTH_ASCII)
+    return _HALFWIDTH_KANA.sub(lambda m: unicodedata.normalize('NFKC', m.group()), text)
+
+
+@functools.cache
+def _punctuation_pattern() -> re.Pattern:
+    # 句読点・括弧など (Unicodeの一般カテゴリが P の文字) にマッチする正規表現 (基本多言語面の文字だけを対象にする)
+    ranges = []
+    for code in range(0x10000):
+        if unicodedata.category(chr(code)).startswith('P'):
+            if ranges and ranges[-1][1] == code - 1:
+                ranges[-1][1] = code
+            else:
+                ranges.append([code, code])
+    return re.compile('[' + ''.join(f'{re.escape(chr(start))}-{re.escape(chr(end))}' for start, end in ranges) + ']+')
+
+
+# 設定 EVALUATION_CACHE_NORMALIZATION で指定できる正規化 (指定した順に適用する)
+NORMALIZERS = {
+    'nfkc': lambda text: unicodedata.normalize('NFKC', text),
+    'width': _fold_width,
+    'whitespace': lambda text: _WHITESPACE.sub(' ', text).strip(),
+    'lower': str.casefold,
+    'punctuation': lambda text: _punctuation_pattern().sub('', text),
+}
+
+_HITS_KEY = 'evaluation_cache:hits'
+_MISSES_KEY = 'evaluation_cache:misses'
+# 1回の DELETE で削除する最大件数 (SQLite の変数の数の上限 (古いバージョンでは999) を超えず、書き込みのロックを長く持たないように)
+EVICT_CHUNK_SIZE = 500
+
+
+def normalize_text(text: str, normalization: list[str] | None = None) -> str:
+    """
+    キャッシュのキーを作るために、表記ゆれを正規化する。
+    """
+    if normalization is None:
+        normalization = settings.EVALUATION_CACHE_NORMALIZATION
+    for name in normalization:
+        text = NORMALIZERS[name](text)
+    return text
+
+
+def make_cache_key(question_text: str, answer_text: str) -> str:
+    """
+    お題と回答を正規化してハッシュ化したキーを返す。
+    正規化の設定もキーに含め、設定を変えたときに古い正規化のキーと混ざらないようにする。
+    """
+    normalization = settings.EVALUATION_CACHE_NORMALIZATION
+    source = "\0".join([
+        ",".join(normalization),
+        normalize_text(question_text, normalization),
+        normalize_text(answer_text, normalization),
+    ])
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+def lookup_evaluation(question_text: str, answer_text: str) -> dict | None:
+    """
+    保存済みの採点結果を {"score": int, "comment": str} で返す。無ければ None。
+    """
+    if not settings.EVALUATION_CACHE_ENABLED:
+        return None
+
+    key = make_cache_key(question_text, answer_text)
+    entry = EvaluationCacheEntry.objects.filter(key=key).values('score', 'comment').first()
+    if entry is None:
+        increment(_MISSES_KEY)
+        return None
+
+    increment(_HITS_KEY)
+    EvaluationCacheEntry.objects.filter(key=key).update(hit_count=F('hit_count') + 1, last_hit_at=timezone.now())
+    return entry
+
+
+def store_evaluation(question_text: str, answer_text: str, evaluation_result: dict) -> None:
+    """
+    Geminiの採点結果を保存する。
+    """
+    if not settings.EVALUATION_CACHE_ENABLED:
+        return
+
+    EvaluationCacheEntry.objects.update_or_create(
+        key=make_cache_key(question_text, answer_text),
+        defaults={
+            'score': evaluation_result['score'],
+            'comment': evaluation_result['comment'],
+            'last_hit_at': timezone.now(),
+        },
+    )
+
+
+def _delete_in_chunks(entries) -> int:
+    """
+    entries を最後に使われた日時が古いものから EVICT_CHUNK_SIZE 件ずつ削除し、削除した件数を返す。
+    """
+    deleted = 0
+    while True:
+        entry_ids = list(entries.order_by('last_hit_at', 'id').values_list('id', flat=True)[:EVICT_CHUNK_SIZE])
+        if not entry_ids:
+            return deleted
+        chunk_deleted, _ = EvaluationCacheEntry.objects.filter(id__in=entry_ids).delete()
+        deleted += chunk_deleted
+
+
+def evict_evaluation_cache() -> int:
+    """
+    EVALUATION_CACHE_TTL_DAYS 日以上使われていないものを削除し、
+    それでも EVALUATION_CACHE_MAX_ENTRIES 件を超える場合は最後に使われた日時が古いものから削除する (LRU)。
+    削除した件数を返す。
+    """
+    deadline = timezone.now() - timedelta(days=settings.EVALUATION_CACHE_TTL_DAYS)
+    deleted = _delete_in_chunks(EvaluationCacheEntry.objects.filter(last_hit_at__lt=deadline))
+
+    # 残すものの次に新しいもの (これより古いものを全て削除する)。削除するIDを全て読み込まずに範囲で指定する
+    max_entries = settings.EVALUATION_CACHE_MAX_ENTRIES
+    cutoff = list(
+        EvaluationCacheEntry.objects.order_by('-last_hit_at', '-id')
+        .values_list('last_hit_at', 'id')[max_entries:max_entries + 1]
+    )
+    if cutoff:
+        [(last_hit_at, entry_id)] = cutoff
+        deleted += _delete_in_chunks(EvaluationCacheEntry.objects.filter(
+            Q(last_hit_at__lt=last_hit_at) | Q(last_hit_at=last_hit_at, id__lte=entry_id)
+        ))
+    return deleted
+
+
+def evaluation_cache_stats() -> dict:
+    """
+    ヒット数・ミス数・ヒット率と、保存件数を返す。
+    """
+    counts = counter_values(_HITS_KEY, _MISSES_KEY)
+    hits = counts[_HITS_KEY]
+    misses = counts[_MISSES_KEY]
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / total if total else 0.0,
+        'entries': EvaluationCacheEntry.objects.count(),
+    }
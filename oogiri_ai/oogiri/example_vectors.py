@@ -0,0 +1,285 @@
+# oogiri/example_vectors.py
+"""
+Few-Shot事例を選ぶための、文字n-gramのベクトルと類似度の検索。
+
+テキストは正規化してから文字2-gram・3-gramに分け、ハッシュで DIMENSION 次元のどれかに割り当てる
+(語彙を持たないため、事例が増えても既存のベクトルは変わらない)。重みは 1 + log(出現回数) を L2正規化したもの。
+IDF は検索のたびに、インデックスの行数と各次元を含む行の数から計算してクエリ側に掛ける。
+
+計算したベクトルは VectorStore にテキストのハッシュをキーにして保存し、Few-Shotのインデックスを作り直すときは
+新しく事例になったテキストだけをベクトルにして追記する。保存形式は疎行列 (CSR) の3つのバイナリファイルで、
+memory-map して必要な行だけを読む (numpy.memmap や scipy.sparse.csr_matrix でも同じ形式で読める)。
+
+- <世代>.indices.bin : 全ての行の次元の番号を連結した配列 (uint32, リトルエンディアン)
+- <世代>.values.bin  : 全ての行の重みを連結した配列 (float32, リトルエンディアン)
+- <世代>.offsets.bin : i 行目が indices[offsets[i]:offsets[i + 1]] であることを表す配列 (uint64, 要素数は行数 + 1)
+
+テキストのハッシュ → 行番号は vectors.json に保存する。使われなくなった行が増えたら、新しい世代のファイルに詰め直す。
+
+検索は NumPy を使わず、読み込んだベクトルの転置インデックス (SimilarityIndex) で行う。Webアプリの依存パッケージに NumPy は無く、
+DIMENSION 次元の密な行列は memory-map しても大きすぎる (1行4MB) ため、NumPy で同じことをするには疎行列 (scipy.sparse) が要る。
+クエリと同じ次元を持つ行だけを調べるため、「特に面白い」事例の数 (数百〜数千件) なら1回の検索は数ms (1,000件で約1ms)。
+ありふれた n-gram を共有する行が多いと行数に比例して遅くなる (10,000件で約20ms) ため、事例がそれを超える規模になったら、
+保存したファイルを scipy.sparse.csr_matrix として読み、行列とベクトルの積で検索する方式に切り替える。
+"""
+import collections
+import hashlib
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
+import sys
+import zlib
+from array import array
+from pathlib import Path
+from .evaluation_cache import normalize_text
+from .locks import acquire_lock, release_lock
+
+logger = logging.getLogger(__name__)
+
+STORE_VERSION = 1
+DIMENSION = 1 << 20
+NGRAM_SIZES = (2, 3)
+# 比較する前の正規化 (変えると保存済みのベクトルと合わなくなるため、設定にはしない)
+_NORMALIZATION = ['nfkc', 'whitespace', 'lower', 'punctuation']
+
+_INDEX_NAME = 'vectors.json'
+_INDICES_SUFFIX, _VALUES_SUFFIX, _OFFSETS_SUFFIX = '.indices.bin', '.values.bin', '.offsets.bin'
+_INDICES_TYPECODE, _VALUES_TYPECODE, _OFFSETS_TYPECODE = 'I', 'f', 'Q'
+# 追記は1つのプロセスだけが行う (ロックを取れなかったプロセスは、計算したベクトルを保存せずに使う)
+# ロックはDBの行で取る (oogiri/locks.py)。キャッシュの add は FileBasedCache では原子的でなく、2つのプロセスが同時に書き込みうる
+_LOCK_NAME = 'few_shot_vectors'
+_LOCK_TIMEOUT = 60
+# 使われている行がこの割合を下回ったら詰め直す
+_COMPACT_RATIO = 0.5
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(normalize_text(text, _NORMALIZATION).encode('utf-8')).hexdigest()
+
+
+def vectorize(text: str) -> dict[int, float]:
+    """
+    テキストを {次元の番号: 重み} の疎ベクトルにする。
+    """
+    normalized = normalize_text(text, _NORMALIZATION)
+    counts = collections.Counter()
+    for n in NGRAM_SIZES:
+        for i in range(len(normalized) - n + 1):
+            counts[zlib.crc32(normalized[i:i + n].encode('utf-8')) % DIMENSION] += 1
+    if not counts and normalized:
+        # n-gram の作れない1文字のテキスト
+        counts[zlib.crc32(normalized.encode('utf-8')) % DIMENSION] = 1
+    weights = {index: 1.0 + math.log(count) for index, count in counts.items()}
+    norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+    return {index: weight / norm for index, weight in weights.items()}
+
+
+class SimilarityIndex:
+    """
+    items (事例) とそのベクトルの転置インデックス。クエリと同じ次元を持つ事例だけを調べて、類似度の高い事例を返す。
+    """
+
+    def __init__(self, items: list, vectors: list[dict[int, float]]):
+        self.items = items
+        self._size = len(vectors)
+        self._postings: dict[int, list[tuple[int, float]]] = {}
+        for row, vector in enumerate(vectors):
+            for index, weight in vector.items():
+                self._postings.setdefault(index, []).append((row, weight))
+
+    def __len__(self) -> int:
+        return self._size
+
+    def search(self, query: dict[int, float], k: int) -> list[tuple[int, float]]:
+        """
+        類似度 (クエリにIDFを掛けた内積) が0より大きい事例を、高い順に最大 k 件 (items の位置, 類似度) で返す。
+        同じ類似度なら items の前にある方を優先する。
+        """
+        scores = collections.defaultdict(float)
+        for index, weight in query.items():
+            postings = self._postings.get(index)
+            if not postings:
+                continue
+            weight *= math.log((self._size + 1) / (len(postings) + 1)) + 1.0
+            for row, value in postings:
+                scores[row] += weight * value
+        return heapq.nlargest(k, scores.items(), key=lambda item: (item[1], -item[0]))
+
+
+def _map_array(path: Path, typecode: str) -> tuple[memoryview, mmap.mmap | None]:
+    """
+    バイナリファイルを memory-map し、要素の型で読める memoryview と mmap を返す。
+    """
+    if path.stat().st_size == 0:
+        return memoryview(array(typecode)), None
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if sys.byteorder == 'big':
+        values = array(typecode)
+        values.frombytes(mapped[:])
+        values.byteswap()
+        mapped.close()
+        return memoryview(values), None
+    return memoryview(mapped).cast(typecode), mapped
+
+
+def _write_array(f, values: array) -> None:
+    if sys.byteorder == 'big':
+        values.byteswap()
+    values.tofile(f)
+
+
+class VectorStore:
+    """
+    テキストのベクトルを directory に保存し、同じテキストのベクトルは保存したものを読む。
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def _read_index(self) -> dict:
+        try:
+            index = json.loads((self.directory / _INDEX_NAME).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return {}
+        if index.get('version') != STORE_VERSION or index.get('dimension') != DIMENSION:
+            # 形式や次元の数が変わった場合は、保存したベクトルを使わない
+            return {}
+        return index
+
+    def _files(self, generation: int) -> tuple[Path, Path, Path]:
+        prefix = f'vectors-{generation}'
+        return tuple(
+            self.directory / f'{prefix}{suffix}' for suffix in (_INDICES_SUFFIX, _VALUES_SUFFIX, _OFFSETS_SUFFIX)
+        )
+
+    def _read_rows(self, index: dict, rows: list[int]) -> list[dict[int, float]]:
+        views = []
+        mmaps = []
+        try:
+            for path, typecode in zip(self._files(index['generation']),
+                                      (_INDICES_TYPECODE, _VALUES_TYPECODE, _OFFSETS_TYPECODE)):
+                view, mapped = _map_array(path, typecode)
+                views.append(view)
+                if mapped is not None:
+                    mmaps.append(mapped)
+            indices, values, offsets = views
+            vectors = []
+            for row in rows:
+                start, end = offsets[row], offsets[row + 1]
+                vectors.append(dict(zip(indices[start:end].tolist(), values[start:end].tolist())))
+            return vectors
+        finally:
+            for view in views:
+                view.release()
+            for mapped in mmaps:
+                mapped.close()
+
+    def vectors(self, texts: list[str]) -> list[dict[int, float]]:
+        """
+        texts のベクトルを同じ順で返す。保存されていないテキストはベクトルにして、保存できれば追記する。
+        texts に含まれない行が増えた場合は、texts の行だけを新しい世代のファイルに詰め直す。
+        """
+        digests = [text_digest(text) for text in texts]
+        index = self._read_index()
+        rows = index.get('rows', {})
+        stored = [digest for digest in dict.fromkeys(digests) if digest in rows]
+        vectors_by_digest = {}
+        if stored:
+            try:
+                vectors_by_digest = dict(zip(stored, self._read_rows(index, [rows[digest] for digest in stored])))
+            except (OSError, IndexError, ValueError) as e:
+                logger.warning("保存したFew-Shot事例のベクトルを読めませんでした: %s", e)
+                index = {}
+        new_vectors = {}
+        for text, digest in zip(texts, digests):
+            if digest not in vectors_by_digest:
+                new_vectors[digest] = vectors_by_digest[digest] = vectorize(text)
+
+        if not index:
+            if vectors_by_digest:
+                self._save(vectors_by_digest, None, rewrite=True)
+        elif len(vectors_by_digest) < (len(index['rows']) + len(new_vectors)) * _COMPACT_RATIO:
+            self._save(vectors_by_digest, index['generation'], rewrite=True)
+        elif new_vectors:
+            self._save(new_vectors, index['generation'], rewrite=False)
+        return [vectors_by_digest[digest] for digest in digests]
+
+    def _save(self, vectors: dict[str, dict[int, float]], generation: int | None, rewrite: bool) -> None:
+        if not vectors and not rewrite:
+            return
+        token = acquire_lock(_LOCK_NAME, _LOCK_TIMEOUT)
+        if token is None:
+            return
+        try:
+            current = self._read_index()
+            if rewrite:
+                self._rewrite(current, vectors)
+            elif current.get('generation') == generation:
+                self._append(current, vectors)
+            # 読んだ後に他のプロセスが詰め直していれば、次に作り直すときに追記する
+        except OSError as e:
+            logger.warning("Few-Shot事例のベクトルを保存できませんでした: %s", e)
+        finally:
+            release_lock(_LOCK_NAME, token)
+
+    def _write_rows(self, files: tuple[Path, Path, Path], vectors: list[dict[int, float]], nnz: int) -> int:
+        """
+        ファイルの末尾に行を追記し、追記後の要素数 (indices の長さ) を返す。
+        """
+        indices = array(_INDICES_TYPECODE)
+        values = array(_VALUES_TYPECODE)
+        offsets = array(_OFFSETS_TYPECODE)
+        for vector in vectors:
+            indices.extend(vector.keys())
+            values.extend(vector.values())
+            offsets.append(nnz + len(indices))
+        for path, data in zip(files, (indices, values, offsets)):
+            with open(path, 'ab') as f:
+                _write_array(f, data)
+        return nnz + len(indices)
+
+    def _write_index(self, index: dict) -> None:
+        temporary_path = self.directory / f'{_INDEX_NAME}.tmp'
+        temporary_path.write_text(json.dumps(index), encoding='utf-8')
+        # 行を書き終えてから行番号を公開する (読む側は vectors.json にある行だけを読む)
+        os.replace(temporary_path, self.directory / _INDEX_NAME)
+
+    def _rewrite(self, current: dict, vectors: dict[str, dict[int, float]]) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        generation = current.get('generation', 0) + 1
+        files = self._files(generation)
+        for path in files:
+            path.write_bytes(b'')
+        with open(files[2], 'ab') as f:
+            _write_array(f, array(_OFFSETS_TYPECODE, [0]))
+        nnz = self._write_rows(files, list(vectors.values()), 0)
+        self._write_index({
+            'version': STORE_VERSION, 'dimension': DIMENSION, 'generation': generation, 'nnz': nnz,
+            'rows': {digest: row for row, digest in enumerate(vectors)},
+        })
+        if current:
+            for path in self._files(current['generation']):
+                try:
+                    path.unlink()
+                except OSError:
+                    # Windows では他のプロセスが memory-map している間は消せないため、次に詰め直すときまで残す
+                    pass
+
+    def _append(self, current: dict, vectors: dict[str, dict[int, float]]) -> None:
+        rows = current['rows']
+        vectors = {digest: vector for digest, vector in vectors.items() if digest not in rows}
+        if not vectors:
+            return
+        files = self._files(current['generation'])
+        # 途中で失敗した追記の残りを、vectors.json に記録した長さまで切り詰める
+        for path, length in zip(files, (current['nnz'] * 4, current['nnz'] * 4, (len(rows) + 1) * 8)):
+            with open(path, 'r+b') as f:
+                f.truncate(length)
+        nnz = self._write_rows(files, list(vectors.values()), current['nnz'])
+        for digest in vectors:
+            rows[digest] = len(rows)
+        self._write_index({**current, 'nnz': nnz, 'rows': rows})
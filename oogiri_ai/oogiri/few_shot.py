@@ -0,0 +1,188 @@
+# oogiri/few_shot.py
+"""
+Few-Shotプロンプト用の事例のインデックス。
+「特に面白い」回答 (is_excellent_answer) は事例用のJSON文字列に整形済みの状態で、
+「特に面白い」お題 (is_excellent) はテーマごとに新しい順に並べた状態で、プロセスのメモリに保持する。
+採点のたびに ORDER BY RANDOM() で全件を並べ替える代わりに、メモリ上のリストから k 件を選ぶ。
+お題の文字n-gramのベクトル (oogiri/example_vectors.py) も持ち、採点するお題やお題生成に使うニュースに近い事例を選ぶ。
+ベクトルは FEW_SHOT_VECTOR_ROOT に保存し、作り直すときは新しく事例になったものだけを計算する。
+
+管理画面などでフラグが変わると、シグナル (oogiri/signals.py) がDjangoのキャッシュ上のバージョンを更新し、
+各プロセスは次に参照したときにDBから作り直す。シグナルを通らない更新 (QuerySet.update など) に備えて、
+FEW_SHOT_INDEX_TTL 秒経ったインデックスも作り直す。
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from .example_vectors import SimilarityIndex, VectorStore, vectorize
+from .models import Answer, Question
+
+_VERSION_KEY = 'few_shot_index:version'
+
+
+def render_answer_example(question_text: str, answer_text: str, score: int | None, review_text: str) -> str:
+    """
+    「特に面白い」回答を、評価プロンプトに埋め込む事例のJSON文字列に整形する。
+    """
+    example_data = {
+        "お題": question_text,
+        "回答": answer_text,
+        "評価結果": {
+            "score": score,
+            "commentary": review_text
+        }
+    }
+    # 日本語が化けないように ensure_ascii=False を指定し、indent=2 でプロンプト内で見やすくする
+    json_string = json.dumps(example_data, ensure_ascii=False, indent=2)
+    # AIへの指示として「事例:」という見出しを付ける
+    return f"事例:\n{json_string}"
+
+
+def invalidate_few_shot_index() -> None:
+    """
+    全プロセスのインデックスを古いものとして扱わせる (次に参照したときに作り直される)。
+    """
+    cache.set(_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+class FewShotIndex:
+    """
+    Few-Shot事例のインデックス。モジュールの few_shot_index をプロセス内で共有して使う。
+    """
+
+    def __init__(self, ttl: int | None = None):
+        self.ttl = settings.FEW_SHOT_INDEX_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._version = None
+        self._built_at = 0.0
+        self._answer_ids: list[int] = []
+        self._answer_examples: list[str] = []
+        self._questions_by_theme: dict[str, list[str]] = {}
+        self._answer_search = SimilarityIndex([], [])
+        self._question_search: dict[str, SimilarityIndex] = {}
+
+    def _current_version(self) -> str:
+        version = cache.get(_VERSION_KEY)
+        if version is None:
+            # キャッシュが消えていた場合は新しいバージョンを決め、どのプロセスも作り直すようにする
+            cache.add(_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+            version = cache.get(_VERSION_KEY)
+        return version
+
+    def _is_fresh(self, version: str) -> bool:
+        return self._version == version and time.monotonic() - self._built_at < self.ttl
+
+    def _ensure_fresh(self) -> None:
+        version = self._current_version()
+        if self._is_fresh(version):
+            return
+        with self._lock:
+            # 他のスレッドが作り直し終えていれば、それを使う
+            if self._is_fresh(version):
+                return
+            self._rebuild(version)
+
+    def _rebuild(self, version: str) -> None:
+        # DBを読む前のバージョンを記録し、読んでいる間にフラグが変わった場合は次の参照で再度作り直す
+        answers = (
+            Answer.objects.filter(is_excellent_answer=True)
+            .order_by('id')
+            .values_list('id', 'question__question_text', 'answer_text', 'score', 'review_text')
+        )
+        answer_ids = []
+        answer_examples = []
+        answer_questions = []
+        for answer_id, question_text, answer_text, score, review_text in answers.iterator():
+            answer_ids.append(answer_id)
+            answer_examples.append(render_answer_example(question_text, answer_text, score, review_text))
+            answer_questions.append(question_text)
+
+        questions_by_theme = {}
+        questions = Question.objects.filter(is_excellent=True).order_by('-created_at').values_list('theme', 'question_text')
+        for theme, question_text in questions.iterator():
+            questions_by_theme.setdefault(theme, []).append(question_text)
+
+        # 回答の事例はお題の本文で検索する (採点するお題に近いお題への回答を選ぶ)
+        vectors = self._vectors(answer_questions + [
+            question_text for theme_questions in questions_by_theme.values() for question_text in theme_questions
+        ])
+        answer_search = SimilarityIndex(answer_examples, vectors[:len(answer_examples)])
+        question_search = {}
+        position = len(answer_examples)
+        for theme, theme_questions in questions_by_theme.items():
+            question_search[theme] = SimilarityIndex(theme_questions, vectors[position:position + len(theme_questions)])
+            position += len(theme_questions)
+
+        self._answer_ids = answer_ids
+        self._answer_examples = answer_examples
+        self._questions_by_theme = questions_by_theme
+        self._answer_search = answer_search
+        self._question_search = question_search
+        self._version = version
+        self._built_at = time.monotonic()
+
+    def _vectors(self, texts: list[str]) -> list[dict[int, float]]:
+        if not settings.FEW_SHOT_VECTOR_ROOT:
+            return [vectorize(text) for text in texts]
+        return VectorStore(settings.FEW_SHOT_VECTOR_ROOT).vectors(texts)
+
+    def sample_answer_examples(self, k: int, seed: int | None = None) -> list[str]:
+        """
+        「特に面白い」回答の事例 (整形済みのJSON文字列) をランダムに最大 k 件返す。
+        seed を指定すると、インデックスが変わらない限り同じ seed には同じ事例の組を同じ順序で返す。
+        """
+        self._ensure_fresh()
+        examples = self._answer_examples
+        rng = random if seed is None else random.Random(seed)
+        return rng.sample(examples, min(k, len(examples)))
+
+    def similar_answer_examples(self, question_text: str, k: int, seed: int | None = None) -> list[str]:
+        """
+        question_text に近いお題への「特に面白い」回答の事例を、近い順に最大 k 件返す。
+        近い事例 (同じ文字n-gramを含むもの) が k 件に満たない場合は、残りを sample_answer_examples と同じくランダムに選ぶ。
+        """
+        self._ensure_fresh()
+        search = self._answer_search
+        chosen = [position for position, _ in search.search(vectorize(question_text), k)]
+        if len(chosen) < min(k, len(search.items)):
+            rng = random if seed is None else random.Random(seed)
+            # 全ての事例の位置を並べずに、近い事例と重なりうる分だけ多めに k 件程度を引き、重なったものを除く
+            close = set(chosen)
+            sampled = rng.sample(range(len(search.items)), min(len(search.items), k + len(close)))
+            chosen += [position for position in sampled if position not in close][:k - len(chosen)]
+        return [search.items[position] for position in chosen]
+
+    def similar_questions(self, theme: str, query: str, max_examples: int) -> list[str]:
+        """
+        テーマの「特に面白い」お題を、query (お題生成に使うニュースタイトルなど) に近い順に最大 max_examples 件返す。
+        近いお題が足りない分は、登録日時が新しい順に加える。
+        """
+        self._ensure_fresh()
+        search = self._question_search.get(theme)
+        if search is None:
+            return []
+        chosen = [position for position, _ in search.search(vectorize(query), max_examples)]
+        for position in range(len(search.items)):
+            if len(chosen) >= max_examples:
+                break
+            if position not in chosen:
+                chosen.append(position)
+        return [search.items[position] for position in chosen]
+
+    def excellent_questions(self, theme: str, max_examples: int) -> list[str]:
+        """
+        テーマの「特に面白い」お題を、登録日時が新しい順に最大 max_examples 件返す。
+        """
+        self._ensure_fresh()
+        return self._questions_by_theme.get(theme, [])[:max_examples]
+
+    def __len__(self) -> int:
+        self._ensure_fresh()
+        return len(self._answer_ids)
+
+
+few_shot_index = FewShotIndex()
@@ -0,0 +1,125 @@
+# oogiri/headline_selection.py
+"""
+お題生成のプロンプトに入れるニュースタイトルを選ぶ (NewsAPIから取得した最大100件を、そのまま全て入れない)。
+
+1. 日本語でないタイトル (かなを含まないもの。英語や中国語のニュース) を除く
+2. テーマと「特に面白い」お題に近い順に並べる (テーマを含むか + お題の文字2-gramとのコサイン類似度)
+3. ほぼ同じタイトル (文字3-gramの Jaccard 係数が QUESTION_HEADLINE_DUPLICATE_THRESHOLD 以上) は、順位の低い方を除く
+4. 推定トークン数の合計が QUESTION_HEADLINE_TOKEN_BUDGET に収まるだけ、順位の高い方から入れる
+"""
+import collections
+import logging
+import math
+import re
+from django.conf import settings
+from .evaluation_cache import normalize_text
+from .few_shot import few_shot_index
+
+logger = logging.getLogger(__name__)
+
+# 比較する前の正規化 (表記ゆれと句読点の違いを無視する)
+_NORMALIZATION = ['nfkc', 'whitespace', 'lower', 'punctuation']
+# ひらがな・カタカナ (中国語のタイトルは漢字だけで書かれているため、かなの有無で日本語かを見分ける)
+_KANA = re.compile(r'[ぁ-ゟ゠-ヿ]')
+_ASCII_RUN = re.compile(r'[\x00-\x7f]+')
+# 類似度の計算に使う「特に面白い」お題の数
+_MAX_REFERENCE_QUESTIONS = 50
+# プロンプトの1行ごとに付く "- " と改行の推定トークン数
+_LINE_OVERHEAD_TOKENS = 2
+
+
+def is_japanese(title: str) -> bool:
+    return _KANA.search(title) is not None
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Geminiのトークン数の大まかな推定 (日本語は1文字1トークン、英数字は4文字1トークンとして、多めに見積もる)。
+    """
+    ascii_chars = sum(len(run) for run in _ASCII_RUN.findall(text))
+    return len(text) - ascii_chars + math.ceil(ascii_chars / 4)
+
+
+def _ngrams(text: str, n: int) -> set[str]:
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _jaccard(a: set[str], b: set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class _ReferenceProfile:
+    """
+    「特に面白い」お題の文字2-gramの出現回数。タイトルとのコサイン類似度を計算する。
+    """
+
+    def __init__(self, texts: list[str]):
+        self.counts = collections.Counter()
+        for text in texts:
+            self.counts.update(_ngrams(normalize_text(text, _NORMALIZATION), 2))
+        self.norm = math.sqrt(sum(count * count for count in self.counts.values()))
+
+    def similarity(self, bigrams: set[str]) -> float:
+        if not self.norm or not bigrams:
+            return 0.0
+        return sum(self.counts[gram] for gram in bigrams) / (self.norm * math.sqrt(len(bigrams)))
+
+
+def select_headlines(headlines: list[str], theme: str, reference_questions: list[str] | None = None,
+                     token_budget: int | None = None, duplicate_threshold: float | None = None) -> list[str]:
+    """
+    プロンプトに入れるニュースタイトルを、順位の高い順に返す。
+    reference_questions を省略した場合は、テーマの「特に面白い」お題 (Few-shotの事例のインデックス) を使う。
+    """
+    token_budget = settings.QUESTION_HEADLINE_TOKEN_BUDGET if token_budget is None else token_budget
+    if duplicate_threshold is None:
+        duplicate_threshold = settings.QUESTION_HEADLINE_DUPLICATE_THRESHOLD
+    if reference_questions is None:
+        reference_questions = few_shot_index.excellent_questions(theme, _MAX_REFERENCE_QUESTIONS)
+
+    titles = [title.strip() for title in headlines if title and title.strip()]
+    japanese_titles = [title for title in titles if is_japanese(title)]
+    # 日本語のタイトルが1つも無い場合は、除かずに使う (Geminiへの指示で日本語のニュースだけを使わせる)
+    candidates = japanese_titles or titles
+
+    profile = _ReferenceProfile(reference_questions)
+    normalized_theme = normalize_text(theme, _NORMALIZATION)
+    scored = []
+    for position, title in enumerate(candidates):
+        normalized = normalize_text(title, _NORMALIZATION)
+        score = (1.0 if normalized_theme and normalized_theme in normalized else 0.0)
+        score += profile.similarity(_ngrams(normalized, 2))
+        # 同じ点数なら、NewsAPIの並び (新しい順) で前のものを優先する
+        scored.append((-score, position, title, _ngrams(normalized, 3)))
+    scored.sort(key=lambda item: (item[0], item[1]))
+
+    selected = []
+    selected_shingles = []
+    used_tokens = 0
+    duplicates = 0
+    for _, _, title, shingles in scored:
+        if any(_jaccard(shingles, other) >= duplicate_threshold for other in selected_shingles):
+            duplicates += 1
+            continue
+        tokens = estimate_tokens(title) + _LINE_OVERHEAD_TOKENS
+        if used_tokens + tokens > token_budget:
+            # 長いタイトルで予算を超える場合も、短いタイトルは入る可能性があるため続ける
+            continue
+        selected.append(title)
+        selected_shingles.append(shingles)
+        used_tokens += tokens
+    if not selected and scored:
+        # 予算より長いタイトルしか無い場合も、最も順位の高い1件は入れる
+        selected.append(scored[0][2])
+        used_tokens = estimate_tokens(scored[0][2]) + _LINE_OVERHEAD_TOKENS
+
+    logger.info(
+        "ニュースタイトルを選びました: %d件 → %d件 (日本語以外 %d件、重複 %d件を除外、推定 %dトークン)",
+        len(titles), len(selected), len(titles) - len(japanese_titles) if japanese_titles else 0, duplicates,
+        used_tokens,
+    )
+    return selected
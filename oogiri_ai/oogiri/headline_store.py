@@ -0,0 +1,101 @@
+# oogiri/headline_store.py
+"""
+NewsAPIから取得したニュースタイトルの保存と検索。
+タイトルは正規化したタイトルのハッシュで重複を除いて1行ずつ保存し (NewsHeadline)、取得したテーマと日時を記録する。
+お題の生成に使ったタイトルの組 (HeadlineSet) からは多対多で参照する。
+SQLite ではタイトルの全文検索インデックス (FTS5、trigram トークナイザー) で検索する。
+2文字以下の語 (trigram では検索できない) と他のDBでは、重複を除いたタイトルを icontains で絞り込む。
+"""
+import functools
+import hashlib
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from .evaluation_cache import normalize_text
+from .models import NewsHeadline, NewsHeadlineTheme
+
+# ハッシュを作るときの正規化 (変えると既存の行と重複を見分けられなくなるため、設定にはしない)
+HEADLINE_NORMALIZATION = ['nfkc', 'whitespace', 'lower']
+
+FTS_TABLE = 'oogiri_newsheadline_fts'
+# trigram トークナイザーで検索できる語の最小の文字数
+_FTS_MIN_TERM_LENGTH = 3
+
+
+def headline_digest(title: str) -> str:
+    return hashlib.sha256(normalize_text(title, HEADLINE_NORMALIZATION).encode('utf-8')).hexdigest()
+
+
+def record_headlines(theme: str | None, titles: list[str], urls: list[str] | None = None,
+                     fetched: bool = True) -> list[NewsHeadline]:
+    """
+    ニュースタイトルを保存し (既にあるタイトルは最終取得日時を更新する)、テーマを記録する (theme が None の場合は記録しない)。
+    fetched=False の場合 (お題の生成に使ったタイトルを参照するだけのとき) は、無いタイトルを保存するだけで最終取得日時は更新しない。
+    titles の順に (重複を除いて) NewsHeadline のリストを返す。
+    """
+    now = timezone.now()
+    urls = urls or [''] * len(titles)
+    new_headlines = {}
+    for title, url in zip(titles, urls):
+        title = title.strip()
+        if title:
+            digest = headline_digest(title)
+            new_headlines.setdefault(digest, NewsHeadline(
+                digest=digest, title=title, url=url or '', first_fetched_at=now, last_fetched_at=now,
+            ))
+    if not new_headlines:
+        return []
+
+    with transaction.atomic():
+        NewsHeadline.objects.bulk_create(new_headlines.values(), ignore_conflicts=True)
+        if fetched:
+            NewsHeadline.objects.filter(digest__in=new_headlines).update(last_fetched_at=now)
+        headlines = {headline.digest: headline for headline in NewsHeadline.objects.filter(digest__in=new_headlines)}
+        if theme is not None:
+            NewsHeadlineTheme.objects.bulk_create(
+                [NewsHeadlineTheme(headline=headline, theme=theme) for headline in headlines.values()],
+                ignore_conflicts=True,
+            )
+    return [headlines[digest] for digest in new_headlines]
+
+
+@functools.cache
+def _has_fts_index(alias: str) -> bool:
+    # FTS5 が使えないSQLiteでは、マイグレーションで全文検索インデックスを作らない
+    db = connections[alias]
+    return db.vendor == 'sqlite' and FTS_TABLE in db.introspection.table_names()
+
+
+def search_headlines(query: str, theme: str | None = None):
+    """
+    空白で区切った語を全て含むニュースタイトルを、最終取得日時が新しい順に返す (QuerySet)。
+    """
+    terms = query.split()
+    indexed_terms = []
+    condition = Q()
+    for term in terms:
+        if _has_fts_index(connection.alias) and len(term) >= _FTS_MIN_TERM_LENGTH:
+            indexed_terms.append(term)
+        else:
+            condition &= Q(title__icontains=term)
+    queryset = NewsHeadline.objects.filter(condition)
+    if indexed_terms:
+        # 語ごとに "" で囲み、FTS5 の検索構文 (AND, NEAR など) として解釈させない
+        match = ' '.join('"{}"'.format(term.replace('"', '""')) for term in indexed_terms)
+        queryset = queryset.filter(
+            id__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', (match,))
+        )
+    if theme is not None:
+        queryset = queryset.filter(themes__theme=theme)
+    return queryset.order_by('-last_fetched_at', '-id')
+
+
+def recent_headlines(theme: str, max_count: int = 100) -> list[str]:
+    """
+    テーマで取得したことのあるニュースタイトルを、最終取得日時が新しい順に最大 max_count 件返す。
+    """
+    return list(
+        NewsHeadline.objects.filter(themes__theme=theme).order_by('-last_fetched_at', '-id')
+        .values_list('title', flat=True)[:max_count]
+    )
@@ -0,0 +1,409 @@
+# oogiri/inference_server.py
+"""
+ファインチューニングしたローカルモデルを常駐させる推論サーバー (run_inference_server コマンドで起動する)。
+
+モデルを1回だけ読み込んでメモリに保持し、localhost のTCPポートかUnixソケットでHTTPのリクエストを受け付ける。
+同時に届いたリクエストは、最初のリクエストから batch_window 秒以内に届いたものを最大 max_batch_size 件まで
+まとめて (左側をパディングした) 1つのバッチとして推論する。
+temperature などのサンプリングのパラメータはリクエストごとに指定でき、バッチの中でも行ごとに適用する。
+プロンプトの先頭 (Chatテンプレートの先頭からタスクの指示文まで) は計算済みの past_key_values を使い回し、
+残りのトークンだけをモデルに通す (llm_backends.PrefixKVCache)。
+
+Djangoアプリからは LLM_BACKENDS に 'local_server' を指定すると (llm_backends.LocalServerBackend)、このサーバーを使う。
+
+    POST /generate  {"prompt": "...", "max_new_tokens": 50, "temperature": 0.7, "top_p": 1.0, "top_k": 0,
+                     "num_return_sequences": 1}
+                 -> {"texts": ["..."], "prompt_tokens": 42, "completion_tokens": 17, "cached_prompt_tokens": 30,
+                     "batch_size": 4, "queue_ms": 12.3}
+    GET  /health    -> {"status": "ok", "model": "...", "stats": {...}}
+"""
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .llm_backends import get_prefix_kv_cache, load_local_model
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationRequest:
+    """
+    1件の推論リクエスト。結果 (GenerationResult) は future に設定される。
+    """
+
+    def __init__(self, prompt: str, max_new_tokens: int = 50, temperature: float = 0.7, top_p: float = 1.0,
+                 top_k: int = 0, num_return_sequences: int = 1):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        # 0 の場合はサンプリングせずに最も確率の高いトークンを選ぶ (greedy)
+        self.temperature = temperature
+        self.top_p = top_p
+        # 0 の場合は top-k で絞り込まない
+        self.top_k = top_k
+        self.num_return_sequences = num_return_sequences
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+    @classmethod
+    def from_payload(cls, payload: dict) -> 'GenerationRequest':
+        """
+        HTTPリクエストのJSONから作る。不正な値の場合は ValueError を投げる。
+        """
+        if not isinstance(payload.get('prompt'), str) or not payload['prompt']:
+            raise ValueError("prompt を文字列で指定してください。")
+        request = cls(
+            prompt=payload['prompt'],
+            max_new_tokens=int(payload.get('max_new_tokens', 50)),
+            temperature=float(payload.get('temperature', 0.7)),
+            top_p=float(payload.get('top_p', 1.0)),
+            top_k=int(payload.get('top_k', 0)),
+            num_return_sequences=int(payload.get('num_return_sequences', 1)),
+        )
+        if request.max_new_tokens < 1 or request.num_return_sequences < 1:
+            raise ValueError("max_new_tokens と num_return_sequences は1以上にしてください。")
+        if request.temperature < 0 or not 0 < request.top_p <= 1 or request.top_k < 0:
+            raise ValueError("サンプリングのパラメータが不正です。")
+        return request
+
+
+class GenerationResult:
+    def __init__(self, texts: list[str], prompt_tokens: int, completion_tokens: int, cached_prompt_tokens: int = 0):
+        self.texts = texts
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        # プロンプトのうち、計算済みの共通部分 (PrefixKVCache) を使ったトークン数
+        self.cached_prompt_tokens = cached_prompt_tokens
+        # バッチャーが設定する (何件のリクエストと一緒に推論されたか、キューで待った時間)
+        self.batch_size = 1
+        self.queue_ms = 0.0
+
+
+class DynamicBatcher:
+    """
+    推論リクエストをキューに貯め、1つのスレッドでバッチにまとめて generate_batch に渡す。
+    generate_batch はリクエストのリストを受け取り、同じ順序で GenerationResult のリストを返す関数。
+    """
+
+    def __init__(self, generate_batch, max_batch_size: int = 8, batch_window: float = 0.02):
+        self.generate_batch = generate_batch
+        # 1バッチの最大行数 (num_return_sequences の合計)
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self._queue = queue.Queue()
+        # 前のバッチに入りきらず、次のバッチの先頭にするリクエスト
+        self._pending = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            'requests': 0, 'batches': 0, 'prompt_tokens': 0, 'cached_prompt_tokens': 0, 'completion_tokens': 0,
+            'busy_seconds': 0.0,
+        }
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+
+    def submit(self, request: GenerationRequest) -> Future:
+        self._queue.put(request)
+        return request.future
+
+    def _collect_batch(self, first: GenerationRequest) -> list[GenerationRequest]:
+        batch = [first]
+        rows = first.num_return_sequences
+        deadline = time.monotonic() + self.batch_window
+        while rows < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # 停止の合図は、このバッチを処理した後のループで受け取れるよう戻しておく
+                self._queue.put(None)
+                break
+            if rows + request.num_return_sequences > self.max_batch_size:
+                # 入りきらないリクエストは次のバッチの先頭にする
+                self._pending = request
+                break
+            batch.append(request)
+            rows += request.num_return_sequences
+        return batch
+
+    def _loop(self) -> None:
+        while not self._stopped.is_set():
+            first, self._pending = self._pending, None
+            if first is None:
+                first = self._queue.get()
+                if first is None:
+                    break
+            batch = self._collect_batch(first)
+
+            started = time.monotonic()
+            try:
+                results = self.generate_batch(batch)
+            except Exception as e:
+                logger.error(f"バッチ推論に失敗しました: {e}", exc_info=True)
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            elapsed = time.monotonic() - started
+
+            for request, result in zip(batch, results):
+                result.batch_size = len(batch)
+                result.queue_ms = (started - request.enqueued_at) * 1000
+                request.future.set_result(result)
+            with self._stats_lock:
+                self.stats['requests'] += len(batch)
+                self.stats['batches'] += 1
+                self.stats['prompt_tokens'] += sum(result.prompt_tokens for result in results)
+                self.stats['cached_prompt_tokens'] += sum(result.cached_prompt_tokens for result in results)
+                self.stats['completion_tokens'] += sum(result.completion_tokens for result in results)
+                self.stats['busy_seconds'] += elapsed
+
+        # 停止時に残っているリクエストは失敗させる
+        for request in [self._pending] + list(self._queue.queue):
+            if request is not None and not request.future.done():
+                request.future.set_exception(RuntimeError("推論サーバーが停止しました。"))
+
+
+class LocalModelEngine:
+    """
+    ローカルモデルでバッチ推論を行う。DynamicBatcher の generate_batch として使う。
+
+    transformers の generate() はバッチ全体で同じサンプリングのパラメータしか使えないため、
+    デコードのループを自前で回し、行ごとに temperature / top_p / top_k / max_new_tokens を適用する。
+    """
+
+    def __init__(self, model_path: str, dtype: str | None = None, compile: bool | None = None,
+                 threads: int | None = None):
+        self.model_path = str(model_path)
+        self.model, self.tokenizer, _ = load_local_model(self.model_path, dtype=dtype, compile=compile, threads=threads)
+        # タスクの指示文までの past_key_values (推論はバッチャーの1つのスレッドだけが行う)
+        self.prefix_cache = get_prefix_kv_cache(self.model, self.tokenizer)
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # Gemmaのチャット形式では <end_of_turn> で応答が終わるため、generation_config の終了トークンも使う
+        eos_token_ids = self.model.generation_config.eos_token_id
+        if not isinstance(eos_token_ids, list):
+            eos_token_ids = [eos_token_ids]
+        self.stop_token_ids = {token_id for token_id in eos_token_ids + [self.tokenizer.eos_token_id] if token_id is not None}
+
+    def _chat_prompt(self, prompt: str) -> str:
+        return self.tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt}], tokenize=False, add_generation_prompt=True
+        )
+
+    def _sample(self, logits, temperatures, top_ps, top_ks):
+        """
+        行ごとのパラメータで次のトークンを選ぶ。temperature が 0 の行は greedy にする。
+        """
+        import torch
+
+        greedy_tokens = logits.argmax(dim=-1)
+        scaled = logits / temperatures.clamp(min=1e-5).unsqueeze(1)
+        sorted_logits, sorted_indices = scaled.sort(dim=-1, descending=True)
+        ranks = torch.arange(sorted_logits.shape[1]).unsqueeze(0)
+        # top-k: 上位 k 件より後ろを除外する (k=0 は除外しない)
+        top_k_mask = (top_ks.unsqueeze(1) > 0) & (ranks >= top_ks.unsqueeze(1))
+        sorted_logits = sorted_logits.masked_fill(top_k_mask, float('-inf'))
+        # top-p: 確率の累積が top_p を超えた後ろを除外する (先頭の1件は必ず残す)
+        sorted_probs = sorted_logits.softmax(dim=-1)
+        cumulative = sorted_probs.cumsum(dim=-1) - sorted_probs
+        top_p_mask = cumulative > top_ps.unsqueeze(1)
+        sorted_logits = sorted_logits.masked_fill(top_p_mask, float('-inf'))
+        sampled = torch.multinomial(sorted_logits.softmax(dim=-1), num_samples=1).squeeze(1)
+        sampled_tokens = sorted_indices.gather(1, sampled.unsqueeze(1)).squeeze(1)
+        return torch.where(temperatures > 0, sampled_tokens, greedy_tokens)
+
+    def generate_batch(self, requests: list[GenerationRequest]) -> list[GenerationResult]:
+        # num_return_sequences の分だけ行を複製する
+        rows = [request for request in requests for _ in range(request.num_return_sequences)]
+        chat_prompts = [self._chat_prompt(request.prompt) for request in rows]
+        token_ids = self.tokenizer(chat_prompts, add_special_tokens=False)['input_ids']
+
+        # 共通部分 (Chatテンプレートの先頭からタスクの指示文まで) が同じ行をまとめ、
+        # 計算済みの共通部分の past_key_values から続きを推論する
+        groups = {}
+        for index, (chat_prompt, ids) in enumerate(zip(chat_prompts, token_ids)):
+            prefix = self.prefix_cache.lookup(chat_prompt, ids)
+            groups.setdefault(id(prefix), (prefix, []))[1].append(index)
+
+        generated = [None] * len(rows)
+        cached_tokens = [0] * len(rows)
+        for prefix, indices in groups.values():
+            group_generated = self._decode([rows[i] for i in indices], [token_ids[i] for i in indices], prefix)
+            for i, tokens in zip(indices, group_generated):
+                generated[i] = tokens
+                cached_tokens[i] = len(prefix[0]) if prefix else 0
+
+        texts = [text.strip() for text in self.tokenizer.batch_decode(generated, skip_special_tokens=True)]
+
+        # 複製した行をリクエストごとにまとめ直す
+        results = []
+        offset = 0
+        for request in requests:
+            count = request.num_return_sequences
+            results.append(GenerationResult(
+                texts=texts[offset:offset + count],
+                prompt_tokens=len(token_ids[offset]),
+                completion_tokens=sum(len(tokens) for tokens in generated[offset:offset + count]),
+                cached_prompt_tokens=cached_tokens[offset],
+            ))
+            offset += count
+        return results
+
+    def _decode(self, rows: list[GenerationRequest], token_ids: list[list[int]], prefix) -> list[list[int]]:
+        """
+        行ごとのプロンプトのトークン列から、行ごとのパラメータで生成したトークン列を返す。
+        prefix (PrefixKVCache.lookup の結果) を渡すと、共通部分より後ろのトークンだけをモデルに通す。
+        """
+        import torch
+
+        prefix_length = len(prefix[0]) if prefix else 0
+        suffixes = [ids[prefix_length:] for ids in token_ids]
+        width = max(len(suffix) for suffix in suffixes)
+        pad_token_id = self.tokenizer.pad_token_id
+        # 長さの違うプロンプトは、末尾を揃えるため左側をパディングする (共通部分がある場合は共通部分の直後に入る)
+        input_ids = torch.tensor([[pad_token_id] * (width - len(suffix)) + suffix for suffix in suffixes])
+        suffix_mask = torch.tensor([[0] * (width - len(suffix)) + [1] * len(suffix) for suffix in suffixes])
+        attention_mask = torch.cat([suffix_mask.new_ones((len(rows), prefix_length)), suffix_mask], dim=1)
+
+        temperatures = torch.tensor([request.temperature for request in rows], dtype=torch.float32)
+        top_ps = torch.tensor([request.top_p for request in rows], dtype=torch.float32)
+        top_ks = torch.tensor([request.top_k for request in rows], dtype=torch.long)
+        max_new_tokens = [request.max_new_tokens for request in rows]
+
+        generated = [[] for _ in rows]
+        finished = [False] * len(rows)
+        # 位置はパディングを除いて数える
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)[:, prefix_length:]
+        # 共通部分の past_key_values は推論中に書き換えられるため、複製して使う
+        past_key_values = self.prefix_cache.expand(prefix[1], len(rows)) if prefix else None
+        next_input_ids = input_ids
+
+        with torch.inference_mode():
+            for step in range(max(max_new_tokens)):
+                outputs = self.model(
+                    input_ids=next_input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+                past_key_values = outputs.past_key_values
+                next_tokens = self._sample(outputs.logits[:, -1, :].float(), temperatures, top_ps, top_ks)
+
+                for i, token_id in enumerate(next_tokens.tolist()):
+                    if finished[i]:
+                        continue
+                    if token_id in self.stop_token_ids:
+                        finished[i] = True
+                        continue
+                    generated[i].append(token_id)
+                    if len(generated[i]) >= max_new_tokens[i]:
+                        finished[i] = True
+                if all(finished):
+                    break
+
+                # 終わった行にはパディングを入れて進める (結果には含めない)
+                next_tokens = next_tokens.masked_fill(torch.tensor(finished), pad_token_id)
+                next_input_ids = next_tokens.unsqueeze(1)
+                attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(rows), 1))], dim=1)
+                position_ids = position_ids[:, -1:] + 1
+        return generated
+
+
+class _InferenceHandler(BaseHTTPRequestHandler):
+    # サーバー側で設定される値 (make_inference_server を参照)
+    server: 'InferenceHTTPServer'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def address_string(self):
+        # Unixソケットでは接続元のアドレスが無い
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def _send_json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json({'status': 'ok', 'model': self.server.model_name, 'stats': self.server.batcher.stats})
+            return
+        self._send_json({'error': f'{self.path} は存在しません。'}, status=404)
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self._send_json({'error': f'{self.path} は存在しません。'}, status=404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = GenerationRequest.from_payload(json.loads(self.rfile.read(length).decode('utf-8')))
+        except (ValueError, TypeError, AttributeError) as e:
+            self._send_json({'error': f'リクエストが不正です: {e}'}, status=400)
+            return
+
+        try:
+            result = self.server.batcher.submit(request).result(timeout=self.server.request_timeout)
+        except Exception as e:
+            self._send_json({'error': f'推論に失敗しました: {e}'}, status=500)
+            return
+        self._send_json({
+            'texts': result.texts,
+            'prompt_tokens': result.prompt_tokens,
+            'completion_tokens': result.completion_tokens,
+            'cached_prompt_tokens': result.cached_prompt_tokens,
+            'batch_size': result.batch_size,
+            'queue_ms': round(result.queue_ms, 1),
+        })
+
+
+class InferenceHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class UnixInferenceHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def server_bind(self):
+        # 前回の起動で残ったソケットファイルを消してから待ち受ける
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+
+def make_inference_server(batcher: DynamicBatcher, model_name: str, host: str = '127.0.0.1', port: int = 8765,
+                          socket_path: str | None = None, request_timeout: float = 120):
+    """
+    推論サーバーを作る。socket_path を指定した場合はUnixソケットで、それ以外は host:port で待ち受ける。
+    """
+    if socket_path:
+        server = UnixInferenceHTTPServer(socket_path, _InferenceHandler)
+    else:
+        server = InferenceHTTPServer((host, port), _InferenceHandler)
+    server.batcher = batcher
+    server.model_name = model_name
+    server.request_timeout = request_timeout
+    return server
@@ -0,0 +1,295 @@
+# oogiri/jobs.py
+"""
+回答の採点ジョブ。
+外部のメッセージブローカーは使わず、EvaluationJob テーブルをキューとして使う。
+ジョブの登録はビューから、処理は run_evaluation_worker コマンドのワーカーから行う。
+
+ワーカーは講評をストリーミングで受け取り、生成途中の講評をDjangoのキャッシュに書き込む。
+結果画面のストリーム (AnswerStreamView) はそれを読んで、採点の完了を待たずにブラウザへ送る。
+"""
+import logging
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .evaluation_cache import lookup_evaluation, make_cache_key, store_evaluation
+from .models import Answer, EvaluationJob
+from .llm_backends import LLMBackend
+
+logger = logging.getLogger(__name__)
+
+# 生成途中の講評をキャッシュに書き込む最短の間隔 (秒)
+PARTIAL_REVIEW_INTERVAL = 0.1
+
+
+def partial_review_key(answer_id: int) -> str:
+    return f'evaluation_partial:{answer_id}'
+
+
+def _partial_review_publisher(answer_id: int):
+    """
+    生成途中の講評をキャッシュに書き込む関数を返す。
+    トークンごとに書き込まないよう、PARTIAL_REVIEW_INTERVAL 秒に1回までに間引く (最後の講評は採点結果として保存される)。
+    """
+    last_published = 0.0
+
+    def publish(review_text: str) -> None:
+        nonlocal last_published
+        now = time.monotonic()
+        if now - last_published < PARTIAL_REVIEW_INTERVAL:
+            return
+        last_published = now
+        cache.set(partial_review_key(answer_id), review_text, settings.EVALUATION_JOB_TIMEOUT)
+
+    return publish
+
+
+def submit_answer(user, question, answer_text: str) -> Answer:
+    """
+    回答を未採点の状態で保存し、採点ジョブをキューに登録する。
+    同じお題・同じ回答の採点結果がキャッシュにあれば、それを使って採点済みとして保存する。
+    """
+    cached_result = lookup_evaluation(question.question_text, answer_text)
+
+    with transaction.atomic():
+        answer = Answer.objects.create(
+            user=user,
+            question=question,
+            answer_text=answer_text,
+            score=cached_result['score'] if cached_result else None,
+            review_text=cached_result['comment'] if cached_result else '',
+        )
+        EvaluationJob.objects.create(
+            answer=answer,
+            status=EvaluationJob.Status.DONE if cached_result else EvaluationJob.Status.PENDING,
+        )
+    return answer
+
+
+def requeue_stale_jobs() -> int:
+    """
+    処理中のまま EVALUATION_JOB_TIMEOUT を過ぎたジョブ (ワーカーが落ちた場合など) を待機中に戻す。
+    """
+    deadline = timezone.now() - timedelta(seconds=settings.EVALUATION_JOB_TIMEOUT)
+    return EvaluationJob.objects.filter(
+        status=EvaluationJob.Status.RUNNING, locked_at__lt=deadline
+    ).update(status=EvaluationJob.Status.PENDING, locked_at=None, updated_at=timezone.now())
+
+
+def claim_evaluation_jobs(limit: int = 1, question_id: int | None = None, max_retries: int = 3) -> list[EvaluationJob]:
+    """
+    待機中のジョブを古い順に最大 limit 件取り出し、処理中にして返す。question_id を指定するとそのお題の回答に絞る。
+
+    take_pooled_questions と同じく、select_for_update(skip_locked=True) に加えて
+    status=待機中 を条件にした更新件数で、複数ワーカーによる取り合いを検出する。
+    """
+    for _ in range(max_retries):
+        with transaction.atomic():
+            pending_jobs = EvaluationJob.objects.select_for_update(skip_locked=True, of=('self',)).filter(
+                status=EvaluationJob.Status.PENDING
+            )
+            if question_id is not None:
+                pending_jobs = pending_jobs.filter(answer__question_id=question_id)
+            job_ids = list(pending_jobs.order_by('created_at', 'id').values_list('id', flat=True)[:limit])
+            if not job_ids:
+                return []
+
+            now = timezone.now()
+            updated = EvaluationJob.objects.filter(id__in=job_ids, status=EvaluationJob.Status.PENDING).update(
+                status=EvaluationJob.Status.RUNNING, locked_at=now, attempts=F('attempts') + 1, updated_at=now
+            )
+            if updated == len(job_ids):
+                return list(
+                    EvaluationJob.objects.select_related('answer__question__headline_set')
+                    .filter(id__in=job_ids).order_by('created_at', 'id')
+                )
+
+            # 他のワーカーが先に取り出したジョブがあれば、この取り出しを取り消して選び直す
+            transaction.set_rollback(True)
+    return []
+
+
+def claim_evaluation_job(question_id: int | None = None) -> EvaluationJob | None:
+    """
+    待機中のジョブを1件取り出して返す。無ければ None。question_id を指定するとそのお題の回答に絞る。
+    """
+    jobs = claim_evaluation_jobs(limit=1, question_id=question_id)
+    return jobs[0] if jobs else None
+
+
+def claim_evaluation_batch(max_size: int | None = None, window: float | None = None,
+                           question_id: int | None = None) -> list[EvaluationJob]:
+    """
+    まとめて採点するジョブを取り出す。
+    最も古いジョブと同じお題のジョブを最大 max_size 件まで集める。
+    同じお題の待機中のジョブが足りない場合は、最も古いジョブの登録から window 秒経つまで後続の回答を待つ。
+    question_id を指定すると、そのお題の回答のジョブだけを取り出す。
+    """
+    max_size = settings.EVALUATION_BATCH_SIZE if max_size is None else max_size
+    window = settings.EVALUATION_BATCH_WINDOW if window is None else window
+
+    head = claim_evaluation_job(question_id=question_id)
+    if head is None or max_size <= 1:
+        return [head] if head else []
+
+    question_id = head.answer.question_id
+    wait = window - (timezone.now() - head.created_at).total_seconds()
+    if wait > 0:
+        pending_count = EvaluationJob.objects.filter(
+            status=EvaluationJob.Status.PENDING, answer__question_id=question_id
+        ).count()
+        if pending_count < max_size - 1:
+            time.sleep(wait)
+
+    return [head] + claim_evaluation_jobs(limit=max_size - 1, question_id=question_id)
+
+
+def complete_evaluation_job(job: EvaluationJob, evaluation_result: dict) -> None:
+    """
+    採点結果を回答に保存し、ジョブを完了にする。
+    """
+    with transaction.atomic():
+        Answer.objects.filter(id=job.answer_id).update(
+            score=evaluation_result['score'],
+            review_text=evaluation_result['comment'],
+        )
+        EvaluationJob.objects.filter(id=job.id).update(
+            status=EvaluationJob.Status.DONE, locked_at=None, last_error='', updated_at=timezone.now()
+        )
+    cache.delete(partial_review_key(job.answer_id))
+
+
+def retry_or_fail_evaluation_job(job: EvaluationJob, error: str) -> None:
+    """
+    採点に失敗したジョブを待機中に戻す。EVALUATION_MAX_ATTEMPTS 回失敗していれば失敗扱いにする。
+    """
+    if job.attempts >= settings.EVALUATION_MAX_ATTEMPTS:
+        status = EvaluationJob.Status.FAILED
+    else:
+        status = EvaluationJob.Status.PENDING
+    EvaluationJob.objects.filter(id=job.id).update(
+        status=status, locked_at=None, last_error=error, updated_at=timezone.now()
+    )
+    cache.delete(partial_review_key(job.answer_id))
+
+
+def _evaluate_with_backend(job: EvaluationJob, backend: LLMBackend) -> dict | None:
+    """
+    ジョブの回答をLLMバックエンドで1件だけ採点し、結果をキャッシュにも保存する。
+    成功した場合は採点結果を、失敗した場合は None を返す。
+    """
+    answer = job.answer
+    evaluation_result = backend.evaluate_answer_streaming(
+        question=answer.question, answer_text=answer.answer_text, on_partial=_partial_review_publisher(answer.id)
+    )
+
+    if isinstance(evaluation_result, str):
+        retry_or_fail_evaluation_job(job, evaluation_result)
+        return None
+
+    store_evaluation(answer.question.question_text, answer.answer_text, evaluation_result)
+    complete_evaluation_job(job, evaluation_result)
+    return evaluation_result
+
+
+def _complete_from_cache(job: EvaluationJob) -> bool:
+    """
+    キャッシュに採点結果があればそれでジョブを完了し、True を返す。
+    (キューに入っている間に、同じ回答の別のコピーが採点された場合など)
+    """
+    cached_result = lookup_evaluation(job.answer.question.question_text, job.answer.answer_text)
+    if cached_result is None:
+        return False
+    complete_evaluation_job(job, cached_result)
+    return True
+
+
+def process_evaluation_job(job: EvaluationJob, backend: LLMBackend) -> bool:
+    """
+    ジョブの回答を採点する (キャッシュに無ければLLMバックエンドで採点する)。成功した場合は True を返す。
+    """
+    if _complete_from_cache(job):
+        return True
+    return _evaluate_with_backend(job, backend) is not None
+
+
+def process_evaluation_batch(jobs: list[EvaluationJob], backend: LLMBackend) -> int:
+    """
+    同じお題のジョブをまとめて1回のリクエストで採点し、成功した件数を返す。
+    キャッシュにある回答はLLMに送らず、同じ回答が複数ある場合は1つだけ送る。
+    応答はストリーミングで受け取り、採点し終えた回答のジョブから順に完了にする。
+    まとめた応答から結果を読み取れなかった回答は、evaluate_answer で1件ずつ採点し直す。
+    """
+    succeeded = 0
+    remaining = []
+    for job in jobs:
+        if _complete_from_cache(job):
+            succeeded += 1
+        else:
+            remaining.append(job)
+    if not remaining:
+        return succeeded
+
+    # 正規化すると同じになる回答は、代表の1件だけを採点して結果を共有する
+    jobs_by_key = {}
+    for job in remaining:
+        key = make_cache_key(job.answer.question.question_text, job.answer.answer_text)
+        jobs_by_key.setdefault(key, []).append(job)
+    jobs_by_answer_id = {same_jobs[0].answer_id: same_jobs for same_jobs in jobs_by_key.values()}
+
+    def complete_same_jobs(answer_id, evaluation_result):
+        same_jobs = jobs_by_answer_id[answer_id]
+        answer = same_jobs[0].answer
+        store_evaluation(answer.question.question_text, answer.answer_text, evaluation_result)
+        for job in same_jobs:
+            complete_evaluation_job(job, evaluation_result)
+
+    completed_ids = set()
+    if len(jobs_by_answer_id) > 1:
+        question = remaining[0].answer.question
+        publishers = {answer_id: _partial_review_publisher(answer_id) for answer_id in jobs_by_answer_id}
+
+        def on_result(answer_id, evaluation_result):
+            # 採点し終えた回答から順に保存し、応答全体が届くのを待たずに結果画面へ出す
+            if answer_id in jobs_by_answer_id and answer_id not in completed_ids:
+                complete_same_jobs(answer_id, evaluation_result)
+                completed_ids.add(answer_id)
+
+        evaluations = backend.evaluate_answers_batch_streaming(
+            question=question,
+            answers=[(answer_id, same_jobs[0].answer.answer_text) for answer_id, same_jobs in jobs_by_answer_id.items()],
+            on_partial=lambda answer_id, review_text: publishers[answer_id](review_text),
+            on_result=on_result,
+        )
+        if isinstance(evaluations, str):
+            logger.warning(f"まとめての採点に失敗したため、1件ずつ採点します: {evaluations}")
+            evaluations = {}
+    else:
+        evaluations = {}
+
+    for answer_id, same_jobs in jobs_by_answer_id.items():
+        if answer_id in completed_ids:
+            succeeded += len(same_jobs)
+            continue
+
+        representative, duplicates = same_jobs[0], same_jobs[1:]
+        evaluation_result = evaluations.get(answer_id)
+        if evaluation_result is not None:
+            complete_same_jobs(answer_id, evaluation_result)
+            succeeded += len(same_jobs)
+            continue
+
+        evaluation_result = _evaluate_with_backend(representative, backend)
+        if evaluation_result is None:
+            # 代表の採点に失敗した場合は、同じ回答のジョブも待機中に戻して次の機会に採点する
+            for job in duplicates:
+                retry_or_fail_evaluation_job(job, "同じ回答の採点に失敗しました。")
+            continue
+
+        for job in duplicates:
+            complete_evaluation_job(job, evaluation_result)
+        succeeded += len(same_jobs)
+    return succeeded
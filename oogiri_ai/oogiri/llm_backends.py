@@ -0,0 +1,674 @@
+# oogiri/llm_backends.py
+"""
+お題生成・回答生成・採点に使うLLMのバックエンド。
+
+- 'gemini': Gemini API (oogiri.services.GeminiService)
+- 'local' : ファインチューニングしたローカルモデル (LocalModelBackend)
+- 'local_server': run_inference_server コマンドで常駐させたローカルモデルの推論サーバー (LocalServerBackend)
+
+どのタスクにどのバックエンドを使うかは settings.LLM_BACKENDS で選び、get_llm_backend(task) で取得する。
+settings.LLM_BACKENDS にはバックエンドの名前の代わりに、LLMBackend を継承したクラスのパスも書ける (テスト用の偽物など)。
+"""
+import asyncio
+import copy
+import httpx
+import json
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from .streaming import partial_string_value
+
+logger = logging.getLogger(__name__)
+
+# タスクの種類 (settings.LLM_BACKENDS のキー)
+TASK_QUESTION_GENERATION = 'question_generation'
+TASK_ANSWER_GENERATION = 'answer_generation'
+TASK_EVALUATION = 'evaluation'
+TASKS = (TASK_QUESTION_GENERATION, TASK_ANSWER_GENERATION, TASK_EVALUATION)
+
+# バックエンドの名前と実装クラス
+BACKENDS = {
+    'gemini': 'oogiri.services.GeminiService',
+    'local': 'oogiri.llm_backends.LocalModelBackend',
+    'local_server': 'oogiri.llm_backends.LocalServerBackend',
+}
+
+# ファインチューニングの学習データ (export_training_data コマンド) と同じ指示文。
+# ローカルモデルには学習時と同じ形式のプロンプトを渡す必要があるため、両方からこの定義を使う
+ANSWER_INSTRUCTION = "あなたはプロの大喜利回答者です。以下の情報に基いて、最高の面白さの回答を一つ生成してください。"
+QUESTION_INSTRUCTION = (
+    "あなたはプロの大喜利クリエイターです。"
+    "与えられたニュースタイトルを参考に、それにインスパイアされた、秀逸で面白い大喜利のお題を一つ生成してください。"
+)
+# ローカルモデルでの採点の指示文 (学習データには無いタスク)
+EVALUATION_INSTRUCTION = (
+    "あなたは厳しくも愛のある大喜利のプロ審査員です。"
+    "以下の大喜利のお題に対する回答を5段階で評価し、短い講評コメントを行ってください。"
+    "出力は必ずJSON形式で、整数型の`score`（1〜5）と、文字列型の`comment`を含むオブジェクトにしてください。"
+)
+# ローカルモデルで回答の候補を採点するときの、応答の書き出しと点数の値 (LocalModelBackend.score_answers)
+SCORE_RESPONSE_PREFIX = '{"score": '
+SCORE_VALUES = (1, 2, 3, 4, 5)
+# タスクごとの、ローカルモデルのプロンプトの先頭に置く指示文。
+# ローカルモデルでは、Chatテンプレートの先頭からこの指示文までの past_key_values を計算済みのものから使い回す (PrefixKVCache)
+TASK_INSTRUCTIONS = {
+    TASK_QUESTION_GENERATION: QUESTION_INSTRUCTION,
+    TASK_ANSWER_GENERATION: ANSWER_INSTRUCTION,
+    TASK_EVALUATION: EVALUATION_INSTRUCTION,
+}
+
+
+def build_answer_task_prompt(question_text: str, source_title: str | None) -> str:
+    """
+    回答生成タスクのプロンプト (学習データの user メッセージ) を組み立てる。
+    """
+    user_input_text = f"\n\n【お題】{question_text}"
+    if source_title:
+        user_input_text += f"\n【背景ニュース】{source_title}"
+    return ANSWER_INSTRUCTION + user_input_text
+
+
+def build_question_task_prompt(source_title: str) -> str:
+    """
+    お題生成タスクのプロンプト (学習データの user メッセージ) を組み立てる。
+    """
+    return QUESTION_INSTRUCTION + f"\n\n【背景ニュース】{source_title}"
+
+
+class StreamingError(Exception):
+    """
+    ストリーミング版のメソッド (astream_questions) で生成に失敗したことを表す。
+    途中まで返した後に失敗することがあるため、エラーメッセージの文字列を返す代わりにこの例外を投げる。
+    """
+
+
+class LLMBackend:
+    """
+    LLMバックエンドの共通インターフェース。
+    同期版のメソッドを実装すれば、非同期版はスレッドで同期版を呼び出す。
+    ストリーミング版のメソッドは、生成し終えてからまとめて返す既定の実装を持つ。
+    失敗時は例外を投げずに、エラーメッセージの文字列を返す (GeminiService と同じ約束)。
+    """
+
+    def generate_questions(self, headlines: list[str], theme: str) -> list[str] | str:
+        """
+        ニュースタイトルに基づき、大喜利のお題を3つ生成する。
+        """
+        raise NotImplementedError
+
+    async def agenerate_questions(self, headlines: list[str], theme: str) -> list[str] | str:
+        return await sync_to_async(self.generate_questions, thread_sensitive=False)(headlines, theme=theme)
+
+    async def astream_questions(self, headlines: list[str], theme: str):
+        """
+        agenerate_questions のストリーミング版。お題を1つ生成し終えるたびに返す非同期ジェネレーター。
+        失敗時は StreamingError を投げる。
+        """
+        result = await self.agenerate_questions(headlines, theme=theme)
+        if isinstance(result, str):
+            raise StreamingError(result)
+        for question_text in result:
+            yield question_text
+
+    def generate_answers(self, question, count: int = 1, max_time: float | None = None) -> list[str] | str:
+        """
+        お題に対する大喜利の回答を count 個生成する。
+        max_time は生成に使ってよい秒数の目安 (生成を途中で打ち切れないバックエンドでは無視する)。
+        """
+        raise NotImplementedError
+
+    async def agenerate_answers(self, question, count: int = 1, max_time: float | None = None) -> list[str] | str:
+        return await sync_to_async(self.generate_answers, thread_sensitive=False)(
+            question, count=count, max_time=max_time
+        )
+
+    def evaluate_answer(self, question, answer_text: str) -> dict | str:
+        """
+        回答を採点し、{"score": int, "comment": str} を返す。
+        """
+        raise NotImplementedError
+
+    def evaluate_answers_batch(self, question, answers: list[tuple[int, str]]) -> dict[int, dict] | str:
+        """
+        同じお題に対する複数の回答を採点し、回答ID -> 採点結果 の辞書を返す。
+        まとめて採点する手段が無いバックエンドでは、1件ずつ evaluate_answer で採点する。
+        採点できなかった回答は結果に含めない (呼び出し側で個別に採点し直す)。
+        """
+        evaluations = {}
+        for answer_id, answer_text in answers:
+            evaluation_result = self.evaluate_answer(question, answer_text)
+            if isinstance(evaluation_result, dict):
+                evaluations[answer_id] = evaluation_result
+        return evaluations
+
+    def score_answers(self, question, answer_texts: list[str]) -> list[float] | str:
+        """
+        同じお題に対する回答の候補をまとめて採点し、候補と同じ順序で点数 (大きいほど面白い) のリストを返す。
+        講評は返さない (回答の提案で候補を並べ替えるために使う)。
+        既定では evaluate_answers_batch で採点し、採点できなかった候補は0点とする。
+        """
+        evaluations = self.evaluate_answers_batch(question, list(enumerate(answer_texts)))
+        if isinstance(evaluations, str):
+            return evaluations
+        return [
+            float(evaluations[index]['score']) if index in evaluations else 0.0
+            for index in range(len(answer_texts))
+        ]
+
+    def evaluate_answer_streaming(self, question, answer_text: str, on_partial) -> dict | str:
+        """
+        evaluate_answer のストリーミング版。生成途中の講評を on_partial(途中までの講評) に渡しながら採点する。
+        """
+        evaluation_result = self.evaluate_answer(question, answer_text)
+        if isinstance(evaluation_result, dict):
+            on_partial(evaluation_result['comment'])
+        return evaluation_result
+
+    def evaluate_answers_batch_streaming(self, question, answers: list[tuple[int, str]],
+                                         on_partial, on_result) -> dict[int, dict] | str:
+        """
+        evaluate_answers_batch のストリーミング版。生成途中の講評を on_partial(回答ID, 途中までの講評) に、
+        採点し終えた回答の結果を on_result(回答ID, 採点結果) に、採点し終えた順に渡す。
+        """
+        evaluations = self.evaluate_answers_batch(question, answers)
+        if isinstance(evaluations, dict):
+            for answer_id, evaluation_result in evaluations.items():
+                on_partial(answer_id, evaluation_result['comment'])
+                on_result(answer_id, evaluation_result)
+        return evaluations
+
+
+def get_llm_backend(task: str) -> LLMBackend:
+    """
+    settings.LLM_BACKENDS でタスクに割り当てられたバックエンドを返す。
+    """
+    if task not in TASKS:
+        raise ImproperlyConfigured(f"不明なLLMのタスクです: {task}")
+    backend = settings.LLM_BACKENDS.get(task, 'gemini')
+    backend_class = import_string(BACKENDS.get(backend, backend))
+    if not issubclass(backend_class, LLMBackend):
+        raise ImproperlyConfigured(f"{backend} は LLMBackend を継承していません。")
+    return backend_class()
+
+
+# ローカルモデルの推論モード (settings.LOCAL_MODEL_DTYPE)
+# fp32: 変換しない / bf16: bfloat16で読み込む (CPUが対応している場合のみ) / int8: Linear層を動的量子化する
+LOCAL_MODEL_DTYPES = ('fp32', 'bf16', 'int8')
+
+# ロード済みのローカルモデル ((モデルのパス, 推論モード, compile) -> (model, tokenizer, 推論用のロック))
+_local_models = {}
+_local_models_lock = threading.Lock()
+
+
+def cpu_supports_bf16() -> bool:
+    """
+    CPUがbfloat16の演算 (AVX512-BF16 / AMX) に対応しているかを返す。
+    対応していないCPUでbf16を使うと、fp32より遅くなる。
+    """
+    import torch
+
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def load_local_model(model_path: str, dtype: str | None = None, compile: bool | None = None,
+                     threads: int | None = None):
+    """
+    ファインチューニングしたモデルとトークナイザーを読み込む。
+    読み込みには数十秒かかるため、プロセスごとに1回だけ読み込み、以降のリクエストで使い回す。
+    torch / transformers はローカルモデルを使う場合だけ必要なので、ここで読み込む。
+
+    dtype, compile, threads を省略した場合は settings の LOCAL_MODEL_DTYPE, LOCAL_MODEL_COMPILE, LOCAL_MODEL_THREADS を使う。
+    """
+    model_path = str(model_path)
+    dtype = settings.LOCAL_MODEL_DTYPE if dtype is None else dtype
+    compile = settings.LOCAL_MODEL_COMPILE if compile is None else compile
+    threads = settings.LOCAL_MODEL_THREADS if threads is None else threads
+    if dtype not in LOCAL_MODEL_DTYPES:
+        raise ImproperlyConfigured(f"LOCAL_MODEL_DTYPE は {LOCAL_MODEL_DTYPES} のいずれかにしてください: {dtype}")
+
+    key = (model_path, dtype, compile)
+    with _local_models_lock:
+        if key not in _local_models:
+            import torch
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+
+            # 推論に使うCPUのスレッド数 (プロセス全体の設定。0 の場合はtorchの既定値 = 物理コア数)
+            if threads:
+                torch.set_num_threads(threads)
+
+            if dtype == 'bf16' and not cpu_supports_bf16():
+                logger.warning("このCPUはbfloat16に対応していないため、fp32で読み込みます。")
+                dtype = 'fp32'
+
+            logger.info(f"ローカルモデルを読み込みます: {model_path} ({dtype}, compile={compile}, threads={torch.get_num_threads()})")
+            torch_dtype = torch.bfloat16 if dtype == 'bf16' else torch.float32
+            model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch_dtype).to("cpu")
+            model.eval()
+            if dtype == 'int8':
+                # 重みをint8にし、活性は推論時に動的に量子化する (メモリが約1/4になり、行列積が速くなる)
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            if compile:
+                # forward をコンパイルする (初回の推論でコンパイルが走り、以降の推論が速くなる)
+                # 生成中に長さが変わるため dynamic=True にする
+                model.forward = torch.compile(model.forward, dynamic=True)
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+            # 同じモデルでの推論はスレッド間で1つずつ行う (CPUのスレッドを取り合って遅くなるのを防ぐ)
+            _local_models[key] = (model, tokenizer, threading.Lock())
+        return _local_models[key]
+
+
+class PrefixKVCache:
+    """
+    ローカルモデルのプロンプトの共通部分 (Chatテンプレートの先頭からタスクの指示文まで) の past_key_values を保持する。
+    プロンプトのトークン列が共通部分のトークン列で始まっていれば、残りのトークンだけをモデルに通せば済む。
+    共通部分はタスクの指示文 (TASK_INSTRUCTIONS) ごとに1つ作り、max_entries 件を超えたら最も長く使われていないものを捨てる。
+    モデルの推論と同じロックの中で (または推論を行う1つのスレッドから) 使う。
+    """
+
+    def __init__(self, model, tokenizer, max_entries: int | None = None, instructions: list[str] | None = None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_entries = settings.LOCAL_MODEL_PREFIX_CACHE_SIZE if max_entries is None else max_entries
+        self.instructions = list(TASK_INSTRUCTIONS.values()) if instructions is None else instructions
+        # 共通部分のテキスト -> (共通部分のトークン列, バッチサイズ1の past_key_values)
+        self._entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'cached_tokens': 0}
+
+    def _prefix_text(self, chat_prompt: str) -> str | None:
+        for instruction in self.instructions:
+            index = chat_prompt.find(instruction)
+            if index >= 0:
+                return chat_prompt[:index + len(instruction)]
+        return None
+
+    def _compute(self, prefix_ids: list[int]):
+        import torch
+        from transformers import DynamicCache
+
+        with torch.inference_mode():
+            outputs = self.model(
+                input_ids=torch.tensor([prefix_ids]), past_key_values=DynamicCache(), use_cache=True
+            )
+        return outputs.past_key_values
+
+    def lookup(self, chat_prompt: str, input_ids: list[int]) -> tuple[list[int], object] | None:
+        """
+        Chatテンプレートで整形したプロンプトとそのトークン列に使える共通部分を、(トークン列, past_key_values) で返す。
+        使える共通部分が無ければ None を返す。past_key_values は expand で複製してから使う (推論中に書き換えられるため)。
+        """
+        if self.max_entries <= 0:
+            return None
+        prefix_text = self._prefix_text(chat_prompt)
+        if prefix_text is None:
+            return None
+
+        entry = self._entries.get(prefix_text)
+        hit = entry is not None
+        if hit:
+            self._entries.move_to_end(prefix_text)
+        else:
+            prefix_ids = self.tokenizer(prefix_text, add_special_tokens=False)['input_ids']
+            entry = (prefix_ids, self._compute(prefix_ids))
+            self._entries[prefix_text] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        prefix_ids, past_key_values = entry
+        # 指示文の直後でトークンの区切りが変わる場合は使えない (また、残りのトークンが1つ以上必要)
+        if len(input_ids) <= len(prefix_ids) or input_ids[:len(prefix_ids)] != prefix_ids:
+            return None
+        if hit:
+            self.stats['hits'] += 1
+            self.stats['cached_tokens'] += len(prefix_ids)
+        else:
+            self.stats['misses'] += 1
+        return entry
+
+    @staticmethod
+    def expand(past_key_values, batch_size: int):
+        """
+        共通部分の past_key_values (バッチサイズ1) を複製し、batch_size 行分に広げる。
+        """
+        past_key_values = copy.deepcopy(past_key_values)
+        if batch_size > 1:
+            past_key_values.batch_repeat_interleave(batch_size)
+        return past_key_values
+
+
+# ロード済みのモデルごとの PrefixKVCache
+_prefix_kv_caches = weakref.WeakKeyDictionary()
+
+
+def get_prefix_kv_cache(model, tokenizer) -> PrefixKVCache:
+    """
+    モデルごとに1つの PrefixKVCache を返す。
+    """
+    with _local_models_lock:
+        if model not in _prefix_kv_caches:
+            _prefix_kv_caches[model] = PrefixKVCache(model, tokenizer)
+        return _prefix_kv_caches[model]
+
+
+class SequenceStreamer:
+    """
+    model.generate(streamer=...) に渡し、生成中のトークンを系列 (num_return_sequences の1つ1つ) ごとに受け取る。
+    transformers の TextIteratorStreamer と同じ put / end の約束で呼ばれるが、複数の系列を同時に扱える。
+    系列ごとに、途中までの文字列を on_text(系列の番号, 文字列) に、
+    終了トークンに達した (または生成が終わった) 系列の文字列を on_finish(系列の番号, 文字列) に渡す。
+    """
+
+    def __init__(self, tokenizer, on_text=None, on_finish=None):
+        self.tokenizer = tokenizer
+        self.on_text = on_text
+        self.on_finish = on_finish
+        self.stop_token_ids = {tokenizer.eos_token_id, tokenizer.pad_token_id} - {None}
+        self._prompt_received = False
+        self._tokens = None
+        self._finished = None
+
+    def _decode(self, index: int) -> str:
+        return self.tokenizer.decode(self._tokens[index], skip_special_tokens=True).strip()
+
+    def _finish(self, index: int) -> None:
+        self._finished[index] = True
+        if self.on_finish:
+            self.on_finish(index, self._decode(index))
+
+    def put(self, value) -> None:
+        # 最初に渡されるのはプロンプトのトークンなので読み飛ばす
+        if not self._prompt_received:
+            self._prompt_received = True
+            return
+        token_ids = value.reshape(-1).tolist()
+        if self._tokens is None:
+            self._tokens = [[] for _ in token_ids]
+            self._finished = [False] * len(token_ids)
+        for index, token_id in enumerate(token_ids):
+            if self._finished[index]:
+                continue
+            if token_id in self.stop_token_ids:
+                self._finish(index)
+                continue
+            self._tokens[index].append(token_id)
+            if self.on_text:
+                self.on_text(index, self._decode(index))
+
+    def end(self) -> None:
+        # max_new_tokens に達して終わった系列
+        for index, finished in enumerate(self._finished or []):
+            if not finished:
+                self._finish(index)
+
+
+class LocalModelBackend(LLMBackend):
+    """
+    ファインチューニングしたローカルモデル (local_inference/oogiri_finetuned_model) をプロセス内で動かすバックエンド。
+    ネットワークを経由しないため、APIキーが無い環境やオフラインのテストでもアプリ全体を動かせる。
+    """
+    # プロンプトに含めるニュースタイトルの最大数 (学習データの背景ニュースと同程度の長さにする)
+    max_headlines = 10
+
+    def __init__(self, model_path: str | None = None):
+        self.model_path = settings.LOCAL_MODEL_PATH if model_path is None else model_path
+        self.max_new_tokens = settings.LOCAL_MODEL_MAX_NEW_TOKENS
+        self.temperature = settings.LOCAL_MODEL_TEMPERATURE
+
+    def _generate(self, prompt: str, count: int = 1, streamer_callbacks: dict | None = None,
+                  max_time: float | None = None) -> list[str]:
+        """
+        ユーザーメッセージ1つに対して、モデルの応答を count 個生成する。
+        streamer_callbacks を渡すと、SequenceStreamer(on_text=..., on_finish=...) で生成途中の文字列を受け取る。
+        max_time 秒を過ぎると、その時点までに生成した文字列を返す。
+        """
+        import torch
+
+        model, tokenizer, lock = load_local_model(self.model_path)
+        # Chatテンプレートで整形
+        chat_prompt = tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt}], tokenize=False, add_generation_prompt=True
+        )
+        inputs = tokenizer(chat_prompt, return_tensors='pt', add_special_tokens=False)
+        streamer = SequenceStreamer(tokenizer, **streamer_callbacks) if streamer_callbacks else None
+        with lock, torch.inference_mode():
+            prefix = get_prefix_kv_cache(model, tokenizer).lookup(chat_prompt, inputs['input_ids'][0].tolist())
+            if prefix is not None:
+                # 共通部分の past_key_values を count 行分に複製して渡す (generate はその分のトークンを計算しない)
+                # num_return_sequences では past_key_values が複製されないため、入力の行を増やす
+                output_ids = model.generate(
+                    input_ids=inputs['input_ids'].repeat(count, 1),
+                    attention_mask=inputs['attention_mask'].repeat(count, 1),
+                    past_key_values=PrefixKVCache.expand(prefix[1], count),
+                    max_new_tokens=self.max_new_tokens,
+                    do_sample=True,
+                    temperature=self.temperature,
+                    pad_token_id=tokenizer.eos_token_id,
+                    streamer=streamer,
+                    max_time=max_time,
+                )
+            else:
+                output_ids = model.generate(
+                    **inputs,
+                    max_new_tokens=self.max_new_tokens,
+                    do_sample=True,
+                    temperature=self.temperature,
+                    num_return_sequences=count,
+                    pad_token_id=tokenizer.eos_token_id,
+                    streamer=streamer,
+                    max_time=max_time,
+                )
+        # プロンプト部分を除いた、生成されたトークンだけを文字列にする
+        prompt_length = inputs['input_ids'].shape[1]
+        texts = tokenizer.batch_decode(output_ids[:, prompt_length:], skip_special_tokens=True)
+        return [text.strip() for text in texts]
+
+    def _build_question_prompt(self, headlines: list[str], theme: str) -> str:
+        source_title = "\n".join(headlines[:self.max_headlines]) if headlines else f"{theme}に関するニュース"
+        return build_question_task_prompt(source_title)
+
+    def generate_questions(self, headlines: list[str], theme: str) -> list[str] | str:
+        try:
+            questions = [q for q in self._generate(self._build_question_prompt(headlines, theme), count=3) if q]
+        except Exception as e:
+            logger.error(f"ローカルモデルでのお題生成に失敗しました: {e}", exc_info=True)
+            return f"予期せぬエラーが発生しました: {e}"
+
+        if len(questions) != 3:
+            return "ローカルモデルの応答が不正です: お題を3つ生成できませんでした。"
+        return questions
+
+    async def astream_questions(self, headlines: list[str], theme: str):
+        """
+        3つのお題を1回の generate で同時に生成し、終了トークンに達したお題から順に返す。
+        """
+        loop = asyncio.get_running_loop()
+        finished_questions = asyncio.Queue()
+
+        def on_finish(index, text):
+            # 生成はスレッドで動くため、イベントループのスレッドでキューに入れる
+            loop.call_soon_threadsafe(finished_questions.put_nowait, text)
+
+        generation = asyncio.ensure_future(sync_to_async(self._generate, thread_sensitive=False)(
+            self._build_question_prompt(headlines, theme), count=3, streamer_callbacks={'on_finish': on_finish}
+        ))
+        emitted = 0
+        try:
+            while emitted < 3:
+                if generation.done():
+                    # 生成が終わった後は、キューに残っているお題を取り出す
+                    # (on_finish はすべて generate の中で呼ばれ、キューに入れ終わっている)
+                    if finished_questions.empty():
+                        break
+                    question_text = finished_questions.get_nowait()
+                else:
+                    next_question = asyncio.ensure_future(finished_questions.get())
+                    await asyncio.wait({next_question, generation}, return_when=asyncio.FIRST_COMPLETED)
+                    if not next_question.done():
+                        next_question.cancel()
+                        continue
+                    question_text = next_question.result()
+                if question_text:
+                    emitted += 1
+                    yield question_text
+        finally:
+            if not generation.done():
+                # クライアントが切断した場合も、生成は最後まで走らせてから終える (モデルのロックを握ったまま中断しない)
+                generation.add_done_callback(lambda future: future.exception())
+        if generation.done() and generation.exception() is not None:
+            e = generation.exception()
+            logger.error(f"ローカルモデルでのお題生成に失敗しました: {e}", exc_info=e)
+            raise StreamingError(f"予期せぬエラーが発生しました: {e}")
+        if emitted < 3:
+            raise StreamingError("ローカルモデルの応答が不正です: お題を3つ生成できませんでした。")
+
+    def generate_answers(self, question, count: int = 1, max_time: float | None = None) -> list[str] | str:
+        try:
+            answers = self._generate(
+                build_answer_task_prompt(question.question_text, question.source_text), count=count, max_time=max_time
+            )
+        except Exception as e:
+            logger.error(f"ローカルモデルでの回答生成に失敗しました: {e}", exc_info=True)
+            return f"予期せぬエラーが発生しました: {e}"
+        return [answer for answer in answers if answer] or "ローカルモデルの応答が空でした。"
+
+    def _build_evaluation_prompt(self, question, answer_text: str) -> str:
+        return EVALUATION_INSTRUCTION + f"\n\n【お題】{question.question_text}\n【回答】{answer_text}"
+
+    def _parse_evaluation(self, raw_text: str) -> dict | str:
+        if raw_text.startswith('```json') and raw_text.endswith('```'):
+            raw_text = raw_text.strip('```json').strip('```').strip()
+        try:
+            data = json.loads(raw_text)
+        except json.JSONDecodeError:
+            return "ローカルモデルの応答が不正です。JSON形式で出力されていません。"
+        if not isinstance(data, dict) or 'score' not in data or 'comment' not in data:
+            return "ローカルモデルの応答構造が不正です: scoreまたはcommentがありません。"
+        try:
+            return {"score": int(data['score']), "comment": str(data['comment'])}
+        except (TypeError, ValueError):
+            return "ローカルモデルの応答構造が不正です: scoreが整数ではありません。"
+
+    def score_answers(self, question, answer_texts: list[str]) -> list[float] | str:
+        """
+        回答の候補を1回の forward でまとめて採点する (講評を生成しない)。
+        採点のプロンプトに続けて応答の書き出し '{"score": ' までを入力し、次のトークンが点数 (1〜5) の
+        それぞれである確率から点数の期待値を求める。候補ごとに採点結果を生成するよりずっと速い。
+        """
+        import torch
+
+        try:
+            model, tokenizer, lock = load_local_model(self.model_path)
+            chat_prompts = [
+                tokenizer.apply_chat_template(
+                    [{"role": "user", "content": self._build_evaluation_prompt(question, answer_text)}],
+                    tokenize=False, add_generation_prompt=True,
+                ) + SCORE_RESPONSE_PREFIX
+                for answer_text in answer_texts
+            ]
+            inputs = tokenizer(
+                chat_prompts, return_tensors='pt', padding=True, padding_side='left', add_special_tokens=False
+            )
+            # 左側をパディングした行も位置がずれないよう、position_ids を attention_mask から求める
+            position_ids = (inputs['attention_mask'].cumsum(-1) - 1).clamp(min=0)
+            score_token_ids = [tokenizer.encode(str(score), add_special_tokens=False)[-1] for score in SCORE_VALUES]
+            with lock, torch.inference_mode():
+                logits = model(**inputs, position_ids=position_ids, logits_to_keep=1).logits[:, -1, score_token_ids]
+            probabilities = torch.softmax(logits.float(), dim=-1)
+            scores = probabilities @ torch.tensor(SCORE_VALUES, dtype=torch.float32)
+        except Exception as e:
+            logger.error(f"ローカルモデルでの回答候補の採点に失敗しました: {e}", exc_info=True)
+            return f"予期せぬエラーが発生しました: {e}"
+        return scores.tolist()
+
+    def evaluate_answer(self, question, answer_text: str) -> dict | str:
+        try:
+            raw_text = self._generate(self._build_evaluation_prompt(question, answer_text))[0]
+        except Exception as e:
+            logger.error(f"ローカルモデルでの採点に失敗しました: {e}", exc_info=True)
+            return f"予期せぬエラーが発生しました: {e}"
+        return self._parse_evaluation(raw_text)
+
+    def evaluate_answer_streaming(self, question, answer_text: str, on_partial) -> dict | str:
+        def on_text(index, text):
+            comment = partial_string_value(text, 'comment')
+            if comment:
+                on_partial(comment)
+
+        try:
+            raw_text = self._generate(
+                self._build_evaluation_prompt(question, answer_text), streamer_callbacks={'on_text': on_text}
+            )[0]
+        except Exception as e:
+            logger.error(f"ローカルモデルでの採点に失敗しました: {e}", exc_info=True)
+            return f"予期せぬエラーが発生しました: {e}"
+        return self._parse_evaluation(raw_text)
+
+
+class LocalServerBackend(LocalModelBackend):
+    """
+    run_inference_server コマンドで常駐させた推論サーバーに、HTTPで推論を依頼するバックエンド。
+    モデルは推論サーバーのプロセスだけが読み込み、Webプロセスや採点ワーカーはそれを共有する
+    (同時に届いたリクエストはサーバー側でまとめて推論される)。
+    推論サーバーは生成し終えてから応答を返すため、ストリーミング版のメソッドは LLMBackend の既定の実装
+    (生成し終えてからまとめて返す) を使う。
+    """
+    astream_questions = LLMBackend.astream_questions
+    evaluate_answer_streaming = LLMBackend.evaluate_answer_streaming
+    # 推論サーバーは生成しかできないため、候補の採点も evaluate_answers_batch で行う
+    score_answers = LLMBackend.score_answers
+
+    def __init__(self, server_url: str | None = None, socket_path: str | None = None):
+        super().__init__()
+        self.server_url = settings.LOCAL_INFERENCE_SERVER_URL if server_url is None else server_url
+        self.socket_path = settings.LOCAL_INFERENCE_SERVER_SOCKET if socket_path is None else socket_path
+        self._client = None
+
+    def _get_client(self) -> httpx.Client:
+        if self._client is None:
+            # LOCAL_INFERENCE_SERVER_SOCKET が設定されている場合はUnixソケットで接続する
+            transport = httpx.HTTPTransport(uds=self.socket_path) if self.socket_path else None
+            self._client = httpx.Client(
+                base_url=self.server_url, transport=transport, timeout=settings.LOCAL_INFERENCE_SERVER_TIMEOUT
+            )
+        return self._client
+
+    def _generate(self, prompt: str, count: int = 1, max_time: float | None = None) -> list[str]:
+        # 推論サーバーの生成は途中で打ち切れないため max_time は使わない (LOCAL_INFERENCE_SERVER_TIMEOUT で待つ)
+        response = self._get_client().post('/generate', json={
+            'prompt': prompt,
+            'max_new_tokens': self.max_new_tokens,
+            'temperature': self.temperature,
+            'num_return_sequences': count,
+        })
+        if response.status_code != 200:
+            try:
+                error = response.json().get('error')
+            except ValueError:
+                # プロキシなどが返したJSONでない応答 (502のHTMLなど) は本文をそのまま使う
+                error = response.text
+            raise RuntimeError(f"推論サーバーのエラー ({response.status_code}): {error}")
+        return response.json()['texts']
+
+    def evaluate_answers_batch(self, question, answers: list[tuple[int, str]]) -> dict[int, dict] | str:
+        """
+        回答を1件ずつ並行して推論サーバーに送る。同時に届いたリクエストは推論サーバーで1つのバッチにまとめて推論される。
+        """
+        if not answers:
+            return {}
+        # HTTPクライアントをスレッドから同時に作らないよう、先に作っておく
+        self._get_client()
+        with ThreadPoolExecutor(max_workers=min(len(answers), settings.LOCAL_INFERENCE_MAX_BATCH_SIZE)) as executor:
+            results = executor.map(lambda answer: self.evaluate_answer(question, answer[1]), answers)
+            return {
+                answer_id: evaluation_result
+                for (answer_id, _), evaluation_result in zip(answers, results)
+                if isinstance(evaluation_result, dict)
+            }
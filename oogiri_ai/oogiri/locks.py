@@ -0,0 +1,37 @@
+# oogiri/locks.py
+"""
+DBの一意制約を使ったプロセス間のロック (ProcessLock)。
+
+Djangoのキャッシュの add はキャッシュのバックエンドによっては原子的でない (FileBasedCache は存在を確かめてから書き込む)
+ため、複数のプロセスが同時に「取れた」ことになる。ここではロックの名前を一意制約にした行を挿入し、挿入できたものだけが
+ロックを取れたことにする。持ち主が解放せずに落ちた場合に備えて、timeout 秒を過ぎたロックは他のものが取り直せる。
+"""
+import uuid
+from datetime import timedelta
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import ProcessLock
+
+
+def acquire_lock(name: str, timeout: float) -> str | None:
+    """
+    ロックを取り、解放に使うトークンを返す。他のものが持っている場合は待たずに None を返す。
+    """
+    now = timezone.now()
+    # 期限の切れたロック (持ち主が落ちた場合など) は消してから取り直す
+    ProcessLock.objects.filter(name=name, expires_at__lte=now).delete()
+    token = uuid.uuid4().hex
+    try:
+        with transaction.atomic():
+            ProcessLock.objects.create(name=name, token=token, expires_at=now + timedelta(seconds=timeout))
+    except IntegrityError:
+        return None
+    return token
+
+
+def release_lock(name: str, token: str) -> None:
+    """
+    acquire_lock で取ったロックを解放する (期限が切れて他のものが取り直したロックは消さない)。
+    """
+    ProcessLock.objects.filter(name=name, token=token).delete()
+
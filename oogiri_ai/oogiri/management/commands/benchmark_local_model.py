@@ -0,0 +1,169 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from oogiri.llm_backends import (
+    LOCAL_MODEL_DTYPES, PrefixKVCache, build_answer_task_prompt, cpu_supports_bf16, load_local_model,
+)
+
+# local_inference/local_inference.py と同じ、回答生成タスクの入力
+BENCHMARK_QUESTION = "ついに判明した、トナカイの角が毎年落ちる理由とは？"
+BENCHMARK_SOURCE_TITLE = "北海道でシカの角拾いブーム"
+
+
+def _resident_memory_mb() -> float:
+    """
+    現在の常駐メモリ (RSS) をMBで返す。/proc が無い環境では最大RSSで代用する。
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS はバイト、Linux はKB単位
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+
+class Command(BaseCommand):
+    help = (
+        'ローカルモデルの推論モード (fp32 / bf16 / int8, torch.compile) ごとに、読み込み時間・メモリ・初回トークンまでの時間'
+        ' (指示文までの past_key_values を使い回した場合も)・生成速度を計測します。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', nargs='+', choices=LOCAL_MODEL_DTYPES, default=list(LOCAL_MODEL_DTYPES),
+                            help='計測する推論モード')
+        parser.add_argument('--compile', action='store_true', help='各モードを torch.compile した場合も計測する')
+        parser.add_argument('--threads', type=int, default=None, help='推論に使うCPUのスレッド数。既定値は LOCAL_MODEL_THREADS')
+        parser.add_argument('--max-new-tokens', type=int, default=50, help='1回の生成で生成するトークン数')
+        parser.add_argument('--runs', type=int, default=3, help='計測する生成の回数 (初回のウォームアップは含めない)')
+        parser.add_argument('--model-path', default=None, help='モデルのフォルダ。既定値は LOCAL_MODEL_PATH')
+        # 1つのモードを計測し、結果をJSONで出力する (メモリを正しく測るため、モードごとに別プロセスで実行する)
+        parser.add_argument('--single', default=None, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['single']:
+            dtype, compile = options['single'].split(':')
+            result = self._measure(dtype, compile == 'compile', options)
+            self.stdout.write(json.dumps(result))
+            return
+
+        configurations = [(dtype, False) for dtype in options['modes']]
+        if options['compile']:
+            configurations += [(dtype, True) for dtype in options['modes']]
+
+        self.stdout.write(self.style.NOTICE(
+            f"回答生成のプロンプトで {options['runs']}回 × {options['max_new_tokens']}トークンを生成します"
+        ))
+        self.stdout.write(
+            f"{'モード':<14}{'読み込み(秒)':>12}{'メモリ(MB)':>12}{'初回トークン(ms)':>18}"
+            f"{'共通部分キャッシュ時(ms)':>24}{'トークン/秒':>12}"
+        )
+        for dtype, compile in configurations:
+            label = f"{dtype}{'+compile' if compile else ''}"
+            command = [
+                sys.executable, str(settings.BASE_DIR / 'manage.py'), 'benchmark_local_model', '--single', f"{dtype}:{'compile' if compile else 'eager'}",
+                '--max-new-tokens', str(options['max_new_tokens']), '--runs', str(options['runs']),
+            ]
+            if options['threads'] is not None:
+                command += ['--threads', str(options['threads'])]
+            if options['model_path']:
+                command += ['--model-path', options['model_path']]
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                self.stdout.write(self.style.ERROR(f"{label:<14}計測に失敗しました: {completed.stderr.strip().splitlines()[-1:]}"))
+                continue
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            prefix_first_token = result['prefix_first_token_ms']
+            self.stdout.write(
+                f"{label + (' (fp32)' if result['dtype'] != dtype else ''):<14}{result['load_seconds']:>12.1f}"
+                f"{result['memory_mb']:>12.0f}{result['first_token_ms']:>18.0f}"
+                f"{'-' if prefix_first_token is None else f'{prefix_first_token:.0f}':>24}"
+                f"{result['tokens_per_second']:>12.1f}"
+            )
+
+    def _measure(self, dtype, compile, options):
+        import torch
+        from transformers.generation.streamers import BaseStreamer
+
+        class TimingStreamer(BaseStreamer):
+            """
+            generate() から渡されるトークンの時刻を記録する (最初の put はプロンプト)。
+            """
+
+            def __init__(self):
+                self.first_token_at = None
+                self.tokens = 0
+                self._prompt_received = False
+
+            def put(self, value):
+                if not self._prompt_received:
+                    self._prompt_received = True
+                    return
+                if self.first_token_at is None:
+                    self.first_token_at = time.perf_counter()
+                self.tokens += value.numel()
+
+            def end(self):
+                pass
+
+        model_path = options['model_path'] or settings.LOCAL_MODEL_PATH
+        memory_before = _resident_memory_mb()
+        started = time.perf_counter()
+        model, tokenizer, _ = load_local_model(model_path, dtype=dtype, compile=compile, threads=options['threads'])
+        load_seconds = time.perf_counter() - started
+        memory_mb = _resident_memory_mb() - memory_before
+
+        chat_prompt = tokenizer.apply_chat_template(
+            [{"role": "user", "content": build_answer_task_prompt(BENCHMARK_QUESTION, BENCHMARK_SOURCE_TITLE)}],
+            tokenize=False, add_generation_prompt=True,
+        )
+        inputs = tokenizer(chat_prompt, return_tensors='pt', add_special_tokens=False)
+        # 指示文までの past_key_values (トークンの区切りが合わない場合は None)
+        prefix = PrefixKVCache(model, tokenizer, max_entries=1).lookup(chat_prompt, inputs['input_ids'][0].tolist())
+
+        def generate(use_prefix=False):
+            streamer = TimingStreamer()
+            started = time.perf_counter()
+            with torch.inference_mode():
+                # 指示文までの past_key_values の複製も、初回トークンまでの時間に含める
+                cache_kwargs = {'past_key_values': PrefixKVCache.expand(prefix[1], 1)} if use_prefix else {}
+                # トークン数を揃えるため、終了トークンが出ても max_new_tokens まで生成する
+                model.generate(
+                    **inputs, **cache_kwargs, streamer=streamer, do_sample=False,
+                    max_new_tokens=options['max_new_tokens'], min_new_tokens=options['max_new_tokens'],
+                    pad_token_id=tokenizer.eos_token_id,
+                )
+            finished = time.perf_counter()
+            # 生成速度は初回トークンより後 (デコード) のトークン数と時間で計算する
+            return (
+                (streamer.first_token_at - started) * 1000,
+                (streamer.tokens - 1) / (finished - streamer.first_token_at),
+            )
+
+        if options['runs'] < 1:
+            raise CommandError("--runs は1以上にしてください。")
+        # 初回はウォームアップ (torch.compile のコンパイルなど) として計測しない
+        generate()
+        measurements = [generate() for _ in range(options['runs'])]
+        prefix_measurements = [generate(use_prefix=True) for _ in range(options['runs'])] if prefix else []
+        return {
+            # bf16 に対応していないCPUでは fp32 で読み込まれる
+            'dtype': 'fp32' if dtype == 'bf16' and not cpu_supports_bf16() else dtype,
+            'load_seconds': load_seconds,
+            'memory_mb': memory_mb,
+            'first_token_ms': statistics.median(first_token for first_token, _ in measurements),
+            'prefix_first_token_ms': (
+                statistics.median(first_token for first_token, _ in prefix_measurements) if prefix_measurements else None
+            ),
+            'tokens_per_second': statistics.median(speed for _, speed in measurements),
+        }
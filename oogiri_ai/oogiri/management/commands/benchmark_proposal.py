@@ -0,0 +1,145 @@
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import override_settings
+from django.test.utils import setup_databases, teardown_databases
+from oogiri.services import NewsService, GeminiService
+from oogiri.stubs import StubAPIServer
+
+# 計測ではプロセス内のキャッシュを使う (共有のキャッシュにスタブのヘッドラインを保存したり、消したりしない)
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class Command(BaseCommand):
+    help = 'ローカルのスタブAPIサーバーを使い、お題生成パイプラインの同期版と非同期版のスループットを比較します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='各モードで処理するお題生成リクエスト数')
+        parser.add_argument('--workers', type=int, default=4, help='同期版のワーカー数 (WSGIワーカー数に相当)')
+        parser.add_argument('--concurrency', type=int, default=200, help='非同期版の同時実行数の上限')
+        parser.add_argument('--news-latency', type=float, default=0.5, help='スタブNewsAPIの応答遅延 (秒)')
+        parser.add_argument('--gemini-latency', type=float, default=1.0, help='スタブGeminiの応答遅延 (秒)')
+        parser.add_argument('--theme', default='政治')
+        parser.add_argument(
+            '--stream', action='store_true',
+            help='非同期版に加えて、ストリーミング版 (お題が1つ揃うごとに受け取る) の最初のお題までの時間も計測する',
+        )
+
+    def handle(self, *args, **options):
+        # スタブのニュースタイトル (NewsHeadline) やロックは使い捨てのDBに保存し、実行後に削除する
+        with tempfile.TemporaryDirectory() as directory, override_settings(CACHES=LOCMEM_CACHES):
+            old_config = self._setup_throwaway_databases(directory)
+            try:
+                self._benchmark(options)
+            finally:
+                teardown_databases(old_config, verbosity=0)
+
+    def _setup_throwaway_databases(self, directory):
+        for alias in connections:
+            settings_dict = connections[alias].settings_dict
+            if settings_dict['ENGINE'] == 'django.db.backends.sqlite3':
+                # SQLite のテスト用DBは既定でメモリ上 (スレッド間で同時に書き込めない) のため、一時ファイルにする
+                settings_dict['TEST']['NAME'] = os.path.join(directory, f'{alias}.sqlite3')
+        return setup_databases(verbosity=0, interactive=False)
+
+    def _benchmark(self, options):
+        with StubAPIServer(news_latency=options['news_latency'], gemini_latency=options['gemini_latency']) as stub:
+            # settings と NewsApiClient (同期版) の接続先をスタブサーバーに向ける
+            with override_settings(
+                NEWS_API_KEY='stub', GEMINI_API_KEY='stub',
+                NEWS_API_BASE_URL=f'{stub.base_url}/v2', GEMINI_API_BASE_URL=stub.base_url,
+            ), mock.patch('newsapi.const.EVERYTHING_URL', f'{stub.base_url}/v2/everything'):
+
+                self.stdout.write(self.style.NOTICE(
+                    f"スタブサーバー: {stub.base_url} (NewsAPI {options['news_latency']}秒 / Gemini {options['gemini_latency']}秒)"
+                ))
+
+                # ヘッドラインキャッシュ (計測用のプロセス内のキャッシュ) を空にし、両モードともキャッシュが無い状態から計測する
+                cache.clear()
+                sync_elapsed, sync_latencies = self._run_sync(options)
+                self._report(f"同期版 (workers={options['workers']})", options['requests'], sync_elapsed, sync_latencies)
+
+                cache.clear()
+                async_elapsed, async_latencies = asyncio.run(self._run_async(options))
+                self._report(f"非同期版 (concurrency={options['concurrency']})", options['requests'], async_elapsed, async_latencies)
+
+                if options['stream']:
+                    cache.clear()
+                    stream_elapsed, first_latencies, stream_latencies = asyncio.run(self._run_stream(options))
+                    self._report(f"ストリーミング版 (concurrency={options['concurrency']})", options['requests'],
+                                 stream_elapsed, stream_latencies)
+                    self.stdout.write(
+                        f"  最初のお題が届くまで: p50 {statistics.median(first_latencies):.2f}秒 "
+                        f"(3つ揃うまで p50 {statistics.median(stream_latencies):.2f}秒)"
+                    )
+
+                self.stdout.write(f"スタブへのリクエスト数: {stub.request_counts}")
+                self.stdout.write(self.style.SUCCESS(f"スループット比 (非同期/同期): {sync_elapsed / async_elapsed:.1f}倍"))
+
+    def _run_sync(self, options):
+        theme = options['theme']
+
+        def generate_once(_):
+            started = time.perf_counter()
+            headlines = NewsService().get_recent_headlines(theme)
+            result = GeminiService().generate_questions(headlines, theme=theme)
+            if isinstance(result, str):
+                raise RuntimeError(result)
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            latencies = list(executor.map(generate_once, range(options['requests'])))
+        return time.perf_counter() - started, latencies
+
+    async def _run_async(self, options):
+        theme = options['theme']
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def generate_once():
+            async with semaphore:
+                started = time.perf_counter()
+                headlines = await NewsService().aget_recent_headlines(theme)
+                result = await GeminiService().agenerate_questions(headlines, theme=theme)
+                if isinstance(result, str):
+                    raise RuntimeError(result)
+                return time.perf_counter() - started
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(generate_once() for _ in range(options['requests'])))
+        return time.perf_counter() - started, latencies
+
+    async def _run_stream(self, options):
+        theme = options['theme']
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def generate_once():
+            async with semaphore:
+                started = time.perf_counter()
+                first_latency = None
+                headlines = await NewsService().aget_recent_headlines(theme)
+                async for _ in GeminiService().astream_questions(headlines, theme=theme):
+                    if first_latency is None:
+                        first_latency = time.perf_counter() - started
+                return first_latency, time.perf_counter() - started
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(generate_once() for _ in range(options['requests'])))
+        elapsed = time.perf_counter() - started
+        return elapsed, [first for first, _ in results], [total for _, total in results]
+
+    def _report(self, label, count, elapsed, latencies):
+        latencies = sorted(latencies)
+        p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+        self.stdout.write(
+            f"{label}: {count}件 / {elapsed:.2f}秒 = {count / elapsed:.1f} req/s "
+            f"(p50 {statistics.median(latencies):.2f}秒, p95 {p95:.2f}秒)"
+        )
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from oogiri.models import THEMES
+from oogiri.query_plans import drop_model_indexes, hot_queries, query_plan, seed_synthetic_data, time_query
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = '合成データを使い、Few-shotの事例や管理画面の一覧などのクエリの実行時間をインデックスの有無で比べます。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--questions', type=int, default=20000, help='合成データのお題の数')
+        parser.add_argument('--answers-per-question', type=int, default=10, help='お題ごとの回答の数')
+        parser.add_argument('--repeat', type=int, default=5, help='クエリごとの計測回数 (最も速かった回を表示する)')
+        parser.add_argument('--plans', action='store_true', help='インデックスがある場合の実行計画も表示する')
+
+    def handle(self, *args, **options):
+        # 合成データとインデックスの削除は1つのトランザクションの中で行い、最後にロールバックしてDBを元に戻す
+        try:
+            with transaction.atomic():
+                self.stdout.write(
+                    f"合成データを作成しています (お題 {options['questions']}件、"
+                    f"回答 {options['questions'] * options['answers_per_question']}件)..."
+                )
+                users = seed_synthetic_data(options['questions'], options['answers_per_question'])
+                queries = hot_queries(THEMES[0], users[0].id)
+
+                with_indexes = {}
+                for name, (queryset, index_name) in queries.items():
+                    with_indexes[name] = time_query(queryset, options['repeat'])
+                    if options['plans']:
+                        self.stdout.write(f"{name} ({index_name}):\n{query_plan(queryset)}")
+
+                drop_model_indexes()
+                if connection.vendor == 'sqlite':
+                    with connection.cursor() as cursor:
+                        cursor.execute('ANALYZE')
+                without_indexes = {
+                    name: time_query(queryset, options['repeat']) for name, (queryset, _) in queries.items()
+                }
+                raise _Rollback
+        except _Rollback:
+            pass
+
+        self.stdout.write(f"{'クエリ':<27}{'インデックス無し':>8}{'インデックス有り':>8}{'速さ':>7}")
+        for name in queries:
+            before, after = without_indexes[name], with_indexes[name]
+            self.stdout.write(
+                f"{name:<30}{before * 1000:>14.2f}ms{after * 1000:>14.2f}ms{before / max(after, 1e-9):>9.1f}x"
+            )
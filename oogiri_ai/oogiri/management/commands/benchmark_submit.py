@@ -0,0 +1,146 @@
+import io
+import itertools
+import random
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import Client, override_settings
+from django.urls import reverse
+from oogiri.evaluation_cache import evaluation_cache_stats, make_cache_key
+from oogiri.models import Answer, EvaluationCacheEntry, EvaluationJob, Question
+from oogiri.prompt_cache import prompt_cache_stats
+from oogiri.services import GeminiService
+from oogiri.stubs import StubAPIServer
+
+
+class Command(BaseCommand):
+    help = '複数ユーザーが同時に回答を送信したときの送信レイテンシを、スタブのGeminiを使って計測します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help='同時に回答を送信するユーザー数')
+        parser.add_argument('--submissions', type=int, default=5, help='1ユーザーあたりの送信回数')
+        parser.add_argument('--gemini-latency', type=float, default=1.0, help='スタブGeminiの応答遅延 (秒)')
+        parser.add_argument('--inline', action='store_true', help='比較用に、送信時にその場で採点する従来方式も計測する')
+        parser.add_argument('--drain', action='store_true', help='送信後に採点ワーカーでキューを処理し、処理時間も計測する')
+        parser.add_argument('--workers', type=int, default=4, help='--drain で使う採点ワーカーのスレッド数')
+        parser.add_argument('--batch-size', type=int, default=None, help='--drain で使う採点ワーカーのまとめ採点の件数')
+        parser.add_argument(
+            '--duplicates', type=float, default=0.0,
+            help='同じ回答 (採点結果キャッシュに当たる回答) を送る割合 (0〜1)',
+        )
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        users = [
+            User.objects.create_user(f'benchmark-{i}@example.com', f'benchmark-{i}', password=None)
+            for i in range(options['users'])
+        ]
+        # 実行ごとにお題の文面を変え、前回の計測で保存された採点結果キャッシュに当たらないようにする
+        question = Question.objects.create(theme='ベンチマーク', question_text=f'ベンチマーク用のお題 {uuid.uuid4()}')
+        serial = itertools.count()
+        answer_texts = set()
+
+        def next_answer_text():
+            if random.random() < options['duplicates']:
+                answer_text = 'ベンチマーク用の定番の回答'
+            else:
+                answer_text = f'ベンチマーク用の回答{next(serial)}'
+            answer_texts.add(answer_text)
+            return answer_text
+
+        try:
+            with StubAPIServer(gemini_latency=options['gemini_latency']) as stub, override_settings(
+                GEMINI_API_KEY='stub', GEMINI_API_BASE_URL=stub.base_url, ALLOWED_HOSTS=['testserver'],
+                LLM_BACKENDS={**settings.LLM_BACKENDS, 'evaluation': 'gemini'},
+            ):
+                self.stdout.write(self.style.NOTICE(
+                    f"ユーザー {options['users']}人 × {options['submissions']}回 / スタブGemini {options['gemini_latency']}秒"
+                ))
+
+                if options['inline']:
+                    elapsed, latencies = self._run(
+                        users, options, lambda user: self._submit_inline(user, question, next_answer_text())
+                    )
+                    self._report('従来方式 (送信時に採点)', elapsed, latencies)
+
+                url = reverse('oogiri:answer_input', kwargs={'question_id': question.id})
+                elapsed, latencies = self._run(users, options, lambda user: self._submit_queued(user, url, next_answer_text()))
+                self._report('キュー方式 (送信後に採点)', elapsed, latencies)
+
+                if options['drain']:
+                    started = time.perf_counter()
+                    # 計測用のお題の回答だけを採点する (他のユーザーの回答をスタブで採点しない)
+                    call_command('run_evaluation_worker', concurrency=options['workers'], burst=True,
+                                 batch_size=options['batch_size'], question=question.id, stdout=io.StringIO())
+                    drained = time.perf_counter() - started
+                    scored = EvaluationJob.objects.filter(
+                        answer__question=question, status=EvaluationJob.Status.DONE
+                    ).count()
+                    self.stdout.write(
+                        f"採点ワーカー (スレッド {options['workers']}): {scored}件 / {drained:.2f}秒 = {scored / drained:.1f} 件/秒"
+                    )
+                stats = evaluation_cache_stats()
+                self.stdout.write(f"採点結果キャッシュ: ヒット {stats['hits']}回, ミス {stats['misses']}回 (累計)")
+                prompt_stats = prompt_cache_stats()
+                self.stdout.write(
+                    f"プロンプトキャッシュ: 入力 {prompt_stats['prompt_tokens']}トークン中 "
+                    f"{prompt_stats['cached_tokens']}トークンをキャッシュで処理 (累計)"
+                )
+                self.stdout.write(f"スタブへのリクエスト数: {stub.request_counts}")
+        finally:
+            # 計測用のユーザー・お題・回答 (と採点ジョブ、採点結果キャッシュ) を削除する
+            EvaluationCacheEntry.objects.filter(
+                key__in=[make_cache_key(question.question_text, answer_text) for answer_text in answer_texts]
+            ).delete()
+            question.delete()
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+    def _run(self, users, options, submit):
+        def run_user(user):
+            try:
+                return [submit(user) for _ in range(options['submissions'])]
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(users)) as executor:
+            latencies = [latency for result in executor.map(run_user, users) for latency in result]
+        return time.perf_counter() - started, latencies
+
+    def _submit_queued(self, user, url, answer_text):
+        client = Client()
+        client.force_login(user)
+        started = time.perf_counter()
+        response = client.post(url, {'answer_text': answer_text})
+        latency = time.perf_counter() - started
+        if response.status_code != 302:
+            raise RuntimeError(f'回答の送信に失敗しました: {response.status_code}')
+        return latency
+
+    def _submit_inline(self, user, question, answer_text):
+        # キュー導入前の AnswerInputView.post と同じく、採点してから回答を保存する
+        started = time.perf_counter()
+        evaluation_result = GeminiService().evaluate_answer(question=question, answer_text=answer_text)
+        if isinstance(evaluation_result, str):
+            raise RuntimeError(evaluation_result)
+        Answer.objects.create(
+            user=user, question=question, answer_text=answer_text,
+            score=evaluation_result['score'], review_text=evaluation_result['comment'],
+        )
+        return time.perf_counter() - started
+
+    def _report(self, label, elapsed, latencies):
+        latencies = sorted(latencies)
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        self.stdout.write(
+            f"{label}: {len(latencies)}件 / {elapsed:.2f}秒 = {len(latencies) / elapsed:.1f} 件/秒 "
+            f"(送信レイテンシ p50 {statistics.median(latencies) * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms, "
+            f"最大 {latencies[-1] * 1000:.0f}ms)"
+        )
@@ -0,0 +1,39 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from oogiri.models import Question, QuestionFingerprint
+from oogiri.question_dedup import index_questions
+
+
+class Command(BaseCommand):
+    help = '保存済みのお題を、生成したお題の重複判定 (oogiri/question_dedup.py) のインデックスに登録します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='1回のトランザクションで登録するお題の数')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='登録済みのハッシュを全て消してから登録し直す (MinHash の設定を変えた場合)')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['rebuild']:
+            QuestionFingerprint.objects.all().delete()
+
+        # 登録済みのお題 (新しく生成・作成したお題) は飛ばし、IDの順に少しずつ登録する
+        last_id = 0
+        indexed = 0
+        while True:
+            with transaction.atomic():
+                questions = list(
+                    Question.objects.filter(id__gt=last_id, fingerprints__isnull=True)
+                    .order_by('id').only('id', 'theme', 'question_text')[:options['batch_size']]
+                )
+                if not questions:
+                    break
+                index_questions(questions)
+            last_id = questions[-1].id
+            indexed += len(questions)
+            self.stdout.write(f"{indexed}件を登録しました (ID {last_id} まで)")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"SUCCESS: {indexed}件のお題を登録しました。 ({time.perf_counter() - started:.1f}秒)"
+        ))
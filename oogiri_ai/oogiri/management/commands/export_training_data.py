@@ -1,93 +1,83 @@
-import json
-import os
-from django.core.management.base import BaseCommand
+import time
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from oogiri.models import Answer, Question # Questionもimport
+from oogiri.training_data import COMPRESSIONS, export_training_data
 from pathlib import Path
 
 class Command(BaseCommand):
     help = 'ファインチューニング用の大喜利データ（JSONL形式）を出力します。'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--output', type=Path, default=None,
+                            help='出力先のファイル (既定は TRAINING_DATA_ROOT/oogiri_multitask_training_data.jsonl)')
+        parser.add_argument('--incremental', action='store_true',
+                            help='前回の書き出し以降に追加された行と「特に面白い」が付けられた行だけを、新しいファイルに書き出す')
+        parser.add_argument('--compression', choices=list(COMPRESSIONS), default='none', help='出力の圧縮形式')
+        parser.add_argument('--shards', type=int, default=1, help='出力を分けるファイルの数')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='DBから1回に読み込む件数')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='サンプルの組み立てを並行して行うプロセスの数 (1 のときはこのプロセスだけで行う)')
+        parser.add_argument('--validation', type=float, default=0.0, help='validation に分けるサンプルの割合 (0〜1)')
+        parser.add_argument('--test', type=float, default=0.0, help='test に分けるサンプルの割合 (0〜1)')
+        parser.add_argument('--max-per-task', type=int, default=None, help='タスクごとのサンプル数の上限 (超える分は間引く)')
+        parser.add_argument('--max-per-theme', type=int, default=None,
+                            help='タスクごと・テーマごとのサンプル数の上限 (超える分は間引く)')
+        parser.add_argument('--progress-every', type=int, default=10000, help='この件数ごとに進み具合を表示する (0 で表示しない)')
+
     def handle(self, *args, **options):
-        
+
         # 1. 出力パスの確認とディレクトリの作成
-        output_dir = settings.TRAINING_DATA_ROOT
+        output_path = options['output'] or settings.TRAINING_DATA_ROOT / 'oogiri_multitask_training_data.jsonl'
+        output_dir = output_path.parent
         if not output_dir.exists():
             # ディレクトリが存在しない場合は作成
             output_dir.mkdir(parents=True, exist_ok=True)
             self.stdout.write(self.style.NOTICE(f"ディレクトリを作成しました: {output_dir}"))
-            
-        output_filename = 'oogiri_multitask_training_data.jsonl'
-        output_path = output_dir / output_filename
-        
-        training_data = []
-        
-        # 2. 【タスク 1: 回答生成】: Answerモデルから模範回答を抽出
-        excellent_answers = Answer.objects.filter(is_excellent_answer=True).select_related('question')
 
-        # Instruction: 回答タスク用
-        answer_instruction = "あなたはプロの大喜利回答者です。以下の情報に基いて、最高の面白さの回答を一つ生成してください。"
-        
-        for answer in excellent_answers:
-            question = answer.question
-            user_input_text = f"\n\n【お題】{question.question_text}"
-            if question.source_title:
-                user_input_text += f"\n【背景ニュース】{question.source_title}"
-            
-            # JSONLデータポイント: 回答タスク
-            data_point = {
-                "messages": [
-                    {"role": "user", "content": answer_instruction + user_input_text},
-                    {"role": "assistant", "content": answer.answer_text}
-                ]
-            }
-            training_data.append(json.dumps(data_point, ensure_ascii=False))
+        # 2. 回答生成タスクとお題生成タスクの学習データを、DBから少しずつ読みながら1件ずつ書き出す
+        # (全件をメモリに載せないため、Answerが増えてもメモリの使用量は変わらない)
+        progress_every = options['progress_every']
+        started = time.perf_counter()
 
-            # training_data.append(json.dumps([
-            #     {"role": "user", "content": answer_instruction + user_input_text},
-            #     {"role": "assistant", "content": answer.answer_text}
-            # ], ensure_ascii=False))
+        def report_progress(total):
+            if progress_every and total % progress_every == 0:
+                self.stdout.write(f"{total}件 ({total / (time.perf_counter() - started):.0f} 件/秒)")
 
+        try:
+            result = export_training_data(
+                output_path, incremental=options['incremental'], shards=options['shards'],
+                compression=options['compression'], chunk_size=options['chunk_size'], workers=options['workers'],
+                split_ratios={'validation': options['validation'], 'test': options['test']},
+                max_per_task=options['max_per_task'], max_per_theme=options['max_per_theme'],
+                on_progress=report_progress,
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f'ERROR: ファイル書き出し中にエラーが発生しました: {e}'))
+            return
 
-        # 3. 【タスク 2: お題生成】: Questionモデルから特に面白いお題を抽出
-        # Instruction: お題タスク用
-        question_instruction = "あなたはプロの大喜利クリエイターです。与えられたニュースタイトルを参考に、それにインスパイアされた、秀逸で面白い大喜利のお題を一つ生成してください。"
-        
-        # is_excellent=True (品質の良いお題) かつ source_title (元ネタ) があるものに絞る
-        excellent_questions = Question.objects.filter(is_excellent=True, source_title__isnull=False).exclude(source_title="")
-
-        for question in excellent_questions:
-            # 元ネタのニュースがない場合はスキップ (お題生成タスクとして成立しないため)
-            if not question.source_title:
-                continue
-                
-            user_input_text = f"\n\n【背景ニュース】{question.source_title}"
-            
-            # JSONLデータポイント: お題タスク
-            data_point = {
-                "messages": [
-                    {"role": "user", "content": question_instruction + user_input_text},
-                    {"role": "assistant", "content": question.question_text}
-                ]
-            }
-            training_data.append(json.dumps(data_point, ensure_ascii=False))
-            # training_data.append(json.dumps([
-            #     {"role": "user", "content": question_instruction + user_input_text},
-            #     {"role": "assistant", "content": question.question_text}
-            # ], ensure_ascii=False))
-            
-        
-        if not training_data:
-            self.stdout.write(self.style.WARNING("WARNING: 'is_excellent'または'is_excellent_answer'にフラグが立っているデータが見つかりませんでした。"))
+        elapsed = time.perf_counter() - started
+        if options['incremental'] and not result['incremental']:
+            self.stdout.write(self.style.NOTICE("前回の書き出しの記録 (マニフェスト) が無いため、全件を書き出しました。"))
+        if result['duplicates']:
+            self.stdout.write(f"重複していた {result['duplicates']}件を除きました。")
+        if result['stats']['dropped']:
+            self.stdout.write(f"件数の上限を超えた {result['stats']['dropped']}件を間引きました。")
+        # 分割・タスクごとの件数 (テーマごとの内訳)
+        for split, tasks in result['stats']['splits'].items():
+            for task, themes in tasks.items():
+                breakdown = ', '.join(f"{theme} {count}" for theme, count in themes.items())
+                self.stdout.write(f"  {split} / {task}: {sum(themes.values())}件 ({breakdown})")
+        if not result['rows']:
+            if result['incremental']:
+                self.stdout.write(self.style.SUCCESS(f'SUCCESS: 前回の書き出し以降に追加されたデータはありません。 ({elapsed:.1f}秒)'))
+            else:
+                # 前回の出力は上書きせずに残す
+                self.stdout.write(self.style.WARNING("WARNING: 'is_excellent'または'is_excellent_answer'にフラグが立っているデータが見つかりませんでした。"))
             return
 
-        # 4. ファイルへの書き出し
-        try:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                # JSONL形式として1行ずつ書き込む（各データポイントはすでにJSON文字列）
-                f.write("\n".join(training_data) + '\n')
-            
-            self.stdout.write(self.style.SUCCESS(f'SUCCESS: {len(training_data)}件のマルチタスクデータを {output_path} に出力しました。'))
-            
-        except Exception as e:
-            self.stdout.write(self.style.ERROR(f'ERROR: ファイル書き出し中にエラーが発生しました: {e}'))
\ No newline at end of file
+        paths = ', '.join(str(output_path.with_name(entry['path'])) for entry in result['files'])
+        self.stdout.write(self.style.SUCCESS(
+            f"SUCCESS: {result['rows']}件のマルチタスクデータを {paths} に出力しました。 ({elapsed:.1f}秒)"
+        ))
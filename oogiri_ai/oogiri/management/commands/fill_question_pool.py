@@ -0,0 +1,70 @@
+import asyncio
+import random
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from oogiri.headline_selection import select_headlines
+from oogiri.models import THEMES
+from oogiri.llm_backends import TASK_QUESTION_GENERATION, get_llm_backend
+from oogiri.question_dedup import agenerate_unique_questions
+from oogiri.services import NewsService, count_pooled_questions, save_generated_questions
+
+
+class Command(BaseCommand):
+    help = 'テーマごとのお題プールを監視し、残りが少なくなったらお題を事前生成して補充し続けます（常駐プロセス）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=30, help='プールの残数を確認する間隔 (秒)')
+        parser.add_argument('--jitter', type=float, default=0.1, help='間隔に加える揺らぎの割合 (0.1 = ±10%%)')
+        parser.add_argument('--low-water', type=int, default=None, help='補充を始める残数。既定値は QUESTION_POOL_LOW_WATER')
+        parser.add_argument('--size', type=int, default=None, help='補充後の目標数。既定値は QUESTION_POOL_SIZE')
+        parser.add_argument('--once', action='store_true', help='全テーマを1回だけ補充して終了する (cron向け)')
+
+    def handle(self, *args, **options):
+        low_water = options['low_water'] if options['low_water'] is not None else settings.QUESTION_POOL_LOW_WATER
+        size = options['size'] if options['size'] is not None else settings.QUESTION_POOL_SIZE
+        self.stdout.write(self.style.NOTICE(
+            f"お題プールの補充を開始します: テーマ {THEMES}, 残り {low_water}件未満で {size}件まで補充"
+        ))
+        try:
+            asyncio.run(self._run(low_water, size, options))
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.NOTICE("補充を終了しました。"))
+
+    async def _run(self, low_water, size, options):
+        # テーマごとに独立したループを並行して回す
+        await asyncio.gather(*(self._fill_loop(theme, low_water, size, options) for theme in THEMES))
+
+    async def _fill_loop(self, theme, low_water, size, options):
+        while True:
+            pooled = await sync_to_async(count_pooled_questions)(theme)
+            if pooled < low_water:
+                await self._fill(theme, pooled, size)
+
+            if options['once']:
+                return
+            await asyncio.sleep(options['interval'] * random.uniform(1 - options['jitter'], 1 + options['jitter']))
+
+    async def _fill(self, theme, pooled, size):
+        news_service = NewsService()
+        # お題生成に使うバックエンド (settings.LLM_BACKENDS で選ぶ)
+        backend = get_llm_backend(TASK_QUESTION_GENERATION)
+
+        while pooled < size:
+            # ヘッドラインはキャッシュ (prefetch_headlines で先読み済み) から取得する
+            headlines = await news_service.aget_recent_headlines(theme)
+            if not headlines:
+                self.stdout.write(self.style.WARNING(f"[{theme}] ニュースタイトルを取得できないため、補充を中断します。"))
+                return
+
+            headlines = await sync_to_async(select_headlines)(headlines, theme)
+            # 既存のお題とほぼ同じお題は除く (足りない分は QUESTION_DEDUP_MAX_RETRIES 回まで生成し直す)
+            result = await agenerate_unique_questions(backend, headlines, theme)
+            if isinstance(result, str):
+                self.stdout.write(self.style.WARNING(f"[{theme}] お題生成に失敗したため、補充を中断します: {result}"))
+                return
+
+            await sync_to_async(save_generated_questions)(None, theme, headlines, result, is_pooled=True)
+            pooled += len(result)
+            self.stdout.write(self.style.SUCCESS(f"[{theme}] {len(result)}件を補充しました (プール残数 {pooled}件)"))
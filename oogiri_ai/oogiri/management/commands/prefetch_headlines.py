@@ -0,0 +1,77 @@
+import asyncio
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from oogiri.models import THEMES
+from oogiri.services import NewsService
+
+
+class Command(BaseCommand):
+    help = '全テーマのニュースタイトルを定期的に取得してキャッシュに保存し続けます（常駐プロセス）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float, default=None,
+            help='取得に成功した後の再取得間隔 (秒)。既定値は NEWS_HEADLINE_CACHE_TTL の半分',
+        )
+        parser.add_argument('--jitter', type=float, default=0.1, help='間隔に加える揺らぎの割合 (0.1 = ±10%%)')
+        parser.add_argument('--retry', type=float, default=30, help='取得に失敗した後の最初の再試行までの秒数')
+        parser.add_argument('--max-backoff', type=float, default=600, help='失敗が続いた場合の再試行間隔の上限 (秒)')
+        parser.add_argument('--max-count', type=int, default=100, help='1テーマあたりの取得件数 (提案画面と同じ値にする)')
+        parser.add_argument('--once', action='store_true', help='全テーマを1回だけ取得して終了する (cron向け)')
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or settings.NEWS_HEADLINE_CACHE_TTL / 2
+        self.stdout.write(self.style.NOTICE(
+            f"ヘッドラインの先読みを開始します: テーマ {THEMES}, 間隔 {interval:.0f}秒"
+        ))
+        try:
+            asyncio.run(self._run(interval, options))
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.NOTICE("先読みを終了しました。"))
+
+    async def _run(self, interval, options):
+        # テーマごとに独立したループを並行して回す (1テーマの失敗やバックオフが他のテーマを遅らせないように)
+        await asyncio.gather(*(self._prefetch_loop(theme, interval, options) for theme in THEMES))
+
+    async def _prefetch_loop(self, theme, interval, options):
+        news_service = NewsService()
+        failures = 0
+
+        while True:
+            started = time.monotonic()
+            try:
+                titles, previous_age = await news_service.arefresh_headlines(theme, max_count=options['max_count'])
+            except Exception as e:
+                # 予期せぬエラーでこのテーマのループが止まらないよう、取得の失敗として扱う (キャッシュの古いデータは残る)
+                self.stdout.write(self.style.ERROR(f"[{theme}] 取得中に予期せぬエラーが発生しました: {e}"))
+                titles, previous_age = [], None
+            elapsed = time.monotonic() - started
+
+            if titles:
+                failures = 0
+                delay = interval
+            else:
+                # 失敗が続くほど再試行の間隔を倍々に延ばす (指数バックオフ)
+                failures += 1
+                delay = min(options['retry'] * 2 ** (failures - 1), options['max_backoff'])
+
+            # 複数プロセスやテーマの取得タイミングが揃わないように揺らぎを加える
+            delay *= random.uniform(1 - options['jitter'], 1 + options['jitter'])
+
+            # 更新直前のデータの経過時間 = リクエストに返していたデータの最大の古さ
+            age_text = '無し' if previous_age is None else f'{previous_age:.0f}秒'
+            message = (
+                f"[{theme}] {len(titles)}件 ({elapsed:.2f}秒) / 更新前のデータの経過時間 {age_text} / "
+                f"連続失敗 {failures}回 / 次回 {delay:.0f}秒後"
+            )
+            if titles:
+                self.stdout.write(self.style.SUCCESS(message))
+            else:
+                self.stdout.write(self.style.WARNING(message))
+
+            if options['once']:
+                return
+            await asyncio.sleep(delay)
@@ -0,0 +1,115 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from oogiri.evaluation_cache import evaluation_cache_stats, evict_evaluation_cache
+from oogiri.jobs import (
+    claim_evaluation_batch, process_evaluation_batch, requeue_stale_jobs, retry_or_fail_evaluation_job,
+)
+from oogiri.llm_backends import TASK_EVALUATION, get_llm_backend
+from oogiri.prompt_cache import prompt_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'DBのキューに登録された回答の採点ジョブを処理し続けます（常駐プロセス）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=None,
+            help='同時に採点するワーカースレッド数。既定値は EVALUATION_WORKER_CONCURRENCY',
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=None,
+            help='キューが空のときに次を確認するまでの秒数。既定値は EVALUATION_WORKER_POLL_INTERVAL',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='同じお題の回答を1回のリクエストでまとめて採点する最大件数 (1でまとめない)。既定値は EVALUATION_BATCH_SIZE',
+        )
+        parser.add_argument(
+            '--batch-window', type=float, default=None,
+            help='まとめる回答が揃うのを待つ最大秒数。既定値は EVALUATION_BATCH_WINDOW',
+        )
+        parser.add_argument('--burst', action='store_true', help='キューが空になったら終了する')
+        parser.add_argument(
+            '--question', type=int, default=None,
+            help='このIDのお題の回答のジョブだけを処理する (計測用。他のジョブの回収とキャッシュの削除も行わない)',
+        )
+
+    def handle(self, *args, **options):
+        concurrency = options['concurrency'] or settings.EVALUATION_WORKER_CONCURRENCY
+        poll_interval = options['poll_interval'] or settings.EVALUATION_WORKER_POLL_INTERVAL
+        self.stdout.write(self.style.NOTICE(f"採点ワーカーを開始します: スレッド数 {concurrency}"))
+
+        threads = [
+            threading.Thread(target=self._work, args=(i, poll_interval, options), daemon=True)
+            for i in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                # join にタイムアウトを付けて、Ctrl+C を受け付けられるようにする
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.NOTICE("採点ワーカーを終了しました。"))
+
+    def _work(self, worker_id, poll_interval, options):
+        # 採点に使うバックエンド (settings.LLM_BACKENDS で選ぶ)
+        backend = get_llm_backend(TASK_EVALUATION)
+        last_evicted = time.monotonic()
+        try:
+            while True:
+                # 落ちたワーカーが残した処理中のジョブを回収する (1スレッドだけで十分)
+                if worker_id == 0 and options['question'] is None:
+                    requeued = requeue_stale_jobs()
+                    if requeued:
+                        self.stdout.write(self.style.WARNING(f"タイムアウトした{requeued}件のジョブを待機中に戻しました。"))
+
+                    # 採点結果キャッシュの古いものを定期的に削除し、ヒット率とプロンプトキャッシュの効果を出力する
+                    if time.monotonic() - last_evicted >= settings.EVALUATION_CACHE_EVICT_INTERVAL:
+                        evicted = evict_evaluation_cache()
+                        stats = evaluation_cache_stats()
+                        self.stdout.write(
+                            f"採点結果キャッシュ: {stats['entries']}件 (削除 {evicted}件) / "
+                            f"ヒット {stats['hits']}回, ミス {stats['misses']}回, ヒット率 {stats['hit_rate']:.1%}"
+                        )
+                        prompt_stats = prompt_cache_stats()
+                        self.stdout.write(
+                            f"プロンプトキャッシュ: 入力 {prompt_stats['prompt_tokens']}トークン中 "
+                            f"{prompt_stats['cached_tokens']}トークンをキャッシュで処理 ({prompt_stats['cached_ratio']:.1%})"
+                        )
+                        last_evicted = time.monotonic()
+
+                jobs = claim_evaluation_batch(
+                    max_size=options['batch_size'], window=options['batch_window'], question_id=options['question']
+                )
+                if not jobs:
+                    if options['burst']:
+                        return
+                    time.sleep(poll_interval)
+                    continue
+
+                started = time.monotonic()
+                try:
+                    succeeded = process_evaluation_batch(jobs, backend)
+                except Exception as e:
+                    # 予期せぬエラーでスレッドが止まらないよう、ジョブの失敗として扱う
+                    for job in jobs:
+                        retry_or_fail_evaluation_job(job, f"予期せぬエラーが発生しました: {e}")
+                    succeeded = 0
+
+                message = (
+                    f"[worker{worker_id}] お題{jobs[0].answer.question_id}の回答{len(jobs)}件を採点 "
+                    f"(成功 {succeeded}件, {time.monotonic() - started:.2f}秒)"
+                )
+                if succeeded == len(jobs):
+                    self.stdout.write(self.style.SUCCESS(message))
+                else:
+                    self.stdout.write(self.style.WARNING(message))
+        finally:
+            # スレッドごとに開いたDB接続を閉じる
+            connections.close_all()
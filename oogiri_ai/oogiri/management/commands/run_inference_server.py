@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from oogiri.inference_server import DynamicBatcher, LocalModelEngine, make_inference_server
+from oogiri.llm_backends import LOCAL_MODEL_DTYPES
+
+
+class Command(BaseCommand):
+    help = 'ファインチューニングしたローカルモデルを読み込み、推論サーバーとして常駐させます。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='待ち受けるアドレス')
+        parser.add_argument('--port', type=int, default=8765, help='待ち受けるポート')
+        parser.add_argument('--socket', default=None, help='指定した場合は、このパスのUnixソケットで待ち受ける')
+        parser.add_argument('--model-path', default=None, help='モデルのフォルダ。既定値は LOCAL_MODEL_PATH')
+        parser.add_argument('--dtype', choices=LOCAL_MODEL_DTYPES, default=None, help='推論モード。既定値は LOCAL_MODEL_DTYPE')
+        parser.add_argument('--compile', action='store_true', default=None, help='forward を torch.compile する')
+        parser.add_argument('--threads', type=int, default=None, help='推論に使うCPUのスレッド数。既定値は LOCAL_MODEL_THREADS')
+        parser.add_argument(
+            '--max-batch-size', type=int, default=None,
+            help='まとめて推論する最大件数。既定値は LOCAL_INFERENCE_MAX_BATCH_SIZE',
+        )
+        parser.add_argument(
+            '--batch-window', type=float, default=None,
+            help='まとめるリクエストが揃うのを待つ最大秒数。既定値は LOCAL_INFERENCE_BATCH_WINDOW',
+        )
+
+    def handle(self, *args, **options):
+        model_path = options['model_path'] or settings.LOCAL_MODEL_PATH
+        max_batch_size = options['max_batch_size'] or settings.LOCAL_INFERENCE_MAX_BATCH_SIZE
+        batch_window = (
+            options['batch_window'] if options['batch_window'] is not None else settings.LOCAL_INFERENCE_BATCH_WINDOW
+        )
+
+        self.stdout.write(self.style.NOTICE(f"モデルを読み込みます: {model_path}"))
+        engine = LocalModelEngine(model_path, dtype=options['dtype'], compile=options['compile'], threads=options['threads'])
+        batcher = DynamicBatcher(engine.generate_batch, max_batch_size=max_batch_size, batch_window=batch_window)
+        batcher.start()
+
+        server = make_inference_server(
+            batcher, model_name=model_path, host=options['host'], port=options['port'], socket_path=options['socket'],
+            request_timeout=settings.LOCAL_INFERENCE_SERVER_TIMEOUT,
+        )
+        address = options['socket'] or f"http://{options['host']}:{options['port']}"
+        self.stdout.write(self.style.SUCCESS(
+            f"推論サーバーを開始しました: {address} (最大 {max_batch_size}件 / {batch_window * 1000:.0f}ms でまとめて推論)"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.NOTICE("推論サーバーを終了しました。"))
+        finally:
+            server.server_close()
+            batcher.stop()
+            stats = batcher.stats
+            if stats['batches']:
+                self.stdout.write(
+                    f"{stats['requests']}件 / {stats['batches']}バッチ (平均 {stats['requests'] / stats['batches']:.1f}件), "
+                    f"生成 {stats['completion_tokens']}トークン / 推論 {stats['busy_seconds']:.1f}秒"
+                )
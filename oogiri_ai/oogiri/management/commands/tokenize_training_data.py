@@ -0,0 +1,47 @@
+import time
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from oogiri.token_dataset import index_path, tokenize_training_data
+from oogiri.training_data import load_manifest
+
+
+class Command(BaseCommand):
+    help = 'export_training_data で書き出した学習データを、ローカルモデルのトークナイザーでトークンIDのバイナリファイルにします。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', type=Path, default=None,
+                            help='export_training_data の出力先 (既定は TRAINING_DATA_ROOT/oogiri_multitask_training_data.jsonl)')
+        parser.add_argument('--tokenizer', default=None, help='トークナイザーのパス (既定は LOCAL_MODEL_PATH)')
+        parser.add_argument('--batch-size', type=int, default=256, help='まとめてトークナイズするサンプルの数')
+        parser.add_argument('--workers', type=int, default=1, help='ファイルごとに並行してトークナイズするプロセスの数')
+        parser.add_argument('--force', action='store_true', help='前回と同じ内容のファイルもトークナイズし直す')
+
+    def handle(self, *args, **options):
+        output_path = options['output'] or settings.TRAINING_DATA_ROOT / 'oogiri_multitask_training_data.jsonl'
+        manifest = load_manifest(output_path)
+        if manifest is None:
+            raise CommandError(f"{output_path} のマニフェストがありません。先に export_training_data を実行してください。")
+
+        def report(path, samples, tokenized):
+            status = 'トークナイズしました' if tokenized else '前回の結果を使います'
+            self.stdout.write(f"{path}: {samples}件 ({status})")
+
+        started = time.perf_counter()
+        try:
+            index = tokenize_training_data(
+                output_path, manifest['files'], tokenizer_path=options['tokenizer'] or settings.LOCAL_MODEL_PATH,
+                batch_size=options['batch_size'], workers=options['workers'], force=options['force'], on_file=report,
+            )
+        except ImportError as e:
+            raise CommandError(f"トークナイザーを読み込めません (transformers が必要です): {e}")
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        samples = sum(entry['samples'] for entry in index['files'])
+        tokens = sum(entry['tokens'] for entry in index['files'])
+        assistant_tokens = sum(entry['assistant_tokens'] for entry in index['files'])
+        self.stdout.write(self.style.SUCCESS(
+            f"SUCCESS: {samples}件 / {tokens}トークン (うち応答 {assistant_tokens}トークン) を "
+            f"{index_path(output_path)} に出力しました。 ({time.perf_counter() - started:.1f}秒)"
+        ))
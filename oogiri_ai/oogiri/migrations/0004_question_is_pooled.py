@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oogiri', '0003_answer_is_excellent_answer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='is_pooled',
+            field=models.BooleanField(default=False, verbose_name='プール中（未提案）'),
+        ),
+    ]
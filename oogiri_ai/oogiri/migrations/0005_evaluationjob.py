@@ -0,0 +1,42 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oogiri', '0004_question_is_pooled'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='answer',
+            name='review_text',
+            field=models.TextField(blank=True, default='', verbose_name='AIの講評'),
+        ),
+        migrations.AlterField(
+            model_name='answer',
+            name='score',
+            field=models.IntegerField(blank=True, help_text='5段階評価', null=True, verbose_name='面白さの点数'),
+        ),
+        migrations.CreateModel(
+            name='EvaluationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', '待機中'), ('running', '採点中'), ('done', '完了'), ('failed', '失敗')], db_index=True, default='pending', max_length=10, verbose_name='状態')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='試行回数')),
+                ('locked_at', models.DateTimeField(blank=True, null=True, verbose_name='処理開始日時')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='最後のエラー')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='登録日時')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+                ('answer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='evaluation_job', to='oogiri.answer', verbose_name='対象の回答')),
+            ],
+            options={
+                'verbose_name': '採点ジョブ',
+                'verbose_name_plural': '採点ジョブ',
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:37
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oogiri', '0005_evaluationjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EvaluationCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True, verbose_name='キー')),
+                ('score', models.IntegerField(verbose_name='面白さの点数')),
+                ('comment', models.TextField(verbose_name='AIの講評')),
+                ('hit_count', models.PositiveIntegerField(default=0, verbose_name='ヒット数')),
+                ('last_hit_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='最終利用日時')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+            ],
+            options={
+                'verbose_name': '採点結果キャッシュ',
+                'verbose_name_plural': '採点結果キャッシュ',
+                'ordering': ['-last_hit_at'],
+            },
+        ),
+    ]
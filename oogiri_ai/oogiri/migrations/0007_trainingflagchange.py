@@ -0,0 +1,27 @@
+# Generated by Django 5.2.6 on 2026-10-17 23:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oogiri', '0006_evaluationcacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrainingFlagChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('answer', '回答'), ('question', 'お題')], max_length=10, verbose_name='種類')),
+                ('object_id', models.BigIntegerField(verbose_name='回答/お題のID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='記録日時')),
+            ],
+            options={
+                'verbose_name': '学習データのフラグ変更',
+                'verbose_name_plural': '学習データのフラグ変更',
+                'ordering': ['id'],
+            },
+        ),
+    ]
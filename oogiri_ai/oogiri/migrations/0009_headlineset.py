@@ -0,0 +1,59 @@
+# Generated by Django 5.2.6 on 2026-10-17 23:19
+
+import hashlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_joined_headlines(apps, schema_editor):
+    """
+    改行区切りで source_title に保存されているニュースタイトルを、ニュースタイトルの組に移す。
+    """
+    Question = apps.get_model('oogiri', 'Question')
+    HeadlineSet = apps.get_model('oogiri', 'HeadlineSet')
+    joined_titles = (
+        Question.objects.filter(source_title__contains='\n').values_list('source_title', flat=True).distinct()
+    )
+    for headlines in list(joined_titles.iterator()):
+        headline_set, _ = HeadlineSet.objects.get_or_create(
+            digest=hashlib.sha256(headlines.encode('utf-8')).hexdigest(), defaults={'headlines': headlines}
+        )
+        Question.objects.filter(source_title=headlines).update(headline_set=headline_set, source_title=None)
+
+
+def restore_joined_headlines(apps, schema_editor):
+    Question = apps.get_model('oogiri', 'Question')
+    HeadlineSet = apps.get_model('oogiri', 'HeadlineSet')
+    for headline_set in HeadlineSet.objects.iterator():
+        Question.objects.filter(headline_set=headline_set).update(source_title=headline_set.headlines, headline_set=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oogiri', '0008_question_answer_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HeadlineSet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True, verbose_name='ハッシュ')),
+                ('headlines', models.TextField(verbose_name='ニュースタイトル')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+            ],
+            options={
+                'verbose_name': 'ニュースタイトルの組',
+                'verbose_name_plural': 'ニュースタイトルの組',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='headline_set',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='questions', to='oogiri.headlineset', verbose_name='基にしたニュースタイトルの組'),
+        ),
+        migrations.RunPython(move_joined_headlines, restore_joined_headlines),
+    ]
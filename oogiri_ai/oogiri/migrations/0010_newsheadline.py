@@ -0,0 +1,118 @@
+# Generated by Django 5.2.6 on 2026-10-17 23:22
+
+import hashlib
+import unicodedata
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.utils import OperationalError
+
+# タイトルの全文検索インデックス (SQLite の FTS5、日本語を分かち書きせずに検索できる trigram トークナイザーを使う)
+FTS_SQL = [
+    "CREATE VIRTUAL TABLE oogiri_newsheadline_fts USING fts5("
+    "title, content='oogiri_newsheadline', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER oogiri_newsheadline_fts_insert AFTER INSERT ON oogiri_newsheadline BEGIN "
+    "INSERT INTO oogiri_newsheadline_fts(rowid, title) VALUES (new.id, new.title); END",
+    "CREATE TRIGGER oogiri_newsheadline_fts_delete AFTER DELETE ON oogiri_newsheadline BEGIN "
+    "INSERT INTO oogiri_newsheadline_fts(oogiri_newsheadline_fts, rowid, title) VALUES ('delete', old.id, old.title); END",
+    "CREATE TRIGGER oogiri_newsheadline_fts_update AFTER UPDATE OF title ON oogiri_newsheadline BEGIN "
+    "INSERT INTO oogiri_newsheadline_fts(oogiri_newsheadline_fts, rowid, title) VALUES ('delete', old.id, old.title); "
+    "INSERT INTO oogiri_newsheadline_fts(rowid, title) VALUES (new.id, new.title); END",
+]
+DROP_FTS_SQL = [
+    "DROP TRIGGER IF EXISTS oogiri_newsheadline_fts_insert",
+    "DROP TRIGGER IF EXISTS oogiri_newsheadline_fts_delete",
+    "DROP TRIGGER IF EXISTS oogiri_newsheadline_fts_update",
+    "DROP TABLE IF EXISTS oogiri_newsheadline_fts",
+]
+
+
+def create_fts_index(apps, schema_editor):
+    # 他のDBでは全文検索インデックスを作らず、icontains で検索する
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        for sql in FTS_SQL:
+            schema_editor.execute(sql)
+    except OperationalError:
+        # FTS5 (trigram は SQLite 3.34 以降) が使えない場合も、icontains で検索する
+        for sql in DROP_FTS_SQL:
+            schema_editor.execute(sql)
+
+
+def drop_fts_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for sql in DROP_FTS_SQL:
+            schema_editor.execute(sql)
+
+
+def split_headline_sets(apps, schema_editor):
+    """
+    既存のニュースタイトルの組を1件ずつのニュースタイトルに分けて保存し、組から参照する。
+    テーマは、NewsAPIから取得したときだけ記録する (save_generated_questions と同じ)。
+    ハッシュは oogiri/headline_store.py の headline_digest と同じ正規化 (NFKC・空白・大文字小文字) で作る。
+    """
+    HeadlineSet = apps.get_model('oogiri', 'HeadlineSet')
+    NewsHeadline = apps.get_model('oogiri', 'NewsHeadline')
+    for headline_set in HeadlineSet.objects.iterator():
+        headlines = []
+        for title in headline_set.headlines.split('\n'):
+            title = title.strip()
+            if not title:
+                continue
+            normalized = ' '.join(unicodedata.normalize('NFKC', title).split()).casefold()
+            headline, _ = NewsHeadline.objects.get_or_create(
+                digest=hashlib.sha256(normalized.encode('utf-8')).hexdigest(),
+                defaults={'title': title, 'first_fetched_at': headline_set.created_at,
+                          'last_fetched_at': headline_set.created_at},
+            )
+            headlines.append(headline)
+        headline_set.news_headlines.set(headlines)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oogiri', '0009_headlineset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NewsHeadline',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True, verbose_name='ハッシュ')),
+                ('title', models.TextField(verbose_name='タイトル')),
+                ('url', models.URLField(blank=True, default='', max_length=2048, verbose_name='URL')),
+                ('first_fetched_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='初回取得日時')),
+                ('last_fetched_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='最終取得日時')),
+            ],
+            options={
+                'verbose_name': 'ニュースタイトル',
+                'verbose_name_plural': 'ニュースタイトル',
+                'ordering': ['-last_fetched_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='headlineset',
+            name='news_headlines',
+            field=models.ManyToManyField(blank=True, related_name='headline_sets', to='oogiri.newsheadline', verbose_name='ニュースタイトル'),
+        ),
+        migrations.CreateModel(
+            name='NewsHeadlineTheme',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('theme', models.CharField(max_length=50, verbose_name='テーマ')),
+                ('headline', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='themes', to='oogiri.newsheadline', verbose_name='ニュースタイトル')),
+            ],
+            options={
+                'verbose_name': 'ニュースタイトルのテーマ',
+                'verbose_name_plural': 'ニュースタイトルのテーマ',
+                'indexes': [models.Index(fields=['theme', 'headline'], name='headline_theme_idx')],
+                'constraints': [models.UniqueConstraint(fields=('headline', 'theme'), name='unique_headline_theme')],
+            },
+        ),
+        migrations.RunPython(create_fts_index, drop_fts_index),
+        migrations.RunPython(split_headline_sets, migrations.RunPython.noop),
+    ]
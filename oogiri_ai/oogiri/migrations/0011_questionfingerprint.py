@@ -0,0 +1,27 @@
+# Generated by Django 5.2.6 on 2026-10-17 23:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oogiri', '0010_newsheadline'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionFingerprint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.BigIntegerField(verbose_name='帯のハッシュ')),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fingerprints', to='oogiri.question', verbose_name='お題')),
+            ],
+            options={
+                'verbose_name': 'お題の重複判定用ハッシュ',
+                'verbose_name_plural': 'お題の重複判定用ハッシュ',
+                'indexes': [models.Index(fields=['bucket'], name='question_fingerprint_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.6 on 2026-10-17 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oogiri', '0011_questionfingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='名前')),
+                ('token', models.CharField(max_length=32, verbose_name='トークン')),
+                ('expires_at', models.DateTimeField(verbose_name='有効期限')),
+            ],
+            options={
+                'verbose_name': 'ロック',
+                'verbose_name_plural': 'ロック',
+            },
+        ),
+    ]
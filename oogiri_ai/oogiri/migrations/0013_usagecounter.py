@@ -0,0 +1,25 @@
+# Generated by Django 5.2.6 on 2026-10-17 23:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oogiri', '0012_processlock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='名前')),
+                ('value', models.BigIntegerField(default=0, verbose_name='値')),
+            ],
+            options={
+                'verbose_name': 'カウンタ',
+                'verbose_name_plural': 'カウンタ',
+            },
+        ),
+    ]
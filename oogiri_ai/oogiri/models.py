@@ -1,7 +1,92 @@
 from django.db import models
+from django.utils import timezone
 
 from django.conf import settings
 
+# 提案画面で選択できるお題のテーマ (ヘッドラインの先読みなどもこの一覧を使う)
+THEMES = ['政治', '芸能', 'スポーツ', 'アニメ']
+
+class NewsHeadline(models.Model):
+    """
+    NewsAPIから取得したニュースタイトル。同じタイトル (正規化後) は1行だけ保存する (oogiri/headline_store.py を参照)。
+    SQLite ではタイトルの全文検索インデックス (FTS5) をトリガーで更新する。
+    """
+    # 正規化したタイトルのハッシュ
+    digest = models.CharField(max_length=64, unique=True, verbose_name='ハッシュ')
+
+    title = models.TextField(verbose_name='タイトル')
+
+    # 記事のURL (最初に取得したときのもの。分からない場合は空欄)
+    url = models.URLField(max_length=2048, blank=True, default='', verbose_name='URL')
+
+    first_fetched_at = models.DateTimeField(default=timezone.now, verbose_name='初回取得日時')
+    last_fetched_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name='最終取得日時')
+
+    class Meta:
+        verbose_name = 'ニュースタイトル'
+        verbose_name_plural = 'ニュースタイトル'
+        ordering = ['-last_fetched_at']
+
+    def __str__(self):
+        return self.title[:50]
+
+
+class NewsHeadlineTheme(models.Model):
+    """
+    ニュースタイトルを取得したときのテーマ (1つのタイトルが複数のテーマで取得されることがある)。
+    """
+    headline = models.ForeignKey(
+        NewsHeadline,
+        on_delete=models.CASCADE,
+        related_name='themes',
+        verbose_name='ニュースタイトル'
+    )
+    theme = models.CharField(max_length=50, verbose_name='テーマ')
+
+    class Meta:
+        verbose_name = 'ニュースタイトルのテーマ'
+        verbose_name_plural = 'ニュースタイトルのテーマ'
+        constraints = [
+            models.UniqueConstraint(fields=['headline', 'theme'], name='unique_headline_theme'),
+        ]
+        indexes = [
+            models.Index(fields=['theme', 'headline'], name='headline_theme_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.theme} - {self.headline}'
+
+
+class HeadlineSet(models.Model):
+    """
+    お題の生成に使ったニュースタイトルの組。同じ組から生成したお題 (1回の提案の3つ、お題プールの補充など) は、
+    この1行を参照する (お題ごとに最大100件のタイトルを保存し直さないため)。
+    """
+    # 改行区切りのタイトルのハッシュ (同じ組を2回保存しないため)
+    digest = models.CharField(max_length=64, unique=True, verbose_name='ハッシュ')
+
+    # ニュースタイトル (改行区切り)
+    headlines = models.TextField(verbose_name='ニュースタイトル')
+
+    # 組に含まれるニュースタイトル (検索用。順序は headlines の方を使う)
+    news_headlines = models.ManyToManyField(
+        NewsHeadline,
+        related_name='headline_sets',
+        verbose_name='ニュースタイトル',
+        blank=True
+    )
+
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
+
+    class Meta:
+        verbose_name = 'ニュースタイトルの組'
+        verbose_name_plural = 'ニュースタイトルの組'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f'{self.headlines.count(chr(10)) + 1}件 - {self.headlines[:30]}...'
+
+
 class Question(models.Model):
     """
     AIによって生成された、または管理者が手動で入力した大喜利のお題を保存するモデル。
@@ -20,7 +105,18 @@ class Question(models.Model):
     is_manual = models.BooleanField(default=False, verbose_name='手動入力') 
 
     # AI生成のソースとなったニュースタイトル (手動入力の場合は空欄可)
+    # AIが生成したお題のニュースタイトルは headline_set に保存し、ここには保存しない
     source_title = models.CharField(max_length=255, verbose_name='基にしたニュースタイトル', blank=True, null=True)
+
+    # AI生成のソースとなったニュースタイトルの組
+    headline_set = models.ForeignKey(
+        HeadlineSet,
+        on_delete=models.PROTECT,
+        related_name='questions',
+        verbose_name='基にしたニュースタイトルの組',
+        null=True,
+        blank=True
+    )
     
     # AIが提案したお題の本文
     question_text = models.TextField(verbose_name='お題の本文')
@@ -28,6 +124,10 @@ class Question(models.Model):
     # お題のテーマ
     theme = models.CharField(max_length=50, verbose_name='テーマ')
     
+    # 事前生成されたまま、まだユーザーに提案されていないお題か (お題プール)
+    # 提案時にプールから取り出され、False になる
+    is_pooled = models.BooleanField(default=False, verbose_name='プール中（未提案）')
+
     # 管理者による品質評価 (要件4対応)
     is_excellent = models.BooleanField(default=False, verbose_name='特に面白い') # Few-shot/RAGのフィルタリングに利用
     
@@ -38,10 +138,54 @@ class Question(models.Model):
         verbose_name = 'お題'
         verbose_name_plural = 'お題'
         ordering = ['-created_at']
+        # よく使う絞り込みと並び順に合わせたインデックス (oogiri/query_plans.py で使われていることを確かめる)
+        # 新しい順の一覧は (created_at, id) の降順で読むため、昇順のインデックスを逆向きに読ませる
+        indexes = [
+            # 管理画面の一覧 (作成日時の新しい順、テーマでの絞り込み)
+            models.Index(fields=['created_at'], name='question_created_idx'),
+            models.Index(fields=['theme', 'created_at'], name='question_theme_created_idx'),
+            # Few-shotの事例に使う「特に面白い」お題 (件数が少ないため部分インデックスにする)
+            models.Index(fields=['theme', 'created_at'], condition=models.Q(is_excellent=True),
+                         name='question_excellent_idx'),
+            # お題プールからの取り出し (テーマごとに古い順)
+            models.Index(fields=['theme', 'created_at'], condition=models.Q(is_pooled=True),
+                         name='question_pooled_idx'),
+        ]
 
     def __str__(self):
         return f'{self.theme} {"(手動)" if self.is_manual else "(AI)"} - {self.question_text[:30]}...'
 
+    @property
+    def source_text(self) -> str | None:
+        """
+        プロンプトに入れる元ネタのニュース (ニュースタイトルの組、無ければ source_title)。
+        """
+        if self.headline_set_id is not None:
+            return self.headline_set.headlines
+        return self.source_title
+
+
+class QuestionFingerprint(models.Model):
+    """
+    ほぼ同じお題を見つけるための、お題の MinHash の帯ごとのハッシュ (oogiri/question_dedup.py)。お題1件につき複数行。
+    """
+    question = models.ForeignKey(
+        Question,
+        on_delete=models.CASCADE,
+        related_name='fingerprints',
+        verbose_name='お題'
+    )
+
+    # テーマ・帯の番号・帯の MinHash から作ったハッシュ (同じ値を持つお題が、ほぼ同じお題の候補になる)
+    bucket = models.BigIntegerField(verbose_name='帯のハッシュ')
+
+    class Meta:
+        verbose_name = 'お題の重複判定用ハッシュ'
+        verbose_name_plural = 'お題の重複判定用ハッシュ'
+        indexes = [
+            models.Index(fields=['bucket'], name='question_fingerprint_idx'),
+        ]
+
 
 class Answer(models.Model):
     """
@@ -63,9 +207,9 @@ class Answer(models.Model):
     
     answer_text = models.TextField(verbose_name='回答内容')
     
-    # AIによる評価結果
-    score = models.IntegerField(verbose_name='面白さの点数', help_text='5段階評価')
-    review_text = models.TextField(verbose_name='AIの講評')
+    # AIによる評価結果 (採点ジョブが終わるまでは空)
+    score = models.IntegerField(verbose_name='面白さの点数', help_text='5段階評価', null=True, blank=True)
+    review_text = models.TextField(verbose_name='AIの講評', blank=True, default='')
     
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='回答日時')
 
@@ -78,6 +222,143 @@ class Answer(models.Model):
         verbose_name = '回答'
         verbose_name_plural = '回答'
         ordering = ['-created_at']
+        # ユーザーでの絞り込みは外部キー (user) のインデックスを使う
+        indexes = [
+            # 管理画面の一覧 (回答日時の新しい順)
+            models.Index(fields=['created_at'], name='answer_created_idx'),
+            # Few-shotの事例・学習データ・管理画面の絞り込みに使う「特に面白い」回答 (件数が少ないため部分インデックスにする)
+            models.Index(fields=['id'], condition=models.Q(is_excellent_answer=True), name='answer_excellent_idx'),
+        ]
+
+    def __str__(self):
+        score = '採点待ち' if self.score is None else f'{self.score}点'
+        return f'{self.user.nickname}の回答 ({score})'
+
+
+class EvaluationJob(models.Model):
+    """
+    回答の採点ジョブ。DBをキューとして使い、run_evaluation_worker コマンドのワーカーが順に処理する。
+    """
+    class Status(models.TextChoices):
+        PENDING = 'pending', '待機中'
+        RUNNING = 'running', '採点中'
+        DONE = 'done', '完了'
+        FAILED = 'failed', '失敗'
+
+    answer = models.OneToOneField(
+        Answer,
+        on_delete=models.CASCADE,
+        related_name='evaluation_job',
+        verbose_name='対象の回答'
+    )
+
+    status = models.CharField(
+        max_length=10,
+        choices=Status.choices,
+        default=Status.PENDING,
+        db_index=True,
+        verbose_name='状態'
+    )
+
+    # 採点を試みた回数 (EVALUATION_MAX_ATTEMPTS に達すると失敗扱い)
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='試行回数')
+
+    # ワーカーが処理を始めた日時 (EVALUATION_JOB_TIMEOUT を過ぎたら待機中に戻す)
+    locked_at = models.DateTimeField(null=True, blank=True, verbose_name='処理開始日時')
+
+    last_error = models.TextField(blank=True, default='', verbose_name='最後のエラー')
+
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='登録日時')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
+
+    class Meta:
+        verbose_name = '採点ジョブ'
+        verbose_name_plural = '採点ジョブ'
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f'回答{self.answer_id}の採点 ({self.get_status_display()})'
+
+
+
+class EvaluationCacheEntry(models.Model):
+    """
+    採点結果のキャッシュ。同じお題・同じ回答 (正規化後) の組をGeminiで再び採点しないために使う。
+    キーはお題と回答を正規化して連結したもののハッシュ (oogiri/evaluation_cache.py を参照)。
+    """
+    key = models.CharField(max_length=64, unique=True, verbose_name='キー')
+
+    score = models.IntegerField(verbose_name='面白さの点数')
+    comment = models.TextField(verbose_name='AIの講評')
+
+    # 利用状況 (最後に使われた日時が古いものから削除する)
+    hit_count = models.PositiveIntegerField(default=0, verbose_name='ヒット数')
+    last_hit_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name='最終利用日時')
+
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
+
+    class Meta:
+        verbose_name = '採点結果キャッシュ'
+        verbose_name_plural = '採点結果キャッシュ'
+        ordering = ['-last_hit_at']
+
+    def __str__(self):
+        return f'{self.key[:12]} ({self.score}点, {self.hit_count}ヒット)'
+
+
+class TrainingFlagChange(models.Model):
+    """
+    学習データの対象になった (「特に面白い」が付けられた) 既存の回答・お題の記録。
+    export_training_data --incremental は、前回の出力以降に追加された行に加えて、ここに記録された行を書き出す。
+    記録はシグナル (oogiri/signals.py) で残すため、QuerySet.update で変えたフラグは記録されない。
+    """
+    class Kind(models.TextChoices):
+        ANSWER = 'answer', '回答'
+        QUESTION = 'question', 'お題'
+
+    kind = models.CharField(max_length=10, choices=Kind.choices, verbose_name='種類')
+    object_id = models.BigIntegerField(verbose_name='回答/お題のID')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='記録日時')
+
+    class Meta:
+        verbose_name = '学習データのフラグ変更'
+        verbose_name_plural = '学習データのフラグ変更'
+        ordering = ['id']
+
+    def __str__(self):
+        return f'{self.get_kind_display()}{self.object_id} ({self.created_at:%Y-%m-%d %H:%M})'
+
+
+class ProcessLock(models.Model):
+    """
+    複数のプロセス・スレッドのうち1つだけが処理するためのロック (oogiri/locks.py)。
+    name の一意制約で取り合いを判定する (FileBasedCache の add は原子的でないため、キャッシュではロックしない)。
+    """
+    name = models.CharField(max_length=255, unique=True, verbose_name='名前')
+    # ロックを取ったものだけが解放できるよう、取るたびに変える値
+    token = models.CharField(max_length=32, verbose_name='トークン')
+    # 持ち主が解放せずに落ちた場合は、この日時を過ぎたら他のものが取れる
+    expires_at = models.DateTimeField(verbose_name='有効期限')
+
+    class Meta:
+        verbose_name = 'ロック'
+        verbose_name_plural = 'ロック'
+
+    def __str__(self):
+        return self.name
+
+
+class UsageCounter(models.Model):
+    """
+    採点結果キャッシュのヒット数やプロンプトのトークン数などの累計 (oogiri/counters.py)。
+    複数のプロセス・スレッドが同時に数えても失われないよう、キャッシュの incr ではなくDBの UPDATE で加算する。
+    """
+    name = models.CharField(max_length=255, unique=True, verbose_name='名前')
+    value = models.BigIntegerField(default=0, verbose_name='値')
+
+    class Meta:
+        verbose_name = 'カウンタ'
+        verbose_name_plural = 'カウンタ'
 
     def __str__(self):
-        return f'{self.user.nickname}の回答 ({self.score}点)'
\ No newline at end of file
+        return f'{self.name}: {self.value}'
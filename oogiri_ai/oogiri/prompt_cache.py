@@ -0,0 +1,172 @@
+# oogiri/prompt_cache.py
+"""
+Gemini のコンテキストキャッシュ (cachedContents) を使ったプロンプトの共通部分のキャッシュ。
+
+お題生成・採点のプロンプトは「システム命令 + Few-Shot事例 (共通部分)」と「ニュースや回答 (毎回変わる部分)」の順に組み立てる。
+共通部分をGemini側にキャッシュとして登録し、以降のリクエストでは毎回変わる部分だけを送る。
+登録したキャッシュの名前は、共通部分のハッシュをキーにしてDjangoのキャッシュに保存し、プロセス間で共有する。
+
+キャッシュを作れない場合 (共通部分がGeminiの最小トークン数に満たないなど) は、全文を同じ順序で送る。
+この場合もGemini側の暗黙的なキャッシュが効くことがある。
+どちらの場合も、応答の usage_metadata からキャッシュで処理されたトークン数を数える (UsageCounter テーブル、oogiri/counters.py)。
+"""
+import hashlib
+import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from google.genai import errors, types
+from .counters import counter_values, increment
+from .locks import acquire_lock, release_lock
+
+logger = logging.getLogger(__name__)
+
+_KEY_PREFIX = 'gemini_prompt_cache'
+# 共通部分が小さすぎてキャッシュにできなかったことを表す値 (TTLの間は作成を再試行しない)
+_UNCACHEABLE = ''
+# Gemini側のキャッシュが期限切れになる前に、こちらの記録を消しておくための余裕 (秒)
+_EXPIRY_MARGIN = 60
+# キャッシュを作成する間のロックの有効期限 (秒)
+_LOCK_TIMEOUT = 60
+
+_CALLS_KEY = f'{_KEY_PREFIX}:calls'
+_PROMPT_TOKENS_KEY = f'{_KEY_PREFIX}:prompt_tokens'
+_CACHED_TOKENS_KEY = f'{_KEY_PREFIX}:cached_tokens'
+_CREATED_KEY = f'{_KEY_PREFIX}:created'
+
+
+def make_prefix_key(model: str, system_instruction: str, prefix: str) -> str:
+    source = "\0".join([model, system_instruction, prefix])
+    return f"{_KEY_PREFIX}:{hashlib.sha256(source.encode('utf-8')).hexdigest()}"
+
+
+def _build_cache_config(system_instruction: str, prefix: str, ttl: int) -> types.CreateCachedContentConfig:
+    return types.CreateCachedContentConfig(
+        system_instruction=system_instruction,
+        contents=[types.Content(role='user', parts=[types.Part(text=prefix)])] if prefix else None,
+        ttl=f'{ttl}s',
+        display_name='oogiri-prompt-prefix',
+    )
+
+
+def _is_uncacheable(error: Exception) -> bool:
+    # 共通部分が最小トークン数に満たない場合は 400 (INVALID_ARGUMENT) が返る。
+    # タイムアウト・429・5xx などは一時的なエラーのため、次のリクエストで作成し直す
+    return isinstance(error, errors.ClientError) and error.code == 400
+
+
+def record_usage(response) -> None:
+    """
+    応答の usage_metadata から、プロンプトのトークン数とキャッシュで処理されたトークン数を数える。
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    prompt_tokens = usage.prompt_token_count or 0
+    cached_tokens = usage.cached_content_token_count or 0
+    increment(_CALLS_KEY)
+    increment(_PROMPT_TOKENS_KEY, prompt_tokens)
+    if cached_tokens:
+        increment(_CACHED_TOKENS_KEY, cached_tokens)
+    logger.debug("Geminiの入力トークン: %d (うちキャッシュ %d)", prompt_tokens, cached_tokens)
+
+
+def prompt_cache_stats() -> dict:
+    """
+    リクエスト数・入力トークン数・キャッシュで処理されたトークン数 (節約できたトークン数) と、その割合を返す。
+    """
+    counts = counter_values(_CALLS_KEY, _CREATED_KEY, _PROMPT_TOKENS_KEY, _CACHED_TOKENS_KEY)
+    prompt_tokens = counts[_PROMPT_TOKENS_KEY]
+    cached_tokens = counts[_CACHED_TOKENS_KEY]
+    return {
+        'calls': counts[_CALLS_KEY],
+        'caches_created': counts[_CREATED_KEY],
+        'prompt_tokens': prompt_tokens,
+        'cached_tokens': cached_tokens,
+        'cached_ratio': cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+    }
+
+
+class PromptPrefixCache:
+    """
+    プロンプトの共通部分 (システム命令 + prefix) ごとに、Gemini側のキャッシュを作成・再利用する。
+    """
+
+    def __init__(self, ttl: int | None = None):
+        self.ttl = settings.GEMINI_PROMPT_CACHE_TTL if ttl is None else ttl
+
+    def _lock_key(self, key: str) -> str:
+        return f"{key}:lock"
+
+    def _remember(self, key: str, cache_name: str) -> None:
+        cache.set(key, cache_name, max(self.ttl - _EXPIRY_MARGIN, 1))
+        if cache_name != _UNCACHEABLE:
+            increment(_CREATED_KEY)
+
+    def get_or_create(self, client, model: str, system_instruction: str, prefix: str) -> str | None:
+        """
+        共通部分のキャッシュ名 (cachedContents/...) を返す。使えない場合は None。
+        """
+        if not settings.GEMINI_PROMPT_CACHE_ENABLED:
+            return None
+
+        key = make_prefix_key(model, system_instruction, prefix)
+        cache_name = cache.get(key)
+        if cache_name is not None:
+            return cache_name or None
+
+        # 同じ共通部分のキャッシュを複数のリクエストが同時に作らないよう、作成は1つのリクエストだけが行う
+        # (作成中は他のリクエストはキャッシュを使わずに送る)
+        token = acquire_lock(self._lock_key(key), _LOCK_TIMEOUT)
+        if token is None:
+            return None
+        try:
+            cached_content = client.caches.create(
+                model=model, config=_build_cache_config(system_instruction, prefix, self.ttl)
+            )
+        except Exception as e:
+            logger.info(f"プロンプトの共通部分をキャッシュにできませんでした: {e}")
+            if _is_uncacheable(e):
+                self._remember(key, _UNCACHEABLE)
+            return None
+        finally:
+            release_lock(self._lock_key(key), token)
+
+        self._remember(key, cached_content.name)
+        return cached_content.name
+
+    async def aget_or_create(self, client, model: str, system_instruction: str, prefix: str) -> str | None:
+        """
+        get_or_create の非同期版 (client.aio でキャッシュを作成する)。
+        """
+        if not settings.GEMINI_PROMPT_CACHE_ENABLED:
+            return None
+
+        key = make_prefix_key(model, system_instruction, prefix)
+        cache_name = await cache.aget(key)
+        if cache_name is not None:
+            return cache_name or None
+
+        token = await sync_to_async(acquire_lock)(self._lock_key(key), _LOCK_TIMEOUT)
+        if token is None:
+            return None
+        try:
+            cached_content = await client.aio.caches.create(
+                model=model, config=_build_cache_config(system_instruction, prefix, self.ttl)
+            )
+        except Exception as e:
+            logger.info(f"プロンプトの共通部分をキャッシュにできませんでした: {e}")
+            if _is_uncacheable(e):
+                await sync_to_async(self._remember)(key, _UNCACHEABLE)
+            return None
+        finally:
+            await sync_to_async(release_lock)(self._lock_key(key), token)
+
+        await sync_to_async(self._remember)(key, cached_content.name)
+        return cached_content.name
+
+    def forget(self, model: str, system_instruction: str, prefix: str) -> None:
+        """
+        Gemini側でキャッシュが見つからなかった場合 (期限切れ・削除) に、こちらの記録を消す。
+        """
+        cache.delete(make_prefix_key(model, system_instruction, prefix))
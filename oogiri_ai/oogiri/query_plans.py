@@ -0,0 +1,144 @@
+# oogiri/query_plans.py
+"""
+よく使うクエリ (Few-shotの事例、お題プール、管理画面の一覧など) と、それぞれが使うべきインデックスの一覧。
+テスト (実行計画でインデックスを使っていることを確かめる) と benchmark_queries コマンド (インデックスの有無で
+実行時間を比べる) で同じ一覧を使う。
+"""
+import itertools
+import time
+from django.contrib.auth import get_user_model
+from django.db import connection
+from .models import THEMES, Answer, Question
+
+
+
+def hot_queries(theme: str, user_id: int) -> dict:
+    """
+    クエリの名前 → (QuerySet, 使うべきインデックスの名前) の辞書を返す。
+    ユーザーでの絞り込みは外部キーのインデックス (名前はハッシュ付きのため、先頭だけ) を使う。
+    """
+    return {
+        # Few-shotの事例 (oogiri/few_shot.py)
+        'few_shot_questions': (
+            Question.objects.filter(is_excellent=True).order_by('-created_at').values_list('theme', 'question_text'),
+            'question_excellent_idx',
+        ),
+        'few_shot_answers': (
+            Answer.objects.filter(is_excellent_answer=True).order_by('id')
+            .values_list('id', 'question__question_text', 'answer_text', 'score', 'review_text'),
+            'answer_excellent_idx',
+        ),
+        # テーマの「特に面白い」お題 (新しい順)
+        'excellent_questions_by_theme': (
+            Question.objects.filter(theme=theme, is_excellent=True).order_by('-created_at')[:20],
+            'question_excellent_idx',
+        ),
+        # お題プールからの取り出し (oogiri/services.py の take_pooled_questions)
+        'pooled_questions': (
+            Question.objects.filter(theme=theme, is_pooled=True).order_by('created_at', 'id')[:5],
+            'question_pooled_idx',
+        ),
+        # 管理画面の一覧 (1ページ目)
+        'admin_answers': (
+            Answer.objects.select_related('question', 'user').order_by('-created_at', '-pk')[:100],
+            'answer_created_idx',
+        ),
+        'admin_questions': (
+            Question.objects.select_related('user').order_by('-created_at', '-pk')[:100],
+            'question_created_idx',
+        ),
+        'admin_questions_by_theme': (
+            Question.objects.select_related('user').filter(theme=theme).order_by('-created_at', '-pk')[:100],
+            'question_theme_created_idx',
+        ),
+        'admin_excellent_answers': (
+            Answer.objects.select_related('question', 'user').filter(is_excellent_answer=True)
+            .order_by('-created_at', '-pk')[:100],
+            'answer_excellent_idx',
+        ),
+        # ユーザーの回答 (結果画面は pk と user で引く)
+        'answers_by_user': (
+            Answer.objects.filter(user_id=user_id).order_by('-created_at')[:20],
+            'oogiri_answer_user_id',
+        ),
+    }
+
+
+def query_plan(queryset) -> str:
+    """
+    QuerySet の実行計画 (SQLite では EXPLAIN QUERY PLAN の結果) を返す。
+    """
+    return queryset.explain()
+
+
+def uses_index(queryset, index_name: str) -> bool:
+    return index_name in query_plan(queryset)
+
+
+def model_indexes() -> dict[str, str]:
+    """
+    Question と Answer の Meta.indexes の、インデックスの名前 → テーブル名の辞書を返す。
+    """
+    return {
+        index.name: model._meta.db_table
+        for model in (Question, Answer)
+        for index in model._meta.indexes
+    }
+
+
+def drop_model_indexes() -> None:
+    """
+    Meta.indexes のインデックスを削除する (インデックスが無い場合と比べるため、トランザクションの中で使い、ロールバックする)。
+    """
+    with connection.cursor() as cursor:
+        for name in model_indexes():
+            cursor.execute(f'DROP INDEX {connection.ops.quote_name(name)}')
+
+
+def seed_synthetic_data(questions: int, answers_per_question: int, users: int = 20, excellent_every: int = 50,
+                        pooled_every: int = 20, batch_size: int = 2000) -> list:
+    """
+    実行計画と実行時間を確かめるための合成データを作り、回答者のユーザーのリストを返す。
+    お題は THEMES に、回答はユーザーに均等に振り分け、excellent_every 件に1件を「特に面白い」、
+    pooled_every 件に1件をプール中にする。bulk_create で作るため、シグナル (学習データのフラグ変更の記録など) は送られない。
+    """
+    User = get_user_model()
+    users = [
+        User.objects.create_user(f'query-plan-{i}@example.com', f'query-plan-{i}', password=None) for i in range(users)
+    ]
+    question_ids = []
+    for start in range(0, questions, batch_size):
+        created = Question.objects.bulk_create(
+            Question(
+                theme=THEMES[i % len(THEMES)], question_text=f'合成データのお題{i}',
+                is_excellent=i % excellent_every == 0, is_pooled=i % pooled_every == 1,
+            )
+            for i in range(start, min(start + batch_size, questions))
+        )
+        question_ids.extend(question.id for question in created)
+    answers = (
+        Answer(user=users[(question_id + j) % len(users)], question_id=question_id, answer_text=f'合成データの回答{question_id}-{j}',
+               score=j % 5 + 1, is_excellent_answer=(question_id + j) % excellent_every == 0)
+        for question_id in question_ids
+        for j in range(answers_per_question)
+    )
+    while batch := list(itertools.islice(answers, batch_size)):
+        Answer.objects.bulk_create(batch)
+    # SQLite ではテーブルの統計を取り直し、実際のデータの分布で実行計画を選ばせる
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+    return users
+
+
+def time_query(queryset, repeat: int = 5) -> float:
+    """
+    QuerySet を repeat 回評価し、最も速かった回の秒数を返す。
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        # QuerySet の結果のキャッシュを使わないよう、毎回複製して評価する
+        list(queryset.all())
+        timings.append(time.perf_counter() - started)
+    return min(timings)
@@ -0,0 +1,193 @@
+# oogiri/question_dedup.py
+"""
+生成したお題の重複判定。同じテーマの保存済みのお題とほぼ同じお題 (文字3-gramの Jaccard 係数が
+QUESTION_DUPLICATE_THRESHOLD 以上) は保存せずに除き、足りない分は QUESTION_DEDUP_MAX_RETRIES 回まで生成し直す。
+
+お題ごとに文字3-gramの MinHash (NUM_PERMUTATIONS 個) を計算し、ROWS_PER_BAND 個ずつの帯に分けて、
+テーマ・帯の番号と合わせたハッシュを QuestionFingerprint に保存する (LSH)。判定するお題と帯のハッシュが1つでも一致する
+お題だけをDBのインデックスで候補として引き、本文の Jaccard 係数で確かめるため、保存済みのお題の数が増えても
+判定の時間はほとんど変わらない。Jaccard 係数が 0.6 のお題は約9割、0.7 のお題は約99%の確率で候補になる。
+
+帯のハッシュは save_generated_questions (bulk_create で保存する) とシグナル (管理画面などで作成・編集したお題) で登録する。
+この仕組みより前から保存されているお題は、build_question_fingerprints コマンドで登録する。
+"""
+import hashlib
+import logging
+import zlib
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Count, F, Window
+from django.db.models.functions import RowNumber
+from .evaluation_cache import normalize_text
+from .models import Question, QuestionFingerprint
+
+logger = logging.getLogger(__name__)
+
+# 変えると保存済みの帯のハッシュと合わなくなるため、設定にはしない (変えた場合は build_question_fingerprints --rebuild)
+_NORMALIZATION = ['nfkc', 'whitespace', 'lower', 'punctuation']
+SHINGLE_SIZE = 3
+NUM_PERMUTATIONS = 64
+ROWS_PER_BAND = 4
+_PRIME = (1 << 61) - 1
+# 帯のハッシュ1つあたりで本文を確かめる候補の最大数 (ありふれた言い回しで候補が増えすぎないように、新しいお題から)
+_MAX_CANDIDATES = 200
+
+
+def _hash64(source: str, signed: bool = False) -> int:
+    return int.from_bytes(hashlib.blake2b(source.encode('utf-8'), digest_size=8).digest(), 'little', signed=signed)
+
+
+# MinHash の各ハッシュ関数 (a * x + b) mod _PRIME の係数 (プロセスによらず同じ値にする)
+_PERMUTATIONS = [
+    (_hash64(f'a{i}') % (_PRIME - 1) + 1, _hash64(f'b{i}') % _PRIME) for i in range(NUM_PERMUTATIONS)
+]
+
+
+def shingles(text: str) -> set[str]:
+    normalized = normalize_text(text, _NORMALIZATION)
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def jaccard(a: set[str], b: set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def minhash(shingle_set: set[str]) -> list[int]:
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingle_set]
+    return [min((a * value + b) % _PRIME for value in hashes) for a, b in _PERMUTATIONS]
+
+
+def band_buckets(theme: str, text: str) -> list[int]:
+    """
+    お題の帯のハッシュ (NUM_PERMUTATIONS / ROWS_PER_BAND 個) を返す。本文が空の場合は空のリスト。
+    """
+    shingle_set = shingles(text)
+    if not shingle_set:
+        return []
+    signature = minhash(shingle_set)
+    return [
+        _hash64(f"{theme}\0{band}\0{','.join(map(str, signature[band:band + ROWS_PER_BAND]))}", signed=True)
+        for band in range(0, NUM_PERMUTATIONS, ROWS_PER_BAND)
+    ]
+
+
+def index_questions(questions, replace: bool = False) -> None:
+    """
+    お題の帯のハッシュを保存する。replace=True の場合は、保存済みのハッシュを消してから保存する (本文やテーマの変更)。
+    """
+    if replace:
+        QuestionFingerprint.objects.filter(question__in=[question.pk for question in questions]).delete()
+    QuestionFingerprint.objects.bulk_create(
+        (
+            QuestionFingerprint(question_id=question.pk, bucket=bucket)
+            for question in questions
+            for bucket in band_buckets(question.theme, question.question_text)
+        ),
+        batch_size=1000,
+    )
+
+
+def find_duplicates(theme: str, question_texts: list[str], threshold: float | None = None) -> list[int | None]:
+    """
+    各お題とほぼ同じ、同じテーマの保存済みのお題のID (無ければ None) を question_texts と同じ順で返す。
+    """
+    if threshold is None:
+        threshold = settings.QUESTION_DUPLICATE_THRESHOLD
+    buckets = [band_buckets(theme, question_text) for question_text in question_texts]
+    all_buckets = {bucket for text_buckets in buckets for bucket in text_buckets}
+    if not all_buckets:
+        return [None] * len(question_texts)
+
+    questions_by_bucket = {}
+    # 同じテーマのお題に絞ってから、帯のハッシュごとに新しいお題から _MAX_CANDIDATES 件までを候補にする
+    fingerprints = (
+        QuestionFingerprint.objects.filter(bucket__in=all_buckets, question__theme=theme)
+        .annotate(
+            rank=Window(RowNumber(), partition_by=F('bucket'), order_by=F('question_id').desc()),
+            bucket_size=Window(Count('id'), partition_by=F('bucket')),
+        )
+        .filter(rank__lte=_MAX_CANDIDATES)
+        .values_list('bucket', 'question_id', 'bucket_size')
+    )
+    truncated = set()
+    for bucket, question_id, bucket_size in fingerprints:
+        questions_by_bucket.setdefault(bucket, set()).add(question_id)
+        if bucket_size > _MAX_CANDIDATES:
+            truncated.add((bucket, bucket_size))
+    for bucket, bucket_size in truncated:
+        logger.warning("[%s] 帯のハッシュ %d の候補 %d件のうち、新しい %d件だけを確かめました",
+                       theme, bucket, bucket_size, _MAX_CANDIDATES)
+    candidate_ids = set().union(*questions_by_bucket.values())
+    candidates = {
+        question_id: shingles(question_text)
+        for question_id, question_text in Question.objects.filter(id__in=candidate_ids, theme=theme)
+        .values_list('id', 'question_text')
+    } if candidate_ids else {}
+
+    duplicates = []
+    for question_text, text_buckets in zip(question_texts, buckets):
+        shingle_set = shingles(question_text)
+        ids = set().union(*(questions_by_bucket.get(bucket, ()) for bucket in text_buckets))
+        duplicates.append(next(
+            (question_id for question_id in sorted(ids)
+             if question_id in candidates and jaccard(shingle_set, candidates[question_id]) >= threshold),
+            None,
+        ))
+    return duplicates
+
+
+class QuestionDeduplicator:
+    """
+    1回の提案・補充 (生成し直す分を含む) で生成したお題のうち、保存済みのお題とも、既に受け入れたお題とも
+    ほぼ同じでないものだけを受け入れる。
+    """
+
+    def __init__(self, theme: str, threshold: float | None = None):
+        self.theme = theme
+        self.threshold = settings.QUESTION_DUPLICATE_THRESHOLD if threshold is None else threshold
+        self.dropped = 0
+        self._accepted: list[set[str]] = []
+
+    def accept(self, question_texts: list[str]) -> list[str]:
+        """
+        受け入れたお題を、question_texts の順に返す。
+        """
+        accepted = []
+        for question_text, duplicate_id in zip(question_texts, find_duplicates(self.theme, question_texts, self.threshold)):
+            shingle_set = shingles(question_text)
+            if duplicate_id is None and not any(jaccard(shingle_set, other) >= self.threshold for other in self._accepted):
+                self._accepted.append(shingle_set)
+                accepted.append(question_text)
+                continue
+            self.dropped += 1
+            logger.info("[%s] 既存のお題とほぼ同じお題を除きました: %s (既存のお題ID: %s)",
+                        self.theme, question_text, duplicate_id)
+        return accepted
+
+
+async def agenerate_unique_questions(backend, headlines: list[str], theme: str, count: int = 3,
+                                     deduplicator: QuestionDeduplicator | None = None,
+                                     max_retries: int | None = None) -> list[str] | str:
+    """
+    backend でお題を生成し、重複を除いたお題を最大 count 個返す。足りない場合は max_retries 回まで生成し直す。
+    最初の生成に失敗した場合はエラーメッセージを、全て重複していた場合はその旨のメッセージを返す。
+    """
+    if deduplicator is None:
+        deduplicator = QuestionDeduplicator(theme)
+    if max_retries is None:
+        max_retries = settings.QUESTION_DEDUP_MAX_RETRIES
+
+    questions = []
+    for _ in range(max_retries + 1):
+        result = await backend.agenerate_questions(headlines, theme=theme)
+        if isinstance(result, str):
+            # 生成し直しに失敗した場合は、それまでに受け入れたお題を使う
+            return questions or result
+        questions += (await sync_to_async(deduplicator.accept)(result))[:count - len(questions)]
+        if len(questions) >= count:
+            break
+    return questions or "生成したお題が全て既存のお題とほぼ同じでした。"
@@ -2,11 +2,184 @@
 from newsapi import NewsApiClient
 from datetime import datetime, timedelta
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+from asgiref.sync import sync_to_async
+import asyncio
+import certifi
+import functools
+import hashlib
+import httpx
 import json
+import logging
+import os
+import re
+import ssl
+import threading
+import time
 from google import genai
 from google.genai.errors import APIError # APIエラー処理用
 from django.conf import settings # Questionモデルを使うために必要
-from .models import Question, Answer
+from .few_shot import few_shot_index
+from .headline_store import record_headlines
+from .locks import acquire_lock, release_lock
+from .llm_backends import LLMBackend, StreamingError
+from .models import HeadlineSet, Question, Answer
+from .prompt_cache import PromptPrefixCache, record_usage
+from .question_dedup import index_questions
+from .streaming import JSONArrayStream, partial_string_value
+
+logger = logging.getLogger(__name__)
+
+@functools.cache
+def _shared_ssl_context() -> ssl.SSLContext:
+    """
+    HTTPクライアント間で共有するSSLコンテキスト。
+    証明書の読み込みが重く (数十ms)、リクエスト毎に作るとイベントループを止めてしまうため、プロセスで一度だけ作る。
+    """
+    return ssl.create_default_context(
+        cafile=os.environ.get('SSL_CERT_FILE', certifi.where()),
+        capath=os.environ.get('SSL_CERT_DIR'),
+    )
+
+
+# NewsAPIの取得結果をDjangoのキャッシュフレームワークに保存するクラス
+class HeadlineCache:
+    """
+    ヘッドラインを (テーマ, 期間, 取得件数) ごとにキャッシュする。
+
+    - TTL (NEWS_HEADLINE_CACHE_TTL) 以内のデータはそのまま返す。
+    - TTLを過ぎても NEWS_HEADLINE_CACHE_STALE_TTL 以内なら古いデータを即座に返し、裏で再取得する (stale-while-revalidate)。
+    - キャッシュが無い場合は、キーごとに1つのリクエストだけがNewsAPIを呼び、他はその結果を待つ (single-flight)。
+
+    single-flight と裏での再取得のロックは、全てのプロセスで共有するDBのロック (oogiri/locks.py) で取る。
+    Djangoのキャッシュの add は FileBasedCache などでは原子的でなく、複数のプロセスが同時にロックを取れてしまうため使わない。
+    キャッシュ自体は全てのプロセスで共有するバックエンド (FileBasedCache・Redis・Memcached など) にすること
+    (LocMemCache ではプロセスごとにNewsAPIを呼ぶ)。
+    """
+    key_prefix = 'news_headlines'
+    # 他のリクエストの取得完了を待つ間隔 (秒)
+    poll_interval = 0.05
+
+    def __init__(self, ttl: int | None = None, stale_ttl: int | None = None, lock_timeout: int | None = None):
+        self.ttl = settings.NEWS_HEADLINE_CACHE_TTL if ttl is None else ttl
+        self.stale_ttl = settings.NEWS_HEADLINE_CACHE_STALE_TTL if stale_ttl is None else stale_ttl
+        # NewsAPIのタイムアウト (30秒) より長くしておき、取得中にロックが切れないようにする
+        self.lock_timeout = settings.NEWS_HEADLINE_CACHE_LOCK_TIMEOUT if lock_timeout is None else lock_timeout
+
+    def make_key(self, theme: str, from_date: str, to_date: str, max_count: int) -> str:
+        # memcachedなどは日本語のキーを扱えないため、テーマはハッシュ化する
+        theme_hash = hashlib.sha256(theme.encode('utf-8')).hexdigest()[:16]
+        return f"{self.key_prefix}:{theme_hash}:{from_date}:{to_date}:{max_count}"
+
+    def _lock_key(self, key: str) -> str:
+        return f"{key}:lock"
+
+    def _is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry['fetched_at'] < self.ttl
+
+    def _store(self, key: str, titles: list[str]) -> None:
+        # 取得失敗 (空リスト) は保存しない。古いデータがあればそちらを返し続ける
+        if titles:
+            cache.set(key, {'titles': titles, 'fetched_at': time.time()}, self.ttl + self.stale_ttl)
+
+    def _log_served(self, entry: dict) -> None:
+        # 返したデータの経過時間 (先読みが追いついているかの指標)
+        age = time.time() - entry['fetched_at']
+        logger.info("ヘッドラインキャッシュから返却: 経過 %.0f秒 (%s)", age, '新鮮' if age < self.ttl else '期限切れ')
+
+    def entry_age(self, key: str) -> float | None:
+        """
+        キャッシュされているデータの経過秒数を返す。キャッシュが無い場合は None。
+        """
+        entry = cache.get(key)
+        return None if entry is None else time.time() - entry['fetched_at']
+
+    async def arefresh(self, key: str, afetch) -> list[str]:
+        """
+        キャッシュの状態に関係なく afetch() で取得し直して保存する (先読みコマンド用)。
+        """
+        titles = await afetch()
+        await sync_to_async(self._store)(key, titles)
+        return titles
+
+    def _refresh_in_background(self, key: str, fetch, token: str) -> None:
+        # ロックは呼び出し側で取得済み。再取得が終わったら解放する
+        def refresh():
+            try:
+                self._store(key, fetch())
+            finally:
+                release_lock(self._lock_key(key), token)
+                # 取得したタイトルの保存でこのスレッドが開いたDB接続を閉じる
+                connections.close_all()
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def get_or_fetch(self, key: str, fetch) -> list[str]:
+        """
+        キャッシュからタイトルを返す。無い場合は fetch() でNewsAPIから取得して保存する。
+        """
+        entry = cache.get(key)
+        if entry is not None:
+            self._log_served(entry)
+            if not self._is_fresh(entry):
+                token = acquire_lock(self._lock_key(key), self.lock_timeout)
+                if token is not None:
+                    self._refresh_in_background(key, fetch, token)
+            return entry['titles']
+
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            token = acquire_lock(self._lock_key(key), self.lock_timeout)
+            if token is not None:
+                try:
+                    titles = fetch()
+                    self._store(key, titles)
+                    return titles
+                finally:
+                    release_lock(self._lock_key(key), token)
+
+            # 他のリクエストが取得中のため、結果が保存されるのを待つ
+            time.sleep(self.poll_interval)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry['titles']
+
+        # ロックを持つリクエストが応答しない場合は、自分で取得する
+        return fetch()
+
+    async def aget_or_fetch(self, key: str, afetch, fetch) -> list[str]:
+        """
+        get_or_fetch の非同期版。
+        バックグラウンドでの再取得はイベントループの寿命に依存しないよう、同期版の fetch をスレッドで実行する。
+        """
+        entry = await cache.aget(key)
+        if entry is not None:
+            self._log_served(entry)
+            if not self._is_fresh(entry):
+                token = await sync_to_async(acquire_lock)(self._lock_key(key), self.lock_timeout)
+                if token is not None:
+                    self._refresh_in_background(key, fetch, token)
+            return entry['titles']
+
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            token = await sync_to_async(acquire_lock)(self._lock_key(key), self.lock_timeout)
+            if token is not None:
+                try:
+                    titles = await afetch()
+                    await sync_to_async(self._store)(key, titles)
+                    return titles
+                finally:
+                    await sync_to_async(release_lock)(self._lock_key(key), token)
+
+            await asyncio.sleep(self.poll_interval)
+            entry = await cache.aget(key)
+            if entry is not None:
+                return entry['titles']
+
+        return await afetch()
+
 
 # NewsAPIと連携し、ニュースタイトルを取得するクラス
 class NewsService:
@@ -19,19 +192,46 @@ class NewsService:
         # NewsApiClientの初期化
         self.newsapi = NewsApiClient(api_key=self.api_key)
 
-    def get_recent_headlines(self, theme: str, max_count: int = 100) -> list[str]:
+    def _date_window(self) -> tuple[str, str]:
         """
-        指定されたテーマと期間（過去30日間）に基づいてニュースタイトルを取得する。
+        ニュースの取得期間（過去30日間）を NewsAPI の形式 'YYYY-MM-DD' で返す。
         """
-        
-        # ニュースの期間の定義（過去30日間）
-        # NewsAPIの形式: 'YYYY-MM-DD'
         today = datetime.now()
-        fourteen_days_ago = today - timedelta(days=30)
-        
-        from_date_str = fourteen_days_ago.strftime('%Y-%m-%d')
-        to_date_str = today.strftime('%Y-%m-%d')
-        
+        thirty_days_ago = today - timedelta(days=30)
+        return thirty_days_ago.strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d')
+
+    def _extract_titles(self, response: dict) -> list[str]:
+        """
+        NewsAPIのレスポンス(dict)からタイトルのリストを取り出す。エラー時は空リスト。
+        """
+        # エラーチェック
+        if response.get('status') != 'ok':
+            logger.warning(f"NewsAPIエラー: {response.get('code')}, {response.get('message')}")
+            return []
+
+        # タイトルをリストとして抽出
+        # 最大100個に満たなかった場合はそのまま返す (要件2に適合)
+        return [article['title'] for article in response['articles']]
+
+    def _record_headlines(self, theme: str, response: dict) -> None:
+        """
+        取得したニュースタイトルをURLと一緒にDBに保存する (oogiri/headline_store.py)。
+        保存に失敗しても、取得したタイトルはそのまま使う。
+        """
+        if response.get('status') != 'ok':
+            return
+        articles = response['articles']
+        try:
+            record_headlines(
+                theme, [article.get('title') or '' for article in articles], [article.get('url') or '' for article in articles]
+            )
+        except Exception as e:
+            logger.warning(f"ニュースタイトルの保存に失敗しました: {e}")
+
+    def _fetch_headlines(self, theme: str, max_count: int, from_date_str: str, to_date_str: str) -> list[str]:
+        """
+        NewsApiClient でNewsAPIからタイトルを取得する (キャッシュを経由しない)。
+        """
         try:
             # NewsAPIの 'everything' エンドポイントを使用
             # q=テーマ, language=日本語, sortBy=新着順, 期間指定
@@ -43,23 +243,79 @@ class NewsService:
                 to=to_date_str,
                 page_size=max_count,    # 最大100個を取得
             )
-
-            # エラーチェック
-            if response['status'] != 'ok':
-                print(f"NewsAPIエラー: {response.get('code')}, {response.get('message')}")
-                return []
-
-            # タイトルをリストとして抽出
-            titles = [article['title'] for article in response['articles']]
-            
-            # 最大100個に満たなかった場合はそのまま返す (要件2に適合)
-            return titles
+            self._record_headlines(theme, response)
+            return self._extract_titles(response)
             
         except Exception as e:
             # APIキーが無効、ネットワークエラーなどの一般的な例外処理
-            print(f"NewsServiceで予期せぬエラーが発生しました: {e}")
+            logger.exception(f"NewsServiceで予期せぬエラーが発生しました: {e}")
+            return []
+
+    async def _afetch_headlines(self, theme: str, max_count: int, from_date_str: str, to_date_str: str) -> list[str]:
+        """
+        _fetch_headlines の非同期版。
+        NewsApiClient (requests) はイベントループをブロックするため、httpx で REST API を直接呼び出す。
+        """
+        try:
+            async with httpx.AsyncClient(timeout=30, verify=_shared_ssl_context()) as client:
+                r = await client.get(
+                    f"{settings.NEWS_API_BASE_URL}/everything",
+                    params={
+                        'q': theme,
+                        'sortBy': 'publishedAt',
+                        'from': from_date_str,
+                        'to': to_date_str,
+                        'pageSize': max_count,
+                    },
+                    headers={'X-Api-Key': self.api_key or ''},
+                )
+            response = r.json()
+            await sync_to_async(self._record_headlines)(theme, response)
+            return self._extract_titles(response)
+
+        except Exception as e:
+            logger.exception(f"NewsServiceで予期せぬエラーが発生しました: {e}")
             return []
 
+    def get_recent_headlines(self, theme: str, max_count: int = 100) -> list[str]:
+        """
+        指定されたテーマと期間（過去30日間）に基づいてニュースタイトルを取得する。
+        取得結果は HeadlineCache にキャッシュされ、同じテーマではNewsAPIを呼ばずに返す。
+        """
+        from_date_str, to_date_str = self._date_window()
+        headline_cache = HeadlineCache()
+        key = headline_cache.make_key(theme, from_date_str, to_date_str, max_count)
+        return headline_cache.get_or_fetch(
+            key, lambda: self._fetch_headlines(theme, max_count, from_date_str, to_date_str)
+        )
+
+    async def aget_recent_headlines(self, theme: str, max_count: int = 100) -> list[str]:
+        """
+        get_recent_headlines の非同期版。
+        """
+        from_date_str, to_date_str = self._date_window()
+        headline_cache = HeadlineCache()
+        key = headline_cache.make_key(theme, from_date_str, to_date_str, max_count)
+        return await headline_cache.aget_or_fetch(
+            key,
+            lambda: self._afetch_headlines(theme, max_count, from_date_str, to_date_str),
+            lambda: self._fetch_headlines(theme, max_count, from_date_str, to_date_str),
+        )
+
+    async def arefresh_headlines(self, theme: str, max_count: int = 100) -> tuple[list[str], float | None]:
+        """
+        キャッシュを使わずにNewsAPIから取得し直し、リクエスト時と同じキーでキャッシュに保存する (先読みコマンド用)。
+        取得したタイトルと、更新前のキャッシュの経過秒数 (無ければ None) を返す。
+        """
+        from_date_str, to_date_str = self._date_window()
+        headline_cache = HeadlineCache()
+        key = headline_cache.make_key(theme, from_date_str, to_date_str, max_count)
+        previous_age = await sync_to_async(headline_cache.entry_age)(key)
+        titles = await headline_cache.arefresh(
+            key, lambda: self._afetch_headlines(theme, max_count, from_date_str, to_date_str)
+        )
+        return titles, previous_age
+
 # テスト用ダミーデータ取得関数 (APIキー未設定時の代替)
 def get_dummy_headlines(theme: str) -> list[str]:
     return [
@@ -71,45 +327,260 @@ def get_dummy_headlines(theme: str) -> list[str]:
 
 
 # Few-Shotプロンプト用のデータ取得ヘルパー関数
-def get_few_shot_questions(theme: str, max_examples: int = 5) -> list[str]:
+def get_few_shot_questions(theme: str, max_examples: int = 5, headlines: list[str] | None = None) -> list[str]:
     """
     指定されたテーマと「is_excellent=True」に基づき、Few-Shotに利用するお題を取得する。
-    登録日時が新しいものを優先する (要件5)。
+    headlines を指定した場合はニュースタイトルに近いお題を、それ以外は登録日時が新しいものを優先する (要件5)。
     """
     try:
-        # is_excellent=True でフィルタリング
-        # ordering=['-created_at'] (新しいものを優先) は、モデルのMetaクラスで既に定義済みのため不要
-        excellent_questions = Question.objects.filter(
-            theme=theme,
-            is_excellent=True
-        ).order_by('-created_at')[:max_examples] # 上位 max_examples 件を取得
-
-        # お題のテキストだけをリストにして返す
-        return [q.question_text for q in excellent_questions]
-        
+        # DBを毎回検索せず、テーマごとに新しい順に並べたインデックスから取り出す
+        if headlines:
+            return few_shot_index.similar_questions(theme, "\n".join(headlines), max_examples)
+        return few_shot_index.excellent_questions(theme, max_examples)
+
     except Exception as e:
-        print(f"Few-Shotデータ取得エラー: {e}")
+        logger.exception(f"Few-Shotデータ取得エラー: {e}")
         return []
 
 
+def save_generated_questions(user, theme: str, headlines: list[str], question_texts: list[str],
+                             is_pooled: bool = False, store_headlines: bool = True) -> list[int]:
+    """
+    生成されたお題をDBに保存し、作成したQuestionのIDリスト (question_texts と同じ順) を返す。
+    非同期ビューからは sync_to_async 経由で呼び出す。
+    is_pooled=True の場合はユーザーに提案せず、お題プールに貯めておく。
+    store_headlines=False の場合 (ダミーのタイトルを使ったとき) は、タイトルの組だけを保存し、ニュースタイトルとしては保存しない。
+    """
+    headline_set = None
+    source_title = None
+    if not headlines:
+        source_title = f"{theme}に関するニュース"
+
+    with transaction.atomic():
+        if headlines:
+            # ニュースタイトルの組は1回だけ保存し、お題からはそれを参照する (同じ組は既存の行を使う)
+            joined = "\n".join(headlines)
+            headline_set, created = HeadlineSet.objects.get_or_create(
+                digest=hashlib.sha256(joined.encode('utf-8')).hexdigest(), defaults={'headlines': joined}
+            )
+            if created and store_headlines:
+                # 組に含まれるタイトルを1件ずつのニュースタイトルとして参照する (NewsAPIから取得したときに保存済みのものが多い)
+                # 取得したわけではないため、テーマと最終取得日時は記録しない (NewsAPIから取得したときだけ記録する)
+                headline_set.news_headlines.set(record_headlines(None, headlines, fetched=False))
+        # 生成直後のお題は「特に面白い」が付いていないため、シグナル (Few-shotの事例の更新など) を送らない bulk_create で保存する
+        questions = Question.objects.bulk_create(
+            Question(
+                user=user,
+                theme=theme,
+                headline_set=headline_set,
+                source_title=source_title,
+                question_text=question_text,
+                is_manual=False,
+                is_pooled=is_pooled,
+            )
+            for question_text in question_texts
+        )
+        # 以降に生成するお題の重複判定に使う (bulk_create ではシグナルが送られないため、ここで登録する)
+        index_questions(questions)
+    return [question.id for question in questions]
+
+
+def count_pooled_questions(theme: str) -> int:
+    """
+    指定テーマのお題プールに残っている (未提案の) お題の数を返す。
+    """
+    return Question.objects.filter(theme=theme, is_pooled=True).count()
+
+
+def take_pooled_questions(user, theme: str, count: int = 3, max_retries: int = 3) -> list[tuple[int, str]]:
+    """
+    お題プールから古い順に count 件を取り出してユーザーに割り当て、(ID, お題の本文) のリストを返す。
+    プールの残りが count 件に満たない場合は何も取り出さずに空リストを返す。
+
+    PostgreSQLなどでは select_for_update(skip_locked=True) で他のリクエストがロック中の行を飛ばす。
+    SQLiteのように行ロックが無いDBでは、is_pooled=True を条件に更新した件数で取り合いを検出し、やり直す。
+    """
+    for _ in range(max_retries):
+        with transaction.atomic():
+            questions = list(
+                Question.objects.select_for_update(skip_locked=True)
+                .filter(theme=theme, is_pooled=True)
+                .order_by('created_at', 'id')
+                .values_list('id', 'question_text')[:count]
+            )
+            if len(questions) < count:
+                return []
+            question_ids = [question_id for question_id, _ in questions]
+
+            updated = Question.objects.filter(id__in=question_ids, is_pooled=True).update(
+                is_pooled=False, user=user
+            )
+            if updated == count:
+                return questions
+
+            # 他のリクエストが同じお題を先に取り出した場合は、この取り出しを取り消して選び直す
+            transaction.set_rollback(True)
+    return []
+
+
 # Gemini AIと連携し、お題を取得するクラス
-class GeminiService:
+# LLMバックエンドの1つ ('gemini')。どのタスクに使うかは settings.LLM_BACKENDS で選ぶ (oogiri/llm_backends.py)
+class GeminiService(LLMBackend):
     def __init__(self):
         # settings.pyからAPIキーを取得し、クライアントを初期化
         self.api_key = settings.GEMINI_API_KEY
-        self.client = genai.Client(api_key=self.api_key)
+        # SSLコンテキストは共有のものを渡す ('ssl' はSDK内部のWebSocket接続用)
+        http_options = {
+            'client_args': {'verify': _shared_ssl_context()},
+            'async_client_args': {'verify': _shared_ssl_context(), 'ssl': _shared_ssl_context()},
+        }
+        # GEMINI_API_BASE_URL が設定されている場合は接続先を差し替える (負荷試験用のスタブサーバーなど)
+        if settings.GEMINI_API_BASE_URL:
+            http_options['base_url'] = settings.GEMINI_API_BASE_URL
+        self.client = genai.Client(api_key=self.api_key, http_options=http_options)
         self.model = 'gemini-2.5-flash' # 応答速度を考慮してFlashモデルを選択
+        # システム命令とFew-Shot事例 (プロンプトの共通部分) をGemini側にキャッシュして再利用する
+        self.prompt_cache = PromptPrefixCache()
 
-    def generate_questions(self, headlines: list[str], theme: str) -> list[str] | str:
+    def _generate(self, system_instruction: str, prefix: str, suffix: str):
         """
-        ニュースタイトルリストに基づき、大喜利のお題を3つJSON形式で生成する。
-        成功時はお題のリストを、失敗時はエラーメッセージを返す。
+        共通部分 (system_instruction + prefix) と毎回変わる部分 (suffix) からなるプロンプトでGeminiを呼び出す。
+        共通部分のキャッシュがあれば suffix だけを送り、無ければ全文を同じ順序で送る。
         """
-        # --- 1. Few-Shot事例の取得 ---
-        # トークン長を意識して、10個を上限とする
-        few_shot_examples = get_few_shot_questions(theme=theme, max_examples=10)
+        cache_name = self.prompt_cache.get_or_create(self.client, self.model, system_instruction, prefix)
+        if cache_name:
+            try:
+                response = self.client.models.generate_content(
+                    model=self.model,
+                    contents=[suffix],
+                    config={"cached_content": cache_name}
+                )
+                record_usage(response)
+                return response
+            except APIError as e:
+                if e.code not in (403, 404):
+                    raise
+                # Gemini側でキャッシュが期限切れ・削除済みの場合は記録を消し、全文を送る
+                self.prompt_cache.forget(self.model, system_instruction, prefix)
 
-        # --- 2. プロンプトの構築 ---
+        response = self.client.models.generate_content(
+            model=self.model,
+            contents=[prefix, suffix] if prefix else [suffix],
+            config={"system_instruction": system_instruction}
+        )
+        record_usage(response)
+        return response
+
+    async def _agenerate(self, system_instruction: str, prefix: str, suffix: str):
+        """
+        _generate の非同期版。
+        """
+        cache_name = await self.prompt_cache.aget_or_create(self.client, self.model, system_instruction, prefix)
+        if cache_name:
+            try:
+                response = await self.client.aio.models.generate_content(
+                    model=self.model,
+                    contents=[suffix],
+                    config={"cached_content": cache_name}
+                )
+                await sync_to_async(record_usage)(response)
+                return response
+            except APIError as e:
+                if e.code not in (403, 404):
+                    raise
+                await sync_to_async(self.prompt_cache.forget)(self.model, system_instruction, prefix)
+
+        response = await self.client.aio.models.generate_content(
+            model=self.model,
+            contents=[prefix, suffix] if prefix else [suffix],
+            config={"system_instruction": system_instruction}
+        )
+        await sync_to_async(record_usage)(response)
+        return response
+
+    def _iter_stream_text(self, stream):
+        response = None
+        for response in stream:
+            if response.text:
+                yield response.text
+        if response is not None:
+            # トークン数は最後のチャンクの usage_metadata に応答全体の分が入っている
+            record_usage(response)
+
+    def _generate_stream(self, system_instruction: str, prefix: str, suffix: str):
+        """
+        _generate のストリーミング版。応答のテキストを届いた分ずつ返すジェネレーター。
+        """
+        cache_name = self.prompt_cache.get_or_create(self.client, self.model, system_instruction, prefix)
+        if cache_name:
+            stream = self.client.models.generate_content_stream(
+                model=self.model,
+                contents=[suffix],
+                config={"cached_content": cache_name}
+            )
+            started = False
+            try:
+                for text in self._iter_stream_text(stream):
+                    started = True
+                    yield text
+                return
+            except APIError as e:
+                # キャッシュが見つからないエラーは最初のチャンクより前に返るため、全文を送り直せる
+                if started or e.code not in (403, 404):
+                    raise
+                self.prompt_cache.forget(self.model, system_instruction, prefix)
+
+        stream = self.client.models.generate_content_stream(
+            model=self.model,
+            contents=[prefix, suffix] if prefix else [suffix],
+            config={"system_instruction": system_instruction}
+        )
+        yield from self._iter_stream_text(stream)
+
+    async def _aiter_stream_text(self, stream):
+        response = None
+        async for response in stream:
+            if response.text:
+                yield response.text
+        if response is not None:
+            await sync_to_async(record_usage)(response)
+
+    async def _agenerate_stream(self, system_instruction: str, prefix: str, suffix: str):
+        """
+        _generate_stream の非同期版。
+        """
+        cache_name = await self.prompt_cache.aget_or_create(self.client, self.model, system_instruction, prefix)
+        if cache_name:
+            started = False
+            try:
+                stream = await self.client.aio.models.generate_content_stream(
+                    model=self.model,
+                    contents=[suffix],
+                    config={"cached_content": cache_name}
+                )
+                async for text in self._aiter_stream_text(stream):
+                    started = True
+                    yield text
+                return
+            except APIError as e:
+                if started or e.code not in (403, 404):
+                    raise
+                await sync_to_async(self.prompt_cache.forget)(self.model, system_instruction, prefix)
+
+        stream = await self.client.aio.models.generate_content_stream(
+            model=self.model,
+            contents=[prefix, suffix] if prefix else [suffix],
+            config={"system_instruction": system_instruction}
+        )
+        async for text in self._aiter_stream_text(stream):
+            yield text
+
+    def _build_question_prompt(self, headlines: list[str], few_shot_examples: list[str]) -> tuple[str, str, str]:
+        """
+        お題生成用の (system_instruction, prefix, suffix) を組み立てる。
+        同期版・非同期版で共通のプロンプトを使うために切り出している。
+        prefix (Few-Shotの例) はテーマごとに共通なので先に置き、毎回変わるニュースタイトルは suffix に置く。
+        """
         headline_text = "\n".join([f"- {h}" for h in headlines])
         
         # Few-Shotセクションの構築
@@ -132,101 +603,195 @@ class GeminiService:
         )
         
         # ユーザープロンプト (RAGとFew-Shotを統合)
-        user_prompt = (
+        # Few-Shotの例 (共通部分) を先に、ニュースタイトル (毎回変わる部分) を後に置く
+        prefix = ""
+        if few_shot_text:
+            prefix = (
+                f"--- 面白いお題の例 ---"
+                f"{few_shot_text}\n\n" # Few-Shotの例をプロンプトに組み込む
+            )
+        suffix = (
             "以下のニュースタイトルを見て、3つのお題をJSON形式で提案してください。"
-            "また面白いお題の例を参考にしてください:\n\n"
+            "また面白いお題の例があれば参考にしてください:\n\n"
             f"--- ニュースタイトル ---\n"
             f"{headline_text}"
-            f"--- 面白いお題の例 ---"
-            f"{few_shot_text}" # Few-Shotの例をプロンプトに組み込む
         )
+        return system_instruction, prefix, suffix
 
+    def _parse_questions(self, raw_text: str) -> list[str] | str:
+        """
+        Geminiの応答テキストをパースし、お題のリストを返す。失敗時はエラーメッセージを返す。
+        """
+        raw_text = raw_text.strip()
+        
+        # JSONブロックが検出された場合、それを抽出
+        if raw_text.startswith('```json') and raw_text.endswith('```'):
+             raw_text = raw_text.strip('```json').strip('```').strip()
+        
         try:
-            # --- 2. API呼び出し ---
-            # response = self.client.models.generate_content(...)
-            # 簡潔にするため、 generate_content の呼び出しを仮で記述
-            response = self.client.models.generate_content(
-                model=self.model,
-                contents=[user_prompt],
-                config={"system_instruction": system_instruction}
-            )
-
-            raw_text = response.text.strip()
-            
-            # --- 3. JSONパースとバリデーション (フェーズ3で提案したロジック) ---
-            
-            # JSONブロックが検出された場合、それを抽出
-            if raw_text.startswith('```json') and raw_text.endswith('```'):
-                 raw_text = raw_text.strip('```json').strip('```').strip()
-            
-            # JSONパース
             data = json.loads(raw_text)
-            
-            # 構造検証
-            if 'questions' not in data:
-                return "AIからの応答構造が不正です: 'questions'キーが見つかりません。"
-            
-            questions = data['questions']
-            
-            if not isinstance(questions, list) or len(questions) != 3:
-                return "AIからの応答構造が不正です: お題が3つのリストではありません。"
-            
-            return questions
-
         except json.JSONDecodeError:
             return "AIからの応答が不正です。JSON形式で出力されていません。"
+        
+        # 構造検証
+        if 'questions' not in data:
+            return "AIからの応答構造が不正です: 'questions'キーが見つかりません。"
+        
+        questions = data['questions']
+        
+        if not isinstance(questions, list) or len(questions) != 3:
+            return "AIからの応答構造が不正です: お題が3つのリストではありません。"
+        
+        return questions
+
+    def generate_questions(self, headlines: list[str], theme: str) -> list[str] | str:
+        """
+        ニュースタイトルリストに基づき、大喜利のお題を3つJSON形式で生成する。
+        成功時はお題のリストを、失敗時はエラーメッセージを返す。
+        """
+        # --- 1. Few-Shot事例の取得 ---
+        # トークン長を意識して、ニュースに近いものを FEW_SHOT_QUESTION_EXAMPLES 個だけ入れる
+        few_shot_examples = get_few_shot_questions(
+            theme=theme, max_examples=settings.FEW_SHOT_QUESTION_EXAMPLES, headlines=headlines
+        )
+
+        # --- 2. プロンプトの構築 ---
+        system_instruction, prefix, suffix = self._build_question_prompt(headlines, few_shot_examples)
+
+        try:
+            # --- 3. API呼び出し (共通部分はキャッシュを再利用する) ---
+            response = self._generate(system_instruction, prefix, suffix)
+
+            # --- 4. JSONパースとバリデーション ---
+            return self._parse_questions(response.text)
+
         except APIError as e:
             return f"Gemini APIエラーが発生しました: {e}"
         except Exception as e:
             return f"予期せぬエラーが発生しました: {e}"
-            
-        # ----------------------------------------------------------------
 
-    def _get_few_shot_examples(self, limit=3):
+    async def agenerate_questions(self, headlines: list[str], theme: str) -> list[str] | str:
+        """
+        generate_questions の非同期版。
+        Few-Shot取得(ORM)はスレッドで実行し、Gemini呼び出しは client.aio でイベントループ上で待つ。
+        """
+        few_shot_examples = await sync_to_async(get_few_shot_questions)(
+            theme=theme, max_examples=settings.FEW_SHOT_QUESTION_EXAMPLES, headlines=headlines
+        )
+
+        system_instruction, prefix, suffix = self._build_question_prompt(headlines, few_shot_examples)
+
+        try:
+            response = await self._agenerate(system_instruction, prefix, suffix)
+            return self._parse_questions(response.text)
+
+        except APIError as e:
+            return f"Gemini APIエラーが発生しました: {e}"
+        except Exception as e:
+            return f"予期せぬエラーが発生しました: {e}"
+
+    async def astream_questions(self, headlines: list[str], theme: str):
+        """
+        agenerate_questions のストリーミング版。
+        応答のJSONを届いた分ずつ読み、`questions` の配列のお題が1つ閉じるたびに返す。
+        """
+        few_shot_examples = await sync_to_async(get_few_shot_questions)(
+            theme=theme, max_examples=settings.FEW_SHOT_QUESTION_EXAMPLES, headlines=headlines
+        )
+
+        system_instruction, prefix, suffix = self._build_question_prompt(headlines, few_shot_examples)
+
+        parser = JSONArrayStream('questions')
+        emitted = 0
+        try:
+            async for text in self._agenerate_stream(system_instruction, prefix, suffix):
+                for question_text in parser.feed(text):
+                    if emitted < 3 and isinstance(question_text, str) and question_text.strip():
+                        emitted += 1
+                        yield question_text
+        except APIError as e:
+            raise StreamingError(f"Gemini APIエラーが発生しました: {e}") from e
+        except Exception as e:
+            raise StreamingError(f"予期せぬエラーが発生しました: {e}") from e
+
+        if emitted < 3:
+            raise StreamingError("AIからの応答構造が不正です: お題が3つのリストではありません。")
+
+    def generate_answers(self, question: Question, count: int = 1, max_time: float | None = None) -> list[str] | str:
+        """
+        お題に対する大喜利の回答を count 個生成する (1回のリクエストでまとめて生成するため max_time は使わない)。
+        成功時は回答のリストを、失敗時はエラーメッセージを返す。
+        """
+        system_instruction = (
+            "あなたはプロの大喜利回答者です。与えられたお題に対して、面白くてユニークな回答を考案し、"
+            "**必ずJSON形式**で出力してください。"
+            "JSONのキーは`answers`とし、その値は指定された数の文字列（回答）を持つ配列とすること。"
+            "**回答の文章以外のテキストは一切含めないでください。**"
+        )
+        suffix = f"以下のお題に対する回答を{count}個、JSON形式で提案してください。\n\n【お題】{question.question_text}\n"
+        if question.source_text:
+            suffix += f"【背景ニュース】{question.source_text}\n"
+
+        try:
+            response = self._generate(system_instruction, "", suffix)
+            raw_text = response.text.strip()
+        except APIError as e:
+            return f"Gemini APIエラーが発生しました: {e}"
+        except Exception as e:
+            return f"予期せぬエラーが発生しました: {e}"
+
+        if raw_text.startswith('```json') and raw_text.endswith('```'):
+             raw_text = raw_text.strip('```json').strip('```').strip()
+        try:
+            data = json.loads(raw_text)
+        except json.JSONDecodeError:
+            return "AIからの応答が不正です。JSON形式で出力されていません。"
+
+        answers = data.get('answers') if isinstance(data, dict) else None
+        if not isinstance(answers, list) or not answers:
+            return "AIからの応答構造が不正です: 'answers'キーが見つかりません。"
+        return [str(answer) for answer in answers[:count]]
+
+    def _get_few_shot_examples(self, question_text: str, limit: int | None = None):
         """データベースから Few-Shot 候補の回答と評価を取得し、JSON形式の文字列に整形する"""
-        
-        # '特に面白い'フラグが立っている回答をランダムに3件取得
-        examples = Answer.objects.filter(is_excellent_answer=True).order_by('?')[:limit]
-        
-        few_shot_text = []
-        for example in examples:
-            
-            # ★★★ ここが具体的な整形ロジックです ★★★
-            example_data = {
-                "お題": example.question.question_text, # AnswerからQuestionオブジェクトを経由してお題を取得
-                "回答": example.answer_text,
-                "評価結果": {
-                    "score": example.score,
-                    "commentary": example.commentary
-                }
-            }
-            # JSON文字列に変換し、日本語が化けないように ensure_ascii=False を指定
-            # indent=2 で整形し、プロンプト内で見やすくする
-            json_string = json.dumps(example_data, ensure_ascii=False, indent=2)
-            
-            # AIへの指示として「事例:」という見出しを付けて追加
-            few_shot_text.append(f"事例:\n{json_string}")
-            # ★★★ 整形ロジックここまで ★★★
+        if limit is None:
+            limit = settings.FEW_SHOT_ANSWER_EXAMPLES
+
+        # '特に面白い'フラグが立っている回答から、採点するお題に近いお題への回答を選ぶ
+        # ORDER BY RANDOM() で全件を並べ替えないよう、整形済みの事例のインデックスから選ぶ (oogiri/few_shot.py)
+        # 同じお題への回答の採点では同じ事例の組になるため、プロンプトの共通部分のキャッシュが効く
+        # 近い事例が足りない分は、GEMINI_PROMPT_CACHE_TTL の間は同じ組になるようランダムに選ぶ
+        rotation = int(time.time() // settings.GEMINI_PROMPT_CACHE_TTL)
+        few_shot_text = few_shot_index.similar_answer_examples(question_text, limit, seed=rotation)
             
         # 複数の事例を区切り文字 (---) で結合して一つの文字列として返す
         return "\n\n---\n\n".join(few_shot_text)
+
+    def _build_evaluation_prefix(self, few_shot_examples: str) -> str:
+        """
+        採点用プロンプトの共通部分 (Few-Shot事例) を組み立てる。
+        """
+        return (
+            f"---【評価の参考にすべき事例】---\n"
+            f"あなたは、以下の過去の模範解答と評価結果のパターンを参考に、今回の回答を評価してください。\n"
+            f"{few_shot_examples}"
+            f"---------------------------------\n\n"
+        )
     
 
-def evaluate_answer(self, question: Question, answer_text: str) -> dict | str:
+    def _build_evaluation_prompt(self, question: Question, answer_text: str) -> tuple[str, str, str]:
         """
-        お題と回答を受け取り、面白さを評価してJSONで返す。
-        戻り値の形式: {"score": int, "comment": str}
+        1件の採点用の (system_instruction, prefix, suffix) を組み立てる。
         """
-        
         # 1. Few-Shot 事例を取得
         # self._get_few_shot_examples メソッドが定義されていることが前提
-        few_shot_examples = self._get_few_shot_examples(limit=3) 
+        few_shot_examples = self._get_few_shot_examples(question.question_text)
 
         # 2. プロンプトの構築
         # 元ネタのニュースがある場合はコンテキストとして含める
         source_info = ""
-        if question.source_title:
-            source_info = f"元ネタのニュース: {question.source_title}\n"
+        if question.source_text:
+            source_info = f"元ネタのニュース: {question.source_text}\n"
 
         # 3. system_instruction (役割と出力形式の定義)
         # Few-Shotの参照指示を加え、講評の精度を高める
@@ -239,47 +804,200 @@ def evaluate_answer(self, question: Question, answer_text: str) -> dict | str:
         )
 
         # 4. user_prompt (評価対象とFew-Shot事例のコンテキスト)
-        user_prompt = (
-            f"以下の大喜利のお題に対する回答を評価してください。\n\n"
-            
-            f"---【評価の参考にすべき事例】---\n"
-            f"あなたは、以下の過去の模範解答と評価結果のパターンを参考に、今回の回答を評価してください。\n"
-            f"{few_shot_examples}"
-            f"---------------------------------\n\n"
+        # Few-Shot事例 (共通部分) を先に、評価対象 (毎回変わる部分) を後に置く
+        prefix = self._build_evaluation_prefix(few_shot_examples)
+        suffix = (
+            f"以下の大喜利のお題に対する回答を、上の事例を参考に評価してください。\n\n"
             
             f"【今回の評価対象】\n"
             f"{source_info}"
             f"お題: {question.question_text}\n"
             f"回答: {answer_text}\n"
         )
+        return system_instruction, prefix, suffix
 
+    def _parse_evaluation(self, raw_text: str) -> dict | str:
+        """
+        1件の採点の応答テキストをパースし、採点結果の辞書を返す。失敗時はエラーメッセージを返す。
+        """
+        raw_text = raw_text.strip()
+        
+        if raw_text.startswith('```json') and raw_text.endswith('```'):
+             raw_text = raw_text.strip('```json').strip('```').strip()
+        
         try:
-            response = self.client.models.generate_content(
-                model=self.model,
-                # contents=[user_prompt] と system_instruction を分けて渡す方式を維持
-                contents=[user_prompt], 
-                config={"system_instruction": system_instruction}
-            )
-
-            # ... (中略: JSONパースと構造検証ロジックはそのまま維持) ...
-            raw_text = response.text.strip()
-            
-            if raw_text.startswith('```json') and raw_text.endswith('```'):
-                 raw_text = raw_text.strip('```json').strip('```').strip()
-            
             data = json.loads(raw_text)
+        except json.JSONDecodeError:
+            return "AIからの応答が不正です。JSON形式で出力されていません。"
+        
+        # 構造検証
+        if not isinstance(data, dict) or 'score' not in data or 'comment' not in data:
+            return "AIからの応答構造が不正です: scoreまたはcommentがありません。"
+        
+        return data # 成功時は辞書を返す
+
+    def evaluate_answer(self, question: Question, answer_text: str) -> dict | str:
+        """
+        お題と回答を受け取り、面白さを評価してJSONで返す。
+        戻り値の形式: {"score": int, "comment": str}
+        """
+        system_instruction, prefix, suffix = self._build_evaluation_prompt(question, answer_text)
+
+        try:
+            # system_instruction と共通部分はキャッシュを再利用する
+            response = self._generate(system_instruction, prefix, suffix)
+            return self._parse_evaluation(response.text)
+
+        except Exception as e:
+            # 予期せぬエラーの場合、ログを出力することが望ましい
+            logger.error(f"予期せぬエラーが発生しました: {e}", exc_info=True)
+            return f"予期せぬエラーが発生しました: {e}"
+
+    def evaluate_answer_streaming(self, question: Question, answer_text: str, on_partial) -> dict | str:
+        """
+        evaluate_answer のストリーミング版。応答を届いた分ずつ読み、書きかけの`comment`を on_partial に渡す。
+        """
+        system_instruction, prefix, suffix = self._build_evaluation_prompt(question, answer_text)
+
+        raw_text = ""
+        comment = None
+        try:
+            for text in self._generate_stream(system_instruction, prefix, suffix):
+                raw_text += text
+                partial_comment = partial_string_value(raw_text, 'comment')
+                if partial_comment and partial_comment != comment:
+                    comment = partial_comment
+                    on_partial(comment)
+        except Exception as e:
+            logger.error(f"予期せぬエラーが発生しました: {e}", exc_info=True)
+            return f"予期せぬエラーが発生しました: {e}"
+        return self._parse_evaluation(raw_text)
+
+    def _build_batch_evaluation_prompt(self, question: Question, answers: list[tuple[int, str]]) -> tuple[str, str, str]:
+        """
+        まとめて採点する用の (system_instruction, prefix, suffix) を組み立てる。
+        """
+        # Few-Shot事例とシステム命令は回答数に関係なく1回だけ送る
+        few_shot_examples = self._get_few_shot_examples(question.question_text)
+
+        source_info = ""
+        if question.source_text:
+            source_info = f"元ネタのニュース: {question.source_text}\n"
+
+        system_instruction = (
+            "あなたは厳しくも愛のある大喜利のプロ審査員です。"
+            "提供される【評価の参考にすべき事例】を参考に、評価基準と講評のトーンを学習し、今回の回答を評価してください。"
+            "同じお題に対する複数の回答が番号付きで与えられます。それぞれを独立に5段階で評価し、短い講評コメントを行ってください。"
+            "出力は必ずJSON形式で、キー`results`の値を配列とし、各要素は回答の番号`id`（整数）、整数型の`score`（1〜5）、"
+            "文字列型の`comment`を含むオブジェクトにしてください。"
+            "JSON以外のテキストは出力しないでください。"
+        )
+
+        answers_json = json.dumps(
+            [{"id": answer_id, "回答": answer_text} for answer_id, answer_text in answers],
+            ensure_ascii=False, indent=2
+        )
+        prefix = self._build_evaluation_prefix(few_shot_examples)
+        suffix = (
+            f"以下の大喜利のお題に対する{len(answers)}個の回答を、上の事例を参考に評価してください。\n\n"
             
-            # 構造検証
-            if 'score' not in data or 'comment' not in data:
-                return "AIからの応答構造が不正です: scoreまたはcommentがありません。"
-            
-            return data # 成功時は辞書を返す
+            f"【今回の評価対象】\n"
+            f"{source_info}"
+            f"お題: {question.question_text}\n"
+            f"回答:\n{answers_json}\n"
+        )
+        return system_instruction, prefix, suffix
 
+    def _parse_batch_item(self, item, requested_ids: set[int]) -> tuple[int, dict] | None:
+        """
+        まとめて採点した応答の`results`の要素1つを (回答ID, 採点結果) にする。
+        要求した回答IDでないもの、scoreとcommentが揃っていないものは None。
+        """
+        try:
+            answer_id = int(item['id'])
+            score = int(item['score'])
+            comment = item['comment']
+        except (KeyError, TypeError, ValueError):
+            return None
+        if answer_id in requested_ids and isinstance(comment, str):
+            return answer_id, {"score": score, "comment": comment}
+        return None
+
+    def _parse_batch_evaluations(self, raw_text: str, answers: list[tuple[int, str]]) -> dict[int, dict] | str:
+        raw_text = raw_text.strip()
+
+        if raw_text.startswith('```json') and raw_text.endswith('```'):
+             raw_text = raw_text.strip('```json').strip('```').strip()
+
+        try:
+            data = json.loads(raw_text)
         except json.JSONDecodeError:
             return "AIからの応答が不正です。JSON形式で出力されていません。"
+
+        results = data.get('results') if isinstance(data, dict) else None
+        if not isinstance(results, list):
+            return "AIからの応答構造が不正です: 'results'キーが見つかりません。"
+
+        # 要求した回答IDのうち、scoreとcommentが揃っているものだけを採用する
+        requested_ids = {answer_id for answer_id, _ in answers}
+        evaluations = {}
+        for item in results:
+            parsed = self._parse_batch_item(item, requested_ids)
+            if parsed is not None:
+                answer_id, evaluation_result = parsed
+                evaluations[answer_id] = evaluation_result
+        return evaluations
+
+    def evaluate_answers_batch(self, question: Question, answers: list[tuple[int, str]]) -> dict[int, dict] | str:
+        """
+        同じお題に対する複数の回答を1回のリクエストでまとめて評価する。
+        answers は (回答ID, 回答テキスト) のリスト。
+        戻り値は 回答ID -> {"score": int, "comment": str} の辞書で、応答から読み取れなかった回答は含まれない
+        (呼び出し側で evaluate_answer による個別評価にフォールバックする)。リクエスト自体の失敗時はエラーメッセージを返す。
+        """
+        system_instruction, prefix, suffix = self._build_batch_evaluation_prompt(question, answers)
+
+        try:
+            response = self._generate(system_instruction, prefix, suffix)
+            raw_text = response.text
         except Exception as e:
-            # 予期せぬエラーの場合、ログを出力することが望ましい
-            import logging
-            logger = logging.getLogger(__name__)
             logger.error(f"予期せぬエラーが発生しました: {e}", exc_info=True)
-            return f"予期せぬエラーが発生しました: {e}"
\ No newline at end of file
+            return f"予期せぬエラーが発生しました: {e}"
+
+        return self._parse_batch_evaluations(raw_text, answers)
+
+    def evaluate_answers_batch_streaming(self, question: Question, answers: list[tuple[int, str]],
+                                         on_partial, on_result) -> dict[int, dict] | str:
+        """
+        evaluate_answers_batch のストリーミング版。
+        応答を届いた分ずつ読み、`results`の要素が閉じるたびにその回答の採点結果を on_result に、
+        書きかけの要素の講評を on_partial に渡す。
+        """
+        system_instruction, prefix, suffix = self._build_batch_evaluation_prompt(question, answers)
+
+        requested_ids = {answer_id for answer_id, _ in answers}
+        parser = JSONArrayStream('results')
+        raw_text = ""
+        reported_ids = set()
+        partial = None
+        try:
+            for text in self._generate_stream(system_instruction, prefix, suffix):
+                raw_text += text
+                for item in parser.feed(text):
+                    parsed = self._parse_batch_item(item, requested_ids)
+                    if parsed is not None and parsed[0] not in reported_ids:
+                        reported_ids.add(parsed[0])
+                        on_result(*parsed)
+
+                # 書きかけの要素に回答IDと講評が現れていれば、途中までの講評を渡す
+                id_match = re.search(r'"id"\s*:\s*(\d+)', parser.partial)
+                comment = partial_string_value(parser.partial, 'comment')
+                if id_match and comment and (int(id_match.group(1)), comment) != partial:
+                    partial = (int(id_match.group(1)), comment)
+                    if partial[0] in requested_ids:
+                        on_partial(*partial)
+        except Exception as e:
+            logger.error(f"予期せぬエラーが発生しました: {e}", exc_info=True)
+            return f"予期せぬエラーが発生しました: {e}"
+
+        return self._parse_batch_evaluations(raw_text, answers)
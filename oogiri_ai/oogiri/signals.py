@@ -0,0 +1,96 @@
+# oogiri/signals.py
+"""
+モデルの変更に合わせてキャッシュを更新するシグナルハンドラ。
+OogiriConfig.ready() で読み込まれる。
+"""
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from .few_shot import invalidate_few_shot_index
+from .models import Answer, Question, TrainingFlagChange
+from .question_dedup import index_questions
+
+
+@receiver(pre_save, sender=Answer)
+def remember_answer_was_excellent(sender, instance, **kwargs):
+    # 新規作成 (pk無し) の回答は事例に含まれていないので、DBを確認しない
+    instance._was_excellent_answer = bool(
+        instance.pk and Answer.objects.filter(pk=instance.pk, is_excellent_answer=True).exists()
+    )
+
+
+@receiver(post_save, sender=Answer)
+def refresh_few_shot_index_on_answer_save(sender, instance, **kwargs):
+    # 「特に面白い」を付けた・外した、または事例になっている回答を編集した場合だけ作り直す
+    # (通常の回答の投稿では作り直さない)
+    if instance.is_excellent_answer or getattr(instance, '_was_excellent_answer', False):
+        invalidate_few_shot_index()
+
+
+@receiver(post_save, sender=Answer)
+def record_answer_flag_change(sender, instance, created, **kwargs):
+    # 既存の回答に「特に面白い」を付けたことを、学習データの差分の書き出しのために記録する
+    # (新しい回答は、IDで前回の書き出し以降の行として選ばれる)
+    if not created and instance.is_excellent_answer and not getattr(instance, '_was_excellent_answer', False):
+        TrainingFlagChange.objects.create(kind=TrainingFlagChange.Kind.ANSWER, object_id=instance.pk)
+
+
+@receiver(post_delete, sender=Answer)
+def refresh_few_shot_index_on_answer_delete(sender, instance, **kwargs):
+    if instance.is_excellent_answer:
+        invalidate_few_shot_index()
+
+
+@receiver(pre_save, sender=Question)
+def remember_question_before_save(sender, instance, **kwargs):
+    instance._previous_values = None
+    if instance.pk:
+        instance._previous_values = (
+            Question.objects.filter(pk=instance.pk)
+            .values('is_excellent', 'question_text', 'theme', 'source_title', 'headline_set_id').first()
+        )
+
+
+@receiver(post_save, sender=Question)
+def refresh_few_shot_index_on_question_save(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_previous_values', None)
+    if created or previous is None:
+        if instance.is_excellent:
+            invalidate_few_shot_index()
+        return
+
+    if instance.is_excellent or previous['is_excellent']:
+        invalidate_few_shot_index()
+    elif previous['question_text'] != instance.question_text:
+        # 回答の事例にはお題の本文も含まれるため、事例になっている回答があれば作り直す
+        if instance.answers.filter(is_excellent_answer=True).exists():
+            invalidate_few_shot_index()
+
+
+@receiver(post_save, sender=Question)
+def record_question_flag_change(sender, instance, created, **kwargs):
+    # 既存のお題がお題生成タスクの学習データの対象 (「特に面白い」かつ元ネタのニュースあり) になったことを記録する
+    previous = getattr(instance, '_previous_values', None)
+    if created or previous is None:
+        return
+    has_source = bool(instance.source_title or instance.headline_set_id)
+    had_source = bool(previous['source_title'] or previous['headline_set_id'])
+    if instance.is_excellent and has_source and not (previous['is_excellent'] and had_source):
+        TrainingFlagChange.objects.create(kind=TrainingFlagChange.Kind.QUESTION, object_id=instance.pk)
+
+
+@receiver(post_save, sender=Question)
+def update_question_fingerprints(sender, instance, created, **kwargs):
+    # 管理画面などで作成・編集したお題を、生成したお題の重複判定に使う
+    # (生成したお題は bulk_create で保存するため、save_generated_questions で登録する)
+    previous = getattr(instance, '_previous_values', None)
+    if created:
+        index_questions([instance])
+    elif previous is None or (previous['question_text'], previous['theme']) != (instance.question_text, instance.theme):
+        index_questions([instance], replace=True)
+
+
+@receiver(post_delete, sender=Question)
+def refresh_few_shot_index_on_question_delete(sender, instance, **kwargs):
+    # お題を削除すると回答も削除される (CASCADE) ため、回答側のシグナルでも作り直される
+    if instance.is_excellent:
+        invalidate_few_shot_index()
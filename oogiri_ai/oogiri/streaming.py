@@ -0,0 +1,146 @@
+# oogiri/streaming.py
+"""
+生成途中の出力をブラウザに少しずつ送るための部品 (Server-Sent Events)。
+
+LLMにはお題や採点結果をJSONで出力させているため、応答が全て届くまでJSONとして読めない。
+JSONArrayStream は応答を先頭から少しずつ受け取り、配列の要素 (お題1つ、回答1件分の採点結果) が
+閉じた時点でその要素だけを読み取る。partial_string_value は書きかけの要素から、途中までの文字列 (講評など) を取り出す。
+"""
+import json
+import re
+
+
+def sse_event(event: str, data) -> str:
+    """
+    Server-Sent Events の1イベントを組み立てる (data はJSONにして1行で送る)。
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# 文字列の末尾で途切れたエスケープシーケンス (\ や \u00 など)
+_INCOMPLETE_ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{0,3})?$')
+
+
+def partial_string_value(text: str, field: str) -> str | None:
+    """
+    書きかけのJSONオブジェクト text から、文字列型のフィールド field の値を途中まで取り出す。
+    フィールドがまだ現れていなければ None を返す。
+    """
+    match = re.search(rf'"{re.escape(field)}"\s*:\s*"', text)
+    if match is None:
+        return None
+
+    chars = []
+    escaped = False
+    for char in text[match.end():]:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            break
+        chars.append(char)
+    value = ''.join(chars)
+    try:
+        return json.loads(f'"{value}"')
+    except json.JSONDecodeError:
+        pass
+    # 途中で途切れたエスケープシーケンスを除いて読み直す
+    try:
+        return json.loads(f'"{_INCOMPLETE_ESCAPE.sub("", value)}"')
+    except json.JSONDecodeError:
+        return None
+
+
+class JSONArrayStream:
+    """
+    {"questions": ["...", "..."]} のようなJSONを先頭から少しずつ受け取り、
+    キー key の配列の要素を、要素が閉じた時点で1つずつ取り出す。
+    配列より前の部分 (```json のような囲みや他のキー) は読み飛ばす。
+    """
+
+    def __init__(self, key: str):
+        self._key_pattern = re.compile(rf'"{re.escape(key)}"\s*:\s*\[')
+        self._buffer = ''
+        # 次に読む位置 (配列の開始が見つかるまでは None)
+        self._position = None
+        # 読んでいる要素の開始位置 (要素の外では None)
+        self._item_start = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self.finished = False
+
+    @property
+    def partial(self) -> str:
+        """
+        書きかけの要素のテキスト (要素の外では空文字列)。
+        """
+        if self._item_start is None:
+            return ''
+        return self._buffer[self._item_start:]
+
+    def feed(self, text: str) -> list:
+        """
+        応答の続き text を受け取り、新たに閉じた要素 (JSONとして読んだ値) のリストを返す。
+        JSONとして読めない要素は読み飛ばす。
+        """
+        self._buffer += text
+        if self.finished:
+            return []
+        if self._position is None:
+            match = self._key_pattern.search(self._buffer)
+            if match is None:
+                return []
+            self._position = match.end()
+
+        items = []
+        buffer = self._buffer
+        for position in range(self._position, len(buffer)):
+            char = buffer[position]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 0:
+                        # 文字列の要素が閉じた
+                        self._emit(items, position + 1)
+                continue
+
+            if char == '"':
+                self._in_string = True
+                if self._item_start is None:
+                    self._item_start = position
+            elif char in '{[':
+                if self._item_start is None:
+                    self._item_start = position
+                self._depth += 1
+            elif char in '}]':
+                if self._depth == 0:
+                    # 配列の終わり (数値などの要素が書きかけなら、それも閉じる)
+                    self._emit(items, position)
+                    self.finished = True
+                    break
+                self._depth -= 1
+                if self._depth == 0:
+                    self._emit(items, position + 1)
+            elif char == ',':
+                if self._depth == 0:
+                    self._emit(items, position)
+            elif not char.isspace() and self._item_start is None:
+                # 数値・true/false/null の要素
+                self._item_start = position
+        self._position = len(buffer)
+        return items
+
+    def _emit(self, items: list, end: int) -> None:
+        if self._item_start is None:
+            return
+        try:
+            items.append(json.loads(self._buffer[self._item_start:end]))
+        except json.JSONDecodeError:
+            pass
+        self._item_start = None
@@ -0,0 +1,222 @@
+# oogiri/stubs.py
+"""
+NewsAPI と Gemini API を模したローカルのスタブサーバー。
+負荷試験 (benchmark_proposal, benchmark_submit コマンドなど) で外部APIを呼ばずに、一定の応答遅延だけを再現するために使う。
+Geminiのコンテキストキャッシュ (cachedContents) と usageMetadata のトークン数 (文字数で代用) も模しているため、
+プロンプトキャッシュのテストにも使う。
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _prompt_text(payload: dict) -> str:
+    """
+    Gemini APIのリクエストから、システム命令とcontentsのテキストを取り出して連結する。
+    """
+    contents = list(payload.get('contents') or [])
+    if payload.get('systemInstruction'):
+        contents.insert(0, payload['systemInstruction'])
+    return ''.join(part.get('text', '') for content in contents for part in content.get('parts', []))
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # ThreadingHTTPServer側で設定される値 (StubAPIServer.__init__ を参照)
+    server: 'StubAPIServer'
+
+    def log_message(self, format, *args):
+        # 負荷試験中にアクセスログで標準エラーが埋まらないよう抑制する
+        pass
+
+    def _send_json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # NewsAPI: /v2/everything
+        if self.path.split('?')[0].endswith('/everything'):
+            time.sleep(self.server.news_latency)
+            self.server.count('news')
+            articles = [
+                {'title': f'スタブニュース{i}: 猫が市長に立候補', 'url': f'https://news.example.com/articles/{i}'}
+                for i in range(self.server.headline_count)
+            ]
+            self._send_json({'status': 'ok', 'totalResults': len(articles), 'articles': articles})
+            return
+        self._send_json({'status': 'error', 'code': 'notFound', 'message': self.path}, status=404)
+
+    def _send_gemini_error(self, code: int, status: str, message: str):
+        self._send_json({'error': {'code': code, 'message': message, 'status': status}}, status=code)
+
+    def _send_gemini_stream(self, text: str, usage: dict):
+        """
+        応答のテキストを stream_chunk_size 文字ずつのチャンクに分け、Server-Sent Events で送る。
+        応答全体の遅延 (gemini_latency) はチャンクに均等に割り振る (最初のチャンクは早く届く)。
+        """
+        chunk_size = self.server.stream_chunk_size
+        chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)] or ['']
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for index, chunk in enumerate(chunks):
+            time.sleep(self.server.gemini_latency / len(chunks))
+            response = {'candidates': [{'content': {'role': 'model', 'parts': [{'text': chunk}]}}]}
+            if index == len(chunks) - 1:
+                # 最後のチャンクに終了理由とトークン数を付ける
+                response['candidates'][0]['finishReason'] = 'STOP'
+                response['usageMetadata'] = usage
+            self.wfile.write(f"data: {json.dumps(response, ensure_ascii=False)}\r\n\r\n".encode('utf-8'))
+            self.wfile.flush()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+
+        # Gemini: /v1beta/cachedContents (コンテキストキャッシュの作成)
+        if self.path.split('?')[0].endswith('/cachedContents'):
+            self.server.count('cache_create')
+            payload = json.loads(body)
+            text = _prompt_text(payload)
+            # トークン数は文字数で代用する
+            if len(text) < self.server.cache_min_tokens:
+                self._send_gemini_error(400, 'INVALID_ARGUMENT', 'Cached content is too small.')
+                return
+            name = self.server.store_cached_content(text)
+            self._send_json({
+                'name': name,
+                'model': payload.get('model'),
+                'usageMetadata': {'totalTokenCount': len(text)},
+            })
+            return
+
+        # Gemini: /v1beta/models/<model>:generateContent
+        # /v1beta/models/<model>:streamGenerateContent?alt=sse (ストリーミング)
+        path = self.path.split('?')[0]
+        if path.endswith(':generateContent') or path.endswith(':streamGenerateContent'):
+            stream = path.endswith(':streamGenerateContent')
+            if not stream:
+                time.sleep(self.server.gemini_latency)
+            self.server.count('gemini_stream' if stream else 'gemini')
+            payload = json.loads(body)
+            self.server.last_gemini_request = payload
+            cached_text = ''
+            if payload.get('cachedContent'):
+                cached_text = self.server.cached_contents.get(payload['cachedContent'])
+                if cached_text is None:
+                    self._send_gemini_error(404, 'NOT_FOUND', 'CachedContent not found (or permission denied).')
+                    return
+                self.server.count('gemini_cached')
+            # キャッシュされた共通部分も含めて、何を要求されているかを判定する
+            body = cached_text + body
+            prompt_tokens = len(_prompt_text(payload)) + len(cached_text)
+
+            # まとめて採点 (resultsを要求している) には回答IDごとの採点結果を、
+            # 1件の採点 (scoreを要求している) には採点結果を、それ以外にはお題を返す
+            if 'results' in body:
+                self.server.count('gemini_batch')
+                evaluation = json.loads(self.server.gemini_evaluation_text)
+                answer_ids = [int(answer_id) for answer_id in re.findall(r'\\"id\\": (\d+)', body)]
+                text = json.dumps({'results': [{'id': answer_id, **evaluation} for answer_id in answer_ids]},
+                                  ensure_ascii=False)
+            elif 'score' in body:
+                text = self.server.gemini_evaluation_text
+            else:
+                text = self.server.gemini_text or self.server.next_questions_text()
+            usage = {
+                'promptTokenCount': prompt_tokens,
+                'cachedContentTokenCount': len(cached_text),
+                'candidatesTokenCount': len(text),
+                'totalTokenCount': prompt_tokens + len(text),
+            }
+            if stream:
+                self._send_gemini_stream(text, usage)
+                return
+            self._send_json({
+                'candidates': [{
+                    'content': {'role': 'model', 'parts': [{'text': text}]},
+                    'finishReason': 'STOP',
+                }],
+                'usageMetadata': usage,
+            })
+            return
+        self._send_json({'error': {'code': 404, 'message': self.path, 'status': 'NOT_FOUND'}}, status=404)
+
+
+class StubAPIServer(ThreadingHTTPServer):
+    """
+    127.0.0.1 の空きポートで待ち受けるスタブサーバー。
+    with 文で使うと、バックグラウンドスレッドで起動し、抜けるときに停止する。
+    """
+    daemon_threads = True
+    # 同時接続数の多い負荷試験でも接続が拒否されないよう、待ち行列を大きめにとる
+    request_queue_size = 1024
+
+    def __init__(self, news_latency: float = 0.5, gemini_latency: float = 1.0, headline_count: int = 100,
+                 gemini_text: str | None = None, gemini_evaluation_text: str | None = None,
+                 cache_min_tokens: int = 0, stream_chunk_size: int = 8):
+        super().__init__(('127.0.0.1', 0), _StubHandler)
+        self.news_latency = news_latency
+        self.gemini_latency = gemini_latency
+        self.headline_count = headline_count
+        # 省略した場合は、リクエストごとに別のお題を返す (同じお題は重複判定で除かれるため)
+        self.gemini_text = gemini_text
+        self.questions_generated = 0
+        self.gemini_evaluation_text = gemini_evaluation_text or json.dumps(
+            {'score': 3, 'comment': 'スタブの講評です。'}, ensure_ascii=False
+        )
+        # コンテキストキャッシュを作成できる最小のトークン数 (文字数)
+        self.cache_min_tokens = cache_min_tokens
+        # ストリーミングの応答で1チャンクに含める文字数
+        self.stream_chunk_size = stream_chunk_size
+        self.cached_contents = {}
+        self.last_gemini_request = None
+        self.request_counts = {
+            'news': 0, 'gemini': 0, 'gemini_stream': 0, 'gemini_batch': 0, 'gemini_cached': 0, 'cache_create': 0,
+        }
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, api: str):
+        with self._lock:
+            self.request_counts[api] += 1
+
+    def next_questions_text(self) -> str:
+        """
+        お題生成の応答。お題ごとに通し番号と、番号のハッシュ (ほぼ同じお題にならないように) を付ける。
+        """
+        with self._lock:
+            start = self.questions_generated
+            self.questions_generated += 3
+        questions = [
+            f"スタブのお題{number} {hashlib.sha256(str(number).encode()).hexdigest()[:16]}"
+            for number in range(start + 1, start + 4)
+        ]
+        return json.dumps({'questions': questions}, ensure_ascii=False)
+
+    def store_cached_content(self, text: str) -> str:
+        with self._lock:
+            name = f"cachedContents/stub-{len(self.cached_contents) + 1}"
+            self.cached_contents[name] = text
+        return name
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
@@ -0,0 +1,53 @@
+# oogiri/suggestions.py
+"""
+「AIに回答を提案してもらう」機能 (回答入力画面から使う)。
+
+回答生成のバックエンドで回答の候補を N 個まとめて生成し (ローカルモデルでは1回の generate で N 系列をサンプリングする)、
+採点のバックエンドで候補をまとめて採点して (score_answers)、点数の高い K 個を提案する (best-of-N)。
+候補の数 N・提案する数 K・かける時間の上限は settings.ANSWER_SUGGESTION_* で調整する。
+生成だけで時間の上限を使い切った場合は、採点を省いて生成した順に K 個を返す。
+"""
+import logging
+import time
+from django.conf import settings
+from .llm_backends import TASK_ANSWER_GENERATION, TASK_EVALUATION, get_llm_backend
+
+logger = logging.getLogger(__name__)
+
+
+def suggest_answers(question, candidates: int | None = None, top_k: int | None = None,
+                    time_budget: float | None = None) -> list[dict] | str:
+    """
+    お題に対する回答を提案する。
+    成功時は [{"answer_text": str, "score": float | None}, ...] (点数の高い順、採点を省いた場合は score が None) を、
+    失敗時はエラーメッセージを返す。
+    """
+    candidates = settings.ANSWER_SUGGESTION_CANDIDATES if candidates is None else candidates
+    top_k = settings.ANSWER_SUGGESTION_TOP_K if top_k is None else top_k
+    time_budget = settings.ANSWER_SUGGESTION_TIME_BUDGET if time_budget is None else time_budget
+    started = time.monotonic()
+
+    answer_texts = get_llm_backend(TASK_ANSWER_GENERATION).generate_answers(
+        question, count=candidates, max_time=time_budget
+    )
+    if isinstance(answer_texts, str):
+        return answer_texts
+    # サンプリングで同じ回答が出ることがあるため、重複を除く
+    answer_texts = list(dict.fromkeys(text.strip() for text in answer_texts if text.strip()))
+    if not answer_texts:
+        return "回答の候補を生成できませんでした。"
+
+    unranked = [{"answer_text": text, "score": None} for text in answer_texts[:top_k]]
+    if len(answer_texts) <= 1:
+        return unranked
+    if time.monotonic() - started >= time_budget:
+        logger.info(f"回答の候補の生成に時間がかかったため、採点を省きます ({len(answer_texts)}個)")
+        return unranked
+
+    scores = get_llm_backend(TASK_EVALUATION).score_answers(question, answer_texts)
+    if isinstance(scores, str):
+        # 採点に失敗しても、生成した候補は提案する
+        logger.warning(f"回答の候補の採点に失敗しました: {scores}")
+        return unranked
+    ranked = sorted(zip(answer_texts, scores), key=lambda item: item[1], reverse=True)
+    return [{"answer_text": text, "score": round(score, 2)} for text, score in ranked[:top_k]]
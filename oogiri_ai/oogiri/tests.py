@@ -1,3 +1,1707 @@
-from django.test import TestCase
+import asyncio
+from array import array
+import collections
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import QuerySet
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from google.genai import errors as genai_errors
+import httpx
+
+from .counters import counter_values, increment
+from .inference_server import DynamicBatcher, GenerationRequest, GenerationResult, make_inference_server
+from .evaluation_cache import (
+    NORMALIZERS, evaluation_cache_stats, evict_evaluation_cache, lookup_evaluation, make_cache_key, normalize_text,
+    store_evaluation,
+)
+from .example_vectors import STORE_VERSION
+from .few_shot import FewShotIndex, render_answer_example
+from .headline_selection import estimate_tokens, select_headlines
+from .headline_store import recent_headlines, record_headlines, search_headlines
+from .jobs import (
+    claim_evaluation_batch, claim_evaluation_jobs, partial_review_key, process_evaluation_batch, requeue_stale_jobs,
+    submit_answer,
+)
+from .llm_backends import (
+    TASK_EVALUATION, TASK_QUESTION_GENERATION, LLMBackend, LocalServerBackend, PrefixKVCache, cpu_supports_bf16,
+    get_llm_backend, load_local_model,
+)
+from .locks import acquire_lock, release_lock
+from .management.commands.fill_question_pool import Command as FillQuestionPoolCommand
+from .management.commands.prefetch_headlines import Command as PrefetchHeadlinesCommand
+from .models import (
+    Answer, EvaluationCacheEntry, EvaluationJob, HeadlineSet, NewsHeadline, ProcessLock, Question, QuestionFingerprint,
+    TrainingFlagChange, UsageCounter,
+)
+from .prompt_cache import PromptPrefixCache, make_prefix_key, prompt_cache_stats
+from .query_plans import hot_queries, query_plan, seed_synthetic_data
+from .question_dedup import (
+    NUM_PERMUTATIONS, ROWS_PER_BAND, agenerate_unique_questions, band_buckets, find_duplicates,
+)
+from .services import (
+    GeminiService, HeadlineCache, NewsService, count_pooled_questions, save_generated_questions, take_pooled_questions,
+)
+from .streaming import JSONArrayStream, partial_string_value
+from .suggestions import suggest_answers
+from .stubs import StubAPIServer
+from .token_dataset import TokenDataset, index_path, tokenize_training_data
+from . import training_data
+from .training_data import SampleDeduplicator, load_manifest
+
+# テストごとに空のキャッシュを使う (プロンプトキャッシュの記録を持ち越さない)
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES, GEMINI_PROMPT_CACHE_ENABLED=True)
+class PromptPrefixCacheTests(TestCase):
+    """
+    スタブのGemini (StubAPIServer) を使い、プロンプトの共通部分のキャッシュをオフラインで確認する。
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.question = Question(theme='政治', question_text='こんな総理大臣は嫌だ。どんな総理大臣？')
+
+    def _gemini_service(self, stub):
+        with override_settings(GEMINI_API_KEY='stub', GEMINI_API_BASE_URL=stub.base_url):
+            return GeminiService()
+
+    def test_shared_prefix_is_cached_once_and_reused(self):
+        with StubAPIServer(gemini_latency=0) as stub:
+            service = self._gemini_service(stub)
+            first = service.evaluate_answer(self.question, '答弁がすべて川柳')
+            second = service.evaluate_answer(self.question, '国会で寝ていると思ったら冬眠')
+
+        self.assertEqual(first, {'score': 3, 'comment': 'スタブの講評です。'})
+        self.assertEqual(second, first)
+        self.assertEqual(stub.request_counts['cache_create'], 1)
+        self.assertEqual(stub.request_counts['gemini_cached'], 2)
+
+        # 2回目のリクエストでは、毎回変わる部分だけを送っている
+        request = stub.last_gemini_request
+        self.assertIn('cachedContent', request)
+        self.assertNotIn('systemInstruction', request)
+        self.assertNotIn('評価の参考にすべき事例', str(request['contents']))
+
+        stats = prompt_cache_stats()
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['caches_created'], 1)
+        self.assertGreater(stats['cached_tokens'], 0)
+        self.assertLess(stats['cached_tokens'], stats['prompt_tokens'])
+        # トークン数はDBのカウンタに加算する (ワーカーのスレッドとWebのプロセスが同時に数えても失われない)
+        self.assertEqual(UsageCounter.objects.get(name='gemini_prompt_cache:cached_tokens').value,
+                         stats['cached_tokens'])
+
+    def test_prefix_too_small_for_cache_is_sent_in_full_without_retrying(self):
+        with StubAPIServer(gemini_latency=0, cache_min_tokens=10 ** 6) as stub:
+            service = self._gemini_service(stub)
+            service.evaluate_answer(self.question, '答弁がすべて川柳')
+            result = service.evaluate_answer(self.question, '国会で寝ていると思ったら冬眠')
+
+        self.assertEqual(result['score'], 3)
+        # 作成に失敗した共通部分は、TTLの間は作成し直さない
+        self.assertEqual(stub.request_counts['cache_create'], 1)
+        self.assertEqual(stub.request_counts['gemini_cached'], 0)
+        self.assertIn('systemInstruction', stub.last_gemini_request)
+        self.assertIn('評価の参考にすべき事例', str(stub.last_gemini_request['contents']))
+        self.assertEqual(prompt_cache_stats()['cached_tokens'], 0)
+
+    def test_expired_cache_falls_back_to_full_prompt_and_is_recreated(self):
+        with StubAPIServer(gemini_latency=0) as stub:
+            service = self._gemini_service(stub)
+            service.evaluate_answer(self.question, '答弁がすべて川柳')
+
+            # Gemini側でキャッシュが期限切れになった状態
+            stub.cached_contents.clear()
+            result = service.evaluate_answer(self.question, '国会で寝ていると思ったら冬眠')
+            self.assertEqual(result['score'], 3)
+            self.assertIn('systemInstruction', stub.last_gemini_request)
+
+            service.evaluate_answer(self.question, '公約が全部あいうえお作文')
+
+        self.assertEqual(stub.request_counts['cache_create'], 2)
+        self.assertIn('cachedContent', stub.last_gemini_request)
+
+    def test_cache_is_created_by_the_lock_holder_only(self):
+        prefix_cache = PromptPrefixCache(ttl=600)
+        client = mock.Mock()
+        client.caches.create.return_value = mock.Mock()
+        client.caches.create.return_value.name = 'cachedContents/1'
+        lock_name = f"{make_prefix_key('model', 'システム', '共通部分')}:lock"
+
+        # 他のプロセスが作成中の間は、作成せずにキャッシュを使わない
+        token = acquire_lock(lock_name, 60)
+        self.assertIsNone(prefix_cache.get_or_create(client, 'model', 'システム', '共通部分'))
+        client.caches.create.assert_not_called()
+        release_lock(lock_name, token)
+
+        self.assertEqual(prefix_cache.get_or_create(client, 'model', 'システム', '共通部分'), 'cachedContents/1')
+        self.assertEqual(prefix_cache.get_or_create(client, 'model', 'システム', '共通部分'), 'cachedContents/1')
+        client.caches.create.assert_called_once()
+        self.assertFalse(ProcessLock.objects.filter(name=lock_name).exists())
+
+    def test_transient_errors_are_retried_on_the_next_request(self):
+        prefix_cache = PromptPrefixCache(ttl=600)
+        created = mock.Mock()
+        created.name = 'cachedContents/1'
+        client = mock.Mock()
+        client.caches.create.side_effect = [
+            genai_errors.ServerError(503, {'error': {'status': 'UNAVAILABLE', 'message': 'overloaded'}}),
+            genai_errors.ClientError(429, {'error': {'status': 'RESOURCE_EXHAUSTED', 'message': 'quota'}}),
+            TimeoutError('timed out'),
+            created,
+        ]
+
+        for _ in range(3):
+            self.assertIsNone(prefix_cache.get_or_create(client, 'model', 'システム', '共通部分'))
+        self.assertEqual(prefix_cache.get_or_create(client, 'model', 'システム', '共通部分'), 'cachedContents/1')
+        self.assertEqual(client.caches.create.call_count, 4)
+
+    async def test_transient_errors_are_retried_on_the_next_async_request(self):
+        prefix_cache = PromptPrefixCache(ttl=600)
+        created = mock.Mock()
+        created.name = 'cachedContents/1'
+        client = mock.Mock()
+        client.aio.caches.create = mock.AsyncMock(side_effect=[
+            genai_errors.ServerError(500, {'error': {'status': 'INTERNAL', 'message': 'internal'}}),
+            created,
+        ])
+
+        self.assertIsNone(await prefix_cache.aget_or_create(client, 'model', 'システム', '共通部分'))
+        self.assertEqual(await prefix_cache.aget_or_create(client, 'model', 'システム', '共通部分'),
+                         'cachedContents/1')
+        self.assertEqual(client.aio.caches.create.await_count, 2)
+
+    @override_settings(GEMINI_API_KEY='stub')
+    def test_question_prompt_prefix_does_not_depend_on_headlines(self):
+        service = GeminiService()
+        examples = ['こんな内閣は嫌だ', '国会中継で起きた珍事とは？']
+        system_a, prefix_a, suffix_a = service._build_question_prompt(['ニュースA'], examples)
+        system_b, prefix_b, suffix_b = service._build_question_prompt(['ニュースB'], examples)
+
+        self.assertEqual((system_a, prefix_a), (system_b, prefix_b))
+        self.assertNotEqual(suffix_a, suffix_b)
+        self.assertIn('こんな内閣は嫌だ', prefix_a)
+        self.assertNotIn('ニュースA', prefix_a)
+
+
+class FakeBackend(LLMBackend):
+    """
+    テスト用のLLMバックエンド。回答の文字数に応じた点数を返す。
+    """
+
+    def generate_questions(self, headlines, theme):
+        return [f'{theme}のお題{i}' for i in range(3)]
+
+    def generate_answers(self, question, count=1, max_time=None):
+        # サンプリングで同じ回答が出た場合も再現する
+        return ['案', 'よい案', 'よい案', 'すごい案だ', 'ふつう'][:count]
+
+    def evaluate_answer(self, question, answer_text):
+        return {'score': min(len(answer_text), 5), 'comment': f'{answer_text}の講評'}
+
+
+@override_settings(CACHES=LOCMEM_CACHES, GEMINI_API_KEY='stub')
+class LLMBackendSelectionTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_backend_is_selected_per_task(self):
+        with override_settings(LLM_BACKENDS={
+            'question_generation': 'oogiri.tests.FakeBackend',
+            'evaluation': 'gemini',
+        }):
+            self.assertIsInstance(get_llm_backend(TASK_QUESTION_GENERATION), FakeBackend)
+            self.assertIsInstance(get_llm_backend(TASK_EVALUATION), GeminiService)
+
+    def test_unknown_task_or_backend_is_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_llm_backend('translation')
+        with override_settings(LLM_BACKENDS={'evaluation': 'django.test.TestCase'}):
+            with self.assertRaises(ImproperlyConfigured):
+                get_llm_backend(TASK_EVALUATION)
+
+    @override_settings(LLM_BACKENDS={'evaluation': 'oogiri.tests.FakeBackend'})
+    def test_evaluation_worker_scores_with_configured_backend(self):
+        user = get_user_model().objects.create_user('backend@example.com', 'backend', password=None)
+        question = Question.objects.create(theme='政治', question_text='こんな国会は嫌だ')
+        answers = [submit_answer(user, question, text) for text in ('全員', 'ラップで答弁')]
+
+        jobs = claim_evaluation_batch(max_size=8, window=0)
+        # FakeBackend にはまとめて採点する実装が無いため、LLMBackend の既定の実装で1件ずつ採点される
+        self.assertEqual(process_evaluation_batch(jobs, get_llm_backend(TASK_EVALUATION)), 2)
+
+        for answer in answers:
+            answer.refresh_from_db()
+            self.assertEqual(answer.evaluation_job.status, EvaluationJob.Status.DONE)
+        self.assertEqual([answers[0].score, answers[1].score], [2, 5])
+        self.assertEqual(answers[1].review_text, 'ラップで答弁の講評')
+
+
+@override_settings(LOCAL_MODEL_DTYPE='fp32', LOCAL_MODEL_COMPILE=False, LOCAL_MODEL_THREADS=0)
+class LocalModelLoadingTests(TestCase):
+    """
+    torch と transformers を偽物に差し替え、推論モードごとの読み込み方 (load_local_model) を確かめる。
+    """
+
+    def setUp(self):
+        self.torch = mock.MagicMock(name='torch')
+        self.torch.float32, self.torch.bfloat16, self.torch.qint8 = 'float32', 'bfloat16', 'qint8'
+        self.transformers = mock.MagicMock(name='transformers')
+        self.from_pretrained = self.transformers.AutoModelForCausalLM.from_pretrained
+        self.model = self.from_pretrained.return_value.to.return_value
+        self.enterContext(mock.patch.dict(sys.modules, {'torch': self.torch, 'transformers': self.transformers}))
+        self.enterContext(mock.patch.dict('oogiri.llm_backends._local_models', clear=True))
+
+    def load(self, dtype=None, bf16_supported=True, **kwargs):
+        with mock.patch('oogiri.llm_backends.cpu_supports_bf16', return_value=bf16_supported):
+            return load_local_model('/models/oogiri', dtype=dtype, **kwargs)
+
+    def test_fp32_model_is_loaded_once_without_conversion(self):
+        model, tokenizer, _ = self.load()
+        self.from_pretrained.assert_called_once_with('/models/oogiri', torch_dtype='float32')
+        self.from_pretrained.return_value.to.assert_called_once_with('cpu')
+        self.assertIs(model, self.model)
+        model.eval.assert_called_once_with()
+        self.assertIs(tokenizer, self.transformers.AutoTokenizer.from_pretrained.return_value)
+        self.torch.ao.quantization.quantize_dynamic.assert_not_called()
+        self.torch.compile.assert_not_called()
+        self.torch.set_num_threads.assert_not_called()
+
+        # 2回目以降は読み込み済みのモデルを使い回す
+        self.assertIs(self.load('fp32')[0], model)
+        self.assertEqual(self.from_pretrained.call_count, 1)
+
+    def test_bf16_is_used_only_when_cpu_supports_it(self):
+        self.load('bf16')
+        self.from_pretrained.assert_called_once_with('/models/oogiri', torch_dtype='bfloat16')
+
+        self.from_pretrained.reset_mock()
+        with mock.patch.dict('oogiri.llm_backends._local_models', clear=True), \
+                self.assertLogs('oogiri.llm_backends', 'WARNING'):
+            self.load('bf16', bf16_supported=False)
+        self.from_pretrained.assert_called_once_with('/models/oogiri', torch_dtype='float32')
+
+    def test_int8_quantizes_linear_layers_and_compiles_with_threads(self):
+        model, _, _ = self.load('int8', compile=True, threads=2)
+        quantize_dynamic = self.torch.ao.quantization.quantize_dynamic
+        quantize_dynamic.assert_called_once_with(self.model, {self.torch.nn.Linear}, dtype='qint8')
+        self.assertIs(model, quantize_dynamic.return_value)
+        self.from_pretrained.assert_called_once_with('/models/oogiri', torch_dtype='float32')
+        self.torch.set_num_threads.assert_called_once_with(2)
+        self.torch.compile.assert_called_once_with(mock.ANY, dynamic=True)
+        self.assertIs(model.forward, self.torch.compile.return_value)
+
+    def test_unknown_mode_is_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.load('fp16')
+        with override_settings(LOCAL_MODEL_DTYPE='int4'), self.assertRaises(ImproperlyConfigured):
+            self.load()
+        self.from_pretrained.assert_not_called()
+
+    def test_cpu_bf16_support_is_detected(self):
+        self.torch.ops.mkldnn._is_mkldnn_bf16_supported.return_value = True
+        self.assertTrue(cpu_supports_bf16())
+        self.torch.ops.mkldnn._is_mkldnn_bf16_supported.side_effect = RuntimeError('mkldnn が無い')
+        self.assertFalse(cpu_supports_bf16())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class EvaluationJobTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('job@example.com', 'job', password=None)
+        self.question = Question.objects.create(theme='政治', question_text='こんな国会は嫌だ')
+
+    def test_answer_is_queued_unless_evaluation_is_cached(self):
+        answer = submit_answer(self.user, self.question, '全員ラップで答弁')
+        self.assertIsNone(answer.score)
+        self.assertEqual(str(answer), 'jobの回答 (採点待ち)')
+        self.assertEqual(answer.evaluation_job.status, EvaluationJob.Status.PENDING)
+        self.assertEqual(answer.evaluation_job.attempts, 0)
+
+        # 同じお題・同じ回答 (全角・半角の違いは同じとみなす) の採点結果があれば、キューに入れずに採点済みにする
+        store_evaluation(self.question.question_text, 'ABC', {'score': 4, 'comment': 'キャッシュの講評'})
+        cached_answer = submit_answer(self.user, self.question, 'ＡＢＣ')
+        self.assertEqual((cached_answer.score, cached_answer.review_text), (4, 'キャッシュの講評'))
+        self.assertEqual(str(cached_answer), 'jobの回答 (4点)')
+        self.assertEqual(cached_answer.evaluation_job.status, EvaluationJob.Status.DONE)
+        self.assertEqual(claim_evaluation_jobs(limit=8), [answer.evaluation_job])
+
+    def test_pending_jobs_are_claimed_oldest_first_and_only_once(self):
+        answers = [submit_answer(self.user, self.question, f'回答{i}') for i in range(3)]
+
+        jobs = claim_evaluation_jobs(limit=2)
+        self.assertEqual([job.answer_id for job in jobs], [answers[0].id, answers[1].id])
+        for job in jobs:
+            self.assertEqual((job.status, job.attempts), (EvaluationJob.Status.RUNNING, 1))
+            self.assertIsNotNone(job.locked_at)
+        self.assertEqual([job.answer_id for job in claim_evaluation_jobs(limit=2)], [answers[2].id])
+        self.assertEqual(claim_evaluation_jobs(limit=2), [])
+
+    @override_settings(EVALUATION_MAX_ATTEMPTS=2, EVALUATION_JOB_TIMEOUT=60)
+    def test_failed_job_is_retried_until_max_attempts(self):
+        answer = submit_answer(self.user, self.question, '全員ラップで答弁')
+        backend = FakeBackend()
+
+        with mock.patch.object(backend, 'evaluate_answer', return_value='Gemini APIエラー'):
+            self.assertEqual(process_evaluation_batch(claim_evaluation_batch(max_size=1, window=0), backend), 0)
+            answer.evaluation_job.refresh_from_db()
+            self.assertEqual((answer.evaluation_job.status, answer.evaluation_job.last_error),
+                             (EvaluationJob.Status.PENDING, 'Gemini APIエラー'))
+
+            self.assertEqual(process_evaluation_batch(claim_evaluation_batch(max_size=1, window=0), backend), 0)
+            answer.evaluation_job.refresh_from_db()
+            self.assertEqual((answer.evaluation_job.status, answer.evaluation_job.attempts),
+                             (EvaluationJob.Status.FAILED, 2))
+        self.assertEqual(claim_evaluation_jobs(), [])
+
+        # 処理中のままタイムアウトしたジョブ (ワーカーが落ちた場合) は待機中に戻し、次のワーカーが採点する
+        retried = submit_answer(self.user, self.question, 'ラップで答弁')
+        [job] = claim_evaluation_jobs()
+        self.assertEqual(requeue_stale_jobs(), 0)
+        EvaluationJob.objects.filter(id=job.id).update(locked_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(requeue_stale_jobs(), 1)
+        self.assertEqual(process_evaluation_batch(claim_evaluation_batch(max_size=1, window=0), backend), 1)
+        retried.refresh_from_db()
+        self.assertEqual((retried.score, retried.evaluation_job.status), (5, EvaluationJob.Status.DONE))
+
+    def test_status_is_polled_as_json(self):
+        answer = submit_answer(self.user, self.question, '全員ラップで答弁')
+        url = reverse('oogiri:answer_status', kwargs={'answer_id': answer.id})
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).json(), {'status': 'pending', 'score': None, 'review_text': ''})
+
+        process_evaluation_batch(claim_evaluation_batch(max_size=1, window=0), FakeBackend())
+        self.assertEqual(self.client.get(url).json(),
+                         {'status': 'done', 'score': 5, 'review_text': '全員ラップで答弁の講評'})
+
+        # 他のユーザーの回答の状態は返さない
+        other_user = get_user_model().objects.create_user('job-other@example.com', 'job-other', password=None)
+        self.client.force_login(other_user)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_jobs_can_be_claimed_for_one_question(self):
+        other_question = Question.objects.create(theme='政治', question_text='こんな首相は嫌だ')
+        other_answer = submit_answer(self.user, other_question, '他のお題の回答')
+        answer = submit_answer(self.user, self.question, '全員ラップで答弁')
+
+        # 計測用のワーカー (run_evaluation_worker --question) は、他のお題の回答のジョブを取り出さない
+        jobs = claim_evaluation_batch(max_size=8, window=0, question_id=self.question.id)
+        self.assertEqual([job.answer_id for job in jobs], [answer.id])
+        self.assertEqual(claim_evaluation_batch(max_size=8, window=0, question_id=self.question.id), [])
+        other_answer.evaluation_job.refresh_from_db()
+        self.assertEqual(other_answer.evaluation_job.status, EvaluationJob.Status.PENDING)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class EvaluationCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_normalizers_fold_notation_variants(self):
+        self.assertEqual(NORMALIZERS['width']('ＡＢＣ１２３！　ｶﾞｯｺｳ'), 'ABC123! ガッコウ')
+        self.assertEqual(NORMALIZERS['nfkc']('ＡＢＣ　ｶﾞｯｺｳ'), 'ABC ガッコウ')
+        self.assertEqual(NORMALIZERS['whitespace'](' 全員\n\tラップで　 答弁 '), '全員 ラップで 答弁')
+        self.assertEqual(NORMALIZERS['lower']('ABC'), 'abc')
+        self.assertEqual(NORMALIZERS['punctuation']('「全員、ラップで答弁！」。'), '全員ラップで答弁')
+        self.assertEqual(normalize_text('「ＡＢＣ」　答弁', ['nfkc', 'punctuation', 'whitespace']), 'ABC 答弁')
+
+    def test_notation_variants_share_cache_key(self):
+        key = make_cache_key('こんな国会は嫌だ', '全員 ABC でラップ')
+        # 既定の正規化 (nfkc, width, whitespace) では、全角・半角と空白の違いを同じ回答とみなす
+        self.assertEqual(make_cache_key('こんな国会は嫌だ', '全員　ＡＢＣ　でラップ'), key)
+        self.assertEqual(make_cache_key('こんな国会は嫌だ', ' 全員\nABC  でラップ '), key)
+        self.assertNotEqual(make_cache_key('こんな国会は嫌だ', '全員 ABC でラップ！'), key)
+        self.assertNotEqual(make_cache_key('こんな首相は嫌だ', '全員 ABC でラップ'), key)
+
+        with override_settings(EVALUATION_CACHE_NORMALIZATION=['nfkc', 'whitespace', 'punctuation']):
+            self.assertEqual(make_cache_key('こんな国会は嫌だ', '全員 ABC でラップ！'),
+                             make_cache_key('こんな国会は嫌だ。', '「全員 ABC でラップ」'))
+            # 正規化の設定が違えば、同じ文字列でも別のキーになる
+            self.assertNotEqual(make_cache_key('こんな国会は嫌だ', '全員 ABC でラップ'), key)
+
+        store_evaluation('こんな国会は嫌だ', '全員　ＡＢＣ　でラップ', {'score': 4, 'comment': '講評'})
+        self.assertEqual(lookup_evaluation('こんな国会は嫌だ', '全員 ABC でラップ'), {'score': 4, 'comment': '講評'})
+
+    def test_hits_and_misses_are_counted_in_the_database(self):
+        store_evaluation('こんな国会は嫌だ', '全員ラップで答弁', {'score': 4, 'comment': '講評'})
+        lookup_evaluation('こんな国会は嫌だ', '全員ラップで答弁')
+        lookup_evaluation('こんな国会は嫌だ', '全員ラップで答弁')
+        lookup_evaluation('こんな国会は嫌だ', '別の回答')
+
+        stats = evaluation_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 1, 1))
+        self.assertAlmostEqual(stats['hit_rate'], 2 / 3)
+        # 加算はキャッシュの incr (読んでから書き戻す) ではなく、DBの UPDATE 1回で行う
+        self.assertEqual(UsageCounter.objects.get(name='evaluation_cache:hits').value, 2)
+        with CaptureQueriesContext(connection) as queries:
+            increment('evaluation_cache:hits', 5)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('"value" + 5', queries[0]['sql'])
+        self.assertEqual(counter_values('evaluation_cache:hits', 'unknown'), {'evaluation_cache:hits': 7, 'unknown': 0})
+
+    @override_settings(EVALUATION_CACHE_MAX_ENTRIES=3, EVALUATION_CACHE_TTL_DAYS=30)
+    def test_least_recently_used_entries_are_evicted_in_chunks(self):
+        now = timezone.now()
+        for i, days_ago in enumerate([40, 35, 5, 4, 3, 2, 1, 1]):
+            store_evaluation('こんな国会は嫌だ', f'回答{i}', {'score': 3, 'comment': '講評'})
+            EvaluationCacheEntry.objects.filter(id=EvaluationCacheEntry.objects.latest('id').id).update(
+                last_hit_at=now - timedelta(days=days_ago)
+            )
+        lookup_evaluation('こんな国会は嫌だ', '回答2')
+        kept_keys = {make_cache_key('こんな国会は嫌だ', f'回答{i}') for i in (2, 6, 7)}
+
+        with mock.patch('oogiri.evaluation_cache.EVICT_CHUNK_SIZE', 2), \
+                CaptureQueriesContext(connection) as queries:
+            # 30日以上使われていない2件と、残り6件のうち最後に使われた日時が古い3件を削除する
+            self.assertEqual(evict_evaluation_cache(), 5)
+        self.assertEqual(set(EvaluationCacheEntry.objects.values_list('key', flat=True)), kept_keys)
+        # 削除するIDは EVICT_CHUNK_SIZE 件ずつ指定する
+        deletes = [query['sql'] for query in queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 3)
+        self.assertTrue(all(sql.count(',') <= 1 for sql in deletes))
+
+        self.assertEqual(evict_evaluation_cache(), 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, GEMINI_API_KEY='stub')
+class BatchEvaluationTests(TestCase):
+    """
+    GeminiService のまとめての採点 (ストリーミングの応答を差し替える) と、process_evaluation_batch のフォールバックを確かめる。
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('batch@example.com', 'batch', password=None)
+        self.question = Question.objects.create(theme='政治', question_text='こんな国会は嫌だ')
+        self.service = GeminiService()
+        self.batch_prompts = []
+
+    def submit(self, *answer_texts):
+        answers = [submit_answer(self.user, self.question, answer_text) for answer_text in answer_texts]
+        return answers, claim_evaluation_batch(max_size=8, window=0)
+
+    def batch_response(self, *texts):
+        """
+        まとめての採点の応答を texts の順に返す (届いた分ずつ読めるよう、数文字ずつに分けて返す)。
+        """
+        texts = list(texts)
+
+        def generate_stream(system_instruction, prefix, suffix):
+            self.batch_prompts.append(suffix)
+            text = texts.pop(0)
+            return (text[i:i + 7] for i in range(0, len(text), 7))
+
+        return mock.patch.object(self.service, '_generate_stream', side_effect=generate_stream)
+
+    def single_evaluation(self):
+        def evaluate_answer_streaming(question, answer_text, on_partial):
+            return {'score': 1, 'comment': f'{answer_text}の個別の講評'}
+
+        return mock.patch.object(self.service, 'evaluate_answer_streaming', side_effect=evaluate_answer_streaming)
+
+    def results_text(self, *results):
+        return '```json\n' + json.dumps({'results': list(results)}, ensure_ascii=False) + '\n```'
+
+    def test_batch_response_is_parsed_into_each_answer(self):
+        answers, jobs = self.submit('全員ラップで答弁', '居眠りが公式競技')
+        response = self.results_text(
+            {'id': answers[0].id, 'score': 4, 'comment': '韻が効いている'},
+            {'id': str(answers[1].id), 'score': '2', 'comment': 'ありがち'},
+        )
+        with self.batch_response(response), self.single_evaluation() as single:
+            self.assertEqual(process_evaluation_batch(jobs, self.service), 2)
+
+        single.assert_not_called()
+        # 1回のリクエストに、回答IDと回答を全て含める
+        [prompt] = self.batch_prompts
+        for answer in answers:
+            self.assertIn(f'"id": {answer.id}', prompt)
+            self.assertIn(answer.answer_text, prompt)
+        for answer, expected in zip(answers, [(4, '韻が効いている'), (2, 'ありがち')]):
+            answer.refresh_from_db()
+            self.assertEqual((answer.score, answer.review_text), expected)
+            self.assertEqual(answer.evaluation_job.status, EvaluationJob.Status.DONE)
+            self.assertEqual(lookup_evaluation(self.question.question_text, answer.answer_text),
+                             {'score': expected[0], 'comment': expected[1]})
+
+    def test_short_or_malformed_batch_response_falls_back_to_single_evaluation(self):
+        answers, jobs = self.submit('全員ラップで答弁', '居眠りが公式競技', '野次が全部ダジャレ')
+        # 要求していない回答ID・点数の無い結果は使わず、足りない回答は1件ずつ採点し直す
+        response = self.results_text(
+            {'id': answers[0].id, 'score': 4, 'comment': '韻が効いている'},
+            {'id': answers[2].id + 100, 'score': 5, 'comment': '別の回答'},
+            {'id': answers[2].id, 'comment': '点数が無い'},
+        )
+        with self.batch_response(response), self.single_evaluation() as single:
+            self.assertEqual(process_evaluation_batch(jobs, self.service), 3)
+        self.assertEqual([call.kwargs['answer_text'] for call in single.call_args_list],
+                         ['居眠りが公式競技', '野次が全部ダジャレ'])
+        self.assertEqual([answer.score for answer in Answer.objects.filter(id__in=[a.id for a in answers]).order_by('id')],
+                         [4, 1, 1])
+
+        # JSONとして読めない応答の場合は、全ての回答を1件ずつ採点する
+        answers, jobs = self.submit('議長がDJ', '採決がじゃんけん')
+        with self.batch_response('すみません、採点できませんでした。'), self.single_evaluation() as single:
+            self.assertEqual(process_evaluation_batch(jobs, self.service), 2)
+        self.assertEqual(single.call_count, 2)
+
+    def test_same_answers_are_evaluated_once_per_batch(self):
+        # 全角・半角や空白の違いだけの回答は、代表の1件だけを採点して結果を共有する
+        answers, jobs = self.submit('ABC 答弁', 'ＡＢＣ　答弁', '居眠りが公式競技')
+        response = self.results_text(
+            {'id': answers[0].id, 'score': 3, 'comment': '頭文字で攻めた'},
+            {'id': answers[2].id, 'score': 2, 'comment': 'ありがち'},
+        )
+        with self.batch_response(response), self.single_evaluation() as single:
+            self.assertEqual(process_evaluation_batch(jobs, self.service), 3)
+
+        single.assert_not_called()
+        [prompt] = self.batch_prompts
+        self.assertNotIn(f'"id": {answers[1].id}', prompt)
+        self.assertEqual([answer.score for answer in Answer.objects.filter(id__in=[a.id for a in answers]).order_by('id')],
+                         [3, 3, 2])
+
+        # 代表が1件だけになる場合は、まとめずに1回だけ採点する
+        answers, jobs = self.submit('議長がDJ', '議長がＤＪ')
+        with self.single_evaluation() as single:
+            self.assertEqual(process_evaluation_batch(jobs, self.service), 2)
+        self.assertEqual(single.call_count, 1)
+        self.assertEqual(len(self.batch_prompts), 1)
+
+
+class FakeEngine:
+    """
+    テスト用の推論エンジン。受け取ったバッチを記録し、プロンプトとtemperatureを返す。
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def generate_batch(self, requests):
+        self.batches.append(requests)
+        return [
+            GenerationResult(
+                texts=[f'{request.prompt}@{request.temperature}#{i}' for i in range(request.num_return_sequences)],
+                prompt_tokens=len(request.prompt),
+                completion_tokens=request.max_new_tokens * request.num_return_sequences,
+            )
+            for request in requests
+        ]
+
+
+class InferenceServerTests(TestCase):
+
+    def test_concurrent_requests_are_batched_with_their_own_sampling_parameters(self):
+        engine = FakeEngine()
+        batcher = DynamicBatcher(engine.generate_batch, max_batch_size=8, batch_window=0.5)
+        batcher.start()
+        try:
+            futures = [batcher.submit(GenerationRequest(f'お題{i}', temperature=i / 10)) for i in range(4)]
+            results = [future.result(timeout=5) for future in futures]
+        finally:
+            batcher.stop()
+
+        self.assertEqual(len(engine.batches), 1)
+        self.assertEqual([result.texts for result in results], [[f'お題{i}@{i / 10}#0'] for i in range(4)])
+        self.assertTrue(all(result.batch_size == 4 for result in results))
+
+    def test_batch_is_limited_by_rows_including_return_sequences(self):
+        engine = FakeEngine()
+        batcher = DynamicBatcher(engine.generate_batch, max_batch_size=4, batch_window=0.5)
+        batcher.start()
+        try:
+            futures = [batcher.submit(GenerationRequest(f'お題{i}', num_return_sequences=3)) for i in range(3)]
+            results = [future.result(timeout=5) for future in futures]
+        finally:
+            batcher.stop()
+
+        # 3行のリクエストは4行のバッチに1つずつしか入らない
+        self.assertEqual([len(batch) for batch in engine.batches], [1, 1, 1])
+        self.assertEqual(len(results[2].texts), 3)
+
+    @override_settings(LOCAL_MODEL_MAX_NEW_TOKENS=20, LOCAL_MODEL_TEMPERATURE=0.5)
+    def test_local_server_backend_over_unix_socket(self):
+        engine = FakeEngine()
+        batcher = DynamicBatcher(engine.generate_batch, max_batch_size=8, batch_window=0.2)
+        batcher.start()
+        with tempfile.TemporaryDirectory() as directory:
+            socket_path = os.path.join(directory, 'inference.sock')
+            server = make_inference_server(batcher, model_name='fake', socket_path=socket_path)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                question = Question(question_text='こんな回転寿司は嫌だ')
+                with ThreadPoolExecutor(max_workers=3) as executor:
+                    results = list(executor.map(
+                        lambda _: LocalServerBackend(socket_path=socket_path).generate_answers(question, count=2),
+                        range(3),
+                    ))
+            finally:
+                server.shutdown()
+                server.server_close()
+                batcher.stop()
+
+        for answers in results:
+            self.assertEqual(len(answers), 2)
+            self.assertIn('こんな回転寿司は嫌だ', answers[0])
+            self.assertTrue(answers[0].endswith('@0.5#0'))
+        # 3つの同時リクエストが1つのバッチにまとめられている
+        self.assertEqual(len(engine.batches), 1)
+        self.assertEqual(engine.batches[0][0].max_new_tokens, 20)
+
+    def test_local_server_backend_reports_error_responses(self):
+        responses = [
+            httpx.Response(503, json={'error': 'モデルを読み込み中です'}),
+            httpx.Response(502, text='<html><body>502 Bad Gateway</body></html>'),
+        ]
+        backend = LocalServerBackend(server_url='http://inference.test')
+        backend._client = httpx.Client(base_url='http://inference.test',
+                                       transport=httpx.MockTransport(lambda request: responses.pop(0)))
+
+        with self.assertRaisesMessage(RuntimeError, '推論サーバーのエラー (503): モデルを読み込み中です'):
+            backend._generate('お題')
+        with self.assertRaisesMessage(RuntimeError, '推論サーバーのエラー (502): <html><body>502 Bad Gateway</body></html>'):
+            backend._generate('お題')
+
+
+
+class CharTokenizer:
+    """
+    テスト用のトークナイザー。1文字を1トークンにする。
+    """
+
+    def __call__(self, text, add_special_tokens=False):
+        return {'input_ids': [ord(char) for char in text]}
+
+
+class ChatCharTokenizer:
+    """
+    テスト用のChatテンプレート付きトークナイザー。1文字を1トークンにする。
+    """
+    chat_template = '<u>{user}<m>{model}<e>'
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=False):
+        text = ''.join(
+            f"<u>{message['content']}" if message['role'] == 'user' else f"<m>{message['content']}<e>"
+            for message in messages
+        )
+        return text + '<m>' if add_generation_prompt else text
+
+    def __call__(self, texts, add_special_tokens=False):
+        return {'input_ids': [[ord(char) for char in text] for text in texts]}
+
+    def get_vocab(self):
+        return {chr(code): code for code in range(128)}
+
+
+class PrefixKVCacheTests(TestCase):
+
+    def _lookup(self, prefix_cache, prompt):
+        chat_prompt = f'<user>{prompt}<model>'
+        return prefix_cache.lookup(chat_prompt, CharTokenizer()(chat_prompt)['input_ids'])
+
+    def test_instruction_prefix_is_computed_once_per_task_with_lru_bound(self):
+        prefix_cache = PrefixKVCache(
+            None, CharTokenizer(), max_entries=2, instructions=['回答者です。', '審査員です。', 'お題です。']
+        )
+        with mock.patch.object(PrefixKVCache, '_compute', side_effect=lambda ids: f'kv{len(ids)}') as compute:
+            first = self._lookup(prefix_cache, '回答者です。\n\n【お題】A')
+            second = self._lookup(prefix_cache, '回答者です。\n\n【お題】B')
+            self._lookup(prefix_cache, '審査員です。\n\n【回答】C')
+            self._lookup(prefix_cache, 'お題です。\n\n【背景ニュース】D')
+            # 最も長く使われていない「回答者」の共通部分は捨てられている
+            self._lookup(prefix_cache, '回答者です。\n\n【お題】E')
+
+        self.assertIs(first, second)
+        self.assertEqual(first[0], CharTokenizer()('<user>回答者です。')['input_ids'])
+        self.assertEqual(first[1], 'kv12')
+        self.assertEqual(compute.call_count, 4)
+        self.assertEqual(prefix_cache.stats, {'hits': 1, 'misses': 4, 'cached_tokens': 12})
+        # 指示文の無いプロンプトには使わない
+        self.assertIsNone(self._lookup(prefix_cache, '自由な質問'))
+
+    def test_prefix_is_not_used_when_token_boundary_differs(self):
+        prefix_cache = PrefixKVCache(None, CharTokenizer(), max_entries=2, instructions=['回答者です。'])
+        chat_prompt = '<user>回答者です。\n\n【お題】A<model>'
+        # 指示文と続きの境目で別のトークンにまとめられた場合
+        token_ids = CharTokenizer()(chat_prompt)['input_ids']
+        token_ids[11:13] = [0]
+        with mock.patch.object(PrefixKVCache, '_compute', return_value='kv'):
+            self.assertIsNone(prefix_cache.lookup(chat_prompt, token_ids))
+        self.assertEqual(prefix_cache.stats['hits'] + prefix_cache.stats['misses'], 0)
+
+
+def read_events(body: bytes) -> list[tuple[str, dict]]:
+    """
+    Server-Sent Events のレスポンス本文を (イベント名, データ) のリストにする。
+    """
+    events = []
+    for block in body.decode('utf-8').strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines())
+        events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+@override_settings(CACHES=LOCMEM_CACHES, GEMINI_PROMPT_CACHE_ENABLED=True)
+class StreamingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('stream@example.com', 'stream', password=None)
+
+    def test_array_items_are_parsed_as_soon_as_they_close(self):
+        parser = JSONArrayStream('results')
+        text = '```json\n{"results": [{"id": 1, "comment": "閉じ\\"た]"}, {"id": 2, "comment": "書きかけ\\n'
+        items = []
+        for i in range(0, len(text), 5):
+            items += parser.feed(text[i:i + 5])
+
+        self.assertEqual(items, [{'id': 1, 'comment': '閉じ"た]'}])
+        self.assertEqual(partial_string_value(parser.partial, 'comment'), '書きかけ\n')
+        self.assertEqual(parser.feed('"}]}'), [{'id': 2, 'comment': '書きかけ\n'}])
+        self.assertTrue(parser.finished)
+
+    async def test_questions_are_streamed_and_saved_one_by_one(self):
+        with StubAPIServer(news_latency=0, gemini_latency=0.1) as stub, override_settings(
+            NEWS_API_KEY='stub', NEWS_API_BASE_URL=f'{stub.base_url}/v2',
+            GEMINI_API_KEY='stub', GEMINI_API_BASE_URL=stub.base_url, LLM_BACKENDS={'question_generation': 'gemini'},
+        ):
+            await self.async_client.aforce_login(self.user)
+            response = await self.async_client.get(reverse('oogiri:proposal_stream'), {'theme': '政治'})
+            body = b''.join([chunk async for chunk in response.streaming_content])
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = read_events(body)
+        self.assertEqual([event for event, _ in events], ['question', 'question', 'question', 'done'])
+        self.assertEqual([data['text'].split()[0] for _, data in events[:3]], ['スタブのお題1', 'スタブのお題2', 'スタブのお題3'])
+        saved = [question async for question in Question.objects.filter(user=self.user).order_by('id')]
+        self.assertEqual([(question.id, question.question_text) for question in saved],
+                         [(data['id'], data['text']) for _, data in events[:3]])
+        self.assertEqual(stub.request_counts['gemini_stream'], 1)
+
+    async def test_answer_stream_sends_partial_review_then_result(self):
+        question = await Question.objects.acreate(theme='政治', question_text='こんな国会は嫌だ')
+        answer = await sync_to_async(submit_answer)(self.user, question, '全員ラップで答弁')
+        await cache.aset(partial_review_key(answer.id), '韻の踏み方が')
+
+        async def finish_evaluation():
+            # 途中の講評が送られた後に、ワーカーが採点を終える
+            await asyncio.sleep(0.1)
+            with override_settings(LLM_BACKENDS={'evaluation': 'oogiri.tests.FakeBackend'}):
+                jobs = await sync_to_async(claim_evaluation_batch)(max_size=1, window=0)
+                await sync_to_async(process_evaluation_batch)(jobs, get_llm_backend(TASK_EVALUATION))
+
+        with override_settings(ANSWER_STREAM_POLL_INTERVAL=0.02):
+            await self.async_client.aforce_login(self.user)
+            worker = asyncio.ensure_future(finish_evaluation())
+            response = await self.async_client.get(reverse('oogiri:answer_stream', kwargs={'answer_id': answer.id}))
+            body = b''.join([chunk async for chunk in response.streaming_content])
+            await worker
+
+        self.assertEqual(read_events(body), [
+            ('partial', {'review_text': '韻の踏み方が'}),
+            ('done', {'score': 5, 'review_text': '全員ラップで答弁の講評'}),
+        ])
+        self.assertIsNone(await cache.aget(partial_review_key(answer.id)))
+
+
+class ProposalTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('proposal@example.com', 'proposal', password=None)
+
+    def test_headlines_are_stored_once_per_set(self):
+        headlines = ['国会が開会', '首相が会見']
+        first_ids = save_generated_questions(self.user, '政治', headlines, ['お題1', 'お題2', 'お題3'])
+        second_ids = save_generated_questions(None, '政治', headlines, ['お題4'], is_pooled=True)
+
+        self.assertEqual(HeadlineSet.objects.count(), 1)
+        questions = list(Question.objects.filter(id__in=first_ids + second_ids).order_by('id'))
+        self.assertEqual([question.question_text for question in questions], ['お題1', 'お題2', 'お題3', 'お題4'])
+        self.assertTrue(all(question.source_title is None for question in questions))
+        self.assertEqual(questions[0].source_text, '国会が開会\n首相が会見')
+
+    def test_proposal_page_is_rendered_from_session_without_question_query(self):
+        save_generated_questions(None, '政治', ['国会が開会'], ['お題1', 'お題2', 'お題3'], is_pooled=True)
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('oogiri:proposal'), {'theme': '政治'})
+        self.assertRedirects(response, reverse('oogiri:proposal'), fetch_redirect_response=False)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('oogiri:proposal'))
+        self.assertEqual([question['question_text'] for question in response.context['questions']],
+                         ['お題1', 'お題2', 'お題3'])
+        self.assertFalse([query for query in queries if 'oogiri_question' in query['sql']])
+        self.assertEqual(Question.objects.filter(user=self.user, is_pooled=False).count(), 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, GEMINI_API_KEY='stub', LLM_BACKENDS={'question_generation': 'gemini'})
+class ProposalViewTests(TestCase):
+    """
+    NewsAPIとGeminiの呼び出しを差し替え、お題プールが空のときにその場で生成する流れを確かめる。
+    """
+
+    HEADLINES = ['国会で新しい法案が可決', '首相が記者会見で新しい政策を発表']
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('proposal-view@example.com', 'proposal-view', password=None)
+
+    def _patch_services(self, generated):
+        return (
+            mock.patch.object(NewsService, 'aget_recent_headlines', mock.AsyncMock(return_value=self.HEADLINES)),
+            mock.patch.object(GeminiService, 'agenerate_questions', mock.AsyncMock(return_value=generated)),
+        )
+
+    async def test_generated_questions_are_kept_in_session_and_rendered(self):
+        news_patch, gemini_patch = self._patch_services(['国会のお題', '首相のお題', '法案のお題'])
+        await self.async_client.aforce_login(self.user)
+        with news_patch as aget_recent_headlines, gemini_patch as agenerate_questions:
+            response = await self.async_client.post(reverse('oogiri:proposal'), {'theme': '政治'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, reverse('oogiri:proposal'))
+        aget_recent_headlines.assert_awaited_once_with('政治')
+        self.assertEqual(agenerate_questions.await_args.args[0], self.HEADLINES)
+        saved = [(question.id, question.question_text)
+                 async for question in Question.objects.filter(user=self.user).order_by('id')]
+        self.assertEqual([question_text for _, question_text in saved], ['国会のお題', '首相のお題', '法案のお題'])
+        session = await self.async_client.asession()
+        self.assertEqual(await session.aget('proposal'),
+                         {'theme': '政治', 'questions': [list(question) for question in saved]})
+
+        response = await self.async_client.get(reverse('oogiri:proposal'))
+        self.assertEqual(response.context['questions'],
+                         [{'id': question_id, 'question_text': text} for question_id, text in saved])
+        self.assertEqual(response.context['selected_theme'], '政治')
+        self.assertContains(response, '首相のお題')
+        self.assertContains(response, '新しいお題を生成し、保存しました！')
+        # 表示した提案はセッションから消える
+        session = await self.async_client.asession()
+        self.assertIsNone(await session.aget('proposal'))
+
+    async def test_pooled_questions_are_served_without_generating(self):
+        await sync_to_async(save_generated_questions)(
+            None, '政治', self.HEADLINES, ['プールのお題1', 'プールのお題2', 'プールのお題3'], is_pooled=True
+        )
+        news_patch, gemini_patch = self._patch_services(['国会のお題', '首相のお題', '法案のお題'])
+        await self.async_client.aforce_login(self.user)
+        with news_patch as aget_recent_headlines, gemini_patch as agenerate_questions:
+            await self.async_client.post(reverse('oogiri:proposal'), {'theme': '政治'})
+        aget_recent_headlines.assert_not_awaited()
+        agenerate_questions.assert_not_awaited()
+
+        response = await self.async_client.get(reverse('oogiri:proposal'))
+        self.assertContains(response, 'プールのお題1')
+        self.assertContains(response, '用意してあるお題から新しいお題を取り出しました！')
+        self.assertNotContains(response, '新しいお題を生成し、保存しました！')
+
+    async def test_generation_error_message_is_shown(self):
+        news_patch, gemini_patch = self._patch_services('APIの利用上限に達しました。')
+        await self.async_client.aforce_login(self.user)
+        with news_patch, gemini_patch:
+            response = await self.async_client.post(reverse('oogiri:proposal'), {'theme': '政治'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'AIお題生成中にエラーが発生しました: APIの利用上限に達しました。')
+        self.assertEqual(response.context['questions'], [])
+        self.assertFalse(await Question.objects.filter(user=self.user).aexists())
+        session = await self.async_client.asession()
+        self.assertIsNone(await session.aget('proposal'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, GEMINI_API_KEY='stub', LLM_BACKENDS={'question_generation': 'gemini'})
+class QuestionPoolTests(TestCase):
+
+    HEADLINES = ['国会で新しい法案が可決', '首相が記者会見で新しい政策を発表']
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('pool@example.com', 'pool', password=None)
+
+    def fill_pool(self, question_texts, theme='政治'):
+        return save_generated_questions(None, theme, self.HEADLINES, question_texts, is_pooled=True)
+
+    def test_oldest_pooled_questions_are_taken_once(self):
+        question_ids = self.fill_pool(['お題1', 'お題2', 'お題3', 'お題4'])
+        self.fill_pool(['芸能のお題1', '芸能のお題2', '芸能のお題3'], theme='芸能')
+
+        with CaptureQueriesContext(connection) as queries:
+            taken = take_pooled_questions(self.user, '政治')
+        self.assertEqual(taken, list(zip(question_ids[:3], ['お題1', 'お題2', 'お題3'])))
+        # プールから外してユーザーに割り当てる更新は1回だけ
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE "oogiri_question"')]), 1)
+        self.assertEqual(set(Question.objects.filter(id__in=question_ids[:3]).values_list('is_pooled', 'user_id')),
+                         {(False, self.user.id)})
+
+        # 残りが3件に満たない場合は取り出さない (取り出したお題を他のユーザーに渡すこともない)
+        other_user = get_user_model().objects.create_user('pool-other@example.com', 'pool-other', password=None)
+        self.assertEqual(take_pooled_questions(other_user, '政治'), [])
+        self.assertEqual(count_pooled_questions('政治'), 1)
+        self.assertEqual(count_pooled_questions('芸能'), 3)
+
+    def test_taking_is_retried_when_another_request_took_a_question_first(self):
+        question_ids = self.fill_pool(['お題1', 'お題2', 'お題3'])
+        update = QuerySet.update
+        raced = []
+
+        def racing_update(queryset, **kwargs):
+            if queryset.model is Question and not raced:
+                # 選んだ後に、他のリクエストが1件を先に取り出していた (条件付きの更新が2件にしか当たらない)
+                raced.append(True)
+                return update(queryset.exclude(id=question_ids[0]), **kwargs)
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', autospec=True, side_effect=racing_update) as patched:
+            taken = take_pooled_questions(self.user, '政治')
+        self.assertEqual([question_id for question_id, _ in taken], question_ids)
+        self.assertEqual(patched.call_count, 2)
+        self.assertEqual(Question.objects.filter(user=self.user, is_pooled=False).count(), 3)
+
+        # やり直しても取り合いに負け続けた場合は、途中まで割り当てたお題も戻して空リストを返す
+        question_ids = self.fill_pool(['お題4', 'お題5', 'お題6'])
+        with mock.patch.object(QuerySet, 'update', autospec=True,
+                               side_effect=lambda queryset, **kwargs: update(queryset.exclude(id=question_ids[0]), **kwargs)):
+            self.assertEqual(take_pooled_questions(self.user, '政治', max_retries=2), [])
+        self.assertEqual(count_pooled_questions('政治'), 3)
+
+    async def test_questions_are_generated_when_pool_is_short(self):
+        pooled_ids = await sync_to_async(self.fill_pool)(['お題1', 'お題2'])
+        await self.async_client.aforce_login(self.user)
+        with mock.patch.object(NewsService, 'aget_recent_headlines', mock.AsyncMock(return_value=self.HEADLINES)), \
+                mock.patch.object(GeminiService, 'agenerate_questions',
+                                  mock.AsyncMock(return_value=['国会のお題', '首相のお題', '法案のお題'])) as generate:
+            await self.async_client.post(reverse('oogiri:proposal'), {'theme': '政治'})
+
+        generate.assert_awaited_once()
+        session = await self.async_client.asession()
+        self.assertEqual([text for _, text in (await session.aget('proposal'))['questions']],
+                         ['国会のお題', '首相のお題', '法案のお題'])
+        # 足りないプールのお題はそのまま残る
+        self.assertEqual(await sync_to_async(count_pooled_questions)('政治'), 2)
+        self.assertFalse(await Question.objects.filter(id__in=pooled_ids, user=self.user).aexists())
+
+    async def test_pool_is_filled_up_to_size_when_below_low_water(self):
+        await sync_to_async(self.fill_pool)(['お題1'])
+        backend = ScriptedQuestionBackend([
+            ['猫が市長になったら最初にすることは？', 'こんな記者会見は嫌だ', '新しい祝日の名前を考えてください'],
+            ['国会の新しいルールとは？', '首相の意外な特技とは？', '法案に付け足したい一文とは？'],
+        ])
+        command = FillQuestionPoolCommand(stdout=io.StringIO())
+        options = {'once': True, 'interval': 0, 'jitter': 0}
+        with mock.patch.object(NewsService, 'aget_recent_headlines', mock.AsyncMock(return_value=self.HEADLINES)), \
+                mock.patch('oogiri.management.commands.fill_question_pool.get_llm_backend', return_value=backend):
+            await command._fill_loop('政治', 2, 7, options)
+            self.assertEqual(await sync_to_async(count_pooled_questions)('政治'), 7)
+            self.assertEqual(backend.calls, 2)
+
+            # 残りが low_water 以上なら補充しない
+            await command._fill_loop('政治', 2, 10, options)
+            self.assertEqual(backend.calls, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class HeadlineStoreTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    async def test_fetched_headlines_are_stored_once_with_themes(self):
+        with StubAPIServer(news_latency=0, headline_count=3) as stub, override_settings(
+            NEWS_API_KEY='stub', NEWS_API_BASE_URL=f'{stub.base_url}/v2',
+        ):
+            titles = await NewsService().aget_recent_headlines('政治')
+        # 空白の違うタイトルは同じタイトルとして扱う
+        await sync_to_async(record_headlines)('芸能', ['スタブニュース0:  猫が市長に立候補', '新しいニュース'])
+
+        self.assertEqual(await NewsHeadline.objects.acount(), 4)
+        headline = await NewsHeadline.objects.aget(title=titles[0])
+        self.assertEqual(headline.url, 'https://news.example.com/articles/0')
+        self.assertEqual(sorted([theme async for theme in headline.themes.values_list('theme', flat=True)]),
+                         ['政治', '芸能'])
+        self.assertEqual(await sync_to_async(recent_headlines)('芸能'), ['新しいニュース', titles[0]])
+
+    def test_headlines_are_searched_by_index_and_linked_from_questions(self):
+        record_headlines('政治', ['国会が開会', '首相が会見', 'サッカー日本代表が勝利'])
+        record_headlines('スポーツ', ['サッカー日本代表が勝利'])
+        question_ids = save_generated_questions(None, '政治', ['国会が開会', '首相が会見'], ['お題1'])
+
+        self.assertEqual([headline.title for headline in search_headlines('日本代表')], ['サッカー日本代表が勝利'])
+        self.assertEqual([headline.title for headline in search_headlines('サッカー 勝利', theme='政治')],
+                         ['サッカー日本代表が勝利'])
+        self.assertFalse(search_headlines('日本代表 国会').exists())
+        # 2文字の語 (全文検索インデックスでは探せない) も見つかる
+        self.assertEqual([headline.title for headline in search_headlines('会見')], ['首相が会見'])
+        self.assertEqual(
+            list(Question.objects.filter(headline_set__news_headlines__in=search_headlines('国会が'))
+                 .values_list('id', flat=True)),
+            question_ids,
+        )
+
+    def test_reusing_headlines_for_questions_does_not_touch_fetch_time(self):
+        [fetched] = record_headlines('政治', ['国会が開会'])
+        NewsHeadline.objects.filter(id=fetched.id).update(last_fetched_at=timezone.now() - timedelta(days=3))
+        fetched.refresh_from_db()
+
+        # お題プールの補充などで、以前に取得したタイトルと新しいタイトルの組から生成したお題を保存する
+        save_generated_questions(None, '政治', ['国会が開会', '組にだけあるタイトル'], ['お題1'], is_pooled=True)
+        self.assertEqual(NewsHeadline.objects.get(id=fetched.id).last_fetched_at, fetched.last_fetched_at)
+        self.assertEqual(recent_headlines('政治'), ['国会が開会'])
+        self.assertEqual(sorted(Question.objects.get().headline_set.news_headlines.values_list('title', flat=True)),
+                         ['国会が開会', '組にだけあるタイトル'])
+
+        record_headlines('政治', ['国会が開会'])
+        self.assertGreater(NewsHeadline.objects.get(id=fetched.id).last_fetched_at, fetched.last_fetched_at)
+
+    @override_settings(DEBUG=True, GEMINI_API_KEY='stub', LLM_BACKENDS={'question_generation': 'gemini'})
+    async def test_dummy_headlines_are_not_stored(self):
+        user = await sync_to_async(get_user_model().objects.create_user)('dummy@example.com', 'dummy', password=None)
+        await self.async_client.aforce_login(user)
+        with mock.patch.object(NewsService, 'aget_recent_headlines', mock.AsyncMock(return_value=[])), \
+                mock.patch.object(GeminiService, 'agenerate_questions',
+                                  mock.AsyncMock(return_value=['お題1', 'お題2', 'お題3'])):
+            await self.async_client.post(reverse('oogiri:proposal'), {'theme': '政治'})
+
+        question = await Question.objects.select_related('headline_set').filter(user=user).afirst()
+        self.assertIn('ダミー1', question.headline_set.headlines)
+        self.assertFalse(await NewsHeadline.objects.aexists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class HeadlineCacheTests(TransactionTestCase):
+    """
+    裏での再取得はスレッドからロックを解放するため、トランザクションで囲まない TransactionTestCase で確かめる。
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.headline_cache = HeadlineCache(ttl=60, stale_ttl=600, lock_timeout=5)
+        self.key = self.headline_cache.make_key('政治', '2026-01-01', '2026-01-31', 100)
+        self.fetched = []
+
+    def fetch(self, titles):
+        def fetch():
+            self.fetched.append(titles)
+            return titles
+        return fetch
+
+    def store_stale_entry(self, titles):
+        cache.set(self.key, {'titles': titles, 'fetched_at': time.time() - 120}, 600)
+
+    @contextlib.contextmanager
+    def waiting_for_background_refresh(self):
+        # 裏での再取得が終わってロックを解放するまで待つ
+        released = threading.Event()
+
+        def release(name, token):
+            release_lock(name, token)
+            released.set()
+
+        with mock.patch('oogiri.services.release_lock', side_effect=release):
+            yield
+            self.assertTrue(released.wait(5))
+
+    def test_fresh_entry_is_returned_without_fetching(self):
+        self.assertEqual(self.headline_cache.get_or_fetch(self.key, self.fetch(['国会が開会'])), ['国会が開会'])
+        self.assertEqual(self.headline_cache.get_or_fetch(self.key, self.fetch(['首相が会見'])), ['国会が開会'])
+        self.assertEqual(self.fetched, [['国会が開会']])
+        self.assertLess(self.headline_cache.entry_age(self.key), 60)
+        self.assertFalse(ProcessLock.objects.exists())
+
+    def test_stale_entry_is_returned_and_refreshed_once_in_background(self):
+        self.store_stale_entry(['古いニュース'])
+        can_finish = threading.Event()
+
+        def slow_fetch():
+            self.fetched.append(['新しいニュース'])
+            can_finish.wait(5)
+            return ['新しいニュース']
+
+        with self.waiting_for_background_refresh():
+            # 期限切れのデータをすぐに返し、再取得中は他のリクエストも再取得を重ねずに古いデータを返す
+            self.assertEqual(self.headline_cache.get_or_fetch(self.key, slow_fetch), ['古いニュース'])
+            self.assertEqual(self.headline_cache.get_or_fetch(self.key, slow_fetch), ['古いニュース'])
+            can_finish.set()
+
+        self.assertEqual(self.headline_cache.get_or_fetch(self.key, self.fetch(['さらに新しいニュース'])), ['新しいニュース'])
+        self.assertEqual(self.fetched, [['新しいニュース']])
+
+    def test_empty_result_is_not_cached(self):
+        self.assertEqual(self.headline_cache.get_or_fetch(self.key, self.fetch([])), [])
+        self.assertIsNone(cache.get(self.key))
+        self.assertEqual(self.headline_cache.get_or_fetch(self.key, self.fetch(['国会が開会'])), ['国会が開会'])
+        self.assertEqual(len(self.fetched), 2)
+
+        # 再取得が失敗 (空のリスト) しても、古いデータを消さずに返し続ける
+        self.store_stale_entry(['古いニュース'])
+        with self.waiting_for_background_refresh():
+            self.assertEqual(self.headline_cache.get_or_fetch(self.key, self.fetch([])), ['古いニュース'])
+        self.assertEqual(cache.get(self.key)['titles'], ['古いニュース'])
+        self.assertEqual(len(self.fetched), 3)
+
+    async def test_concurrent_misses_fetch_once(self):
+        calls = 0
+
+        async def afetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.1)
+            return ['国会が開会']
+
+        # キャッシュが無いときに同時に来たリクエストは、1つだけが取得し、他はその結果を待つ
+        results = await asyncio.gather(*(self.headline_cache.aget_or_fetch(self.key, afetch, None) for _ in range(5)))
+        self.assertEqual(results, [['国会が開会']] * 5)
+        self.assertEqual(calls, 1)
+        self.assertFalse(await ProcessLock.objects.aexists())
+
+    def test_lock_is_exclusive_until_released_or_expired(self):
+        token = acquire_lock('headline-test', timeout=60)
+        self.assertIsNotNone(token)
+        self.assertIsNone(acquire_lock('headline-test', timeout=60))
+        # 他のものが取り直したロックは、古いトークンでは解放できない
+        release_lock('headline-test', 'other-token')
+        self.assertIsNone(acquire_lock('headline-test', timeout=60))
+        release_lock('headline-test', token)
+
+        # 持ち主が解放せずに落ちた場合も、期限を過ぎれば取り直せる
+        self.assertIsNotNone(acquire_lock('headline-test', timeout=-1))
+        self.assertIsNotNone(acquire_lock('headline-test', timeout=60))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PrefetchHeadlinesTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    async def test_failures_back_off_and_keep_cached_headlines(self):
+        news_service = NewsService()
+        key = HeadlineCache().make_key('政治', *news_service._date_window(), 100)
+        await cache.aset(key, {'titles': ['古いニュース'], 'fetched_at': time.time() - 3600}, 3600)
+        options = {'max_count': 100, 'retry': 30, 'max_backoff': 50, 'jitter': 0, 'once': False}
+        delays = []
+
+        async def sleep(delay):
+            delays.append((delay, (await cache.aget(key))['titles']))
+            if len(delays) == 4:
+                raise asyncio.CancelledError
+
+        # 接続エラー (例外) と空の結果が続いた後に、取得に成功する
+        fetch = mock.AsyncMock(side_effect=[RuntimeError('接続できません'), [], [], ['新しいニュース']])
+        stdout = io.StringIO()
+        with mock.patch.object(NewsService, '_afetch_headlines', fetch), \
+                mock.patch('oogiri.management.commands.prefetch_headlines.asyncio.sleep', sleep):
+            with self.assertRaises(asyncio.CancelledError):
+                await PrefetchHeadlinesCommand(stdout=stdout)._prefetch_loop('政治', 900, options)
+
+        # 失敗するたびに間隔を倍に延ばし (上限は max_backoff)、成功したら通常の間隔に戻す。失敗の間も古いデータを返し続ける
+        self.assertEqual(delays, [
+            (30, ['古いニュース']), (50, ['古いニュース']), (50, ['古いニュース']), (900, ['新しいニュース']),
+        ])
+        self.assertIn('予期せぬエラーが発生しました: 接続できません', stdout.getvalue())
+
+
+class HeadlineSelectionTests(TestCase):
+    headlines = [
+        'Stock markets rally on tech earnings',
+        '中国经济增长放缓',
+        '猫が市長に立候補 - 日本新聞',
+        '猫が市長に立候補 - 東京新聞',
+        '政治資金の新しいルールが決まる',
+        '首相が記者会見で新しい政策を発表',
+        '人気アニメの映画が公開される',
+    ]
+
+    def test_headlines_are_filtered_and_ranked_by_theme_and_excellent_questions(self):
+        selected = select_headlines(self.headlines, '政治', reference_questions=['こんな記者会見は嫌だ'], token_budget=1000)
+        # 日本語以外とほぼ同じタイトルを除き、テーマを含むもの、「特に面白い」お題に近いものの順に並べる
+        self.assertEqual(selected, [
+            '政治資金の新しいルールが決まる', '首相が記者会見で新しい政策を発表', '猫が市長に立候補 - 日本新聞',
+            '人気アニメの映画が公開される',
+        ])
+
+    def test_headlines_are_packed_into_token_budget(self):
+        selected = select_headlines(self.headlines, '政治', reference_questions=[], token_budget=40)
+        self.assertEqual(selected, ['政治資金の新しいルールが決まる', '猫が市長に立候補 - 日本新聞'])
+        self.assertLessEqual(sum(estimate_tokens(title) + 2 for title in selected), 40)
+        # 予算より長いタイトルしか無くても、1件は使う
+        self.assertEqual(select_headlines(self.headlines[4:5], '政治', reference_questions=[], token_budget=1),
+                         self.headlines[4:5])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, FEW_SHOT_VECTOR_ROOT='')
+class FewShotInvalidationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('few-shot-flag@example.com', 'few-shot-flag', password=None)
+        self.question = Question.objects.create(theme='政治', question_text='こんな国会は嫌だ')
+        self.index = FewShotIndex(ttl=300)
+
+    def test_flag_changes_rebuild_index_on_next_use(self):
+        with mock.patch.object(self.index, '_rebuild', wraps=self.index._rebuild) as rebuild:
+            self.assertEqual(len(self.index), 0)
+            self.assertEqual(len(self.index), 0)
+            self.assertEqual(rebuild.call_count, 1)
+
+            # 通常の回答の投稿では作り直さない
+            answer = Answer.objects.create(user=self.user, question=self.question, answer_text='全員ラップで答弁',
+                                           score=5, review_text='韻が効いている')
+            self.assertEqual(len(self.index), 0)
+            self.assertEqual(rebuild.call_count, 1)
+
+            # 「特に面白い」を付けると、次に参照したときに作り直す
+            answer.is_excellent_answer = True
+            answer.save()
+            self.assertEqual(self.index.sample_answer_examples(1), [
+                render_answer_example('こんな国会は嫌だ', '全員ラップで答弁', 5, '韻が効いている'),
+            ])
+            self.assertEqual(rebuild.call_count, 2)
+
+            # 事例になっている回答のお題を編集すると、事例の本文が変わるため作り直す
+            self.question.question_text = 'こんな国会は絶対に嫌だ'
+            self.question.save()
+            self.assertIn('こんな国会は絶対に嫌だ', self.index.sample_answer_examples(1)[0])
+            self.assertEqual(rebuild.call_count, 3)
+
+            # お題に「特に面白い」を付けた場合も作り直す
+            Question.objects.create(theme='政治', question_text='猫が首相になったら？', is_excellent=True)
+            self.assertEqual(self.index.excellent_questions('政治', 5), ['猫が首相になったら？'])
+            self.assertEqual(rebuild.call_count, 4)
+
+            # 外した場合も作り直す
+            answer.is_excellent_answer = False
+            answer.save()
+            self.assertEqual(len(self.index), 0)
+            self.assertEqual(rebuild.call_count, 5)
+
+            # シグナルを通らない更新は、TTLが過ぎてから反映する
+            Answer.objects.filter(pk=answer.pk).update(is_excellent_answer=True)
+            self.assertEqual(len(self.index), 0)
+            with mock.patch('oogiri.few_shot.time.monotonic', return_value=time.monotonic() + 301):
+                self.assertEqual(len(self.index), 1)
+            self.assertEqual(rebuild.call_count, 6)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FewShotSimilarityTests(TestCase):
+
+    def setUp(self):
+        self.vector_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.vector_root.cleanup)
+        self.enterContext(override_settings(FEW_SHOT_VECTOR_ROOT=self.vector_root.name))
+        user = get_user_model().objects.create_user('few-shot@example.com', 'few-shot', password=None)
+        for question_text, answer_text in [
+            ('猫が市長になったら最初にすることは？', '全ての道にこたつを置く'),
+            ('こんな記者会見は嫌だ', '記者が全員首相のモノマネ'),
+            ('新しい祝日の名前を考えてください', '二度寝の日'),
+        ]:
+            question = Question.objects.create(theme='政治', question_text=question_text, is_excellent=True)
+            Answer.objects.create(user=user, question=question, answer_text=answer_text, is_excellent_answer=True)
+
+    def stored_rows(self) -> dict:
+        index = json.loads((Path(self.vector_root.name) / 'vectors.json').read_text(encoding='utf-8'))
+        self.assertEqual(index['version'], STORE_VERSION)
+        return index['rows']
+
+    def test_examples_close_to_prompt_are_selected(self):
+        index = FewShotIndex(ttl=300)
+        # 新しい順ではなく、ニュースに近いお題を先に返し、足りない分を新しい順に加える
+        self.assertEqual(index.similar_questions('政治', '首相が記者会見で新しい政策を発表', 2), [
+            'こんな記者会見は嫌だ', '新しい祝日の名前を考えてください',
+        ])
+        self.assertEqual(index.similar_questions('スポーツ', '首相が記者会見', 2), [])
+        examples = index.similar_answer_examples('猫が市長になった町の条例とは？', 1)
+        self.assertEqual(len(examples), 1)
+        self.assertIn('全ての道にこたつを置く', examples[0])
+        # 近い事例が無い場合も k 件選ぶ
+        self.assertEqual(len(index.similar_answer_examples('ABC', 2, seed=1)), 2)
+        # 足りない分は近い事例と重ならないように選び、同じ seed には同じ事例を返す
+        examples = index.similar_answer_examples('猫が市長になった町の条例とは？', 5, seed=1)
+        self.assertEqual(len(examples), 3)
+        self.assertEqual(len(set(examples)), 3)
+        self.assertIn('全ての道にこたつを置く', examples[0])
+        self.assertEqual(index.similar_answer_examples('猫が市長になった町の条例とは？', 2, seed=3),
+                         index.similar_answer_examples('猫が市長になった町の条例とは？', 2, seed=3))
+
+    def test_vectors_are_stored_and_updated_incrementally(self):
+        FewShotIndex(ttl=300).similar_questions('政治', '記者会見', 1)
+        rows = self.stored_rows()
+        self.assertEqual(len(rows), 3)
+
+        question = Question.objects.create(theme='政治', question_text='国会の新しいルールとは？', is_excellent=True)
+        index = FewShotIndex(ttl=300)
+        self.assertEqual(index.similar_questions('政治', '国会で新しいルール', 1), ['国会の新しいルールとは？'])
+        # 既存の行はそのまま、新しい事例だけを追記する
+        updated_rows = self.stored_rows()
+        self.assertEqual(len(updated_rows), 4)
+        self.assertEqual({digest: updated_rows[digest] for digest in rows}, rows)
+
+        # 使われなくなった行が増えたら詰め直す
+        Question.objects.exclude(pk=question.pk).update(is_excellent=False)
+        Answer.objects.update(is_excellent_answer=False)
+        FewShotIndex(ttl=300).similar_questions('政治', '国会', 1)
+        self.assertEqual(len(self.stored_rows()), 1)
+        self.assertEqual(len(list(Path(self.vector_root.name).glob('vectors-*.bin'))), 3)
+
+
+class ScriptedQuestionBackend:
+    """
+    お題生成の結果を、決めておいた順に返すテスト用のバックエンド。
+    """
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = 0
+
+    async def agenerate_questions(self, headlines, theme):
+        self.calls += 1
+        return self.results.pop(0)
+
+
+class QuestionDedupTests(TestCase):
+
+    async def test_near_duplicates_are_dropped_and_regenerated(self):
+        await Question.objects.acreate(theme='政治', question_text='猫が市長になったら最初にすることは？')
+        results = [
+            ['猫が市長になったら、最初にやることは？', 'こんな記者会見は嫌だ', 'こんな記者会見は嫌だ！'],
+            ['新しい祝日の名前を考えてください', '国会の新しいルールとは？', '使われないお題'],
+        ]
+
+        backend = ScriptedQuestionBackend(results)
+        # 保存済みのお題とほぼ同じもの、同時に生成したお題とほぼ同じものを除き、足りない分を生成し直す
+        questions = await agenerate_unique_questions(backend, ['ニュース'], '政治', max_retries=1)
+        self.assertEqual(questions, ['こんな記者会見は嫌だ', '新しい祝日の名前を考えてください', '国会の新しいルールとは？'])
+        self.assertEqual(backend.calls, 2)
+
+        backend = ScriptedQuestionBackend(results)
+        self.assertEqual(await agenerate_unique_questions(backend, ['ニュース'], '政治', max_retries=0),
+                         ['こんな記者会見は嫌だ'])
+        # 同じテーマのお題とだけ比べる
+        self.assertEqual(await agenerate_unique_questions(
+            ScriptedQuestionBackend(results), ['ニュース'], 'スポーツ', max_retries=0
+        ), ['猫が市長になったら、最初にやることは？', 'こんな記者会見は嫌だ'])
+
+        # 保存したお題は、以降の生成で重複として除かれる
+        [question_id] = await sync_to_async(save_generated_questions)(None, '政治', ['ニュース'], ['こんな記者会見は嫌だ'])
+        self.assertEqual(await sync_to_async(find_duplicates)('政治', ['こんな記者会見は、嫌だ']), [question_id])
+        self.assertEqual(
+            await agenerate_unique_questions(ScriptedQuestionBackend([['こんな記者会見は嫌だ']]), [], '政治', max_retries=0),
+            '生成したお題が全て既存のお題とほぼ同じでした。',
+        )
+
+    def test_fingerprints_follow_edits_and_can_be_rebuilt(self):
+        question = Question.objects.create(theme='政治', question_text='こんな国会は嫌だ')
+        self.assertEqual(question.fingerprints.count(), NUM_PERMUTATIONS // ROWS_PER_BAND)
+
+        question.question_text = '猫が市長になったら最初にすることは？'
+        question.save()
+        self.assertEqual(find_duplicates('政治', ['こんな国会は嫌だ', '猫が市長になったら最初にすることは']),
+                         [None, question.id])
+
+        # 重複判定の仕組みより前から保存されているお題を登録する
+        QuestionFingerprint.objects.all().delete()
+        call_command('build_question_fingerprints', batch_size=1, stdout=io.StringIO())
+        self.assertEqual(question.fingerprints.count(), NUM_PERMUTATIONS // ROWS_PER_BAND)
+        self.assertEqual(find_duplicates('政治', ['猫が市長になったら最初にすることは']), [question.id])
+
+    def test_candidates_are_limited_per_bucket_within_the_theme(self):
+        question = Question.objects.create(theme='政治', question_text='猫が市長になったら最初にすることは？')
+        buckets = list(question.fingerprints.values_list('bucket', flat=True))
+        query = '猫が市長になったら、最初にやることは？'
+        [shared, *_] = sorted(set(buckets) & set(band_buckets('政治', query)))
+        # 帯のハッシュが (衝突して) 一致する、別のテーマのお題と、同じテーマのより新しいお題
+        others = [Question.objects.create(theme='スポーツ', question_text=f'スポーツのお題{i}') for i in range(10)]
+        others += [Question.objects.create(theme='政治', question_text=f'政治のお題{i}') for i in range(5)]
+        QuestionFingerprint.objects.bulk_create(
+            [QuestionFingerprint(question=other, bucket=bucket) for other in others[:10] for bucket in buckets]
+            + [QuestionFingerprint(question=other, bucket=shared) for other in others[10:]]
+        )
+
+        with mock.patch('oogiri.question_dedup._MAX_CANDIDATES', 3), \
+                self.assertLogs('oogiri.question_dedup', 'WARNING') as logs:
+            self.assertEqual(find_duplicates('政治', [query]), [question.id])
+        # 別のテーマのお題は候補に数えず、候補が上限を超えた帯のハッシュだけを記録する
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn(f'帯のハッシュ {shared} の候補 6件のうち、新しい 3件', logs.output[0])
+
+
+@override_settings(LLM_BACKENDS={'answer_generation': 'oogiri.tests.FakeBackend', 'evaluation': 'oogiri.tests.FakeBackend'})
+class AnswerSuggestionTests(TestCase):
+
+    def setUp(self):
+        self.question = Question.objects.create(theme='政治', question_text='こんな国会は嫌だ')
+
+    def test_best_candidates_are_suggested(self):
+        user = get_user_model().objects.create_user('suggest@example.com', 'suggest', password=None)
+        self.client.force_login(user)
+        with override_settings(ANSWER_SUGGESTION_CANDIDATES=5, ANSWER_SUGGESTION_TOP_K=2):
+            response = self.client.get(reverse('oogiri:answer_suggestions', kwargs={'question_id': self.question.id}))
+
+        self.assertEqual(response.status_code, 200)
+        # 重複を除いた4個の候補から、点数の高い2個を返す
+        self.assertEqual(response.json(), {'suggestions': [
+            {'answer_text': 'すごい案だ', 'score': 5.0},
+            {'answer_text': 'よい案', 'score': 3.0},
+        ]})
+
+    def test_scoring_is_skipped_when_time_budget_is_exceeded(self):
+        with mock.patch.object(FakeBackend, 'score_answers') as score_answers:
+            suggestions = suggest_answers(self.question, candidates=5, top_k=3, time_budget=0)
+
+        score_answers.assert_not_called()
+        self.assertEqual(suggestions, [
+            {'answer_text': '案', 'score': None},
+            {'answer_text': 'よい案', 'score': None},
+            {'answer_text': 'すごい案だ', 'score': None},
+        ])
+
+
+class ExportTrainingDataTests(TestCase):
+
+    def setUp(self):
+        self.output_dir = Path(tempfile.mkdtemp())
+        self.output_path = self.output_dir / 'training.jsonl'
+
+    def tearDown(self):
+        for path in self.output_dir.iterdir():
+            path.unlink()
+        self.output_dir.rmdir()
+
+    def test_samples_are_streamed_into_compressed_shards(self):
+        user = get_user_model().objects.create_user('export@example.com', 'export', password=None)
+        question = Question.objects.create(theme='政治', question_text='こんな国会は嫌だ', source_title='国会が開会',
+                                           is_excellent=True)
+        Question.objects.create(theme='政治', question_text='元ネタの無いお題', is_excellent=True)
+        for i in range(4):
+            Answer.objects.create(user=user, question=question, answer_text=f'回答{i}', is_excellent_answer=i != 3)
+
+        call_command('export_training_data', output=self.output_path, shards=2, compression='gzip', chunk_size=2,
+                     stdout=io.StringIO())
+
+        lines = []
+        for index in range(2):
+            with gzip.open(self.output_dir / f'training-{index:05d}-of-00002.jsonl.gz', 'rt', encoding='utf-8') as f:
+                lines.append(f.read().splitlines())
+        self.assertEqual([len(shard) for shard in lines], [2, 2])
+        samples = [json.loads(line) for line in lines[0] + lines[1]]
+        self.assertEqual(
+            sorted(sample['messages'][1]['content'] for sample in samples),
+            ['こんな国会は嫌だ', '回答0', '回答1', '回答2'],
+        )
+        self.assertFalse(list(self.output_dir.glob('*.tmp')))
+
+    def test_incremental_export_adds_new_and_newly_flagged_rows(self):
+        user = get_user_model().objects.create_user('export@example.com', 'export', password=None)
+        question = Question.objects.create(theme='政治', question_text='こんな国会は嫌だ')
+        Answer.objects.create(user=user, question=question, answer_text='全員ラップで答弁', is_excellent_answer=True)
+        old_answer = Answer.objects.create(user=user, question=question, answer_text='居眠りが公務')
+        call_command('export_training_data', output=self.output_path, stdout=io.StringIO())
+
+        # 既存の回答に「特に面白い」を付け、新しい回答と、句読点だけが違う重複を追加する
+        old_answer.is_excellent_answer = True
+        old_answer.save()
+        Answer.objects.create(user=user, question=question, answer_text='質問が全部ポエム', is_excellent_answer=True)
+        Answer.objects.create(user=user, question=question, answer_text='全員、ラップで答弁！', is_excellent_answer=True)
+        self.assertEqual(TrainingFlagChange.objects.filter(object_id=old_answer.id).count(), 1)
+        call_command('export_training_data', output=self.output_path, incremental=True, stdout=io.StringIO())
+
+        part_path = self.output_dir / 'training.part-0001.jsonl'
+        added = [json.loads(line)['messages'][1]['content'] for line in part_path.read_text(encoding='utf-8').splitlines()]
+        self.assertEqual(added, ['居眠りが公務', '質問が全部ポエム'])
+        manifest = json.loads((self.output_dir / 'training.manifest.json').read_text(encoding='utf-8'))
+        self.assertEqual(manifest['rows'], 3)
+        self.assertEqual([(entry['path'], entry['rows']) for entry in manifest['files']],
+                         [('training.jsonl', 1), ('training.part-0001.jsonl', 2)])
+        self.assertEqual(manifest['files'][1]['sha256'], hashlib.sha256(part_path.read_bytes()).hexdigest())
+
+        # 追加が無ければ新しいファイルは作らない。全件を書き出し直すと差分のファイルは消える
+        call_command('export_training_data', output=self.output_path, incremental=True, stdout=io.StringIO())
+        self.assertFalse((self.output_dir / 'training.part-0002.jsonl').exists())
+        call_command('export_training_data', output=self.output_path, stdout=io.StringIO())
+        self.assertFalse(part_path.exists())
+        self.assertEqual(len(self.output_path.read_text(encoding='utf-8').splitlines()), 3)
+
+    def test_split_keeps_question_together_and_balancer_thins_large_theme(self):
+        user = get_user_model().objects.create_user('export@example.com', 'export', password=None)
+        for i in range(8):
+            question = Question.objects.create(theme='政治', question_text=f'政治のお題{i}')
+            for j in range(5):
+                Answer.objects.create(user=user, question=question, answer_text=f'回答{i}-{j}', is_excellent_answer=True)
+        question = Question.objects.create(theme='芸能', question_text='芸能のお題')
+        Answer.objects.create(user=user, question=question, answer_text='芸能の回答', is_excellent_answer=True)
+
+        call_command('export_training_data', output=self.output_path, validation=0.5, max_per_theme=20,
+                     stdout=io.StringIO())
+
+        splits_by_prompt = {}
+        for split in ('train', 'validation'):
+            for line in (self.output_dir / f'training.{split}.jsonl').read_text(encoding='utf-8').splitlines():
+                splits_by_prompt.setdefault(json.loads(line)['messages'][0]['content'], set()).add(split)
+        # 同じお題への回答は同じ分割に入る
+        self.assertTrue(all(len(splits) == 1 for splits in splits_by_prompt.values()))
+        self.assertEqual(len({next(iter(splits)) for splits in splits_by_prompt.values()}), 2)
+
+        stats = json.loads((self.output_dir / 'training.manifest.json').read_text(encoding='utf-8'))['stats']
+        counts = collections.Counter()
+        for tasks in stats['splits'].values():
+            for theme, count in tasks['answer_generation'].items():
+                counts[theme] += count
+        # 上限を超える政治の回答だけが間引かれる
+        self.assertLess(counts['政治'], 40)
+        self.assertEqual(counts['芸能'], 1)
+        self.assertEqual(counts['政治'] + stats['dropped'], 40)
+
+    def test_tokenized_dataset_masks_prompt_and_skips_unchanged_files(self):
+        user = get_user_model().objects.create_user('export@example.com', 'export', password=None)
+        question = Question.objects.create(theme='政治', question_text='こんな国会は嫌だ')
+        Answer.objects.create(user=user, question=question, answer_text='全員ラップで答弁', is_excellent_answer=True)
+        Answer.objects.create(user=user, question=question, answer_text='居眠りが公務', is_excellent_answer=True)
+        call_command('export_training_data', output=self.output_path, stdout=io.StringIO())
+        samples = [json.loads(line) for line in self.output_path.read_text(encoding='utf-8').splitlines()]
+
+        tokenizer = ChatCharTokenizer()
+        tokenized = []
+        tokenize_training_data(self.output_path, load_manifest(self.output_path)['files'], tokenizer=tokenizer,
+                               batch_size=1, on_file=lambda path, count, retokenized: tokenized.append(retokenized))
+        with TokenDataset(index_path(self.output_path)) as dataset:
+            self.assertEqual(len(dataset), 2)
+            for i, sample in enumerate(samples):
+                ids, mask = dataset[i]
+                text = ''.join(map(chr, ids))
+                self.assertEqual(text, tokenizer.apply_chat_template(sample['messages']))
+                # 損失を計算するのは応答 (と終わりの印) だけ
+                completion = ''.join(chr(token) for token, flag in zip(ids, mask) if flag)
+                self.assertEqual(completion, f"{sample['messages'][1]['content']}<e>")
+                ids.release()
+                mask.release()
+
+        # 学習データが変わらなければトークナイズし直さない
+        tokenize_training_data(self.output_path, load_manifest(self.output_path)['files'], tokenizer=tokenizer,
+                               on_file=lambda path, count, retokenized: tokenized.append(retokenized))
+        self.assertEqual(tokenized, [True, False])
+
+    def test_deduplicator_keeps_new_digests_in_sorted_arrays(self):
+        path = self.output_dir / 'training.digests'
+        path.write_bytes(array('Q', range(0, 200, 2)).tobytes())
+        deduplicator = SampleDeduplicator.load(path, [])
+
+        with mock.patch('oogiri.training_data.DIGEST_BATCH_SIZE', 8):
+            added = [digest for digest in [*range(300, 100, -1), *range(250, 350)] if deduplicator.add_digest(digest)]
+            # 今回のハッシュは集合ではなく、ソート済みの配列 (と8件未満の集合) で持つ
+            self.assertLess(len(deduplicator._batch), 8)
+            self.assertTrue(all(isinstance(run, array) and list(run) == sorted(run) for run in deduplicator._runs))
+            self.assertLess(len(deduplicator._runs), 10)
+            deduplicator.save(path)
+
+        # 前回までの偶数 (102..198) と、今回の中で2度目のもの (250..300) は重複として除く
+        self.assertEqual(added, [*range(300, 199, -1), *range(199, 100, -2), *range(301, 350)])
+        self.assertEqual(deduplicator.duplicates, 49 + 51)
+        saved = array('Q')
+        saved.frombytes(path.read_bytes())
+        self.assertEqual(list(saved), sorted({*range(0, 200, 2), *range(101, 350)}))
+        self.assertEqual(len(deduplicator), len(saved))
+
+    def test_existing_output_is_kept_when_there_is_no_data(self):
+        self.output_path.write_text('前回の出力\n', encoding='utf-8')
+        call_command('export_training_data', output=self.output_path, stdout=io.StringIO())
+        self.assertEqual(self.output_path.read_text(encoding='utf-8'), '前回の出力\n')
+
+
+@skipUnless(connection.vendor == 'sqlite', 'テスト用のDBを SQLite のファイルに写してワーカーのプロセスから読む')
+class ParallelExportTests(TransactionTestCase):
+    """
+    ワーカーのプロセスで組み立てた学習データが、1つのプロセスで書き出したものと同じになることを確かめる
+    (ワーカーから読めるよう、テスト用のDBの行をコミットしてからファイルに写す)。
+    """
+
+    def setUp(self):
+        self.output_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        for path in self.output_dir.iterdir():
+            path.unlink()
+        self.output_dir.rmdir()
+
+    def test_parallel_export_matches_serial_export(self):
+        user = get_user_model().objects.create_user('export@example.com', 'export', password=None)
+        for i in range(6):
+            question = Question.objects.create(theme=['政治', '芸能'][i % 2], question_text=f'お題{i}',
+                                               source_title=f'ニュース{i}', is_excellent=i % 3 != 0)
+            for j in range(4):
+                # 句読点だけが違う重複も含める
+                Answer.objects.create(user=user, question=question, answer_text=f'回答{i}、{j % 3}',
+                                      is_excellent_answer=j != 1)
+        serial_path = self.output_dir / 'serial.jsonl'
+        parallel_path = self.output_dir / 'parallel.jsonl'
+        call_command('export_training_data', output=serial_path, validation=0.3, stdout=io.StringIO())
+
+        # ワーカーのプロセスはテスト用のDB (メモリ上) を読めないため、ファイルに写して接続先にする
+        database_path = self.output_dir / 'db.sqlite3'
+        with contextlib.closing(sqlite3.connect(database_path)) as database:
+            connection.connection.backup(database)
+        with mock.patch('oogiri.training_data._database_names', return_value={'default': str(database_path)}), \
+                mock.patch('oogiri.training_data.MAX_PENDING_ROWS', 8), \
+                mock.patch('oogiri.training_data._id_ranges', wraps=training_data._id_ranges) as id_ranges:
+            call_command('export_training_data', output=parallel_path, validation=0.3, workers=2,
+                         stdout=io.StringIO())
+        database_path.unlink()
+
+        # 親に溜まる行が MAX_PENDING_ROWS を超えないよう、IDの範囲の幅は全体の件数によらず小さく分ける
+        self.assertEqual({call.args[3] for call in id_ranges.call_args_list}, {2})
+        for split in ('train', 'validation'):
+            self.assertEqual(
+                (self.output_dir / f'parallel.{split}.jsonl').read_bytes(),
+                (self.output_dir / f'serial.{split}.jsonl').read_bytes(),
+            )
+        serial_manifest = json.loads((self.output_dir / 'serial.manifest.json').read_text(encoding='utf-8'))
+        parallel_manifest = json.loads((self.output_dir / 'parallel.manifest.json').read_text(encoding='utf-8'))
+        self.assertGreater(serial_manifest['rows'], 0)
+        self.assertEqual(parallel_manifest['stats'], serial_manifest['stats'])
+        self.assertEqual((self.output_dir / 'parallel.digests').read_bytes(),
+                         (self.output_dir / 'serial.digests').read_bytes())
+
+
+@skipUnless(connection.vendor == 'sqlite', '実行計画の形式は SQLite のもの')
+class QueryPlanTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = seed_synthetic_data(questions=2000, answers_per_question=10)
+
+    def test_hot_queries_use_their_indexes(self):
+        for name, (queryset, index_name) in hot_queries('政治', self.users[0].id).items():
+            with self.subTest(name):
+                plan = query_plan(queryset)
+                self.assertIn(index_name, plan)
+                # 一覧の1ページ目を読むのに、表全体を並べ替えない
+                if name.startswith(('admin_questions', 'admin_answers', 'excellent_', 'pooled_')):
+                    self.assertNotIn('TEMP B-TREE', plan)
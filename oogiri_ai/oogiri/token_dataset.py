@@ -0,0 +1,332 @@
+# oogiri/token_dataset.py
+"""
+トークナイズ済みの学習データ (tokenize_training_data コマンドで書き出す)。
+
+export_training_data で書き出したJSONLの各ファイルを、ローカルモデル (oogiri_finetuned_model) の
+トークナイザーとChatテンプレートでトークンIDの列にし、次の3つのバイナリファイルに書き出す。
+
+- <名前>.ids.bin     : 全サンプルのトークンIDを連結した配列 (uint32, リトルエンディアン)
+- <名前>.mask.bin    : トークンごとの損失のマスク (uint8。assistant の応答のトークンが1、プロンプトのトークンが0)
+- <名前>.offsets.bin : i 番目のサンプルが ids[offsets[i]:offsets[i + 1]] であることを表す配列 (uint64, 要素数はサンプル数 + 1)
+
+ファイルの一覧はインデックス (<出力名>.tokens.json) に残す。学習時は TokenDataset でこれらを memory-map して読むため、
+学習を始めるたびにトークナイズし直す必要が無い (numpy.memmap でも同じ形式で読める)。
+学習のスクリプトからも使えるよう、このモジュールはDjangoに依存しない。
+"""
+import gzip
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
+import os
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+INDEX_VERSION = 1
+
+# バイナリファイルの拡張子と、要素の型 (array の型コード)
+_IDS_SUFFIX, _MASK_SUFFIX, _OFFSETS_SUFFIX = '.ids.bin', '.mask.bin', '.offsets.bin'
+_IDS_TYPECODE, _MASK_TYPECODE, _OFFSETS_TYPECODE = 'I', 'B', 'Q'
+
+# ワーカーのプロセスで使うトークナイザー (_init_worker で読み込む)
+_worker_tokenizer = None
+
+
+def load_tokenizer(tokenizer_path: str):
+    """
+    ローカルモデルのトークナイザーを読み込む。transformers はこの機能を使う場合だけ必要なので、ここで読み込む。
+    """
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(str(tokenizer_path))
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    トークナイザーの語彙とChatテンプレートが変わったことを見分けるためのハッシュ。
+    """
+    vocab = sorted(tokenizer.get_vocab().items(), key=lambda item: item[1])
+    source = json.dumps([vocab, getattr(tokenizer, 'chat_template', None)], ensure_ascii=False)
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+def index_path(output_path: Path) -> Path:
+    return output_path.with_name(f"{output_path.stem}.tokens.json")
+
+
+def dataset_prefix(source_path: Path) -> Path:
+    """
+    JSONLのファイル名から、圧縮の拡張子と .jsonl を除いた名前 (バイナリファイルの名前の元) を返す。
+    """
+    name = source_path.name
+    for suffix in ('.gz', '.zst', '.jsonl'):
+        name = name.removesuffix(suffix)
+    return source_path.with_name(name)
+
+
+def _open_text(path: Path):
+    if path.suffix == '.gz':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.suffix == '.zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd で圧縮されたファイルを読むには zstandard をインストールしてください。")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def _to_little_endian(values: array) -> array:
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def tokenize_samples(tokenizer, samples: list[dict]) -> list[tuple[list[int], list[int]]]:
+    """
+    サンプルをまとめてChatテンプレートで整形してトークナイズし、(トークンID, 損失のマスク) のリストを返す。
+    プロンプト (user メッセージと応答の書き出し) は推論時と同じ形になるよう、応答とは別にトークナイズする。
+    """
+    prompts = []
+    completions = []
+    for sample in samples:
+        prompt = tokenizer.apply_chat_template(sample['messages'][:1], tokenize=False, add_generation_prompt=True)
+        conversation = tokenizer.apply_chat_template(sample['messages'], tokenize=False)
+        if not conversation.startswith(prompt):
+            raise ValueError("Chatテンプレートで整形した会話が、プロンプトで始まっていません。")
+        prompts.append(prompt)
+        # 応答の後ろに付くターンの終わりのトークンも学習させる
+        completions.append(conversation[len(prompt):])
+
+    # 高速版のトークナイザーは、リストをまとめて渡すと並行してトークナイズする
+    prompt_ids = tokenizer(prompts, add_special_tokens=False)['input_ids']
+    completion_ids = tokenizer(completions, add_special_tokens=False)['input_ids']
+    return [
+        (list(prompt) + list(completion), [0] * len(prompt) + [1] * len(completion))
+        for prompt, completion in zip(prompt_ids, completion_ids)
+    ]
+
+
+def tokenize_file(source_path: Path, batch_size: int = 256, tokenizer=None) -> dict:
+    """
+    JSONLのファイル1つをトークナイズしてバイナリファイルに書き出し、件数を返す。
+    tokenizer を省略した場合は、ワーカーのプロセスで読み込んだトークナイザーを使う。
+    """
+    tokenizer = _worker_tokenizer if tokenizer is None else tokenizer
+    source_path = Path(source_path)
+    prefix = dataset_prefix(source_path)
+    paths = [prefix.with_name(prefix.name + suffix) for suffix in (_IDS_SUFFIX, _MASK_SUFFIX, _OFFSETS_SUFFIX)]
+    temporary_paths = [path.with_name(path.name + '.tmp') for path in paths]
+    stats = {'samples': 0, 'tokens': 0, 'assistant_tokens': 0, 'max_length': 0}
+
+    def write_batch(batch):
+        ids = array(_IDS_TYPECODE)
+        mask = array(_MASK_TYPECODE)
+        offsets = array(_OFFSETS_TYPECODE)
+        for token_ids, loss_mask in tokenize_samples(tokenizer, batch):
+            ids.extend(token_ids)
+            mask.extend(loss_mask)
+            stats['samples'] += 1
+            stats['tokens'] += len(token_ids)
+            stats['assistant_tokens'] += sum(loss_mask)
+            stats['max_length'] = max(stats['max_length'], len(token_ids))
+            offsets.append(stats['tokens'])
+        _to_little_endian(ids).tofile(ids_file)
+        mask.tofile(mask_file)
+        _to_little_endian(offsets).tofile(offsets_file)
+
+    try:
+        with _open_text(source_path) as source, open(temporary_paths[0], 'wb') as ids_file, \
+                open(temporary_paths[1], 'wb') as mask_file, open(temporary_paths[2], 'wb') as offsets_file:
+            _to_little_endian(array(_OFFSETS_TYPECODE, [0])).tofile(offsets_file)
+            batch = []
+            for line in source:
+                if line.strip():
+                    batch.append(json.loads(line))
+                if len(batch) >= batch_size:
+                    write_batch(batch)
+                    batch = []
+            if batch:
+                write_batch(batch)
+    except BaseException:
+        for path in temporary_paths:
+            path.unlink(missing_ok=True)
+        raise
+    for temporary_path, path in zip(temporary_paths, paths):
+        os.replace(temporary_path, path)
+    return stats
+
+
+def _init_worker(tokenizer_path: str) -> None:
+    global _worker_tokenizer
+    _worker_tokenizer = load_tokenizer(tokenizer_path)
+
+
+def tokenize_training_data(output_path: Path, files: list[dict], tokenizer_path: str | None = None, tokenizer=None,
+                           batch_size: int = 256, workers: int = 1, force: bool = False, on_file=None) -> dict:
+    """
+    export_training_data で書き出したファイル (マニフェストの 'files' の要素) をトークナイズし、インデックスを書き出して返す。
+    前回と同じ内容のファイル (チェックサムとトークナイザーが同じもの) はトークナイズし直さない (force=True で全て作り直す)。
+    workers が2以上のときは、ファイルごとにワーカーのプロセスでトークナイズする。
+    on_file(ファイル名, 件数, トークナイズし直したか) はファイルを1つ処理するごとに呼ばれる。
+    """
+    output_path = Path(output_path)
+    if tokenizer is None:
+        tokenizer = load_tokenizer(tokenizer_path)
+    fingerprint = tokenizer_fingerprint(tokenizer)
+
+    previous = {}
+    if index_path(output_path).exists() and not force:
+        index = json.loads(index_path(output_path).read_text(encoding='utf-8'))
+        if index.get('version') == INDEX_VERSION and index.get('tokenizer_fingerprint') == fingerprint:
+            previous = {entry['source']: entry for entry in index['files']}
+
+    entries = {}
+    pending = []
+    for file in files:
+        entry = previous.get(file['path'])
+        prefix = dataset_prefix(output_path.with_name(file['path']))
+        if entry is not None and entry['source_sha256'] == file['sha256'] and all(
+            prefix.with_name(prefix.name + suffix).exists() for suffix in (_IDS_SUFFIX, _MASK_SUFFIX, _OFFSETS_SUFFIX)
+        ):
+            entries[file['path']] = entry
+            if on_file is not None:
+                on_file(file['path'], entry['samples'], False)
+        else:
+            pending.append(file)
+
+    def record(file, stats):
+        entries[file['path']] = {
+            'source': file['path'], 'source_sha256': file['sha256'], 'split': file.get('split', 'train'),
+            'prefix': dataset_prefix(Path(file['path'])).name, **stats,
+        }
+        if on_file is not None:
+            on_file(file['path'], stats['samples'], True)
+
+    # トークナイザーのパスが分からない (読み込み済みのものを渡された) 場合は、このプロセスでトークナイズする
+    if workers <= 1 or len(pending) <= 1 or tokenizer_path is None:
+        for file in pending:
+            record(file, tokenize_file(output_path.with_name(file['path']), batch_size, tokenizer))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(str(tokenizer_path),)) as executor:
+            futures = [
+                (file, executor.submit(tokenize_file, output_path.with_name(file['path']), batch_size))
+                for file in pending
+            ]
+            for file, future in futures:
+                record(file, future.result())
+
+    # 書き出し直しで無くなったファイル (差分のファイルなど) のバイナリファイルを消す
+    for source, entry in previous.items():
+        if source not in entries:
+            prefix = output_path.with_name(entry['prefix'])
+            for suffix in (_IDS_SUFFIX, _MASK_SUFFIX, _OFFSETS_SUFFIX):
+                prefix.with_name(prefix.name + suffix).unlink(missing_ok=True)
+
+    index = {
+        'version': INDEX_VERSION,
+        'tokenizer': str(tokenizer_path or getattr(tokenizer, 'name_or_path', '')),
+        'tokenizer_fingerprint': fingerprint,
+        'ids_dtype': 'uint32', 'mask_dtype': 'uint8', 'offsets_dtype': 'uint64', 'byteorder': 'little',
+        # マニフェストと同じ順序で並べる
+        'files': [entries[file['path']] for file in files],
+    }
+    temporary_path = index_path(output_path).with_name(index_path(output_path).name + '.tmp')
+    temporary_path.write_text(json.dumps(index, ensure_ascii=False, indent=2), encoding='utf-8')
+    os.replace(temporary_path, index_path(output_path))
+    return index
+
+
+def _map_array(path: Path, typecode: str) -> tuple[memoryview, mmap.mmap | None]:
+    """
+    バイナリファイルを memory-map し、要素の型で読める memoryview と mmap を返す。
+    空のファイルは mmap できないため、空の配列を返す。
+    """
+    if path.stat().st_size == 0:
+        return memoryview(array(typecode)), None
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if sys.byteorder == 'big':
+        # ビッグエンディアンの環境では、メモリに読み込んでバイト順を入れ替える
+        values = array(typecode)
+        values.frombytes(mapped[:])
+        values.byteswap()
+        mapped.close()
+        return memoryview(values), None
+    return memoryview(mapped).cast(typecode), mapped
+
+
+class TokenDataset:
+    """
+    トークナイズ済みの学習データを memory-map して読む。
+    dataset[i] は i 番目のサンプルの (トークンID, 損失のマスク) を、コピーせずに memoryview で返す
+    (list(...) や numpy.asarray(...) で配列にできる)。split のファイルが複数ある場合 (シャードや差分のファイル) は、
+    インデックスの順に連結したものとして扱う。
+    """
+
+    def __init__(self, index_file: Path, split: str = 'train'):
+        index_file = Path(index_file)
+        index = json.loads(index_file.read_text(encoding='utf-8'))
+        if index.get('version') != INDEX_VERSION:
+            raise ValueError(f"対応していないインデックスの形式です: {index_file}")
+        self._views = []
+        self._mmaps = []
+        self._parts = []
+        self._starts = []
+        total = 0
+        for entry in index['files']:
+            if entry['split'] != split or not entry['samples']:
+                continue
+            prefix = index_file.with_name(entry['prefix'])
+            arrays = []
+            for suffix, typecode in ((_IDS_SUFFIX, _IDS_TYPECODE), (_MASK_SUFFIX, _MASK_TYPECODE),
+                                     (_OFFSETS_SUFFIX, _OFFSETS_TYPECODE)):
+                values, mapped = _map_array(prefix.with_name(prefix.name + suffix), typecode)
+                self._views.append(values)
+                if mapped is not None:
+                    self._mmaps.append(mapped)
+                arrays.append(values)
+            self._parts.append(tuple(arrays))
+            self._starts.append(total)
+            total += entry['samples']
+        self._length = total
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: int) -> tuple[memoryview, memoryview]:
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        # index を含むファイルを探す (ファイルの数は少ないため、後ろから順に調べる)
+        part = len(self._starts) - 1
+        while self._starts[part] > index:
+            part -= 1
+        ids, mask, offsets = self._parts[part]
+        local_index = index - self._starts[part]
+        start, end = offsets[local_index], offsets[local_index + 1]
+        return ids[start:end], mask[start:end]
+
+    def close(self) -> None:
+        """
+        memory-map を閉じる。dataset[i] で受け取った memoryview は、閉じる前に使い終えておくこと。
+        """
+        self._parts = []
+        for view in self._views:
+            view.release()
+        for mapped in self._mmaps:
+            mapped.close()
+        self._views = []
+        self._mmaps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
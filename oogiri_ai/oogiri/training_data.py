@@ -0,0 +1,598 @@
+# oogiri/training_data.py
+"""
+ファインチューニング用の学習データ (JSONL) の書き出し (export_training_data コマンドから使う)。
+
+回答やお題が何百万件あってもメモリを使い切らないよう、DBからは .values_list(...).iterator() で
+必要な列だけを chunk_size 件ずつ読み、1件ずつJSONの行にしてファイルに書き込む。
+出力は gzip / zstd で圧縮でき、複数のファイル (シャード) に分けて書き出せる。
+
+書き出したファイルの一覧 (件数とチェックサム) と、どこまでの行を書き出したか (回答・お題・フラグ変更の記録のID) は
+マニフェスト (<名前>.manifest.json) に残す。差分の書き出し (incremental=True) では、前回以降に追加された行と、
+「特に面白い」が付けられた行 (TrainingFlagChange) だけを新しいファイル (<名前>.part-0001.jsonl など) に書き出す。
+正規化すると同じになるサンプルは、前回までに書き出したものも含めて1件だけを残す (ハッシュは <名前>.digests に保存する)。
+
+workers を2以上にすると、回答生成タスクとお題生成タスクの行をIDの範囲ごとにワーカーのプロセスに分け、
+サンプルの組み立て・正規化・JSONへの変換を並行して行う (ファイルへの書き込みと重複の除去は親のプロセスで、IDの順に行う)。
+split_ratios を渡すと、user メッセージのハッシュで train / validation / test に分けて別のファイルに書き出し、
+max_per_task / max_per_theme を渡すと、件数の多いタスクやテーマのサンプルを間引く。
+"""
+import bisect
+import collections
+import contextlib
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import multiprocessing
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import django
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, Max, Min, Q, TextField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .evaluation_cache import normalize_text
+from .llm_backends import (
+    TASK_ANSWER_GENERATION, TASK_QUESTION_GENERATION, build_answer_task_prompt, build_question_task_prompt,
+)
+from .models import Answer, Question, TrainingFlagChange
+
+MANIFEST_VERSION = 1
+
+# 学習データのタスク (書き出す順) と、学習データの分割
+TASKS = (TASK_ANSWER_GENERATION, TASK_QUESTION_GENERATION)
+SPLITS = ('train', 'validation', 'test')
+
+# 出力の圧縮形式と、ファイル名の末尾に付ける拡張子
+COMPRESSIONS = {
+    'none': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# 並列の書き出しで、ワーカーに渡すIDの範囲の幅 (chunk_size の何倍か) と、
+# 書き込みを待つ結果として親のプロセスに溜めてよい行数の上限
+RANGE_CHUNKS = 4
+MAX_PENDING_ROWS = 50_000
+
+# 重複の判定で、今回のハッシュを集合で持つ件数 (これを超えたらソートして配列 (1件8バイト) にする)
+DIGEST_BATCH_SIZE = 4096
+
+
+def make_sample(prompt: str, completion: str) -> dict:
+    """
+    学習データの1件 (user メッセージとそれに対する assistant の応答) を組み立てる。
+    """
+    return {
+        "messages": [
+            {"role": "user", "content": prompt},
+            {"role": "assistant", "content": completion}
+        ]
+    }
+
+
+def current_watermarks() -> dict:
+    """
+    今ある回答・お題・フラグ変更の記録の最大のIDを返す (ここまでの行を書き出したことをマニフェストに残す)。
+    """
+    return {
+        'answer_id': Answer.objects.aggregate(max_id=Max('id'))['max_id'] or 0,
+        'question_id': Question.objects.aggregate(max_id=Max('id'))['max_id'] or 0,
+        'flag_change_id': TrainingFlagChange.objects.aggregate(max_id=Max('id'))['max_id'] or 0,
+    }
+
+
+def _filter_rows(queryset, kind: str, watermarks: dict | None, since: dict | None):
+    """
+    watermarks までの行に絞る。since を渡すと、そのうち since より後に追加された行と、
+    since より後に「特に面白い」が付けられた行 (TrainingFlagChange) に絞る。
+    """
+    if watermarks is not None:
+        queryset = queryset.filter(id__lte=watermarks[f'{kind}_id'])
+    if since is not None:
+        flagged = TrainingFlagChange.objects.filter(kind=kind, id__gt=since['flag_change_id'])
+        if watermarks is not None:
+            flagged = flagged.filter(id__lte=watermarks['flag_change_id'])
+        queryset = queryset.filter(Q(id__gt=since[f'{kind}_id']) | Q(id__in=flagged.values('object_id')))
+    return queryset
+
+
+def _source_text(prefix: str = ''):
+    """
+    お題の元ネタのニュース (Question.source_text と同じく、ニュースタイトルの組、無ければ source_title) の式。
+    """
+    return Coalesce(f'{prefix}headline_set__headlines', f'{prefix}source_title', output_field=TextField())
+
+
+def _task_rows(task: str, watermarks: dict | None, since: dict | None):
+    """
+    タスクの学習データの元になる行のクエリセットと、読み出す列 (先頭はテーマ) を返す。
+    """
+    if task == TASK_ANSWER_GENERATION:
+        # 【タスク 1: 回答生成】「特に面白い」回答 (is_excellent_answer)
+        queryset = _filter_rows(
+            Answer.objects.filter(is_excellent_answer=True), TrainingFlagChange.Kind.ANSWER, watermarks, since
+        ).annotate(source=_source_text('question__'))
+        return queryset, ('question__theme', 'question__question_text', 'source', 'answer_text')
+    # 【タスク 2: お題生成】「特に面白い」お題 (is_excellent)
+    # 元ネタのニュースが無いお題は、お題生成タスクとして成立しないため除く
+    queryset = _filter_rows(
+        Question.objects.filter(is_excellent=True), TrainingFlagChange.Kind.QUESTION, watermarks, since,
+    ).annotate(source=_source_text()).filter(source__isnull=False).exclude(source="")
+    return queryset, ('theme', 'source', 'question_text')
+
+
+def iter_task_samples(task: str, chunk_size: int = 2000, watermarks: dict | None = None, since: dict | None = None,
+                      id_range: tuple[int, int] | None = None):
+    """
+    タスクの学習データを、IDの順に (テーマ, サンプル) の組で1件ずつ返す。
+    id_range=(start, end) を渡すと、start <= ID < end の行に絞る。
+    """
+    queryset, columns = _task_rows(task, watermarks, since)
+    if id_range is not None:
+        queryset = queryset.filter(id__gte=id_range[0], id__lt=id_range[1])
+    for row in queryset.order_by('id').values_list(*columns).iterator(chunk_size=chunk_size):
+        # ローカルモデルのバックエンドと同じ形式のプロンプトを使う
+        if task == TASK_ANSWER_GENERATION:
+            theme, question_text, source, answer_text = row
+            yield theme, make_sample(build_answer_task_prompt(question_text, source), answer_text)
+        else:
+            theme, source, question_text = row
+            yield theme, make_sample(build_question_task_prompt(source), question_text)
+
+
+def _id_ranges(task: str, watermarks: dict, since: dict | None, size: int) -> list[tuple[int, int]]:
+    """
+    タスクの行のIDを、幅 size の範囲に分ける (ワーカーに1つずつ渡す)。IDは重複しないため、1つの範囲は size 行以下になる。
+    """
+    queryset, _ = _task_rows(task, watermarks, since)
+    bounds = queryset.aggregate(min_id=Min('id'), max_id=Max('id'))
+    if bounds['min_id'] is None:
+        return []
+    return [
+        (start, min(start + size, bounds['max_id'] + 1))
+        for start in range(bounds['min_id'], bounds['max_id'] + 1, size)
+    ]
+
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_prompt(prompt: str, normalization: tuple[str, ...]) -> str:
+    # user メッセージは同じお題の回答どうしで同じになるため、正規化した結果を使い回す
+    return normalize_text(prompt, list(normalization))
+
+
+def sample_digest(sample: dict, normalization: list[str]) -> int:
+    """
+    サンプルの user メッセージと assistant の応答を正規化してハッシュ化した、64bitの整数を返す。
+    """
+    user_message, assistant_message = sample['messages']
+    source = "\0".join([
+        _normalize_prompt(user_message['content'], tuple(normalization)),
+        normalize_text(assistant_message['content'], normalization),
+    ])
+    return int.from_bytes(hashlib.blake2b(source.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def assign_split(sample: dict, normalization: list[str], split_ratios: dict | None) -> str:
+    """
+    サンプルを train / validation / test のどれに入れるかを、正規化した user メッセージのハッシュで決める。
+    同じお題への回答は同じ分割に入るため、検証用のお題が学習に混ざらない。何度書き出しても同じ分割になる。
+    split_ratios は {'validation': 0.05, 'test': 0.05} のような割合 (残りが train)。
+    """
+    if not split_ratios:
+        return 'train'
+    prompt = _normalize_prompt(sample['messages'][0]['content'], tuple(normalization))
+    fraction = int.from_bytes(hashlib.blake2b(prompt.encode('utf-8'), digest_size=8).digest(), 'big') / 2 ** 64
+    threshold = 0.0
+    for split in SPLITS[1:]:
+        threshold += split_ratios.get(split, 0.0)
+        if fraction < threshold:
+            return split
+    return 'train'
+
+
+class TaskBalancer:
+    """
+    タスクごと・テーマごとの件数の上限を超える分のサンプルを間引き、学習データの偏りを減らす。
+    間引く割合は書き出す前の件数 (重複を除く前) から決め、残すかどうかはサンプルのハッシュで決める
+    (何度書き出しても同じサンプルが残る)。件数の少ないタスクやテーマを水増しはしない。
+    """
+
+    def __init__(self, counts: dict[tuple[str, str], int], max_per_task: int | None = None,
+                 max_per_theme: int | None = None):
+        task_totals = collections.Counter()
+        for (task, _), count in counts.items():
+            task_totals[task] += count
+        self.keep_ratios = {}
+        for (task, theme), count in counts.items():
+            ratio = 1.0
+            if max_per_theme is not None:
+                ratio *= min(1.0, max_per_theme / count)
+            if max_per_task is not None:
+                ratio *= min(1.0, max_per_task / task_totals[task])
+            self.keep_ratios[(task, theme)] = ratio
+
+    @classmethod
+    def from_database(cls, watermarks: dict, max_per_task: int | None = None,
+                      max_per_theme: int | None = None) -> 'TaskBalancer':
+        counts = {}
+        for task in TASKS:
+            queryset, columns = _task_rows(task, watermarks, None)
+            for row in queryset.order_by().values(columns[0]).annotate(count=Count('id')):
+                counts[(task, row[columns[0]])] = row['count']
+        return cls(counts, max_per_task=max_per_task, max_per_theme=max_per_theme)
+
+    def keep(self, task: str, theme: str, digest: int) -> bool:
+        # 分割を決めるハッシュとは別の値 (サンプル全体のハッシュの下位32bit) で決める
+        return (digest & 0xFFFFFFFF) / 2 ** 32 < self.keep_ratios.get((task, theme), 1.0)
+
+
+class SampleDeduplicator:
+    """
+    正規化すると同じになるサンプルを除く。
+    ハッシュはソート済みの配列 (1件8バイト) の並びで持ち、それぞれを二分探索で調べる。
+    今回のハッシュは DIGEST_BATCH_SIZE 件までを集合で持ち、溜まったらソートして配列にする。
+    配列は同じくらいの大きさのものどうしを併合し、数を (件数の対数ほどに) 抑える。
+    """
+
+    def __init__(self, normalization: list[str] | None = None, digests: array | None = None):
+        self.normalization = settings.TRAINING_DATA_DEDUP_NORMALIZATION if normalization is None else normalization
+        self._runs = [digests] if digests else []
+        self._batch = set()
+        self.duplicates = 0
+
+    def __len__(self) -> int:
+        return sum(len(run) for run in self._runs) + len(self._batch)
+
+    def _is_known(self, digest: int) -> bool:
+        for run in self._runs:
+            index = bisect.bisect_left(run, digest)
+            if index < len(run) and run[index] == digest:
+                return True
+        return False
+
+    def _flush(self) -> None:
+        if not self._batch:
+            return
+        run = array('Q', sorted(self._batch))
+        self._batch = set()
+        # 直前の配列が今回の配列の2倍以下の大きさなら併合する (前回までのハッシュの大きな配列は、今回の分が
+        # 同じくらいに増えるまでそのまま残る)
+        while self._runs and len(self._runs[-1]) <= 2 * len(run):
+            run = array('Q', heapq.merge(self._runs.pop(), run))
+        self._runs.append(run)
+
+    def add(self, sample: dict) -> bool:
+        """
+        まだ書き出していないサンプルなら記録して True を、重複していれば False を返す。
+        """
+        return self.add_digest(sample_digest(sample, self.normalization))
+
+    def add_digest(self, digest: int) -> bool:
+        if digest in self._batch or self._is_known(digest):
+            self.duplicates += 1
+            return False
+        self._batch.add(digest)
+        if len(self._batch) >= DIGEST_BATCH_SIZE:
+            self._flush()
+        return True
+
+    @classmethod
+    def load(cls, path: Path, normalization: list[str] | None = None) -> 'SampleDeduplicator':
+        digests = array('Q')
+        if path.exists():
+            digests.frombytes(path.read_bytes())
+        return cls(normalization, digests)
+
+    def save(self, path: Path) -> None:
+        # 前回までのハッシュと今回のハッシュを、ソート済みのまま1つの配列にまとめる
+        self._flush()
+        digests = array('Q', heapq.merge(*self._runs))
+        _write_atomic(path, digests.tobytes())
+
+
+def manifest_path(output_path: Path) -> Path:
+    return output_path.with_name(f"{output_path.stem}.manifest.json")
+
+
+def digests_path(output_path: Path) -> Path:
+    return output_path.with_name(f"{output_path.stem}.digests")
+
+
+def part_output_path(output_path: Path, part: int, split: str | None = None) -> Path:
+    """
+    part 回目の書き出しの出力先 (全件の書き出しは0回目)。
+    分割しない全件の書き出しでは output_path そのものに、分割する場合は <名前>.train.jsonl などに書く。
+    """
+    name = output_path.stem
+    if split is not None:
+        name += f".{split}"
+    if part:
+        name += f".part-{part:04d}"
+    return output_path.with_name(name + output_path.suffix)
+
+
+def load_manifest(output_path: Path) -> dict | None:
+    path = manifest_path(output_path)
+    if not path.exists():
+        return None
+    manifest = json.loads(path.read_text(encoding='utf-8'))
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    temporary_path = path.with_name(path.name + '.tmp')
+    temporary_path.write_bytes(data)
+    os.replace(temporary_path, path)
+
+
+def _file_checksum(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _iter_range_rows(task: str, id_range: tuple[int, int] | None, watermarks: dict, since: dict | None,
+                     chunk_size: int, normalization: list[str], split_ratios: dict | None):
+    for theme, sample in iter_task_samples(task, chunk_size, watermarks, since, id_range):
+        yield (
+            sample_digest(sample, normalization),
+            assign_split(sample, normalization, split_ratios),
+            theme,
+            json.dumps(sample, ensure_ascii=False),
+        )
+
+
+def build_range(database_names: dict[str, str], *args) -> list[tuple[int, str, str, str]]:
+    """
+    IDの範囲の学習データを、(ハッシュ, 分割, テーマ, JSONの行) のリストにする (ワーカーのプロセスで実行する)。
+    DBは親のプロセスと同じもの (database_names) に接続する (親で接続先を変えている場合も同じ行を読む)。
+    """
+    for alias, name in database_names.items():
+        connections[alias].settings_dict['NAME'] = name
+    return list(_iter_range_rows(*args))
+
+
+def _database_names() -> dict[str, str]:
+    return {alias: str(connections[alias].settings_dict['NAME']) for alias in connections}
+
+
+def _iter_rows(watermarks: dict, since: dict | None, chunk_size: int, normalization: list[str],
+               split_ratios: dict | None, workers: int):
+    """
+    すべてのタスクの学習データを、タスクの順・IDの順に (タスク, ハッシュ, 分割, テーマ, JSONの行) の組で返す。
+    workers が2以上のときは、IDの範囲ごとにワーカーのプロセスで組み立てる (結果の順序は変わらない)。
+    """
+    if workers <= 1:
+        for task in TASKS:
+            for row in _iter_range_rows(task, None, watermarks, since, chunk_size, normalization, split_ratios):
+                yield (task, *row)
+        return
+
+    # 1つの範囲は幅以下の行になるため、投入する範囲の数を抑えれば、親に溜まる行は全体の件数によらず
+    # MAX_PENDING_ROWS 以下になる。ワーカーが待たないよう、範囲の幅はワーカーごとに2つずつ投入できる大きさまでにする
+    range_size = max(1, min(chunk_size * RANGE_CHUNKS, MAX_PENDING_ROWS // (workers * 2)))
+    max_pending = max(1, MAX_PENDING_ROWS // range_size)
+    jobs = [
+        (task, id_range, watermarks, since, chunk_size, normalization, split_ratios)
+        for task in TASKS
+        for id_range in _id_ranges(task, watermarks, since, range_size)
+    ]
+    # 子プロセスにDBの接続を引き継がない。子プロセスは spawn で起動し、Djangoを初期化してから使う
+    database_names = _database_names()
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=django.setup) as executor:
+        # 書き込みが追いつかない間に結果が溜まりすぎないよう、先に投入する範囲の数を抑える
+        pending = collections.deque()
+        for job in jobs:
+            pending.append((job[0], executor.submit(build_range, database_names, *job)))
+            if len(pending) >= max_pending:
+                task, future = pending.popleft()
+                for row in future.result():
+                    yield (task, *row)
+        while pending:
+            task, future = pending.popleft()
+            for row in future.result():
+                yield (task, *row)
+
+
+def export_training_data(output_path: Path, incremental: bool = False, shards: int = 1, compression: str = 'none',
+                         chunk_size: int = 2000, workers: int = 1, split_ratios: dict | None = None,
+                         max_per_task: int | None = None, max_per_theme: int | None = None,
+                         on_progress=None) -> dict:
+    """
+    学習データを書き出し、今回の書き出しの結果 (件数・集計・書き出したファイル) を返す。
+    incremental=True のときは、前回の書き出し以降の差分だけを新しいファイルに書き出す
+    (マニフェストが無ければ全件を書き出す)。on_progress(書き出した件数) は1件書くごとに呼ばれる。
+    返り値の 'rows' が0のときは新しいファイルを作らない (全件の書き出しでは、前回の出力とマニフェストもそのまま残す)。
+    """
+    output_path = Path(output_path)
+    normalization = settings.TRAINING_DATA_DEDUP_NORMALIZATION
+    split_ratios = {split: ratio for split, ratio in (split_ratios or {}).items() if ratio}
+    if sum(split_ratios.values()) >= 1:
+        raise ValueError("validation と test の割合の合計は1未満にしてください。")
+    balance = max_per_task is not None or max_per_theme is not None
+    if incremental and balance:
+        raise ValueError("差分の書き出しでは、タスクやテーマの件数の上限は使えません。")
+
+    previous = load_manifest(output_path) if incremental else None
+    if previous is not None:
+        if previous['normalization'] != normalization:
+            raise ValueError("重複の判定に使う正規化の設定が前回と違います。全件を書き出し直してください。")
+        if previous.get('splits', {}) != split_ratios:
+            raise ValueError("学習データの分割の割合が前回と違います。全件を書き出し直してください。")
+        deduplicator = SampleDeduplicator.load(digests_path(output_path), normalization)
+        part = previous['next_part']
+    else:
+        deduplicator = SampleDeduplicator(normalization)
+        part = 0
+
+    # 書き出している間に追加された行は、次の差分の書き出しに回す
+    watermarks = current_watermarks()
+    since = previous['watermarks'] if previous else None
+    balancer = TaskBalancer.from_database(watermarks, max_per_task, max_per_theme) if balance else None
+
+    counts = {}
+    written = dropped = 0
+    with contextlib.ExitStack() as stack:
+        writers = {}
+        for task, digest, split, theme, line in _iter_rows(
+            watermarks, since, chunk_size, normalization, split_ratios, workers
+        ):
+            if not deduplicator.add_digest(digest):
+                continue
+            if balancer is not None and not balancer.keep(task, theme, digest):
+                dropped += 1
+                continue
+            if split not in writers:
+                # 分割ごとのファイルは、その分割のサンプルが現れたときに作る
+                writers[split] = stack.enter_context(JSONLShardWriter(
+                    part_output_path(output_path, part, split if split_ratios else None),
+                    shards=shards, compression=compression,
+                ))
+            writers[split].write_line(line)
+            counts[(split, task, theme)] = counts.get((split, task, theme), 0) + 1
+            written += 1
+            if on_progress is not None:
+                on_progress(written)
+
+    stats = {'duplicates': deduplicator.duplicates, 'dropped': dropped, 'splits': {}}
+    for (split, task, theme), count in sorted(counts.items()):
+        stats['splits'].setdefault(split, {}).setdefault(task, {})[theme] = count
+    new_files = [
+        {'path': path.name, 'part': part, 'split': split, 'rows': rows, 'sha256': checksum}
+        for split, writer in writers.items()
+        for path, rows, checksum in zip(writer.paths, writer.counts, writer.checksums)
+    ]
+    result = {
+        'incremental': previous is not None,
+        'rows': written,
+        'duplicates': deduplicator.duplicates,
+        'files': new_files,
+        'stats': stats,
+    }
+    if not new_files and previous is None:
+        return result
+
+    files = (previous['files'] if previous else []) + new_files
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'exported_at': timezone.now().isoformat(),
+        'normalization': normalization,
+        'splits': split_ratios,
+        'watermarks': watermarks,
+        'next_part': part + 1 if new_files else part,
+        'rows': sum(entry['rows'] for entry in files),
+        'files': files,
+        # 今回の書き出しの集計 (分割 -> タスク -> テーマ -> 件数)
+        'stats': stats,
+    }
+    if previous is None:
+        # 全件を書き出し直した場合は、前回までの差分のファイルを消す
+        old_manifest = load_manifest(output_path)
+        for entry in (old_manifest or {}).get('files', []):
+            if entry['path'] not in {new_entry['path'] for new_entry in files}:
+                output_path.with_name(entry['path']).unlink(missing_ok=True)
+    deduplicator.save(digests_path(output_path))
+    _write_atomic(manifest_path(output_path), json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
+    return result
+
+
+def _open_compressed(path: Path, compression: str):
+    """
+    path を書き込み用に開き、テキストを書き込めるファイルオブジェクトを返す。
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd で圧縮するには zstandard をインストールしてください。")
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, 'wb')), encoding='utf-8')
+    return open(path, 'w', encoding='utf-8')
+
+
+class JSONLShardWriter:
+    """
+    学習データを1件ずつJSONの行にして、shards 個のファイルに順番に振り分けて書き込む。
+    shards が1のときは output_path に、2以上のときは name-00000-of-00004.jsonl のような名前のファイルに書く。
+    書き込み中は .tmp を付けた名前のファイルに書き、正常に閉じたときだけ本来の名前に変える
+    (途中で失敗しても、前回の出力を壊さない)。
+    """
+
+    def __init__(self, output_path: Path, shards: int = 1, compression: str = 'none'):
+        if shards < 1:
+            raise ValueError("シャードの数は1以上にしてください。")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"不明な圧縮形式です: {compression}")
+        self.paths = self.shard_paths(Path(output_path), shards, compression)
+        self.compression = compression
+        self.counts = [0] * shards
+        # 書き終えた各ファイルの SHA-256 (正常に閉じたときに求める)
+        self.checksums = []
+        self._files = []
+
+    @staticmethod
+    def shard_paths(output_path: Path, shards: int, compression: str) -> list[Path]:
+        suffix = COMPRESSIONS[compression]
+        if shards == 1:
+            return [output_path.with_name(output_path.name + suffix)]
+        return [
+            output_path.with_name(f"{output_path.stem}-{index:05d}-of-{shards:05d}{output_path.suffix}{suffix}")
+            for index in range(shards)
+        ]
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts)
+
+    def _temporary_path(self, path: Path) -> Path:
+        return path.with_name(path.name + '.tmp')
+
+    def __enter__(self):
+        try:
+            for path in self.paths:
+                self._files.append(_open_compressed(self._temporary_path(path), self.compression))
+        except BaseException:
+            self._close(succeeded=False)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._close(succeeded=exc_type is None)
+        return False
+
+    def write(self, sample: dict) -> None:
+        self.write_line(json.dumps(sample, ensure_ascii=False))
+
+    def write_line(self, line: str) -> None:
+        """
+        JSONの文字列にしたサンプルを1行書き込む。
+        """
+        # シャードに1件ずつ順番に書き、シャードごとの件数を揃える
+        index = self.total % len(self._files)
+        self._files[index].write(line + '\n')
+        self.counts[index] += 1
+
+    def _close(self, succeeded: bool) -> None:
+        for file in self._files:
+            file.close()
+        for path in self.paths[:len(self._files)]:
+            temporary_path = self._temporary_path(path)
+            if succeeded:
+                os.replace(temporary_path, path)
+                self.checksums.append(_file_checksum(path))
+            else:
+                temporary_path.unlink(missing_ok=True)
+        self._files = []
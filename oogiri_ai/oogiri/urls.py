@@ -7,13 +7,21 @@ app_name = 'oogiri'
 urlpatterns = [
     # メインの大喜利提案画面 (ルートパス / または /oogiri/ でアクセス)
     path('', views.OogiriProposalView.as_view(), name='proposal'),
+    # お題の生成をストリーミングで受け取る (提案画面からの Server-Sent Events 用)
+    path('stream/', views.OogiriProposalStreamView.as_view(), name='proposal_stream'),
 
 
     # お題選択時のPOST処理用（中間ビュー）
     path('select/', views.QuestionSelectionView.as_view(), name='question_select'),
     # 回答入力画面
     path('answer/input/<int:question_id>/', views.AnswerInputView.as_view(), name='answer_input'),
+    # AIによる回答の提案 (回答入力画面から問い合わせる)
+    path('answer/input/<int:question_id>/suggestions/', views.AnswerSuggestionView.as_view(), name='answer_suggestions'),
     # 評価結果表示画面
     path('answer/result/<int:answer_id>/', views.AnswerResultView.as_view(), name='answer_result'),
+    # 採点状況の問い合わせ (結果画面からのポーリング用)
+    path('answer/result/<int:answer_id>/status/', views.AnswerStatusView.as_view(), name='answer_status'),
+    # 採点状況と生成途中の講評をストリーミングで受け取る (結果画面からの Server-Sent Events 用)
+    path('answer/result/<int:answer_id>/stream/', views.AnswerStreamView.as_view(), name='answer_stream'),
     
 ]
\ No newline at end of file
@@ -1,102 +1,216 @@
-from django.shortcuts import render, redirect, get_object_or_404
+import asyncio
+import time
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.contrib import messages
 from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import redirect
-from .services import NewsService, GeminiService # ← NewsServiceとGeminiServiceをインポート！
-from .models import Question, Answer # Answerモデルを追加
+from django.http import JsonResponse, StreamingHttpResponse
+from asgiref.sync import sync_to_async
+from .services import NewsService, save_generated_questions, take_pooled_questions # ← NewsServiceをインポート！
+from .llm_backends import TASK_QUESTION_GENERATION, StreamingError, get_llm_backend
+from .models import THEMES, Question, Answer, EvaluationJob # Answerモデルを追加
 from .forms import AnswerForm # AnswerFormを追加
+from .headline_selection import select_headlines
+from .headline_store import recent_headlines
+from .jobs import partial_review_key, submit_answer
+from .question_dedup import QuestionDeduplicator, agenerate_unique_questions
+from .streaming import sse_event
+from .suggestions import suggest_answers
+
+
+async def _aget_headlines(theme: str) -> tuple[list[str] | None, str | None, bool]:
+    """
+    お題生成に使うニュースタイトルを取得し、(ニュースタイトル, 警告メッセージ, ダミーのタイトルかどうか) を返す。
+    取得できない場合は (None, エラーメッセージ, False) を返す。
+    """
+    news_service = NewsService()
+    headlines = await news_service.aget_recent_headlines(theme)
+    message = None
+
+    if not headlines:
+        # NewsAPIから取得できない場合は、これまでに取得して保存したニュースタイトルを使う
+        headlines = await sync_to_async(recent_headlines)(theme)
+        message = "最新のニュースを取得できなかったため、以前に取得したニュースタイトルを使用します。"
+
+    if not headlines:
+        # APIキー未設定時などに備え、ダミーデータで試行
+        if settings.DEBUG:
+            from .services import get_dummy_headlines
+            return (get_dummy_headlines(theme),
+                    "【デバッグ】NewsAPIからニュースを取得できなかったため、ダミーデータを使用します。", True)
+        return None, '現在、ニュースタイトルを取得できません。テーマを変えて再度試してください。', False
+
+    # 日本語でないもの・ほぼ同じものを除き、テーマに近いものからトークンの予算に収まるだけ使う
+    return await sync_to_async(select_headlines)(headlines, theme), message, False
+
+
+def _event_stream_response(events) -> StreamingHttpResponse:
+    """
+    Server-Sent Events (sse_event で組み立てたイベントの非同期ジェネレーター) を返すレスポンス。
+    """
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # nginx などのリバースプロキシにイベントを溜め込ませない
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 # メインの大喜利AI提案画面
+# NewsAPIとGeminiの呼び出しを待つ間ワーカーを占有しないよう、非同期ビューとして実装する (asgi.py 経由で動作)
 # @login_required がついているため、未ログインのユーザーは自動でログイン画面にリダイレクトされる
-@method_decorator(login_required, name='dispatch')
+# (非同期ビューでは dispatch ではなく各ハンドラに付けることで、login_required の非同期版が使われる)
+@method_decorator(login_required, name='get')
+@method_decorator(login_required, name='post')
 class OogiriProposalView(View):
     template_name = 'oogiri/proposal.html'
     
-    def post(self, request):
+    async def post(self, request):
         selected_theme = request.POST.get('theme')
 
         if not selected_theme:
             messages.error(request, 'テーマを選択してください。')
-            return self.get(request)
-        
-        # --- 1. ニュースタイトルの取得 ---
-        news_service = NewsService()
-        headlines = news_service.get_recent_headlines(selected_theme)
-        
-        if not headlines:
-            # APIキー未設定時などに備え、ダミーデータで試行
-            if settings.DEBUG:
-                from .services import get_dummy_headlines
-                headlines = get_dummy_headlines(selected_theme)
-                messages.warning(request, "【デバッグ】NewsAPIからニュースを取得できなかったため、ダミーデータを使用します。")
-            else:
-                messages.error(request, '現在、ニュースタイトルを取得できません。テーマを変えて再度試してください。')
-                return self.get(request)
-
-        # --- 2. Gemini AIによるお題生成 ---
-        gemini_service = GeminiService()
-        result = gemini_service.generate_questions(headlines, theme=selected_theme)
-        
-        if isinstance(result, str):
-            # 戻り値が文字列の場合、エラーメッセージとして処理
-            messages.error(request, f'AIお題生成中にエラーが発生しました: {result}')
-            return self.get(request)
+            return await self.get(request)
         
-        # 成功の場合、結果をセッションに格納し、リダイレクトしてGETメソッドで表示させる
-        # POST処理後にリダイレクトするのは、二重送信を防ぐためのベストプラクティスです (Post/Redirect/Getパターン)
-        # request.session['questions'] = result
-        # request.session['theme'] = selected_theme
+        # --- 1. 事前生成済みのお題プールから取り出す ---
+        questions = await sync_to_async(take_pooled_questions)(request.user, selected_theme)
 
-        # 3. 成功時：お題の保存ロジック（テーマ情報を使う）
-        if headlines:
-            source_title = "\n".join(headlines)
+        if questions:
+            success_message = '用意してあるお題から新しいお題を取り出しました！'
         else:
-         source_title = f"{selected_theme}に関するニュース"
-
-        question_ids = [] # IDのリストを格納
-
-        for question_text in result:
-            question = Question.objects.create(
-                user=request.user,
-                theme=selected_theme,
-                source_title=source_title, # 全てのニュースタイトルが保存されます
-                question_text=question_text,
-                is_manual=False
-            )
-            question_ids.append(question.id)
+            # プールが空の場合のみ、その場でニュース取得とお題生成を行う
+            questions = await self._generate_questions(request, selected_theme)
+            if questions is None:
+                return await self.get(request)
+            success_message = '新しいお題を生成し、保存しました！'
 
-        # 4. 結果をセッションに格納し、リダイレクト
-        request.session['questions_data'] = question_ids # ★IDのリストを保存
-        request.session['theme'] = selected_theme
+        # --- 2. 結果をセッションに格納し、リダイレクト ---
+        # POST処理後にリダイレクトするのは、二重送信を防ぐためのベストプラクティスです (Post/Redirect/Getパターン)
+        # 表示に必要なIDと本文をまとめて保存し、GETではDBを読まずに表示する
+        await request.session.aset('proposal', {'theme': selected_theme, 'questions': questions})
         
-        messages.success(request, f'新しいお題を生成し、保存しました！')
+        messages.success(request, success_message)
         
         return redirect('oogiri:proposal')
 
-    def get(self, request):
-        # GETリクエスト時にセッションから結果を取得し、表示
-        # ★'questions_data'（IDリスト）をセッションから取得します
-        question_ids = request.session.pop('questions_data', None)
-        theme = request.session.pop('theme', None)
+    async def _generate_questions(self, request, selected_theme):
+        """
+        NewsAPIとGeminiを呼び出してお題を生成・保存し、(ID, お題の本文) のリストを返す。
+        失敗した場合はエラーメッセージを登録して None を返す。
+        """
+        # --- ニュースタイトルの取得 ---
+        headlines, message, is_dummy = await _aget_headlines(selected_theme)
         
-        questions_with_ids = None
-        if question_ids:
-            # IDリストを使って Questionオブジェクトをデータベースから取得
-            questions_with_ids = Question.objects.filter(id__in=question_ids).order_by('id') 
-            
-        themes = ['政治', '芸能', 'スポーツ', 'アニメ']
+        if headlines is None:
+            messages.error(request, message)
+            return None
+        if message:
+            messages.warning(request, message)
+
+        # --- AIによるお題生成 (Geminiかローカルモデルかは settings.LLM_BACKENDS で選ぶ) ---
+        # 既存のお題とほぼ同じお題は除き、足りない分は QUESTION_DEDUP_MAX_RETRIES 回まで生成し直す
+        backend = get_llm_backend(TASK_QUESTION_GENERATION)
+        result = await agenerate_unique_questions(backend, headlines, selected_theme)
         
+        if isinstance(result, str):
+            # 戻り値が文字列の場合、エラーメッセージとして処理
+            messages.error(request, f'AIお題生成中にエラーが発生しました: {result}')
+            return None
+
+        # 成功時：お題の保存ロジック（テーマ情報を使う）
+        # ORMは同期APIのため、スレッドで実行する
+        # ダミーのタイトルはニュースタイトルとして保存しない
+        question_ids = await sync_to_async(save_generated_questions)(
+            request.user, selected_theme, headlines, result, store_headlines=not is_dummy
+        )
+        return list(zip(question_ids, result))
+
+    async def get(self, request):
+        # GETリクエスト時にセッションから結果を取得し、表示
+        proposal = await request.session.apop('proposal', None) or {}
+        questions = [
+            {'id': question_id, 'question_text': question_text}
+            for question_id, question_text in proposal.get('questions', [])
+        ]
+
         context = {
-            'themes': themes,
-            'questions': questions_with_ids, # ★Questionオブジェクトのリストを渡す
-            'selected_theme': theme,
+            'themes': THEMES,
+            'questions': questions,
+            'selected_theme': proposal.get('theme'),
         }
-        return render(request, self.template_name, context)
+        # テンプレートは request.user を遅延評価する (DBアクセスが発生する) ため、スレッドで描画する
+        return await sync_to_async(render)(request, self.template_name, context)
     
 
+@method_decorator(login_required, name='get')
+class OogiriProposalStreamView(View):
+    """
+    お題の生成を Server-Sent Events で送る (提案画面のJavaScriptが EventSource で接続する)。
+    お題が1つ生成し終わるたびに保存して 'question' イベントで送り、3つ揃ったら 'done' イベントを送る。
+    失敗した場合は 'failed' イベントを送る (それまでに送ったお題は保存済み)。
+    """
+
+    async def get(self, request):
+        selected_theme = request.GET.get('theme')
+        if selected_theme not in THEMES:
+            return JsonResponse({'error': 'テーマを選択してください。'}, status=400)
+        user = await request.auser()
+        return _event_stream_response(self._events(user, selected_theme))
+
+    async def _events(self, user, selected_theme):
+        # --- 1. 事前生成済みのお題プールから取り出す ---
+        questions = await sync_to_async(take_pooled_questions)(user, selected_theme)
+        if questions:
+            for question_id, question_text in questions:
+                yield sse_event('question', {'id': question_id, 'text': question_text})
+            yield sse_event('done', {})
+            return
+
+        # --- 2. プールが空の場合は、その場でニュース取得とお題生成を行う ---
+        headlines, message, is_dummy = await _aget_headlines(selected_theme)
+        if headlines is None:
+            yield sse_event('failed', {'message': message})
+            return
+        if message:
+            yield sse_event('warning', {'message': message})
+
+        backend = get_llm_backend(TASK_QUESTION_GENERATION)
+        # 既存のお題とほぼ同じお題は送らずに除き、足りない分は生成し終えてからまとめて生成し直す
+        deduplicator = QuestionDeduplicator(selected_theme)
+        emitted = 0
+        try:
+            async for question_text in backend.astream_questions(headlines, theme=selected_theme):
+                if not await sync_to_async(deduplicator.accept)([question_text]):
+                    continue
+                # 生成し終えたお題から保存し、IDを付けて送る (そのまま回答に進めるように)
+                [question_id] = await sync_to_async(save_generated_questions)(
+                    user, selected_theme, headlines, [question_text], store_headlines=not is_dummy
+                )
+                emitted += 1
+                yield sse_event('question', {'id': question_id, 'text': question_text})
+        except StreamingError as e:
+            yield sse_event('failed', {'message': f'AIお題生成中にエラーが発生しました: {e}'})
+            return
+
+        if emitted < 3:
+            result = await agenerate_unique_questions(
+                backend, headlines, selected_theme, count=3 - emitted, deduplicator=deduplicator
+            )
+            if isinstance(result, str):
+                if not emitted:
+                    yield sse_event('failed', {'message': f'AIお題生成中にエラーが発生しました: {result}'})
+                    return
+                result = []
+            question_ids = await sync_to_async(save_generated_questions)(
+                user, selected_theme, headlines, result, store_headlines=not is_dummy
+            )
+            for question_id, question_text in zip(question_ids, result):
+                yield sse_event('question', {'id': question_id, 'text': question_text})
+        yield sse_event('done', {})
+
+
 @method_decorator(login_required, name='dispatch')
 class QuestionSelectionView(View):
     """提案画面で選択されたお題IDを受け取り、回答入力画面へリダイレクトする"""
@@ -136,26 +250,13 @@ class AnswerInputView(View):
         if form.is_valid():
             answer_text = form.cleaned_data['answer_text']
             
-            # 2. AIによる評価を実行
-            gemini_service = GeminiService()
-            evaluation_result = gemini_service.evaluate_answer(question=question, answer_text=answer_text)
+            # 2. 回答を未採点のまま保存し、採点ジョブをキューに登録する
+            # AIによる採点は run_evaluation_worker のワーカーが行うため、ここではGeminiの応答を待たない
+            answer = submit_answer(request.user, question, answer_text)
             
-            if isinstance(evaluation_result, str):
-                messages.error(request, f'AI採点中にエラーが発生しました: {evaluation_result}')
-                return redirect('oogiri:proposal')
-            
-            # 3. 評価結果と回答をDBに保存
-            answer = Answer.objects.create(
-                user=request.user,
-                question=question,
-                answer_text=answer_text,
-                score=evaluation_result['score'],
-                review_text=evaluation_result['comment']
-            )
+            messages.success(request, '回答を送信しました！AIが採点しています。')
             
-            messages.success(request, f'回答を送信し、AIから採点（{answer.score}点）を受け取りました！')
-            
-            # 4. 結果画面へリダイレクト
+            # 3. 結果画面へリダイレクト (結果画面で採点の完了を待つ)
             return redirect('oogiri:answer_result', answer_id=answer.id)
             
         context = {
@@ -165,6 +266,19 @@ class AnswerInputView(View):
         return render(request, self.template_name, context)
     
 
+@method_decorator(login_required, name='get')
+class AnswerSuggestionView(View):
+    """AIが考えた回答の候補から、採点の高いものをJSONで返す (回答入力画面のボタンから問い合わせる)"""
+
+    async def get(self, request, question_id):
+        question = await aget_object_or_404(Question, pk=question_id)
+        # 候補の生成と採点には時間がかかるため、スレッドで実行してイベントループを塞がない
+        suggestions = await sync_to_async(suggest_answers, thread_sensitive=False)(question)
+        if isinstance(suggestions, str):
+            return JsonResponse({'error': suggestions}, status=502)
+        return JsonResponse({'suggestions': suggestions})
+
+
 @method_decorator(login_required, name='dispatch')
 class AnswerResultView(View):
     """AIによる評価結果を表示する"""
@@ -174,8 +288,63 @@ class AnswerResultView(View):
         # 1. URLから渡されたIDで回答結果を取得
         # 回答した本人にしか結果を見せないよう、user=request.user でフィルタ
         answer = get_object_or_404(Answer, pk=answer_id, user=request.user)
+        job = EvaluationJob.objects.filter(answer=answer).first()
         
         context = {
             'answer': answer,
+            # 採点ジョブの無い回答 (キュー導入前のデータ) は採点済みとして扱う
+            'status': job.status if job else EvaluationJob.Status.DONE,
+            'last_error': job.last_error if job else '',
         }
-        return render(request, self.template_name, context)
\ No newline at end of file
+        return render(request, self.template_name, context)
+
+
+@method_decorator(login_required, name='dispatch')
+class AnswerStatusView(View):
+    """採点の進み具合をJSONで返す (結果画面から定期的に問い合わせる)"""
+
+    def get(self, request, answer_id):
+        answer = get_object_or_404(Answer, pk=answer_id, user=request.user)
+        job = EvaluationJob.objects.filter(answer=answer).first()
+        
+        return JsonResponse({
+            'status': job.status if job else EvaluationJob.Status.DONE,
+            'score': answer.score,
+            'review_text': answer.review_text,
+        })
+
+
+@method_decorator(login_required, name='get')
+class AnswerStreamView(View):
+    """
+    採点の進み具合を Server-Sent Events で送る (結果画面のJavaScriptが EventSource で接続する)。
+    採点ワーカーが書き込んだ生成途中の講評を 'partial' イベントで、
+    採点が終わったら結果を 'done' イベント (失敗した場合は 'failed' イベント) で送る。
+    """
+
+    async def get(self, request, answer_id):
+        user = await request.auser()
+        answer = await aget_object_or_404(Answer, pk=answer_id, user=user)
+        return _event_stream_response(self._events(answer))
+
+    async def _events(self, answer):
+        # 採点状況と途中の講評はワーカーのプロセスが書き込むため、一定間隔で確認する
+        # (ブラウザからのポーリングと違い、接続は1本のままで、講評が届いた時点で送れる)
+        deadline = time.monotonic() + settings.ANSWER_STREAM_MAX_DURATION
+        review_text = None
+        while time.monotonic() < deadline:
+            job = await EvaluationJob.objects.filter(answer=answer).afirst()
+            status = job.status if job else EvaluationJob.Status.DONE
+            if status == EvaluationJob.Status.DONE:
+                await answer.arefresh_from_db(fields=['score', 'review_text'])
+                yield sse_event('done', {'score': answer.score, 'review_text': answer.review_text})
+                return
+            if status == EvaluationJob.Status.FAILED:
+                yield sse_event('failed', {'error': job.last_error})
+                return
+
+            partial_review = await cache.aget(partial_review_key(answer.id))
+            if partial_review and partial_review != review_text:
+                review_text = partial_review
+                yield sse_event('partial', {'review_text': review_text})
+            await asyncio.sleep(settings.ANSWER_STREAM_POLL_INTERVAL)
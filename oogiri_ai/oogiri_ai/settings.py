@@ -88,6 +88,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # 採点ワーカーなど複数のスレッド/プロセスから同時に書き込んでも "database is locked" にならないよう、
+            # トランザクション開始時に書き込みロックを取り、ロック待ちの時間を延ばす
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -148,6 +154,111 @@ LOGIN_REDIRECT_URL = '/'
 NEWS_API_KEY = os.environ.get('NEWS_API_KEY')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 
+# APIの接続先 (負荷試験などでローカルのスタブサーバーに向ける場合に環境変数で上書きする)
+NEWS_API_BASE_URL = os.environ.get('NEWS_API_BASE_URL', 'https://newsapi.org/v2')
+GEMINI_API_BASE_URL = os.environ.get('GEMINI_API_BASE_URL') # 未設定の場合はSDKの既定値を使う
+
+# キャッシュ
+# ヘッドラインの先読みコマンド (prefetch_headlines) とWebプロセスで共有するため、プロセス間で共有できるファイルキャッシュを使う
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+    }
+}
+
+# NewsAPIのヘッドラインキャッシュの設定 (秒)
+# TTL以内はキャッシュをそのまま返し、STALE_TTL以内は古いデータを返しつつ裏で再取得する
+NEWS_HEADLINE_CACHE_TTL = int(os.environ.get('NEWS_HEADLINE_CACHE_TTL', 60 * 30))
+NEWS_HEADLINE_CACHE_STALE_TTL = int(os.environ.get('NEWS_HEADLINE_CACHE_STALE_TTL', 60 * 60 * 6))
+# 同じテーマの取得を1リクエストに絞るためのロックの有効期限
+NEWS_HEADLINE_CACHE_LOCK_TIMEOUT = int(os.environ.get('NEWS_HEADLINE_CACHE_LOCK_TIMEOUT', 60))
+
+# お題生成のプロンプトに入れるニュースタイトルの選び方 (oogiri/headline_selection.py)
+# 日本語でないタイトルとほぼ同じタイトルを除き、テーマと「特に面白い」お題に近い順に、推定トークン数の合計が BUDGET に収まるだけ入れる
+QUESTION_HEADLINE_TOKEN_BUDGET = int(os.environ.get('QUESTION_HEADLINE_TOKEN_BUDGET', 600))
+# 文字3-gramの Jaccard 係数がこれ以上のタイトルは、ほぼ同じタイトルとして後の方を除く
+QUESTION_HEADLINE_DUPLICATE_THRESHOLD = float(os.environ.get('QUESTION_HEADLINE_DUPLICATE_THRESHOLD', 0.5))
+
+# 生成したお題の重複判定 (oogiri/question_dedup.py)
+# 同じテーマの保存済みのお題、または同時に生成したお題との文字3-gramの Jaccard 係数がこれ以上のお題は保存せずに除く
+QUESTION_DUPLICATE_THRESHOLD = float(os.environ.get('QUESTION_DUPLICATE_THRESHOLD', 0.6))
+# 除いた分を補うためにお題を生成し直す回数の上限 (1回の提案・補充ごと)
+QUESTION_DEDUP_MAX_RETRIES = int(os.environ.get('QUESTION_DEDUP_MAX_RETRIES', 1))
+
+# お題プール (fill_question_pool コマンドがテーマごとに事前生成しておくお題の数)
+# 残りが LOW_WATER を下回ったら、SIZE 件になるまで補充する
+QUESTION_POOL_LOW_WATER = int(os.environ.get('QUESTION_POOL_LOW_WATER', 9))
+QUESTION_POOL_SIZE = int(os.environ.get('QUESTION_POOL_SIZE', 30))
+
+# 回答の採点ジョブ (run_evaluation_worker コマンド)
+EVALUATION_WORKER_CONCURRENCY = int(os.environ.get('EVALUATION_WORKER_CONCURRENCY', 4)) # 同時に採点するスレッド数
+EVALUATION_WORKER_POLL_INTERVAL = float(os.environ.get('EVALUATION_WORKER_POLL_INTERVAL', 1.0)) # キューが空のときの確認間隔 (秒)
+EVALUATION_MAX_ATTEMPTS = int(os.environ.get('EVALUATION_MAX_ATTEMPTS', 3)) # これだけ失敗したら採点を諦める
+EVALUATION_JOB_TIMEOUT = int(os.environ.get('EVALUATION_JOB_TIMEOUT', 120)) # 処理中のまま放置されたジョブを待機中に戻すまでの秒数
+# 同じお題の回答を1回のリクエストでまとめて採点する最大件数と、回答が揃うのを待つ最大秒数
+EVALUATION_BATCH_SIZE = int(os.environ.get('EVALUATION_BATCH_SIZE', 8))
+EVALUATION_BATCH_WINDOW = float(os.environ.get('EVALUATION_BATCH_WINDOW', 0.5))
+
+# 結果画面のストリーム (採点状況と生成途中の講評を Server-Sent Events で送る)
+ANSWER_STREAM_POLL_INTERVAL = float(os.environ.get('ANSWER_STREAM_POLL_INTERVAL', 0.2)) # 採点状況と途中の講評を確認する間隔 (秒)
+ANSWER_STREAM_MAX_DURATION = int(os.environ.get('ANSWER_STREAM_MAX_DURATION', 60)) # 1本のストリームを開いておく最長の秒数 (以降はブラウザが接続し直す)
+
+# 採点結果キャッシュ (同じお題・同じ回答の組をGeminiで再び採点しない)
+EVALUATION_CACHE_ENABLED = os.environ.get('EVALUATION_CACHE_ENABLED', 'true').lower() in ('true', '1')
+# キーを作る前に適用する正規化 (nfkc: Unicode正規化, width: 全角/半角の統一, whitespace: 空白の統一, lower: 大文字/小文字の統一, punctuation: 句読点・括弧などの除去)
+EVALUATION_CACHE_NORMALIZATION = ['nfkc', 'width', 'whitespace']
+EVALUATION_CACHE_MAX_ENTRIES = int(os.environ.get('EVALUATION_CACHE_MAX_ENTRIES', 100000)) # 超えたら最後に使われた日時が古いものから削除
+EVALUATION_CACHE_TTL_DAYS = int(os.environ.get('EVALUATION_CACHE_TTL_DAYS', 90)) # これだけ使われなかったものは削除
+EVALUATION_CACHE_EVICT_INTERVAL = int(os.environ.get('EVALUATION_CACHE_EVICT_INTERVAL', 600)) # 採点ワーカーが削除を行う間隔 (秒)
+
+# 回答の提案 (回答生成のバックエンドで候補を生成し、採点のバックエンドで点数の高いものを選ぶ)
+ANSWER_SUGGESTION_CANDIDATES = int(os.environ.get('ANSWER_SUGGESTION_CANDIDATES', 8)) # 生成する候補の数
+ANSWER_SUGGESTION_TOP_K = int(os.environ.get('ANSWER_SUGGESTION_TOP_K', 3)) # 提案する回答の数
+ANSWER_SUGGESTION_TIME_BUDGET = float(os.environ.get('ANSWER_SUGGESTION_TIME_BUDGET', 20)) # 候補の生成にかける最長の秒数 (超えたら採点を省く)
+
+# LLMのバックエンド (タスクごとに 'gemini' か 'local' (ファインチューニングしたローカルモデル) を選ぶ)
+LLM_BACKENDS = {
+    'question_generation': os.environ.get('LLM_BACKEND_QUESTION_GENERATION', 'gemini'),
+    'answer_generation': os.environ.get('LLM_BACKEND_ANSWER_GENERATION', 'gemini'),
+    'evaluation': os.environ.get('LLM_BACKEND_EVALUATION', 'gemini'),
+}
+# ローカルモデル (local_inference/oogiri_finetuned_model をプロセスごとに1回だけ読み込んで使う)
+LOCAL_MODEL_PATH = os.environ.get('LOCAL_MODEL_PATH', str(BASE_DIR.parent / 'local_inference' / 'oogiri_finetuned_model'))
+LOCAL_MODEL_MAX_NEW_TOKENS = int(os.environ.get('LOCAL_MODEL_MAX_NEW_TOKENS', 50))
+LOCAL_MODEL_TEMPERATURE = float(os.environ.get('LOCAL_MODEL_TEMPERATURE', 0.7))
+# 推論モード (fp32 / bf16 / int8)、forward を torch.compile するか、推論に使うCPUのスレッド数 (0 はtorchの既定値)
+# 各モードの速度とメモリは benchmark_local_model コマンドで比較できる
+LOCAL_MODEL_DTYPE = os.environ.get('LOCAL_MODEL_DTYPE', 'fp32')
+LOCAL_MODEL_COMPILE = os.environ.get('LOCAL_MODEL_COMPILE', 'false').lower() in ('true', '1')
+LOCAL_MODEL_THREADS = int(os.environ.get('LOCAL_MODEL_THREADS', 0))
+# タスクの指示文までの past_key_values を保持する共通部分の最大数 (0 で使わない)
+LOCAL_MODEL_PREFIX_CACHE_SIZE = int(os.environ.get('LOCAL_MODEL_PREFIX_CACHE_SIZE', 4))
+# ローカルモデルの推論サーバー (run_inference_server コマンド。バックエンド 'local_server' で使う)
+LOCAL_INFERENCE_SERVER_URL = os.environ.get('LOCAL_INFERENCE_SERVER_URL', 'http://127.0.0.1:8765')
+LOCAL_INFERENCE_SERVER_SOCKET = os.environ.get('LOCAL_INFERENCE_SERVER_SOCKET') # 設定した場合はUnixソケットで接続する
+LOCAL_INFERENCE_SERVER_TIMEOUT = float(os.environ.get('LOCAL_INFERENCE_SERVER_TIMEOUT', 120))
+# 同時に届いたリクエストをまとめる最大件数と、揃うのを待つ最大秒数
+LOCAL_INFERENCE_MAX_BATCH_SIZE = int(os.environ.get('LOCAL_INFERENCE_MAX_BATCH_SIZE', 8))
+LOCAL_INFERENCE_BATCH_WINDOW = float(os.environ.get('LOCAL_INFERENCE_BATCH_WINDOW', 0.02))
+
+# Geminiのコンテキストキャッシュ (システム命令とFew-Shot事例をGemini側にキャッシュして再利用する)
+GEMINI_PROMPT_CACHE_ENABLED = os.environ.get('GEMINI_PROMPT_CACHE_ENABLED', 'true').lower() in ('true', '1')
+# キャッシュの有効期限 (秒)。採点のFew-Shot事例もこの間隔で入れ替える
+GEMINI_PROMPT_CACHE_TTL = int(os.environ.get('GEMINI_PROMPT_CACHE_TTL', 60 * 60))
+
+# Few-Shot事例のインデックス (oogiri/few_shot.py) を、フラグの変更が無くても作り直すまでの秒数
+FEW_SHOT_INDEX_TTL = int(os.environ.get('FEW_SHOT_INDEX_TTL', 300))
+# Few-Shot事例の文字n-gramのベクトルを保存するディレクトリ (空にすると保存せず、インデックスを作り直すたびに計算する)
+FEW_SHOT_VECTOR_ROOT = os.environ.get('FEW_SHOT_VECTOR_ROOT', str(BASE_DIR / 'data' / 'few_shot_vectors'))
+# プロンプトに入れるFew-Shot事例の数 (お題生成はニュースに近いお題、採点はお題に近いお題への回答を選ぶ)
+FEW_SHOT_QUESTION_EXAMPLES = int(os.environ.get('FEW_SHOT_QUESTION_EXAMPLES', 5))
+FEW_SHOT_ANSWER_EXAMPLES = int(os.environ.get('FEW_SHOT_ANSWER_EXAMPLES', 3))
+
 # ファインチューニング用データを出力するディレクトリ
 # BASE_DIR / 'data' / 'training_data' というパスになる
-TRAINING_DATA_ROOT = BASE_DIR / 'data' / 'training_data'
\ No newline at end of file
+TRAINING_DATA_ROOT = BASE_DIR / 'data' / 'training_data'
+
+# 学習データの重複を判定する前に適用する正規化 (EVALUATION_CACHE_NORMALIZATION と同じ名前が使える)
+# 正規化すると同じになるサンプル (表記ゆれや句読点だけが違うもの) は、最初の1件だけを書き出す
+TRAINING_DATA_DEDUP_NORMALIZATION = ['nfkc', 'whitespace', 'lower', 'punctuation']